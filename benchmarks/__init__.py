@@ -0,0 +1,3 @@
+"""
+Benchmarks for pa11ycrawler. These are not part of the test suite.
+"""
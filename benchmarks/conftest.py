@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Fixtures for the report microbenchmarks. These need pytest-benchmark.
+"""
+import tracemalloc
+import pytest
+from path import Path
+
+from benchmarks.report_data import fake_pages, write_data_dir
+
+DEFAULT_PAGES = "1000,10000"
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--bench-pages", default=DEFAULT_PAGES,
+        help=u"Comma-separated crawl sizes, in pages, to benchmark "
+             u"[{}]. Add 100000 for a large crawl.".format(DEFAULT_PAGES),
+    )
+    parser.addoption(
+        "--bench-rounds", type=int, default=3,
+        help=u"How many times to time each benchmark [3]",
+    )
+
+
+def pytest_generate_tests(metafunc):
+    if "num_pages" in metafunc.fixturenames:
+        sizes = [int(size) for size in metafunc.config.getoption("bench_pages").split(",")]
+        metafunc.parametrize("num_pages", sizes, ids=["{}pages".format(size) for size in sizes], scope="session")
+
+
+@pytest.fixture(scope="session")
+def pages(num_pages):
+    "A list of `(item, results)` pairs for a crawl of `num_pages` pages."
+    return list(fake_pages(num_pages))
+
+
+@pytest.fixture(scope="session")
+def data_dir(num_pages, tmpdir_factory):
+    "A data directory holding a crawl of `num_pages` pages."
+    return write_data_dir(Path(str(tmpdir_factory.mktemp("data"))), num_pages)
+
+
+@pytest.fixture(scope="session")
+def deduplicated_data_dir(num_pages, tmpdir_factory):
+    "The same crawl, with each distinct violation stored only once."
+    return write_data_dir(
+        Path(str(tmpdir_factory.mktemp("data"))), num_pages, deduplicate=True,
+    )
+
+
+@pytest.fixture
+def bench(benchmark, request):
+    """
+    Returns a function that benchmarks `func(*args)`. Besides the timings,
+    the peak memory allocated by one call is recorded in the benchmark's
+    `extra_info`, as `peak_memory_kb`. It is measured in a separate call,
+    since tracing allocations slows everything down.
+    """
+    rounds = request.config.getoption("bench_rounds")
+
+    def run(func, *args):
+        tracemalloc.start()
+        try:
+            func(*args)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        benchmark.extra_info["peak_memory_kb"] = peak // 1024
+        return benchmark.pedantic(func, args=args, rounds=rounds, iterations=1)
+    return run
@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+"""
+An end-to-end benchmark of the crawler. It runs the EdxSpider, with all of
+its item pipelines, against a fake LMS and a fake pa11y, and reports
+throughput, latency percentiles, peak memory use, and the time spent in each
+stage of the crawl. Results can be saved as JSON, and compared against a
+previous run:
+
+    python -m benchmarks.crawl --output baseline.json
+    # ... make some changes ...
+    python -m benchmarks.crawl --compare baseline.json
+"""
+from __future__ import print_function, division
+import os
+import sys
+import json
+import stat
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import functools
+import subprocess as sp
+from collections import defaultdict
+
+from twisted.internet import defer
+from scrapy import signals
+from scrapy.crawler import CrawlerProcess
+from scrapy.settings import Settings
+
+from pa11ycrawler import pipelines
+from pa11ycrawler.spiders.edx import EdxSpider
+from benchmarks.fake_lms import FakeLMS, FakeLMSServer, COURSE_KEY
+
+FAKE_PA11Y = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_pa11y.py")
+
+# The stages whose time is measured, as (name, class, method name).
+STAGES = [
+    ("parse_item", EdxSpider, "parse_item"),
+    ("pipeline/duplicates", pipelines.DuplicatesPipeline, "process_item"),
+    ("pipeline/drop_drf", pipelines.DropDRFPipeline, "process_item"),
+    ("pipeline/pa11y", pipelines.Pa11yPipeline, "process_item"),
+]
+
+# How the metrics compare between runs: does a bigger number mean better?
+HIGHER_IS_BETTER = {"pages_per_second"}
+
+
+def make_parser():
+    """
+    Returns an argparse instance for this script.
+    """
+    parser = argparse.ArgumentParser(description="benchmark a crawl of a fake LMS")
+    parser.add_argument(
+        "--blocks", type=int, default=200,
+        help=u"Number of units in the fake course [%(default)s]"
+    )
+    parser.add_argument(
+        "--session-lifetime", type=int, default=None,
+        help=u"Seconds until fake LMS sessions expire [never]"
+    )
+    parser.add_argument(
+        "--pa11y-latency", type=float, default=0.05,
+        help=u"Seconds that each fake pa11y audit takes [%(default)s]"
+    )
+    parser.add_argument(
+        "--pa11y-failure-rate", type=float, default=0.0,
+        help=u"Fraction of fake pa11y audits that fail [%(default)s]"
+    )
+    parser.add_argument(
+        "--pa11y-results", type=int, default=20,
+        help=u"Average number of fake pa11y results per page [%(default)s]"
+    )
+    parser.add_argument(
+        "--identities", type=int, default=1,
+        help=u"Number of users to crawl as [%(default)s]"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=None,
+        help=u"Value of the CONCURRENT_REQUESTS setting [from settings.py]"
+    )
+    parser.add_argument(
+        "--set", action="append", default=[], metavar="NAME=VALUE",
+        help=u"Override any other Scrapy setting"
+    )
+    parser.add_argument(
+        "--output", default=None,
+        help=u"Write the results as JSON to this file"
+    )
+    parser.add_argument(
+        "--compare", default=None,
+        help=u"Compare the results to a JSON file from a previous run"
+    )
+    return parser
+
+
+def percentile(values, pct):
+    """
+    Returns the given percentile of a list of numbers, using linear
+    interpolation between the closest ranks.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = (len(values) - 1) * pct / 100
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def summarize(durations):
+    "Summarize a list of durations, in seconds."
+    return {
+        "count": len(durations),
+        "total": sum(durations),
+        "p50": percentile(durations, 50),
+        "p90": percentile(durations, 90),
+        "p99": percentile(durations, 99),
+        "max": max(durations) if durations else None,
+    }
+
+
+def git_commit():
+    "The commit that is being benchmarked, if it can be found."
+    try:
+        return sp.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=sp.STDOUT,
+        ).decode("ascii").strip()
+    except (OSError, sp.CalledProcessError):
+        return None
+
+
+def peak_rss_mb(who):
+    "The peak resident set size of this process or its children, in MB."
+    maxrss = resource.getrusage(who).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    if sys.platform == "darwin":
+        return maxrss / (1024 * 1024)
+    return maxrss / 1024
+
+
+class StageTimer(object):
+    """
+    Records how long each call to the methods in STAGES takes, by wrapping
+    those methods on their classes for the duration of the benchmark.
+    Generator methods are timed while they are consumed, and methods that
+    return a Deferred are timed until it fires.
+    """
+    def __init__(self):
+        self.durations = defaultdict(list)
+        self._originals = []
+
+    def _wrap(self, name, func):
+        durations = self.durations[name]
+
+        def timed_generator(gen):
+            "Time the consumption of a generator, but not its consumer."
+            elapsed = 0
+            while True:
+                start = time.time()
+                try:
+                    value = next(gen)
+                except StopIteration:
+                    durations.append(elapsed + time.time() - start)
+                    return
+                elapsed += time.time() - start
+                yield value
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                elapsed = time.time() - start
+            # Deferreds have a `__next__` of their own, but aren't generators
+            if isinstance(result, defer.Deferred):
+                def fired(value):
+                    "Record the time until the Deferred fired."
+                    durations.append(time.time() - start)
+                    return value
+                return result.addBoth(fired)
+            if hasattr(result, "__next__") or hasattr(result, "next"):
+                return timed_generator(result)
+            durations.append(elapsed)
+            return result
+        return wrapper
+
+    def __enter__(self):
+        for name, cls, method in STAGES:
+            original = cls.__dict__[method]
+            self._originals.append((cls, method, original))
+            setattr(cls, method, self._wrap(name, original))
+        return self
+
+    def __exit__(self, *exc_info):
+        for cls, method, original in self._originals:
+            setattr(cls, method, original)
+        self._originals = []
+
+
+def write_pa11y_shims(bin_dir):
+    """
+    Write a `pa11y` executable that runs the fake pa11y, and a `phantomjs`
+    executable that satisfies the Pa11yPipeline's installation check.
+    Returns the path of the `pa11y` executable.
+    """
+    pa11y = os.path.join(bin_dir, "pa11y")
+    phantomjs = os.path.join(bin_dir, "phantomjs")
+    with open(pa11y, "w") as shim:
+        shim.write(u'#!/bin/sh\nexec "{python}" "{script}" "$@"\n'.format(
+            python=sys.executable, script=FAKE_PA11Y,
+        ))
+    with open(phantomjs, "w") as shim:
+        shim.write(u"#!/bin/sh\necho 2.1.1\n")
+    for path in (pa11y, phantomjs):
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return pa11y
+
+
+def make_settings(args, pa11y_path):
+    "The Scrapy settings for a benchmark run."
+    settings = Settings()
+    settings.setmodule("pa11ycrawler.settings", priority="project")
+    settings.set("PA11Y_PATH", pa11y_path)
+    settings.set("LOG_LEVEL", "WARNING")
+    settings.set("LOG_STDOUT", False)
+    settings.set("TELNETCONSOLE_ENABLED", False)
+    if args.concurrency:
+        settings.set("CONCURRENT_REQUESTS", args.concurrency)
+        settings.set("CONCURRENT_REQUESTS_PER_DOMAIN", args.concurrency)
+    for override in args.set:
+        name, _, value = override.partition("=")
+        settings.set(name, value)
+    return settings
+
+
+def run(args):
+    """
+    Run one benchmark crawl, and return its results.
+    """
+    tmp_dir = tempfile.mkdtemp(prefix="pa11ycrawler-bench-")
+    lms = FakeLMS(num_blocks=args.blocks, session_lifetime=args.session_lifetime)
+    server = FakeLMSServer(lms)
+    server.start()
+    os.environ.update({
+        "PATH": tmp_dir + os.pathsep + os.environ.get("PATH", ""),
+        "FAKE_PA11Y_LATENCY": str(args.pa11y_latency),
+        "FAKE_PA11Y_FAILURE_RATE": str(args.pa11y_failure_rate),
+        "FAKE_PA11Y_RESULTS": str(args.pa11y_results),
+    })
+    pa11y_path = write_pa11y_shims(tmp_dir)
+
+    download_latencies = []
+
+    def response_received(response, request, spider):  # pylint: disable=unused-argument
+        "Record how long each download took."
+        latency = request.meta.get("download_latency")
+        if latency is not None:
+            download_latencies.append(latency)
+
+    try:
+        process = CrawlerProcess(make_settings(args, pa11y_path))
+        crawler = process.create_crawler(EdxSpider)
+        crawler.signals.connect(response_received, signal=signals.response_received)
+        with StageTimer() as timer:
+            start = time.time()
+            process.crawl(
+                crawler,
+                domain="127.0.0.1",
+                port=server.port,
+                course_key=COURSE_KEY,
+                data_dir=os.path.join(tmp_dir, "data"),
+                identities=args.identities,
+            )
+            process.start()
+            wall_time = time.time() - start
+    finally:
+        server.stop()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    stats = crawler.stats.get_stats()
+    pages = stats.get("item_scraped_count", 0)
+    return {
+        "commit": git_commit(),
+        "config": {
+            "blocks": args.blocks,
+            "session_lifetime": args.session_lifetime,
+            "pa11y_latency": args.pa11y_latency,
+            "pa11y_failure_rate": args.pa11y_failure_rate,
+            "pa11y_results": args.pa11y_results,
+            "identities": args.identities,
+            "concurrency": crawler.settings.getint("CONCURRENT_REQUESTS"),
+        },
+        "wall_time": wall_time,
+        "pages": pages,
+        "pages_dropped": stats.get("item_dropped_count", 0),
+        "pages_per_second": pages / wall_time if wall_time else None,
+        "requests": stats.get("downloader/request_count", 0),
+        "lms_requests": lms.requests,
+        "errors": stats.get("log_count/ERROR", 0),
+        "download_latency": summarize(download_latencies),
+        "stages": {name: summarize(timer.durations[name]) for name, _, _ in STAGES},
+        "link_extraction_time": stats.get("link_extraction/time", 0),
+        "peak_rss_mb": peak_rss_mb(resource.RUSAGE_SELF),
+        "peak_child_rss_mb": peak_rss_mb(resource.RUSAGE_CHILDREN),
+    }
+
+
+def flatten(results, prefix=""):
+    "Flatten nested results into a dictionary of dotted names to numbers."
+    flat = {}
+    for key, value in results.items():
+        name = prefix + key
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare(results, baseline):
+    """
+    Returns a table comparing these results to the baseline results, with
+    the change in each metric, marked with "+" for improvements and "-" for
+    regressions.
+    """
+    current, previous = flatten(results), flatten(baseline)
+    lines = [u"{:<36} {:>12} {:>12} {:>9}".format(
+        "metric", baseline.get("commit") or "baseline", results.get("commit") or "current", "change",
+    )]
+    for name in sorted(current):
+        if name.startswith("config.") or name not in previous:
+            continue
+        old, new = previous[name], current[name]
+        change = (new - old) / old * 100 if old else 0
+        better = change > 0 if name in HIGHER_IS_BETTER else change < 0
+        mark = u" " if abs(change) < 5 else (u"+" if better else u"-")
+        lines.append(u"{:<36} {:>12.4g} {:>12.4g} {:>+8.1f}%{}".format(name, old, new, change, mark))
+    if baseline.get("config") != results.get("config"):
+        lines.append(u"warning: the runs were made with different configurations")
+    return u"\n".join(lines)
+
+
+def main():
+    """
+    Run the benchmark, and print or save its results.
+    """
+    args = make_parser().parse_args()
+    results = run(args)
+    print(json.dumps(results, indent=2, sort_keys=True))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        print(compare(results, baseline))
+
+
+if __name__ == "__main__":
+    main()
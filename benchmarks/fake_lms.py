@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+"""
+A small stand-in for an Open edX LMS, with just enough of its behavior for
+pa11ycrawler to crawl it: auto auth, login, the course blocks API, and a
+generated course of courseware pages with realistic markup.
+"""
+import json
+import uuid
+import threading
+# the HTTP server library depends on Python version
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+    from http.cookies import SimpleCookie
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+    from Cookie import SimpleCookie
+
+COURSE_KEY = "course-v1:edX+Bench101+run"
+UNITS_PER_SEQUENCE = 5
+SEQUENCES_PER_CHAPTER = 4
+CSRF_TOKEN = "benchmarkcsrftoken0123456789abcd"
+
+PAGE_TEMPLATE = u"""<!DOCTYPE html>
+<html lang="en">
+<head>
+  <meta charset="utf-8">
+  <title>{title} | Bench101 | edX</title>
+  <link rel="stylesheet" href="/static/css/lms-main.css">
+  <script src="/static/js/vendor/jquery.js"></script>
+</head>
+<body class="view-in-course view-courseware">
+  <header class="global-header">
+    <nav class="nav-main" aria-label="Main">
+      <a href="/dashboard">Dashboard</a>
+      <a href="/courses">Discover New</a>
+      <a href="/u/benchmark">Profile</a>
+      <a href="/account/settings">Account</a>
+      <a href="/logout/">Sign Out</a>
+    </nav>
+    <nav class="course-tabs" aria-label="Course">
+      <a href="/courses/{course}/course/">Course</a>
+      <a href="/courses/{course}/progress">Progress</a>
+      <a href="/courses/{course}/discussion/forum/">Discussion</a>
+      <a href="/courses/{course}/wiki">Wiki</a>
+      <a href="/courses/{course}/instructor">Instructor</a>
+    </nav>
+  </header>
+  <main id="main" tabindex="-1">
+    {body}
+  </main>
+  <footer class="wrapper-footer">
+    <nav class="nav-colophon" aria-label="About">
+      {footer_links}
+    </nav>
+    <p class="copyright">&copy; edX Inc. All rights reserved.</p>
+  </footer>
+</body>
+</html>
+"""
+
+FOOTER_LINKS = u"\n      ".join(
+    u'<a href="/{slug}">{slug}</a>'.format(slug=slug) for slug in (
+        "about", "blog", "news", "contact", "careers", "donate", "media-kit",
+        "tos", "privacy", "accessibility", "sitemap", "help", "faq",
+        "affiliates", "partners", "mobile", "enterprise", "schools",
+    )
+)
+
+UNIT_BODY_TEMPLATE = u"""
+    <div class="course-wrapper">
+      <nav class="course-index" aria-label="Course Navigation">
+        {course_nav}
+      </nav>
+      <section id="course-content" class="course-content">
+        <nav class="sequence-nav" aria-label="Section">
+          {sequence_nav}
+        </nav>
+        <div class="xblock xblock-student_view xblock-student_view-vertical">
+          <h2 class="unit-title">{title}</h2>
+          <div class="xblock xblock-student_view-html">
+            <p>Lorem ipsum dolor sit amet, consectetur adipiscing elit. Sed
+            do eiusmod tempor incididunt ut labore et dolore magna aliqua.</p>
+            <img src="/static/images/diagram-{index}.png">
+            <table><tr><th scope="column">Input</th><th>Output</th></tr>
+            <tr><td>1</td><td>2</td></tr></table>
+          </div>
+          <div class="xblock xblock-student_view-problem">
+            <div class="problem">
+              <p>Which of these is correct?</p>
+              <input type="radio" name="input_{index}" value="a"> A
+              <input type="radio" name="input_{index}" value="b"> B
+              <button class="check">Submit</button>
+            </div>
+          </div>
+          <a href="/courses/{course}/xblock/{block_id}/handler/download">Download handout</a>
+          <a href="/assets/courseware/v1/{index}/handout-{index}.pdf">Handout (PDF)</a>
+        </div>
+      </section>
+    </div>
+"""
+
+
+def unit_block_id(index):
+    "The usage key of the unit with the given index."
+    return u"block-v1:edX+Bench101+run+type@vertical+block@unit{}".format(index)
+
+
+def unit_location(index):
+    "The chapter, sequence, and position of the unit with the given index."
+    sequence, position = divmod(index, UNITS_PER_SEQUENCE)
+    chapter = sequence // SEQUENCES_PER_CHAPTER
+    return chapter, sequence, position + 1
+
+
+def courseware_path(chapter, sequence, position):
+    "The courseware URL path of a unit."
+    return u"/courses/{course}/courseware/chapter{chapter}/sequence{sequence}/{position}".format(
+        course=COURSE_KEY, chapter=chapter, sequence=sequence, position=position,
+    )
+
+
+class FakeLMS(object):
+    """
+    The state of the fake LMS: the course, and the users and sessions that
+    have been created.
+    """
+    def __init__(self, num_blocks=100, session_lifetime=None):
+        self.num_blocks = num_blocks
+        self.session_lifetime = session_lifetime
+        self.users = {}
+        self.sessions = set()
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def new_session(self):
+        "Create a session, and return its session cookie."
+        session_id = uuid.uuid4().hex
+        with self.lock:
+            self.sessions.add(session_id)
+        cookie = u"sessionid={}; Path=/".format(session_id)
+        if self.session_lifetime:
+            cookie += u"; Max-Age={}".format(self.session_lifetime)
+        return cookie
+
+    def blocks(self, base_url):
+        "The response of the course blocks API."
+        blocks = {}
+        for index in range(self.num_blocks):
+            block_id = unit_block_id(index)
+            blocks[block_id] = {
+                "id": block_id,
+                "block_id": u"unit{}".format(index),
+                "type": "vertical",
+                "display_name": u"Unit {}".format(index),
+                "lms_web_url": u"{base}/courses/{course}/jump_to/{block}".format(
+                    base=base_url, course=COURSE_KEY, block=block_id,
+                ),
+                "student_view_url": u"{base}/xblock/{block}".format(
+                    base=base_url, block=block_id,
+                ),
+            }
+        return {"root": unit_block_id(0), "blocks": blocks}
+
+    def unit_page(self, chapter, sequence, position):
+        "The HTML of a courseware page."
+        index = sequence * UNITS_PER_SEQUENCE + position - 1
+        num_sequences = (self.num_blocks + UNITS_PER_SEQUENCE - 1) // UNITS_PER_SEQUENCE
+        first_sequence = chapter * SEQUENCES_PER_CHAPTER
+        course_nav = u"\n        ".join(
+            u'<a href="{path}">Subsection {seq}</a>'.format(
+                path=courseware_path(seq // SEQUENCES_PER_CHAPTER, seq, 1), seq=seq,
+            )
+            for seq in range(first_sequence, min(first_sequence + SEQUENCES_PER_CHAPTER, num_sequences))
+        )
+        sequence_nav = u"\n          ".join(
+            u'<a href="{path}" data-position="{pos}">Unit {pos}</a>'.format(
+                path=courseware_path(chapter, sequence, pos), pos=pos,
+            )
+            for pos in range(1, UNITS_PER_SEQUENCE + 1)
+            if sequence * UNITS_PER_SEQUENCE + pos - 1 < self.num_blocks
+        )
+        title = u"Unit {}".format(index)
+        body = UNIT_BODY_TEMPLATE.format(
+            course_nav=course_nav, sequence_nav=sequence_nav, title=title,
+            index=index, course=COURSE_KEY, block_id=unit_block_id(index),
+        )
+        return self.page(title, body)
+
+    @staticmethod
+    def page(title, body):
+        "Wrap the given body in the site chrome."
+        return PAGE_TEMPLATE.format(
+            title=title, body=body, course=COURSE_KEY, footer_links=FOOTER_LINKS,
+        )
+
+
+class FakeLMSRequestHandler(BaseHTTPRequestHandler):
+    "Routes requests to the fake LMS."
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def lms(self):
+        "The state of the fake LMS."
+        return self.server.lms
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def send(self, status, body=b"", content_type="text/html; charset=utf-8", headers=()):
+        "Send a complete response."
+        if not isinstance(body, bytes):
+            body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def session_id(self):
+        "The session cookie sent with this request, if it is valid."
+        cookie = SimpleCookie(self.headers.get("Cookie", ""))
+        morsel = cookie.get("sessionid")
+        if morsel and morsel.value in self.lms.sessions:
+            return morsel.value
+        return None
+
+    def base_url(self):
+        "The URL that this server is reachable at."
+        return u"http://{}".format(self.headers.get("Host"))
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        "Handle a GET request."
+        with self.lms.lock:
+            self.lms.requests += 1
+        path = urlparse(self.path).path
+
+        if path == "/auto_auth":
+            email = u"bench{}@example.com".format(uuid.uuid4().hex[:8])
+            password = uuid.uuid4().hex
+            self.lms.users[email] = password
+            body = json.dumps({"email": email, "password": password})
+            self.send(200, body, "application/json", [("Set-Cookie", self.lms.new_session())])
+        elif path == "/login":
+            self.send(
+                200, self.lms.page("Sign in", u"<form id='login'></form>"),
+                headers=[("Set-Cookie", u"csrftoken={}; Path=/".format(CSRF_TOKEN))],
+            )
+        elif not self.session_id():
+            self.send(302, headers=[("Location", u"/login?next={}".format(path))])
+        elif path == "/api/courses/v1/blocks/":
+            body = json.dumps(self.lms.blocks(self.base_url()))
+            self.send(200, body, "application/json")
+        elif path.startswith(u"/courses/{}/jump_to/".format(COURSE_KEY)):
+            index = int(path.rsplit("@unit", 1)[-1])
+            location = courseware_path(*unit_location(index))
+            self.send(302, headers=[("Location", location)])
+        elif path.startswith(u"/courses/{}/courseware/".format(COURSE_KEY)):
+            bits = path.rstrip("/").split("/")
+            chapter = int(bits[-3][len("chapter"):])
+            sequence = int(bits[-2][len("sequence"):])
+            position = int(bits[-1])
+            self.send(200, self.lms.unit_page(chapter, sequence, position))
+        elif path.endswith(".pdf"):
+            self.send(200, b"%PDF-1.4" + b"\0" * 4096, "application/pdf")
+        else:
+            title = path.strip("/").split("/")[-1] or "Home"
+            self.send(200, self.lms.page(title, u"<h1>{}</h1>".format(title)))
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        "Handle a POST request: only logging in is supported."
+        length = int(self.headers.get("Content-Length") or 0)
+        form = parse_qs(self.rfile.read(length).decode("utf-8"))
+        if urlparse(self.path).path != "/user_api/v1/account/login_session/":
+            self.send(404)
+            return
+        email = form.get("email", [""])[0]
+        password = form.get("password", [""])[0]
+        if self.lms.users.get(email) != password:
+            self.send(400, u"We couldn't sign you in.")
+            return
+        self.send(
+            200, json.dumps({"success": True}), "application/json",
+            [("Set-Cookie", self.lms.new_session())],
+        )
+
+
+class FakeLMSServer(ThreadingMixIn, HTTPServer):
+    "A threaded HTTP server for the fake LMS, listening on a free local port."
+    daemon_threads = True
+
+    def __init__(self, lms, port=0):
+        self.lms = lms
+        HTTPServer.__init__(self, ("127.0.0.1", port), FakeLMSRequestHandler)
+
+    @property
+    def port(self):
+        "The port that this server is listening on."
+        return self.server_address[1]
+
+    def start(self):
+        "Start serving requests in a background thread."
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stop(self):
+        "Stop serving requests."
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+A stand-in for the `pa11y` command line tool, for benchmarking. It accepts
+the same arguments that the Pa11yPipeline passes to pa11y, but instead of
+loading the page in phantomjs, it waits for a while and prints made-up
+results in pa11y's JSON format.
+
+It is configured with environment variables:
+
+* FAKE_PA11Y_LATENCY: how many seconds each audit takes [1.0]
+* FAKE_PA11Y_FAILURE_RATE: the fraction of audits that fail, like pa11y
+  does when "Truffler timed out" [0]
+* FAKE_PA11Y_RESULTS: the average number of results per page [20]
+
+Results are random, but the same URL always gets the same results.
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+
+VERSION = "3.8.1-fake"
+
+# A realistic mix of the results that pa11y reports on Open edX pages.
+MESSAGES = [
+    ("error", "WCAG2AA.Principle1.Guideline1_1.1_1_1.H37",
+     "Img element missing an alt attribute. Use the alt attribute to specify "
+     "a short text alternative.",
+     "<img src=\"/static/images/diagram.png\">"),
+    ("error", "WCAG2AA.Principle1.Guideline1_3.1_3_1.H63.1",
+     "Table cell has an invalid scope attribute. Valid values are row, col, "
+     "rowgroup, or colgroup.",
+     "<th scope=\"column\">Input</th>"),
+    ("error", "WCAG2AA.Principle4.Guideline4_1.4_1_2.H91.InputRadio.Name",
+     "This radiobutton input element does not have a name available to an "
+     "accessibility API.",
+     "<input type=\"radio\" name=\"input\" value=\"a\">"),
+    ("error", "WCAG2AA.Principle1.Guideline1_4.1_4_3.G18.Fail",
+     "This element has insufficient contrast at this conformance level.",
+     "<a href=\"/about\">about</a>"),
+    ("warning", "WCAG2AA.Principle1.Guideline1_3.1_3_1.H48",
+     "If this element contains a navigation section, it is recommended that "
+     "it be marked up as a list.",
+     "<nav class=\"sequence-nav\">...</nav>"),
+    ("warning", "WCAG2AA.Principle1.Guideline1_3.1_3_1.H42",
+     "Heading markup should be used if this content is intended as a heading.",
+     "<p class=\"copyright\">...</p>"),
+    ("notice", "WCAG2AA.Principle2.Guideline2_4.2_4_4.H77,H78,H79,H80,H81",
+     "Check that the link text combined with programmatically determined link "
+     "context identifies the purpose of the link.",
+     "<a href=\"/dashboard\">Dashboard</a>"),
+    ("notice", "WCAG2AA.Principle1.Guideline1_3.1_3_1_A.G141",
+     "Check that the heading structure is logically nested.",
+     "<h2 class=\"unit-title\">...</h2>"),
+]
+TYPE_CODES = {"error": 1, "warning": 2, "notice": 3}
+
+
+def fake_results(url, average):
+    """
+    Returns a list of made-up pa11y results for the given URL.
+    """
+    rand = random.Random(hashlib.md5(url.encode("utf8")).hexdigest())
+    count = rand.randint(0, max(int(average) * 2, 0))
+    results = []
+    for index in range(count):
+        type_, code, message, context = rand.choice(MESSAGES)
+        results.append({
+            "code": code,
+            "type": type_,
+            "typeCode": TYPE_CODES[type_],
+            "message": message,
+            "context": context,
+            "selector": u"#main > div:nth-child({})".format(index + 1),
+        })
+    return results
+
+
+def main(argv=None):
+    """
+    Pretend to audit the URL given on the command line.
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    if "--version" in argv:
+        print(VERSION)
+        return 0
+    urls = [arg for arg in argv if not arg.startswith("-")]
+    if not urls:
+        print("Usage: pa11y [options] <url>", file=sys.stderr)
+        return 1
+    url = urls[0]
+
+    latency = float(os.environ.get("FAKE_PA11Y_LATENCY", 1.0))
+    failure_rate = float(os.environ.get("FAKE_PA11Y_FAILURE_RATE", 0))
+    average = float(os.environ.get("FAKE_PA11Y_RESULTS", 20))
+
+    time.sleep(latency)
+    if random.random() < failure_rate:
+        print("Error: Truffler timed out", file=sys.stderr)
+        return 1
+    results = fake_results(url, average)
+    print(json.dumps(results))
+    return 2 if any(result["type"] == "error" for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
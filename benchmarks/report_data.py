@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Generators for synthetic crawl data, for benchmarking the code that
+processes pa11y results and generates the HTML report.
+
+The data is shaped like a real Open edX crawl: most results come from the
+site chrome and the courseware templates, so the same selector and code show
+up on many pages, while a long tail of results is unique to one page. The
+number of results per page is skewed, with a few pages having many more
+results than the rest. The same seed always generates the same data.
+"""
+import json
+import random
+from datetime import datetime, timedelta
+
+from pa11ycrawler.pipelines.pa11y import write_pa11y_results
+from pa11ycrawler.violations import ViolationStore
+from benchmarks.fake_lms import COURSE_KEY, courseware_path, unit_location
+from benchmarks.fake_pa11y import MESSAGES, TYPE_CODES
+
+# selectors for markup that is shared by many pages
+SHARED_SELECTORS = [
+    "html > body > header > nav.nav-main > a:nth-child({})".format(index)
+    for index in range(1, 6)
+] + [
+    "html > body > footer > nav > a:nth-child({})".format(index)
+    for index in range(1, 19)
+] + [
+    "#course-content > nav.sequence-nav > a:nth-child({})".format(index)
+    for index in range(1, 6)
+] + [
+    "#course-content > div.xblock > div.xblock-student_view-problem > input",
+    "#course-content > div.xblock > div.xblock-student_view-html > img",
+    "#course-content > div.xblock > div.xblock-student_view-html > table > tr > th",
+]
+# the fraction of results that come from shared markup
+SHARED_FRACTION = 0.8
+# the average number of results per page
+AVERAGE_RESULTS = 30
+ACCESSED_AT = datetime(2016, 8, 26, 14, 12, 45)
+
+
+def page_url(index):
+    "The URL of the page with the given index."
+    return u"http://localhost:8000" + courseware_path(*unit_location(index))
+
+
+def page_title(index):
+    "The title of the page with the given index."
+    return u"Unit {} | {} | edX".format(index, COURSE_KEY)
+
+
+def fake_result(rand, index):
+    "Returns one made-up pa11y result for the page with the given index."
+    type_, code, message, context = rand.choice(MESSAGES)
+    if rand.random() < SHARED_FRACTION:
+        selector = rand.choice(SHARED_SELECTORS)
+    else:
+        selector = u"#course-content > div.xblock:nth-child({}) > p:nth-child({})".format(
+            index, rand.randint(1, 50),
+        )
+    return {
+        "code": code,
+        "type": type_,
+        "typeCode": TYPE_CODES[type_],
+        "message": message,
+        "context": context,
+        "selector": selector,
+    }
+
+
+def fake_page_results(rand, index, average=AVERAGE_RESULTS):
+    """
+    Returns the made-up pa11y results for the page with the given index,
+    including the notice about its <title> that pa11y always reports.
+    """
+    count = int(rand.expovariate(1.0 / average)) if average else 0
+    results = [fake_result(rand, index) for _ in range(count)]
+    results.append({
+        "code": "WCAG2AA.Principle2.Guideline2_4.2_4_2.H25.2",
+        "type": "notice",
+        "typeCode": TYPE_CODES["notice"],
+        "message": "Check that the title element describes the document.",
+        "context": u"<title>{}...</title>".format(page_title(index)[:20]),
+        "selector": "html > head > title",
+    })
+    return results
+
+
+def fake_pages(num_pages, seed=0, average=AVERAGE_RESULTS):
+    """
+    Yields `(item, results)` pairs for the given number of pages, where
+    `item` is what the spider would scrape, and `results` is what pa11y
+    would report for it.
+    """
+    rand = random.Random(seed)
+    for index in range(num_pages):
+        item = {
+            "url": page_url(index),
+            "page_title": page_title(index),
+            "request_headers": {"Cookie": "sessionid=benchmark"},
+            "accessed_at": ACCESSED_AT + timedelta(seconds=index),
+        }
+        yield item, fake_page_results(rand, index, average)
+
+
+def fake_pa11y_output(results):
+    "Returns pa11y's output for the given results, as a bytestring."
+    return json.dumps(results).encode('utf8')
+
+
+def write_data_dir(data_dir, num_pages, seed=0, ignore_rules=None, deduplicate=False):
+    """
+    Fill a data directory with the given number of pages of crawl data,
+    as the Pa11yPipeline would write it, with PA11Y_DEDUPLICATE_VIOLATIONS
+    set to `deduplicate`.
+    """
+    store = ViolationStore(data_dir) if deduplicate else None
+    for item, results in fake_pages(num_pages, seed):
+        write_pa11y_results(
+            item, results, data_dir, ignore_rules=ignore_rules, violation_store=store,
+        )
+    return data_dir
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Microbenchmarks for the code that processes pa11y results and generates the
+HTML report, which runs once per result or once per page. Run them with:
+
+    py.test benchmarks --benchmark-autosave
+
+and compare against the last saved run with `--benchmark-compare`.
+"""
+import logging
+from path import Path
+
+from pa11ycrawler.html import render_html, wcag_refs, group_violations
+from pa11ycrawler.util import pa11y_counts
+from pa11ycrawler.replay import ReplaySpider
+from pa11ycrawler.pipelines.pa11y import load_pa11y_results, check_title_match
+from benchmarks.report_data import fake_pa11y_output
+
+IGNORE_RULES = {
+    "*": [
+        {"code": "WCAG2AA.Principle1.Guideline1_3.1_3_1.H42"},
+        {"selector": "html > body > footer *"},
+    ],
+    "*/courseware/*": [
+        {"type": "notice", "code": "*.G141"},
+    ],
+}
+logger = logging.getLogger(__name__)
+
+
+def test_pa11y_counts(bench, pages):
+    def count_all():
+        for _, results in pages:
+            pa11y_counts(results)
+    bench(count_all)
+
+
+def test_wcag_refs(bench, pages):
+    codes = [result["code"] for _, results in pages for result in results]
+
+    def refs_all():
+        for code in codes:
+            wcag_refs(code)
+    bench(refs_all)
+
+
+def test_group_violations(bench, pages):
+    page_data = [
+        dict(item, pa11y=results) for item, results in pages
+    ]
+    bench(group_violations, page_data)
+
+
+def test_load_pa11y_results(bench, pages):
+    spider = ReplaySpider(data_dir=None, pa11y_ignore_rules=IGNORE_RULES)
+    outputs = [(item["url"], fake_pa11y_output(results)) for item, results in pages]
+
+    def load_all():
+        for url, stdout in outputs:
+            load_pa11y_results(stdout, spider, url)
+    bench(load_all)
+
+
+def test_check_title_match(bench, pages):
+    def check_all():
+        for item, results in pages:
+            check_title_match(item["page_title"], results, logger)
+    bench(check_all)
+
+
+def test_render_html(bench, data_dir, tmpdir):
+    output_dir = Path(str(tmpdir))
+    bench(render_html, data_dir, output_dir)
+
+
+def test_render_html_deduplicated(bench, deduplicated_data_dir, tmpdir):
+    output_dir = Path(str(tmpdir))
+    bench(render_html, deduplicated_data_dir, output_dir)
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for how long the crawler and the report generator take to start,
+which is a large part of a short crawl, like a `single_url` audit. Run them
+with:
+
+    py.test benchmarks/test_startup.py --benchmark-autosave
+
+Each import is timed in a new Python process, and also checks that the
+modules that are only needed on some code paths aren't imported.
+"""
+import os
+import sys
+import json
+import subprocess as sp
+import pytest
+from path import Path
+
+from pa11ycrawler.pipelines import Pa11yPipeline
+from benchmarks.crawl import write_pa11y_shims
+
+# modules that take a while to import, and that these entry points only
+# import once they need them
+DEFERRED_MODULES = ["requests", "yaml", "jinja2"]
+IMPORT_SCRIPT = u"""
+import sys, json
+import {module}
+print(json.dumps([name for name in {deferred!r} if name in sys.modules]))
+"""
+
+
+@pytest.mark.parametrize("module", [
+    "pa11ycrawler.html",
+    "pa11ycrawler.diff",
+    "pa11ycrawler.manifest",
+    "pa11ycrawler.spiders.edx",
+    "pa11ycrawler.pipelines",
+])
+def test_import(benchmark, request, module):
+    script = IMPORT_SCRIPT.format(module=module, deferred=DEFERRED_MODULES)
+
+    def run():
+        return json.loads(sp.check_output([sys.executable, "-c", script]).decode("utf8"))
+
+    rounds = request.config.getoption("bench_rounds")
+    imported = benchmark.pedantic(run, rounds=rounds, iterations=1)
+    assert imported == []
+
+
+@pytest.mark.parametrize("cached", [False, True], ids=["probe", "cached_probe"])
+def test_pa11y_pipeline_startup(benchmark, request, tmpdir, monkeypatch, cached):
+    bin_dir = Path(str(tmpdir))
+    pa11y_path = write_pa11y_shims(bin_dir)
+    monkeypatch.setenv("PATH", bin_dir + os.pathsep + os.environ["PATH"])
+    probe_cache = bin_dir / "toolchain.json" if cached else None
+    if cached:
+        Pa11yPipeline(pa11y_path=pa11y_path, probe_cache=probe_cache)
+
+    rounds = request.config.getoption("bench_rounds")
+    benchmark.pedantic(
+        Pa11yPipeline, kwargs={"pa11y_path": pa11y_path, "probe_cache": probe_cache},
+        rounds=rounds, iterations=1,
+    )
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+The static assets of the HTML report: the copies of jQuery, Bootstrap and
+bootstrap-table that ship with pa11ycrawler, and the report's own CSS and
+JavaScript.
+
+They are copied into the `assets` directory of the report once, with a hash
+of their contents in their names, so that the report works without internet
+access, and a static server can tell browsers to cache them forever. The
+report's files can also be written with precompressed `.gz` and `.br`
+copies next to them, for servers that send those instead of compressing
+every response (like nginx's `gzip_static`). The `.br` copies are only
+written if the `brotli` package is installed.
+"""
+import io
+import os
+import re
+import gzip
+import hashlib
+try:
+    import brotli
+except ImportError:  # brotli is optional
+    brotli = None
+from path import Path
+
+from pa11ycrawler.util import write_atomic
+
+ASSETS_DIR = Path(__file__).abspath().parent / "templates" / "assets"
+ASSETS_DIRNAME = "assets"
+# the assets that the report uses, by their paths in ASSETS_DIR; the fonts
+# come first, since the stylesheets refer to them
+BUNDLED_ASSETS = (
+    "fonts/glyphicons-halflings-regular.eot",
+    "fonts/glyphicons-halflings-regular.svg",
+    "fonts/glyphicons-halflings-regular.ttf",
+    "fonts/glyphicons-halflings-regular.woff",
+    "fonts/glyphicons-halflings-regular.woff2",
+    "css/bootstrap.min.css",
+    "css/bootstrap-theme.min.css",
+    "css/bootstrap-table.min.css",
+    "css/report.css",
+    "js/jquery.min.js",
+    "js/bootstrap.min.js",
+    "js/bootstrap-table.min.js",
+    "js/report.js",
+)
+# the assets that are worth compressing; the other fonts are compressed
+# already
+COMPRESSED_ASSETS = (".css", ".js", ".svg", ".ttf")
+COMPRESSED_SUFFIXES = (".gz", ".br")
+# brotli's best compression is slow, so it's only used for the assets,
+# which are compressed once
+PAGE_BROTLI_QUALITY = 9
+ASSET_BROTLI_QUALITY = 11
+
+# a relative URL in a stylesheet, like `url(../fonts/x.woff?#iefix)`
+CSS_URL_RE = re.compile(br"""url\((['"]?)\.\./([^'")?#]+)""")
+# the source maps aren't copied, so browsers shouldn't look for them
+SOURCE_MAP_RE = re.compile(br"(/\*# sourceMappingURL=[^*]*\*/|//# sourceMappingURL=\S*)")
+
+
+def fingerprint(name, data):
+    "The name of an asset, with a hash of its contents before its extension."
+    base, ext = os.path.splitext(name)
+    return u"{}.{}{}".format(base, hashlib.sha1(data).hexdigest()[:12], ext)
+
+
+def rewrite_css_urls(data, names):
+    """
+    Point the relative URLs in a stylesheet at the fingerprinted names of
+    the assets they refer to, given by their names in BUNDLED_ASSETS.
+    """
+    def replace(match):
+        "Replace one URL."
+        name = match.group(2).decode("ascii")
+        return b"url(" + match.group(1) + b"../" + names.get(name, name).encode("ascii")
+    return CSS_URL_RE.sub(replace, data)
+
+
+def gzip_bytes(data):
+    "Gzip some bytes, the same way every time."
+    buf = io.BytesIO()
+    with gzip.GzipFile(filename="", mode="wb", fileobj=buf, compresslevel=9, mtime=0) as gz_file:
+        gz_file.write(data)
+    return buf.getvalue()
+
+
+def write_precompressed(path, data, brotli_quality=PAGE_BROTLI_QUALITY):
+    "Write the `.gz` and `.br` copies of a file that was written with `data`."
+    if not isinstance(data, bytes):
+        data = data.encode('utf8')
+    write_atomic(path + ".gz", gzip_bytes(data))
+    if brotli is not None:
+        write_atomic(path + ".br", brotli.compress(data, quality=brotli_quality))
+    else:
+        # a copy from when brotli was installed would be out of date
+        remove_precompressed(path, suffixes=(".br",))
+
+
+def remove_precompressed(path, suffixes=COMPRESSED_SUFFIXES):
+    "Remove the compressed copies of a file, if there are any."
+    for suffix in suffixes:
+        try:
+            os.remove(path + suffix)
+        except OSError:
+            pass
+
+
+def write_assets(output_dir, compress=True):
+    """
+    Copy the report's assets into the `assets` directory of `output_dir`,
+    with fingerprinted names, and return the URL of each of them (relative
+    to `output_dir`) by its name in BUNDLED_ASSETS. An asset that was
+    already copied isn't copied again. Without `compress`, compressed
+    copies from an earlier report are removed.
+    """
+    names = {}
+    for name in BUNDLED_ASSETS:
+        data = (ASSETS_DIR / name).bytes()
+        if name.endswith(".css"):
+            data = rewrite_css_urls(data, names)
+        data = SOURCE_MAP_RE.sub(b"", data)
+        names[name] = fingerprint(name, data)
+        path = output_dir / ASSETS_DIRNAME / names[name]
+        compress_asset = compress and name.endswith(COMPRESSED_ASSETS)
+        if not path.exists():
+            write_atomic(path, data)
+        if not compress_asset:
+            remove_precompressed(path)
+        elif not Path(path + ".gz").exists():
+            write_precompressed(path, data, brotli_quality=ASSET_BROTLI_QUALITY)
+    return {
+        name: u"{}/{}".format(ASSETS_DIRNAME, fingerprinted)
+        for name, fingerprinted in names.items()
+    }
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Performance budgets for a crawl, checked against its stats when it's done.
+
+Budgets are set with the PERFORMANCE_BUDGETS setting, a dictionary from the
+name of a budget to its limit. Budgets that aren't in the dictionary (or
+whose limit is None) aren't checked.
+"""
+import json
+from collections import OrderedDict
+
+MB = 1024 * 1024
+
+
+def wall_time(stats):
+    "How long the crawl took, in seconds."
+    start_time = stats.get("start_time")
+    finish_time = stats.get("finish_time")
+    if start_time is not None and finish_time is not None:
+        return (finish_time - start_time).total_seconds()
+    return stats.get("elapsed_time_seconds")
+
+
+def pages_per_second(stats):
+    "How many pages were audited per second."
+    seconds = wall_time(stats)
+    if not seconds:
+        return None
+    return stats.get("item_scraped_count", 0) / float(seconds)
+
+
+def audit_p95(stats):
+    """
+    The 95th percentile of how long the pa11y pipeline took for a page, in
+    seconds. This is recorded by the StageMetrics extension.
+    """
+    return stats.get("metrics/pipeline/pa11y/p95")
+
+
+def retry_rate(stats):
+    """
+    The fraction of attempts that were retries, counting both downloads and
+    pa11y runs.
+    """
+    retries = stats.get("retry/count", 0) + stats.get("pa11y/retries", 0)
+    attempts = (
+        stats.get("downloader/request_count", 0) +
+        stats.get("item_scraped_count", 0) +
+        stats.get("pa11y/retries", 0)
+    )
+    if not attempts:
+        return None
+    return retries / float(attempts)
+
+
+def peak_rss_mb(stats):
+    """
+    The peak resident set size of the crawler, in MB, from the MemoryTracker
+    extension or else from Scrapy's MemoryUsage extension.
+    """
+    rss = stats.get("memory/rss_mb_max")
+    if rss is None and stats.get("memusage/max") is not None:
+        rss = stats["memusage/max"] / float(MB)
+    return rss
+
+
+# name: (measure, whether the limit is a maximum rather than a minimum)
+BUDGETS = OrderedDict((
+    ("max_wall_time", (wall_time, True)),
+    ("min_pages_per_second", (pages_per_second, False)),
+    ("max_audit_p95", (audit_p95, True)),
+    ("max_retry_rate", (retry_rate, True)),
+    ("max_peak_rss_mb", (peak_rss_mb, True)),
+))
+
+
+def budgets_from_settings(settings):
+    """
+    The budgets in the PERFORMANCE_BUDGETS setting, which may also be given
+    as JSON on the command line, like
+    `-s PERFORMANCE_BUDGETS='{"max_wall_time": 3600}'`.
+    """
+    budgets = settings.get("PERFORMANCE_BUDGETS") or {}
+    if not isinstance(budgets, dict):
+        budgets = json.loads(budgets)
+    unknown = set(budgets) - set(BUDGETS)
+    if unknown:
+        raise ValueError(u"Unknown performance budgets: {names}".format(
+            names=", ".join(sorted(unknown)),
+        ))
+    return {name: limit for name, limit in budgets.items() if limit is not None}
+
+
+def check_budgets(budgets, stats):
+    """
+    Check the crawl stats against the given budgets. Returns a list of
+    dictionaries, one for each budget, with its limit, the measured value,
+    and a status of "pass", "fail", or "unknown" if the value couldn't be
+    measured (for instance, because the extension that records it is
+    disabled).
+    """
+    results = []
+    for name, (measure, is_maximum) in BUDGETS.items():
+        if name not in budgets:
+            continue
+        limit = budgets[name]
+        value = measure(stats)
+        if value is None:
+            status = "unknown"
+        elif (value <= limit) if is_maximum else (value >= limit):
+            status = "pass"
+        else:
+            status = "fail"
+        results.append({
+            "budget": name,
+            "limit": limit,
+            "value": value,
+            "status": status,
+        })
+    return results
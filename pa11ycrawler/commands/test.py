@@ -1,9 +1,18 @@
 """
 Contains the scrapy test command for configurable process failures.
 """
+import os
+import json
+import logging
 from scrapy.commands import ScrapyCommand
 from scrapy.commands.crawl import Command as ExistingCrawlCommand
 
+from pa11ycrawler.budgets import budgets_from_settings, check_budgets
+from pa11ycrawler.extensions.failfast import REASON as FAIL_FAST_REASON
+from pa11ycrawler.util import DateTimeEncoder, write_atomic
+
+logger = logging.getLogger(__name__)
+
 
 class Command(ScrapyCommand):
     """
@@ -11,6 +20,17 @@ class Command(ScrapyCommand):
     any errors are raised during execution. Error categories are configurable
     via settings['FAILURE_CATEGORIES']. It wraps, rather than extends, the
     existing crawl command so it can be tested in isolation.
+
+    The crawl can also be held to performance budgets, configured via
+    settings['PERFORMANCE_BUDGETS']. A summary of the budgets is written to
+    settings['PERFORMANCE_BUDGETS_FILE'] (by default, `budgets.json` in the
+    spider's data directory), and unless
+    settings['PERFORMANCE_BUDGETS_ENFORCE'] is false, going over a budget
+    also fails the process.
+
+    With --fail-fast, the crawl is cancelled as soon as any of the stats in
+    settings['FAIL_FAST_THRESHOLDS'] reaches its threshold, which also fails
+    the process.
     """
     requires_project = True
     existing_crawl_command = ExistingCrawlCommand()
@@ -24,18 +44,73 @@ class Command(ScrapyCommand):
     def add_options(self, parser):
         self.existing_crawl_command.settings = self.settings
         self.existing_crawl_command.add_options(parser)
+        # argparse in newer versions of Scrapy, optparse in older ones
+        add_option = getattr(parser, "add_argument", None) or parser.add_option
+        add_option(
+            "--fail-fast", action="store_true", dest="fail_fast", default=False,
+            help="cancel the crawl as soon as it is known to fail",
+        )
 
     def process_options(self, args, opts):
         self.existing_crawl_command.process_options(args, opts)
+        if getattr(opts, "fail_fast", False):
+            self.settings.set('FAIL_FAST_ENABLED', True, priority='cmdline')
 
     def run(self, args, opts):
         spname = args[0]
 
         crawler = self.crawler_process.create_crawler(spname)
+        budgets = budgets_from_settings(crawler.settings)
         self.existing_crawl_command.crawler_process = self.crawler_process
-        self.existing_crawl_command.run(args, opts)
+        # run the crawler we just made, so that its stats are the ones we check
+        self.existing_crawl_command.run([crawler] + args[1:], opts)
 
         for setting in crawler.settings['FAILURE_CATEGORIES']:
             if crawler.stats.get_value(setting, 0):
                 self.exitcode = 1
                 break
+        if crawler.stats.get_value('finish_reason') == FAIL_FAST_REASON:
+            self.exitcode = 1
+
+        if budgets:
+            self.check_budgets(crawler, budgets)
+
+    def check_budgets(self, crawler, budgets):
+        """
+        Check the crawl against its performance budgets, write out the
+        summary, and fail the process if the budgets are enforced and the
+        crawl went over any of them.
+        """
+        stats = crawler.stats.get_stats()
+        results = check_budgets(budgets, stats)
+        failed = [result for result in results if result["status"] == "fail"]
+        for result in results:
+            log = logger.error if result in failed else logger.info
+            log(
+                u"Performance budget %s: %s (value %s, limit %s)",
+                result["budget"], result["status"], result["value"], result["limit"],
+            )
+
+        enforce = crawler.settings.getbool('PERFORMANCE_BUDGETS_ENFORCE', True)
+        if failed and enforce:
+            self.exitcode = 1
+
+        summary_path = crawler.settings.get('PERFORMANCE_BUDGETS_FILE')
+        if not summary_path:
+            data_dir = getattr(crawler.spider, "data_dir", ".")
+            summary_path = os.path.join(data_dir, "budgets.json")
+        categories = {
+            category: crawler.stats.get_value(category, 0)
+            for category in crawler.settings['FAILURE_CATEGORIES']
+        }
+        summary = {
+            "passed": not failed and not any(categories.values()),
+            "enforced": enforce,
+            "failure_categories": categories,
+            "budgets": results,
+            "exitcode": self.exitcode,
+        }
+        write_atomic(
+            summary_path,
+            json.dumps(summary, cls=DateTimeEncoder, indent=2, sort_keys=True),
+        )
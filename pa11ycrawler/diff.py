@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+"""
+Compare the pa11y violations found by two runs of the crawler: which are
+new, which were fixed, and which persist.
+
+Every violation is fingerprinted by the page it's on (its normalized URL),
+its code, its selector and a hash of its HTML context. The fingerprints of
+each run are stored in a sorted index, in `fingerprints/<run id>.tsv` in the
+data directory, which is built the first time that the run is compared, so
+comparing two runs is a merge join of two sorted files: it takes time linear
+in the number of violations, and doesn't load any results into memory.
+"""
+import os
+import sys
+import json
+import heapq
+import hashlib
+import argparse
+import logging
+import tempfile
+from collections import Counter
+from path import Path
+
+from pa11ycrawler.html import RecordedIgnoreRules
+from pa11ycrawler.manifest import latest_entries, load_manifest, runs
+from pa11ycrawler.util import normalize_url
+from pa11ycrawler.violations import ViolationStore, load_result
+
+log = logging.getLogger(__name__)
+
+INDEX_DIRNAME = "fingerprints"
+INDEX_HEADER = u"# pa11ycrawler fingerprints v1 results={results}\n"
+# how many fingerprints to sort in memory at once, when building an index
+SORT_CHUNK_SIZE = 200000
+TYPES = ("error", "warning", "notice")
+
+
+def clean_field(value):
+    "A value that can go in a tab-separated line."
+    return u"".join(
+        u" " if ord(char) < 32 else char for char in u"{}".format(value or u"")
+    )
+
+
+def normalized(url):
+    "The normalized form of a URL, as a string."
+    return u"{}".format(normalize_url(url))
+
+
+def fingerprint(url, result):
+    """
+    The fingerprint of a pa11y result on the page with the given normalized
+    URL, as a line of the index: the URL, code, selector and context hash,
+    followed by the type of the result, separated by tabs. Since tab sorts
+    before every other character in a line, sorting the lines sorts them by
+    their fingerprints.
+    """
+    context = hashlib.sha1(
+        u"{}".format(result.get("context") or u"").encode("utf8")
+    ).hexdigest()[:12]
+    return u"\t".join((
+        clean_field(url), clean_field(result.get("code")),
+        clean_field(result.get("selector")), context, clean_field(result.get("type")),
+    )) + u"\n"
+
+
+def run_entries(data_dir, run_id):
+    """
+    The manifest entries of the latest result for each page in the given
+    run, or in the whole data directory if `run_id` is None.
+    """
+    entries = load_manifest(data_dir)
+    if run_id is not None:
+        entries = [entry for entry in entries if entry.get("run_id") == run_id]
+    return latest_entries(entries)
+
+
+def sorted_unique(lines, chunk_size=SORT_CHUNK_SIZE):
+    """
+    Sort the given lines, and leave out duplicates. If there are more than
+    `chunk_size` of them, they are sorted in chunks in temporary files, and
+    the chunks are merged.
+    """
+    chunks = []
+    chunk = []
+    try:
+        for line in lines:
+            chunk.append(line)
+            if len(chunk) >= chunk_size:
+                chunk_file = tempfile.TemporaryFile(mode="w+b")
+                chunk_file.writelines(line.encode("utf8") for line in sorted(chunk))
+                chunk_file.seek(0)
+                chunks.append(chunk_file)
+                chunk = []
+        chunk.sort()
+        if chunks:
+            merged = heapq.merge(
+                (line.encode("utf8") for line in chunk), *chunks
+            )
+            ordered = (line.decode("utf8") for line in merged)
+        else:
+            ordered = chunk
+        previous = None
+        for line in ordered:
+            if line != previous:
+                yield line
+                previous = line
+    finally:
+        for chunk_file in chunks:
+            chunk_file.close()
+
+
+def build_index(data_dir, entries, path):
+    """
+    Build the sorted index of the fingerprints of the violations in the
+    results with the given manifest entries, after the ignore rules that
+    were in use when they were crawled.
+    """
+    recorded_rules = RecordedIgnoreRules(data_dir)
+    store = ViolationStore(data_dir)
+
+    def fingerprints():
+        "The fingerprints of every result, in no particular order."
+        for entry in entries:
+            data = load_result(data_dir / entry["filename"], store)
+            rules = recorded_rules.for_result(data)
+            url = normalized(entry["url"])
+            for result in rules.filter(data["pa11y"], data["url"]):
+                yield fingerprint(url, result)
+
+    path.parent.makedirs_p()
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as index:
+        index.write(INDEX_HEADER.format(results=len(entries)).encode("utf8"))
+        for line in sorted_unique(fingerprints()):
+            index.write(line.encode("utf8"))
+    os.rename(tmp_path, path)
+
+
+def run_index(data_dir, run_id, entries):
+    """
+    The path to the index of the given run, building it if it doesn't exist
+    yet, or if the run had more results when it was built. The index of a
+    whole data directory (with `run_id` None) is always rebuilt.
+    """
+    name = u"{}.tsv".format(run_id) if run_id is not None else u"latest.tsv"
+    path = data_dir / INDEX_DIRNAME / name
+    if run_id is not None and path.isfile():
+        with open(path, "rb") as index:
+            header = index.readline().decode("utf8")
+        if header == INDEX_HEADER.format(results=len(entries)):
+            return path
+    log.info(u"Building the fingerprint index of %s", path)
+    build_index(data_dir, entries, path)
+    return path
+
+
+def read_index(path):
+    """
+    Yield the fingerprints in an index, in order, as (fingerprint, type)
+    pairs. A violation with the same fingerprint as the one before it (but
+    a different type) is skipped.
+    """
+    previous = None
+    with open(path, "rb") as index:
+        index.readline()
+        for line in index:
+            key, _, type_ = line.decode("utf8").rstrip(u"\n").rpartition(u"\t")
+            if key != previous:
+                yield key, type_
+                previous = key
+
+
+def merge_join(base, head):
+    """
+    Join two sorted iterables of (fingerprint, type) pairs. Yields
+    ("new", ...) for the pairs that are only in `head`, ("fixed", ...) for
+    those only in `base`, and ("persisting", ...) for those in both.
+    """
+    base_item = next(base, None)
+    head_item = next(head, None)
+    while base_item is not None or head_item is not None:
+        if head_item is None or (base_item is not None and base_item[0] < head_item[0]):
+            yield "fixed", base_item
+            base_item = next(base, None)
+        elif base_item is None or head_item[0] < base_item[0]:
+            yield "new", head_item
+            head_item = next(head, None)
+        else:
+            yield "persisting", head_item
+            base_item = next(base, None)
+            head_item = next(head, None)
+
+
+def diff_runs(base_dir, base_run, head_dir, head_run, examples=20):
+    """
+    Compare the violations found by the `base_run` in `base_dir` with those
+    found by the `head_run` in `head_dir`. Violations that were only found by
+    the base run, on pages that the head run didn't audit, are counted as
+    "unaudited" rather than fixed.
+
+    Returns a summary: the number of violations of each status, by type,
+    and the most common new and fixed violations, grouped by code and
+    selector, with the number of pages that they're on.
+    """
+    base_entries = run_entries(base_dir, base_run)
+    head_entries = run_entries(head_dir, head_run)
+    head_pages = set(normalized(entry["url"]) for entry in head_entries)
+    base_index = run_index(base_dir, base_run, base_entries)
+    head_index = run_index(head_dir, head_run, head_entries)
+
+    counts = {status: Counter() for status in ("new", "fixed", "persisting", "unaudited")}
+    groups = {"new": Counter(), "fixed": Counter()}
+    group_urls = {}
+    for status, (key, type_) in merge_join(read_index(base_index), read_index(head_index)):
+        url, code, selector, _ = key.split(u"\t")
+        if status == "fixed" and url not in head_pages:
+            status = "unaudited"
+        counts[status][type_] += 1
+        if status in groups:
+            group = (type_, code, selector)
+            groups[status][group] += 1
+            group_urls.setdefault((status, group), url)
+
+    def top(status):
+        "The most common groups of violations with the given status."
+        return [
+            {
+                "type": type_, "code": code, "selector": selector,
+                "pages": pages, "example_url": group_urls[(status, (type_, code, selector))],
+            }
+            for (type_, code, selector), pages in groups[status].most_common(examples)
+        ]
+
+    return {
+        "base": {"data_dir": base_dir, "run_id": base_run, "pages": len(base_entries)},
+        "head": {"data_dir": head_dir, "run_id": head_run, "pages": len(head_entries)},
+        "counts": {status: dict(counter) for status, counter in counts.items()},
+        "new": top("new"),
+        "fixed": top("fixed"),
+    }
+
+
+def format_summary(summary):
+    "A short, human-readable report of a diff summary."
+    lines = [u"Comparing {base} with {head}".format(
+        base=summary["base"]["run_id"] or summary["base"]["data_dir"],
+        head=summary["head"]["run_id"] or summary["head"]["data_dir"],
+    ), u""]
+    lines.append(u"{:<12}{:>10}{:>10}{:>10}".format(u"", *TYPES))
+    for status in ("new", "fixed", "persisting", "unaudited"):
+        counter = summary["counts"][status]
+        lines.append(u"{:<12}{:>10}{:>10}{:>10}".format(
+            status, *[counter.get(type_, 0) for type_ in TYPES]
+        ))
+    for status in ("new", "fixed"):
+        if summary[status]:
+            lines.extend([u"", u"Most common {} violations:".format(status)])
+        for group in summary[status]:
+            lines.append(u"  {pages:>5} pages  {type} {code}  {selector}  (e.g. {example_url})".format(
+                **group
+            ))
+    return u"\n".join(lines) + u"\n"
+
+
+def default_runs(base_dir, head_dir, base_run=None, head_run=None):
+    """
+    Fill in the runs to compare, if they weren't given: the latest run in
+    `head_dir`, and the latest run in `base_dir` before it. If a data
+    directory has no run IDs, its latest results are compared as a whole.
+    """
+    if head_run is None:
+        head_runs = runs(load_manifest(head_dir))
+        head_run = head_runs[0] if head_runs else None
+    if base_run is None:
+        base_runs = [
+            run_id for run_id in runs(load_manifest(base_dir))
+            if base_dir != head_dir or run_id != head_run
+        ]
+        base_run = base_runs[0] if base_runs else None
+    if base_dir == head_dir and (base_run is None or base_run == head_run):
+        raise ValueError(u"{dir} has only one run; give a --base-dir to compare with".format(
+            dir=head_dir,
+        ))
+    return base_run, head_run
+
+
+def make_parser():
+    """
+    Returns an argparse instance for this script.
+    """
+    parser = argparse.ArgumentParser(
+        description="compare the pa11y violations found by two runs of the crawler",
+    )
+    parser.add_argument(
+        "--data-dir", default="data",
+        help=u"Directory containing JSON data from the newer run [%(default)s]"
+    )
+    parser.add_argument(
+        "--base-dir", default=None,
+        help=u"Directory containing JSON data from the older run [the same as --data-dir]"
+    )
+    parser.add_argument(
+        "--run", default=None,
+        help=u"ID of the newer run [the latest run in --data-dir]"
+    )
+    parser.add_argument(
+        "--base-run", default=None,
+        help=u"ID of the older run [the latest run before it in --base-dir]"
+    )
+    parser.add_argument(
+        "--fail-on", default="error",
+        help=u"Exit with status 1 if there are new violations of these types, "
+             u"separated by commas, or 'none' [%(default)s]"
+    )
+    parser.add_argument(
+        "--json", default=None, metavar="FILE",
+        help=u"Also write the diff summary to this file, as JSON"
+    )
+    return parser
+
+
+def main():
+    """
+    Validates script arguments, calls the diff_runs() function with them,
+    and prints the summary. Returns the exit status.
+    """
+    logging.basicConfig(level=logging.INFO)
+    parser = make_parser()
+    args = parser.parse_args()
+    head_dir = Path(args.data_dir).expand()
+    base_dir = Path(args.base_dir).expand() if args.base_dir else head_dir
+    for data_dir in (base_dir, head_dir):
+        if not data_dir.isdir():  # pylint: disable=no-value-for-parameter
+            msg = u"Data directory {dir} does not exist".format(dir=data_dir)
+            raise ValueError(msg)
+    fail_on = set(args.fail_on.split(",")) - {"none", ""}
+    unknown = fail_on - set(TYPES)
+    if unknown:
+        parser.error(u"unknown violation types: {}".format(", ".join(sorted(unknown))))
+
+    base_run, head_run = default_runs(base_dir, head_dir, args.base_run, args.run)
+    summary = diff_runs(base_dir, base_run, head_dir, head_run)
+    sys.stdout.write(format_summary(summary))
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(summary, json_file, indent=2, sort_keys=True)
+    new = summary["counts"]["new"]
+    return 1 if any(new.get(type_) for type_ in fail_on) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+"""
+Scrapy extensions. Extensions are enabled via the EXTENSIONS setting.
+See: http://doc.scrapy.org/en/latest/topics/extensions.html
+"""
+from .metrics import StageMetrics
+from .profiling import Profiling
+from .memory import MemoryTracker
+from .failfast import FailFast
+from .status import StatusServer
+from .runstats import RunStats
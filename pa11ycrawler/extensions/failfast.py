@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+An extension that cancels the crawl as soon as it's known to have failed.
+"""
+from twisted.internet import task
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+
+from pa11ycrawler.signals import crawl_cancelled
+
+REASON = "fail_fast"
+
+
+class FailFast(object):
+    """
+    Closes the spider as soon as one of the stats in FAIL_FAST_THRESHOLDS
+    reaches its threshold, rather than crawling the rest of the site. The
+    stats are checked after every item, and every FAIL_FAST_CHECK_INTERVAL
+    seconds.
+
+    Closing the spider drops the requests that are still waiting to be
+    sent, and the `crawl_cancelled` signal tells the Pa11yPipeline to stop
+    auditing pages. Results that were already written are kept, and the
+    spider closes with a finish reason of "fail_fast".
+    """
+    def __init__(self, crawler, thresholds, check_interval=1):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.thresholds = thresholds
+        self.check_interval = check_interval
+        self.task = None
+        self.cancelled = False
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        "Build the extension from the crawler settings."
+        settings = crawler.settings
+        if not settings.getbool("FAIL_FAST_ENABLED"):
+            raise NotConfigured
+        thresholds = settings.getdict("FAIL_FAST_THRESHOLDS")
+        if not thresholds:
+            raise NotConfigured("FAIL_FAST_THRESHOLDS is empty")
+        ext = cls(
+            crawler,
+            thresholds=thresholds,
+            check_interval=settings.getfloat("FAIL_FAST_CHECK_INTERVAL", 1),
+        )
+        crawler.signals.connect(ext.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(ext.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(ext.check, signal=signals.item_scraped)
+        crawler.signals.connect(ext.check, signal=signals.item_dropped)
+        return ext
+
+    def spider_opened(self, spider):
+        "Start checking the stats regularly."
+        self.task = task.LoopingCall(self.check, spider=spider)
+        self.task.start(self.check_interval, now=False)
+
+    def exceeded(self):
+        """
+        The first stat that has reached its threshold, as a
+        `(stat, value, threshold)` tuple, or None.
+        """
+        for stat, threshold in sorted(self.thresholds.items()):
+            value = self.stats.get_value(stat, 0)
+            if value >= threshold:
+                return stat, value, threshold
+        return None
+
+    def check(self, spider, **kwargs):  # pylint: disable=unused-argument
+        "Cancel the crawl if a threshold has been reached."
+        if self.cancelled:
+            return
+        exceeded = self.exceeded()
+        if exceeded is None:
+            return
+        self.cancelled = True
+        stat, value, threshold = exceeded
+        spider.logger.error(
+            u"Cancelling the crawl: %s is %s, and the fail-fast threshold is %s",
+            stat, value, threshold,
+        )
+        self.stats.set_value("fail_fast/stat", stat)
+        self.crawler.signals.send_catch_log(
+            signal=crawl_cancelled, spider=spider, reason=REASON,
+        )
+        self.crawler.engine.close_spider(spider, REASON)
+
+    def spider_closed(self, spider):  # pylint: disable=unused-argument
+        "Stop checking the stats."
+        if self.task and self.task.running:
+            self.task.stop()
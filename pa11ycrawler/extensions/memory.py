@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""
+An extension that tracks how the crawler's memory use grows, and where.
+"""
+import gc
+import os
+import json
+import time
+import resource
+import collections
+from datetime import datetime
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+from twisted.internet import task
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+
+from pa11ycrawler.util import DateTimeEncoder
+
+MB = 1024 * 1024
+PAGE_SIZE = resource.getpagesize()
+
+
+def rss_mb(pid="self"):
+    """
+    The current resident set size of a process, in MB, or None if it can't
+    be read (for instance, on systems without /proc).
+    """
+    try:
+        with open("/proc/{}/statm".format(pid)) as statm:
+            return int(statm.read().split()[1]) * PAGE_SIZE / float(MB)
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+
+
+def child_pids(pid=None):
+    "The IDs of the running child processes of a process, from /proc."
+    pid = pid or os.getpid()
+    children = []
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        return children
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/{}/stat".format(entry)) as stat:
+                # the command name is in parentheses, and may contain spaces
+                fields = stat.read().rsplit(")", 1)[1].split()
+        except (IOError, OSError, IndexError):
+            continue
+        if int(fields[1]) == pid:
+            children.append(int(entry))
+    return children
+
+
+def children_rss_mb():
+    """
+    The total resident set size of the running child processes, like pa11y,
+    in MB. Without /proc, this is the peak size of any child instead.
+    """
+    if not os.path.isdir("/proc"):
+        return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0
+    return sum(rss or 0 for rss in (rss_mb(pid) for pid in child_pids()))
+
+
+def object_counts():
+    "The number of live objects of each type tracked by the garbage collector."
+    # collect first, so that garbage isn't counted, and neither are the
+    # tuples that the collector would stop tracking
+    gc.collect()
+    return collections.Counter(type(obj).__name__ for obj in gc.get_objects())
+
+
+def growth(counts, previous, top=10):
+    """
+    The types whose number of objects grew the most between two calls to
+    `object_counts()`, as a list of `(type name, count, growth)`.
+    """
+    diffs = [
+        (name, count, count - previous.get(name, 0))
+        for name, count in counts.items()
+    ]
+    diffs = [diff for diff in diffs if diff[2] > 0]
+    diffs.sort(key=lambda diff: diff[2], reverse=True)
+    return diffs[:top]
+
+
+def allocation_growth(snapshot, previous, top=10):
+    """
+    The allocation sites whose memory grew the most between two tracemalloc
+    snapshots, as a list of dictionaries.
+    """
+    diffs = [
+        diff for diff in snapshot.compare_to(previous, "lineno")
+        if diff.size_diff > 0
+    ]
+    return [
+        {
+            "site": u"{}:{}".format(diff.traceback[0].filename, diff.traceback[0].lineno),
+            "size_kb": diff.size // 1024,
+            "size_diff_kb": diff.size_diff // 1024,
+            "count_diff": diff.count_diff,
+        }
+        for diff in diffs[:top]
+    ]
+
+
+class MemoryTracker(object):
+    """
+    Every MEMORY_CHECK_INTERVAL seconds, records the RSS of the crawler and
+    of its child processes into the stats. If MEMORY_SOFT_LIMIT_MB is set
+    and the crawler's RSS goes over it, the engine is paused (so no new
+    requests are sent, but the pipelines keep working through their
+    backlog) until the RSS drops below MEMORY_RESUME_RATIO of the limit.
+    Since memory isn't always given back to the operating system, the crawl
+    resumes anyway after MEMORY_MAX_PAUSE seconds.
+
+    Every MEMORY_TRACKING_INTERVAL seconds, it also takes a tracemalloc
+    snapshot and counts the live objects of each type, and writes what grew
+    the most since the previous time to `memory-report.jsonl` in the
+    spider's data directory. The biggest growth is also put into the stats.
+    """
+    def __init__(self, crawler, check_interval=10, tracking_interval=300,
+                 top=10, frames=1, count_objects=True, soft_limit_mb=0,
+                 resume_ratio=0.9, max_pause=60):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.check_interval = check_interval
+        self.tracking_interval = tracking_interval
+        self.top = top
+        self.frames = frames
+        self.count_objects = count_objects
+        self.soft_limit_mb = soft_limit_mb
+        self.resume_ratio = resume_ratio
+        self.max_pause = max_pause
+        self.started_tracing = False
+        self.report_path = None
+        self.tasks = []
+        self.paused_at = None
+        self.first_snapshot = None
+        self.last_snapshot = None
+        self.last_counts = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        "Build the extension from the crawler settings."
+        settings = crawler.settings
+        if not settings.getbool("MEMORY_TRACKING_ENABLED"):
+            raise NotConfigured
+        ext = cls(
+            crawler,
+            check_interval=settings.getfloat("MEMORY_CHECK_INTERVAL", 10),
+            tracking_interval=settings.getfloat("MEMORY_TRACKING_INTERVAL", 300),
+            top=settings.getint("MEMORY_TRACKING_TOP", 10),
+            frames=settings.getint("MEMORY_TRACKING_FRAMES", 1),
+            count_objects=settings.getbool("MEMORY_OBJECT_COUNTS", True),
+            soft_limit_mb=settings.getfloat("MEMORY_SOFT_LIMIT_MB", 0),
+            resume_ratio=settings.getfloat("MEMORY_RESUME_RATIO", 0.9),
+            max_pause=settings.getfloat("MEMORY_MAX_PAUSE", 60),
+        )
+        crawler.signals.connect(ext.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(ext.spider_closed, signal=signals.spider_closed)
+        return ext
+
+    def spider_opened(self, spider):
+        "Start tracking."
+        self.report_path = os.path.join(getattr(spider, "data_dir", "."), "memory-report.jsonl")
+        if tracemalloc is not None and not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self.started_tracing = True
+        self.track()
+        for func, interval in ((self.check, self.check_interval),
+                               (self.track, self.tracking_interval)):
+            loop = task.LoopingCall(func)
+            loop.start(interval, now=False)
+            self.tasks.append(loop)
+
+    def check(self):
+        "Record the RSS, and pause or unpause the engine if needed."
+        rss = rss_mb()
+        if rss is None:
+            return
+        self.stats.set_value("memory/rss_mb", rss)
+        self.stats.max_value("memory/rss_mb_max", rss)
+        children = children_rss_mb()
+        self.stats.set_value("memory/children_rss_mb", children)
+        self.stats.max_value("memory/children_rss_mb_max", children)
+        if not self.soft_limit_mb:
+            return
+
+        engine = self.crawler.engine
+        if self.paused_at is None and rss > self.soft_limit_mb:
+            engine.pause()
+            self.paused_at = time.time()
+            self.stats.inc_value("memory/paused_count")
+            self.crawler.spider.logger.warning(
+                u"Memory use %.0f MB is over the soft limit of %.0f MB: pausing the crawl",
+                rss, self.soft_limit_mb,
+            )
+        elif self.paused_at is not None:
+            if rss < self.soft_limit_mb * self.resume_ratio:
+                self.resume()
+            elif time.time() - self.paused_at >= self.max_pause:
+                self.stats.inc_value("memory/forced_resume_count")
+                self.resume()
+
+    def resume(self):
+        "Unpause the engine."
+        self.crawler.engine.unpause()
+        self.stats.inc_value("memory/paused_time", time.time() - self.paused_at)
+        self.paused_at = None
+        self.crawler.spider.logger.info(u"Resuming the crawl at %.0f MB", rss_mb() or 0)
+
+    def track(self, final=False):
+        "Record what grew since the last time, and write it to the report."
+        entry = {
+            "time": datetime.utcnow(),
+            "rss_mb": rss_mb(),
+            "children_rss_mb": children_rss_mb(),
+        }
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            # leave out the memory used for tracking memory
+            snapshot = tracemalloc.take_snapshot().filter_traces((
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, __file__.rstrip("c")),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            ))
+            entry["traced_mb"] = tracemalloc.get_traced_memory()[0] / float(MB)
+            if self.last_snapshot is not None:
+                sites = allocation_growth(snapshot, self.last_snapshot, self.top)
+                entry["top_sites"] = sites
+                if sites:
+                    self.stats.set_value("memory/top_growth_site", sites[0]["site"])
+                    self.stats.set_value("memory/top_growth_kb", sites[0]["size_diff_kb"])
+            if final and self.first_snapshot is not None:
+                entry["top_sites_since_start"] = allocation_growth(
+                    snapshot, self.first_snapshot, self.top,
+                )
+            if self.first_snapshot is None:
+                self.first_snapshot = snapshot
+            self.last_snapshot = snapshot
+
+        if self.count_objects:
+            counts = object_counts()
+            if self.last_counts is not None:
+                types = growth(counts, self.last_counts, self.top)
+                entry["top_types"] = [
+                    {"type": name, "count": count, "growth": diff}
+                    for name, count, diff in types
+                ]
+                if types:
+                    self.stats.set_value("memory/top_growth_type", types[0][0])
+            self.last_counts = counts
+
+        if self.last_snapshot is not None or self.last_counts is not None:
+            report_dir = os.path.dirname(self.report_path)
+            if not os.path.isdir(report_dir):
+                os.makedirs(report_dir)
+            with open(self.report_path, "a") as report:
+                report.write(json.dumps(entry, cls=DateTimeEncoder) + "\n")
+
+    def spider_closed(self, spider):  # pylint: disable=unused-argument
+        "Stop tracking, and write a final report entry."
+        for loop in self.tasks:
+            if loop.running:
+                loop.stop()
+        if self.paused_at is not None:
+            self.stats.inc_value("memory/paused_time", time.time() - self.paused_at)
+            self.paused_at = None
+        self.track(final=True)
+        if self.started_tracing:
+            tracemalloc.stop()
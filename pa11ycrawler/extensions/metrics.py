@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+An extension that records histograms of how long each stage of the crawl
+takes, and how deep the crawler's queues get, and exports them.
+"""
+import os
+import time
+from twisted.internet import task
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+
+from pa11ycrawler.metrics import Metrics, PERCENTILES
+from pa11ycrawler.util import write_atomic
+
+
+def queue_depths(engine):
+    """
+    Returns the number of requests and items waiting in each of the
+    crawler's queues. Queues that can't be found are left out.
+    """
+    depths = {}
+    slot = getattr(engine, "slot", None)
+    scheduler = getattr(slot, "scheduler", None)
+    if scheduler is not None:
+        depths["scheduler"] = len(scheduler)
+    downloader = getattr(engine, "downloader", None)
+    if downloader is not None:
+        depths["downloader"] = len(downloader.active)
+    scraper_slot = getattr(getattr(engine, "scraper", None), "slot", None)
+    if scraper_slot is not None:
+        depths["responses"] = len(scraper_slot.active)
+        depths["items"] = scraper_slot.itemproc_size
+    return depths
+
+
+class StageMetrics(object):
+    """
+    Gives the spider a `Metrics` object to record its stage timings into,
+    and records download latency and queue depths itself. The histograms
+    are written every METRICS_DUMP_INTERVAL seconds and when the crawl
+    ends: as JSON to METRICS_JSON_FILE (by default, `metrics.json` in the
+    spider's data directory), and in the Prometheus text format to
+    METRICS_PROMETHEUS_FILE, if it is set. The percentiles of each stage
+    are also added to the Scrapy stats when the crawl ends.
+    """
+    def __init__(self, crawler, sample_interval=5, dump_interval=60,
+                 json_path=None, prometheus_path=None):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.sample_interval = sample_interval
+        self.dump_interval = dump_interval
+        self.json_path = json_path
+        self.prometheus_path = prometheus_path
+        self.metrics = Metrics()
+        self.task = None
+        self.last_dump = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        "Build the extension from the crawler settings."
+        settings = crawler.settings
+        if not settings.getbool("METRICS_ENABLED"):
+            raise NotConfigured
+        ext = cls(
+            crawler,
+            sample_interval=settings.getfloat("METRICS_SAMPLE_INTERVAL", 5),
+            dump_interval=settings.getfloat("METRICS_DUMP_INTERVAL", 60),
+            json_path=settings.get("METRICS_JSON_FILE"),
+            prometheus_path=settings.get("METRICS_PROMETHEUS_FILE"),
+        )
+        crawler.signals.connect(ext.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(ext.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(ext.response_received, signal=signals.response_received)
+        return ext
+
+    def spider_opened(self, spider):
+        "Start recording."
+        spider.metrics = self.metrics
+        if not self.json_path and getattr(spider, "data_dir", None):
+            self.json_path = os.path.join(spider.data_dir, "metrics.json")
+        self.last_dump = time.time()
+        self.task = task.LoopingCall(self.sample)
+        self.task.start(self.sample_interval, now=False)
+
+    def response_received(self, response, request, spider):  # pylint: disable=unused-argument
+        "Record how long the download took."
+        latency = request.meta.get("download_latency")
+        if latency is not None:
+            self.metrics.observe("download", latency)
+
+    def sample(self):
+        "Record the depth of each queue, and dump the metrics if it's time."
+        for queue, depth in queue_depths(self.crawler.engine).items():
+            self.metrics.observe_depth(queue, depth)
+        if time.time() - self.last_dump >= self.dump_interval:
+            self.dump()
+
+    def dump(self):
+        "Write out the metrics."
+        self.last_dump = time.time()
+        stats = self.stats.get_stats()
+        if self.json_path:
+            write_atomic(self.json_path, self.metrics.to_json(stats))
+        if self.prometheus_path:
+            write_atomic(self.prometheus_path, self.metrics.to_prometheus(stats))
+
+    def spider_closed(self, spider, reason):  # pylint: disable=unused-argument
+        "Stop recording, put the percentiles into the stats, and dump."
+        if self.task and self.task.running:
+            self.task.stop()
+        for stage, histogram in self.metrics.stages.items():
+            for pct in PERCENTILES:
+                self.stats.set_value(
+                    u"metrics/{}/p{}".format(stage, pct), histogram.percentile(pct),
+                )
+        self.dump()
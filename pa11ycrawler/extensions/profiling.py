@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+An extension that profiles selected functions during a crawl.
+"""
+import os
+from datetime import datetime
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+
+from pa11ycrawler.profiling import Profiler, DEFAULT_TARGETS
+
+
+class Profiling(object):
+    """
+    Profiles the functions named in PROFILE_TARGETS, in the PROFILE_MODE
+    ("deterministic" or "sample"), for PROFILE_WINDOW seconds or
+    PROFILE_MAX_CALLS calls if either is set, or else for the whole crawl.
+    The profile is written to the `profiles` directory in the spider's data
+    directory. This extension does nothing unless PROFILE_ENABLED is set,
+    so the functions aren't wrapped at all otherwise.
+
+    The functions are wrapped as soon as the extension is built, since the
+    item pipelines keep the `process_item` methods that they find when
+    they're built, which is before the spider is opened.
+    """
+    def __init__(self, targets=None, mode="deterministic", interval=0.005,
+                 window=None, max_calls=None):
+        self.profiler = Profiler(
+            targets=targets, mode=mode, interval=interval,
+            window=window, max_calls=max_calls, on_finish=self.profiler_finished,
+        )
+        self.output_dir = None
+        self.name = None
+        self.saved = False
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        "Build the extension from the crawler settings."
+        settings = crawler.settings
+        if not settings.getbool("PROFILE_ENABLED"):
+            raise NotConfigured
+        ext = cls(
+            targets=settings.getlist("PROFILE_TARGETS") or DEFAULT_TARGETS,
+            mode=settings.get("PROFILE_MODE", "deterministic"),
+            interval=settings.getfloat("PROFILE_INTERVAL", 0.005),
+            window=settings.getfloat("PROFILE_WINDOW") or None,
+            max_calls=settings.getint("PROFILE_MAX_CALLS") or None,
+        )
+        crawler.signals.connect(ext.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(ext.spider_closed, signal=signals.spider_closed)
+        ext.profiler.install()
+        return ext
+
+    def spider_opened(self, spider):
+        "Start profiling."
+        self.output_dir = os.path.join(getattr(spider, "data_dir", "."), "profiles")
+        self.name = u"{spider}-{time}".format(
+            spider=spider.name, time=datetime.utcnow().strftime("%Y%m%dT%H%M%S"),
+        )
+        # the spider was built before this extension was, and a CrawlSpider
+        # looks up its rules' callbacks when it's built, so look them up
+        # again to find the profiled ones
+        if hasattr(spider, "_compile_rules"):
+            spider._compile_rules()  # pylint: disable=protected-access
+        spider.logger.info(
+            u"Profiling %s (%s mode)", ", ".join(self.profiler.targets), self.profiler.mode,
+        )
+
+    def profiler_finished(self, profiler):  # pylint: disable=unused-argument
+        "Save the profile as soon as the profiling window is over."
+        self.save()
+
+    def save(self):
+        "Write out the profile, once."
+        if self.saved:
+            return
+        self.saved = True
+        self.profiler.save(self.output_dir, self.name)
+
+    def spider_closed(self, spider):
+        "Stop profiling, and write out the profile."
+        self.profiler.uninstall()
+        self.save()
+        spider.logger.info(u"Wrote profile to %s", self.output_dir)
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+An extension that records the performance stats of each crawl, for the
+report's performance page.
+"""
+import sys
+import time
+from datetime import datetime
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+from path import Path
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+
+from pa11ycrawler.manifest import make_run_id
+from pa11ycrawler.runstats import DEFAULT_TOP, RunRecorder, write_run_stats
+
+
+def peak_rss_mb():
+    "The peak resident set size of the crawler, in MB, or None."
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    if sys.platform == "darwin":
+        return maxrss / (1024.0 * 1024.0)
+    return maxrss / 1024.0
+
+
+class RunStats(object):
+    """
+    Records how long each page took to audit (as measured by the
+    Pa11yPipeline), and when the crawl ends, writes the crawl's performance
+    stats to the `runs` directory of the data directory: its duration,
+    how many pages it audited, its audit time percentiles, how many audits
+    were retried, how many bytes it downloaded, its peak memory use, and
+    the RUN_STATS_TOP slowest pages and URL templates.
+    """
+    def __init__(self, crawler, top=DEFAULT_TOP):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.recorder = RunRecorder(top)
+        self.run_id = crawler.settings.get("RUN_ID")
+        self.started_at = None
+        self.start = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        "Build the extension from the crawler settings."
+        settings = crawler.settings
+        if not settings.getbool("RUN_STATS_ENABLED"):
+            raise NotConfigured
+        ext = cls(crawler, top=settings.getint("RUN_STATS_TOP", DEFAULT_TOP))
+        crawler.signals.connect(ext.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(ext.item_scraped, signal=signals.item_scraped)
+        # extensions are connected before the pipelines, so this runs before
+        # the ReportPipeline renders the performance page
+        crawler.signals.connect(ext.spider_closed, signal=signals.spider_closed)
+        return ext
+
+    def spider_opened(self, spider):  # pylint: disable=unused-argument
+        "Start the clock."
+        self.started_at = datetime.utcnow()
+        self.start = time.time()
+
+    def item_scraped(self, item, spider):  # pylint: disable=unused-argument
+        "Record how long the page took to audit."
+        entry = item.get("result")
+        if not entry or entry.get("audit_seconds") is None:
+            return
+        # the Pa11yPipeline makes up the run ID, if it isn't set
+        self.run_id = entry.get("run_id") or self.run_id
+        self.recorder.observe(entry["url"], entry["audit_seconds"])
+
+    def spider_closed(self, spider, reason):
+        "Write the stats of the crawl."
+        data_dir = getattr(spider, "data_dir", None)
+        if not data_dir or self.start is None:
+            return
+        stats = self.stats.get_stats()
+        shard_index = None
+        if (getattr(spider, "shard_count", None) or 1) > 1:
+            shard_index = spider.shard_index
+        run = {
+            "run_id": self.run_id or make_run_id(self.started_at),
+            "shard_index": shard_index,
+            "started_at": self.started_at,
+            "finished_at": datetime.utcnow(),
+            "finish_reason": reason,
+            "duration": time.time() - self.start,
+            "pages": stats.get("item_scraped_count", 0),
+            "dropped": stats.get("item_dropped_count", 0),
+            "requests": stats.get("downloader/request_count", 0),
+            "retries": stats.get("pa11y/retries", 0),
+            "response_bytes": stats.get("downloader/response_bytes", 0),
+            "peak_rss_mb": peak_rss_mb(),
+            "peak_children_rss_mb": stats.get("pa11y/children/peak_rss_mb"),
+        }
+        run.update(self.recorder.to_dict())
+        path = write_run_stats(Path(data_dir), run)
+        spider.logger.info(u"Wrote the stats of run %s to %s", run["run_id"], path)
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+An extension that serves the status of a running crawl as JSON, over HTTP,
+and accepts commands to change how fast it crawls.
+"""
+import json
+import time
+import collections
+from twisted.internet import task
+from twisted.web import resource, server
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+
+from pa11ycrawler.extensions.metrics import queue_depths
+
+# how often the number of finished pages is sampled, and over how many
+# seconds the throughput is measured
+SAMPLE_INTERVAL = 10
+THROUGHPUT_WINDOW = 300
+# the stats that count errors, or their prefixes
+ERROR_STATS = (
+    "log_count/ERROR",
+    "downloader/exception_count",
+    "downloader/response_status_count/5",
+    "spider_exceptions/",
+    "pa11y/retries",
+    "pa11y/children/killed_",
+)
+
+
+def error_counts(stats):
+    "The error counts in the stats, keyed by stat."
+    return {
+        key: value for key, value in stats.items()
+        if key.startswith(ERROR_STATS)
+    }
+
+
+def find_pipeline(engine, cls):
+    "The crawler's item pipeline of the given class, or None."
+    itemproc = getattr(getattr(engine, "scraper", None), "itemproc", None)
+    for pipeline in getattr(itemproc, "middlewares", ()):
+        if isinstance(pipeline, cls):
+            return pipeline
+    return None
+
+
+def set_download_concurrency(downloader, concurrency):
+    """
+    Change how many requests the downloader sends at once, in total and to
+    each site, including the sites that it's already sending requests to.
+    """
+    downloader.total_concurrency = concurrency
+    downloader.domain_concurrency = concurrency
+    if downloader.ip_concurrency:
+        downloader.ip_concurrency = concurrency
+    for slot in downloader.slots.values():
+        slot.concurrency = concurrency
+
+
+def positive_int(commands, name):
+    "Read a command's value, which must be a positive integer."
+    value = commands[name]
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        raise ValueError(u"{} must be a positive integer, not {!r}".format(name, value))
+    return value
+
+
+class StatusServer(object):
+    """
+    Serves the status of the crawl at `http://STATUS_HOST:STATUS_PORT/`:
+    how many pages were seeded, crawled and audited, how deep the queues
+    are, how many audits are running, the throughput over the last few
+    minutes, an estimate of when the seeded pages will all be audited, and
+    the error counts.
+
+    Commands are POSTed to `/control`, as a JSON object:
+
+    * `{"audits": "pause"}` or `{"audits": "resume"}` stops or restarts
+      auditing (pages are still downloaded, until the audit queue is full);
+    * `{"audit_concurrency": 4}` changes how many pages are audited at once;
+    * `{"download_concurrency": 2}` changes how many requests are sent to
+      the site at once.
+
+    If STATUS_TOKEN is set, requests must send it in an
+    `Authorization: Bearer <token>` header.
+    """
+    def __init__(self, crawler, host="127.0.0.1", port=6080, token=None):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.host = host
+        self.port = port
+        self.token = token
+        self.started_at = None
+        self.listener = None
+        self.task = None
+        self.samples = collections.deque(maxlen=THROUGHPUT_WINDOW // SAMPLE_INTERVAL + 1)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        "Build the extension from the crawler settings."
+        settings = crawler.settings
+        if not settings.getbool("STATUS_ENABLED"):
+            raise NotConfigured
+        ext = cls(
+            crawler,
+            host=settings.get("STATUS_HOST", "127.0.0.1"),
+            port=settings.getint("STATUS_PORT", 6080),
+            token=settings.get("STATUS_TOKEN"),
+        )
+        crawler.signals.connect(ext.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(ext.spider_closed, signal=signals.spider_closed)
+        return ext
+
+    def spider_opened(self, spider):
+        "Start sampling the throughput, and listening for requests."
+        from twisted.internet import reactor
+        self.started_at = time.time()
+        self.task = task.LoopingCall(self.sample)
+        self.task.start(SAMPLE_INTERVAL)
+        site = server.Site(StatusResource(self))
+        self.listener = reactor.listenTCP(self.port, site, interface=self.host)
+        spider.logger.info(
+            u"Serving the crawl status at http://%s:%s/", self.host, self.listener.getHost().port,
+        )
+
+    @property
+    def pipeline(self):
+        "The Pa11yPipeline of the crawl, if it's enabled."
+        # the pipelines import the frontier, which imports the extensions
+        from pa11ycrawler.pipelines import Pa11yPipeline
+        return find_pipeline(self.crawler.engine, Pa11yPipeline)
+
+    def finished_pages(self):
+        "How many pages have been audited or dropped."
+        return (
+            self.stats.get_value("item_scraped_count", 0) +
+            self.stats.get_value("item_dropped_count", 0)
+        )
+
+    def sample(self):
+        "Record how many pages have been finished so far."
+        self.samples.append((time.time(), self.finished_pages()))
+
+    def throughput(self):
+        "Pages finished per second over the last few minutes, or None."
+        if not self.samples:
+            return None
+        then, finished_then = self.samples[0]
+        elapsed = time.time() - then
+        if elapsed <= 0:
+            return None
+        return (self.finished_pages() - finished_then) / elapsed
+
+    def status(self):
+        "The status of the crawl, as a dictionary."
+        stats = self.stats.get_stats()
+        engine = self.crawler.engine
+        seeded = stats.get("seed/pages")
+        rate = self.throughput()
+        remaining = max(seeded - self.finished_pages(), 0) if seeded else None
+        status = {
+            "spider": getattr(getattr(engine, "spider", None), "name", None),
+            "uptime": time.time() - self.started_at if self.started_at else None,
+            "pages": {
+                "seeded": seeded,
+                "crawled": stats.get("response_received_count", 0),
+                "audited": stats.get("item_scraped_count", 0),
+                "dropped": stats.get("item_dropped_count", 0),
+            },
+            "queues": queue_depths(engine),
+            "pages_per_minute": rate * 60 if rate is not None else None,
+            "eta_seconds": remaining / rate if remaining is not None and rate else None,
+            "errors": error_counts(stats),
+        }
+        downloader = getattr(engine, "downloader", None)
+        if downloader is not None:
+            status["download_concurrency"] = downloader.total_concurrency
+        pipeline = self.pipeline
+        if pipeline is not None:
+            audits = {"running": len(pipeline.supervisor.children)}
+            if pipeline.slots is not None:
+                audits.update(
+                    concurrency=pipeline.slots.limit,
+                    waiting=len(pipeline.slots.waiting),
+                    paused=pipeline.slots.paused,
+                )
+            status["audits"] = audits
+        return status
+
+    def control(self, commands):
+        """
+        Apply a dictionary of commands (see the class docstring). Raises
+        ValueError, without applying any of them, if one is invalid.
+        """
+        unknown = set(commands) - {"audits", "audit_concurrency", "download_concurrency"}
+        if unknown:
+            raise ValueError(u"Unknown commands: {}".format(", ".join(sorted(unknown))))
+        pipeline = self.pipeline
+        slots = pipeline.slots if pipeline is not None else None
+        if ("audits" in commands or "audit_concurrency" in commands) and slots is None:
+            raise ValueError(u"Audits can't be controlled: AUDIT_CONCURRENCY is 0")
+        if commands.get("audits", "pause") not in ("pause", "resume"):
+            raise ValueError(u"audits must be 'pause' or 'resume', not {!r}".format(commands["audits"]))
+        audit_concurrency = download_concurrency = None
+        if "audit_concurrency" in commands:
+            audit_concurrency = positive_int(commands, "audit_concurrency")
+        if "download_concurrency" in commands:
+            download_concurrency = positive_int(commands, "download_concurrency")
+
+        logger = self.crawler.spider.logger
+        if commands.get("audits") == "pause":
+            logger.warning(u"Pausing audits")
+            slots.pause()
+        elif commands.get("audits") == "resume":
+            logger.warning(u"Resuming audits")
+            slots.resume()
+        if audit_concurrency:
+            logger.warning(u"Auditing %d pages at once", audit_concurrency)
+            slots.set_limit(audit_concurrency)
+        if download_concurrency:
+            logger.warning(u"Sending %d requests at once", download_concurrency)
+            set_download_concurrency(self.crawler.engine.downloader, download_concurrency)
+
+    def spider_closed(self, spider):  # pylint: disable=unused-argument
+        "Stop listening."
+        if self.task and self.task.running:
+            self.task.stop()
+        if self.listener is not None:
+            self.listener.stopListening()
+            self.listener = None
+
+
+class StatusResource(resource.Resource):
+    "The HTTP interface of the StatusServer."
+    isLeaf = True
+
+    def __init__(self, ext):
+        resource.Resource.__init__(self)
+        self.ext = ext
+
+    def respond(self, request, data, code=200):
+        "Send `data` as JSON."
+        request.setResponseCode(code)
+        request.setHeader(b"Content-Type", b"application/json")
+        request.setHeader(b"Cache-Control", b"no-store")
+        return json.dumps(data, sort_keys=True, indent=2).encode("utf8") + b"\n"
+
+    def authorized(self, request):
+        "Whether the request has the token, if one is needed."
+        if not self.ext.token:
+            return True
+        expected = u"Bearer {}".format(self.ext.token).encode("utf8")
+        return request.getHeader(b"Authorization") == expected
+
+    def render_GET(self, request):  # pylint: disable=invalid-name
+        "Serve the status."
+        if not self.authorized(request):
+            return self.respond(request, {"error": "unauthorized"}, 401)
+        if request.path not in (b"/", b"/status"):
+            return self.respond(request, {"error": "not found"}, 404)
+        return self.respond(request, self.ext.status())
+
+    def render_POST(self, request):  # pylint: disable=invalid-name
+        "Apply commands, and serve the new status."
+        if not self.authorized(request):
+            return self.respond(request, {"error": "unauthorized"}, 401)
+        if request.path != b"/control":
+            return self.respond(request, {"error": "not found"}, 404)
+        try:
+            commands = json.loads(request.content.read().decode("utf8"))
+            if not isinstance(commands, dict):
+                raise ValueError(u"Commands must be a JSON object")
+            self.ext.control(commands)
+        except ValueError as err:
+            return self.respond(request, {"error": u"{}".format(err)}, 400)
+        return self.respond(request, self.ext.status())
@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+"""
+A crawl frontier shared by several crawler processes, so that they can
+crawl one site together. It is enabled by setting SCHEDULER to
+`pa11ycrawler.frontier.FrontierScheduler`, and FRONTIER_URL to the store.
+"""
+from .stores import SQLiteStore, RedisStore, RedisConnection, open_store
+from .scheduler import FrontierScheduler, frontier_for
@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+"""
+A Scrapy scheduler that shares its queue and its dupefilter with other
+crawler processes, through a frontier store.
+"""
+import os
+import time
+import json
+import base64
+import socket
+import inspect
+import logging
+from twisted.internet import task
+from scrapy import signals, Request
+from scrapy.core.scheduler import Scheduler
+from scrapy.utils.misc import load_object
+from scrapy.utils.spider import iterate_spider_output
+try:
+    from scrapy.utils.request import request_from_dict
+except ImportError:  # Scrapy < 2.6
+    from scrapy.utils.reqser import request_from_dict, request_to_dict
+else:
+    def request_to_dict(request, spider=None):
+        "Serialize a request into a dictionary."
+        return request.to_dict(spider=spider)
+try:
+    from scrapy.utils.asyncgen import collect_asyncgen
+    from scrapy.utils.defer import deferred_from_coro
+except ImportError:  # Scrapy < 2.0 has no asynchronous callbacks
+    collect_asyncgen = deferred_from_coro = None
+
+from pa11ycrawler.extensions.metrics import queue_depths
+from .stores import open_store
+
+logger = logging.getLogger(__name__)
+
+# the fingerprint of the shared request that a request is working on
+LEASE_KEY = "frontier_lease"
+# the meta key of requests that stay in the queue of the node that made them
+LOCAL_KEY = "frontier_local"
+
+
+def request_fingerprint(crawler, request):
+    "The fingerprint of a request, as a hex string."
+    fingerprinter = getattr(crawler, "request_fingerprinter", None)
+    if fingerprinter is not None:
+        return fingerprinter.fingerprint(request).hex()
+    from scrapy.utils.request import request_fingerprint as fingerprint
+    return fingerprint(request)
+
+
+def dump_request(request, spider):
+    """
+    Serialize a request for the shared queue, as JSON. Its meta has to be
+    JSON-serializable too.
+    """
+    data = request_to_dict(request, spider=spider)
+    data["body"] = base64.b64encode(data["body"]).decode("ascii")
+    data["headers"] = [
+        [name.decode("latin-1"), [value.decode("latin-1") for value in values]]
+        for name, values in data["headers"].items()
+    ]
+    return json.dumps(data).encode("utf-8")
+
+
+def load_request(payload, spider):
+    "Rebuild a request from the shared queue, serialized by `dump_request`."
+    data = json.loads(bytes(payload).decode("utf-8"))
+    if "_class" in data and not issubclass(load_object(data["_class"]), Request):
+        raise ValueError(u"{cls} isn't a request class".format(cls=data["_class"]))
+    data["body"] = base64.b64decode(data["body"])
+    data["headers"] = {
+        name.encode("latin-1"): [value.encode("latin-1") for value in values]
+        for name, values in data["headers"]
+    }
+    return request_from_dict(data, spider=spider)
+
+
+def frontier_for(spider):
+    "The frontier scheduler that the given spider is crawling with, if any."
+    frontier = getattr(spider, "frontier", None)
+    if not isinstance(frontier, FrontierScheduler):
+        return None
+    return frontier
+
+
+class FrontierScheduler(Scheduler):
+    """
+    A scheduler for crawling with several nodes (crawler processes) at once.
+    Requests are deduplicated against one set of fingerprints that every
+    node shares, and go into a shared queue that every node pulls from, in
+    the frontier store at FRONTIER_URL.
+
+    Requests that only make sense on the node that made them stay in the
+    node's own queue: requests with `frontier_local` set in their meta (like
+    logins, and HEAD probes), and redirects and retries of a request the
+    node is working on. Every other request is deduplicated against the
+    shared fingerprints, even if it has `dont_filter` set, since that is
+    what keeps two nodes from crawling the same page.
+
+    A node leases each request that it pulls from the shared queue, until
+    its callback (or errback) has finished, and the items that it scraped
+    have been through the item pipelines. Leases are kept alive by a
+    heartbeat every FRONTIER_HEARTBEAT_INTERVAL seconds, and if a node
+    stops sending them for FRONTIER_LEASE_TIMEOUT seconds, its leased
+    requests are put back in the queue, up to FRONTIER_MAX_ATTEMPTS times.
+    A node only finishes once the shared queue is empty, and no other node
+    has work in progress. The engine asks about that on every tick, so the
+    number of requests in the shared queue, and whether other nodes are
+    working, are cached, and refreshed by the heartbeat; the store is only
+    asked directly when the cached counts say that the crawl is done.
+
+    Different requests can still end up at the same page, so the
+    DuplicatesPipeline claims each page in the frontier as well, with
+    `claim_page()`, before it's audited. A page stays claimed by the
+    request that found it, so if that request is requeued, its next attempt
+    can still audit the page.
+    """
+    @classmethod
+    def from_crawler(cls, crawler):
+        scheduler = super(FrontierScheduler, cls).from_crawler(crawler)
+        settings = crawler.settings
+        scheduler.crawler = crawler
+        scheduler.stats = crawler.stats
+        scheduler.store = open_store(
+            settings.get("FRONTIER_URL"), key=settings.get("FRONTIER_KEY", "pa11ycrawler"),
+        )
+        scheduler.node = settings.get("FRONTIER_NODE") or u"{host}-{pid}".format(
+            host=socket.gethostname(), pid=os.getpid(),
+        )
+        scheduler.lease_timeout = settings.getfloat("FRONTIER_LEASE_TIMEOUT", 120)
+        scheduler.heartbeat_interval = settings.getfloat("FRONTIER_HEARTBEAT_INTERVAL", 10)
+        scheduler.max_attempts = settings.getint("FRONTIER_MAX_ATTEMPTS", 3)
+        # the number of things (the callback, and each of its items) that
+        # each lease is waiting for
+        scheduler.leases = {}
+        # the lease that each item in the item pipelines belongs to, by id
+        scheduler.items = {}
+        scheduler.heartbeat_task = None
+        scheduler.started_at = None
+        # cached counts from the store, refreshed by the heartbeat
+        scheduler.shared_pending = 0
+        scheduler.others_working = False
+        crawler.signals.connect(scheduler.spider_idle, signal=signals.spider_idle)
+        crawler.signals.connect(scheduler.item_done, signal=signals.item_scraped)
+        crawler.signals.connect(scheduler.item_done, signal=signals.item_dropped)
+        if hasattr(signals, "item_error"):  # Scrapy >= 2.0
+            crawler.signals.connect(scheduler.item_done, signal=signals.item_error)
+        return scheduler
+
+    def open(self, spider):
+        result = super(FrontierScheduler, self).open(spider)
+        self.started_at = time.time()
+        spider.frontier = self
+        self.refresh_counts()
+        self.heartbeat_task = task.LoopingCall(self.heartbeat)
+        self.heartbeat_task.start(self.heartbeat_interval)
+        logger.info(u"Crawling as frontier node %s", self.node)
+        return result
+
+    def close(self, reason):
+        if self.heartbeat_task is not None and self.heartbeat_task.running:
+            self.heartbeat_task.stop()
+        if reason != "finished":
+            released = self.store.release(self.node)
+            logger.info(u"Released %d leased requests back to the frontier", released)
+        elapsed = time.time() - self.started_at if self.started_at else 0
+        if elapsed:
+            self.stats.set_value(
+                "frontier/acked_per_minute",
+                self.stats.get_value("frontier/acked", 0) * 60.0 / elapsed,
+                spider=self.spider,
+            )
+        for node, acked in self.store.node_counts().items():
+            self.stats.set_value(u"frontier/node/{}/acked".format(node), acked, spider=self.spider)
+        self.store.close()
+        return super(FrontierScheduler, self).close(reason)
+
+    def busy(self):
+        "Does this node have work of its own in progress?"
+        if super(FrontierScheduler, self).has_pending_requests() or self.leases:
+            return True
+        engine = getattr(self.crawler, "engine", None)
+        if engine is None:
+            return False
+        depths = queue_depths(engine)
+        # the scheduler's length includes the shared queue
+        depths.pop("scheduler", None)
+        return any(depths.values())
+
+    def heartbeat(self):
+        "Keep this node's leases alive, and requeue those of dead nodes."
+        self.store.heartbeat(self.node, self.lease_timeout, busy=self.busy())
+        requeued, dropped = self.store.requeue_expired(self.max_attempts)
+        if requeued or dropped:
+            logger.warning(
+                u"Requeued %d requests from nodes that stopped, and dropped %d",
+                requeued, dropped,
+            )
+            self.stats.inc_value("frontier/requeued", requeued, spider=self.spider)
+            self.stats.inc_value("frontier/dropped", dropped, spider=self.spider)
+        self.refresh_counts()
+
+    def refresh_counts(self):
+        "Ask the store how much work is left, on this node and the others."
+        self.shared_pending = self.store.pending()
+        self.others_working = bool(
+            self.store.in_progress(exclude=self.node) or
+            self.store.busy_nodes(exclude=self.node)
+        )
+
+    def is_local(self, request):
+        "Should this request stay in this node's own queue?"
+        return bool(request.meta.get(LOCAL_KEY)) or LEASE_KEY in request.meta
+
+    def enqueue_request(self, request):
+        if self.is_local(request):
+            enqueued = super(FrontierScheduler, self).enqueue_request(request)
+            if not enqueued and LEASE_KEY in request.meta:
+                # a redirect to a page that was already crawled
+                self.ack(request.meta[LEASE_KEY])
+            return enqueued
+
+        fingerprint = request_fingerprint(self.crawler, request)
+        if self.store.seen(fingerprint):
+            self.df.log(request, self.spider)
+            self.stats.inc_value("frontier/duplicates", spider=self.spider)
+            return False
+        # identities (cookiejars) belong to the node that pulls the request
+        meta = dict(request.meta)
+        meta.pop("cookiejar", None)
+        payload = dump_request(request.replace(meta=meta), self.spider)
+        self.store.push(fingerprint, payload, priority=request.priority)
+        self.shared_pending += 1
+        self.stats.inc_value("frontier/pushed", spider=self.spider)
+        return True
+
+    def next_request(self):
+        request = super(FrontierScheduler, self).next_request()
+        if request is not None:
+            return request
+        if not getattr(self.spider, "crawl_started", True):
+            # the spider is still logging in
+            return None
+        leased = self.store.pop(self.node)
+        if leased is None:
+            self.shared_pending = 0
+            return None
+        self.shared_pending = max(self.shared_pending - 1, 0)
+        fingerprint, payload = leased
+        request = load_request(payload, self.spider)
+        request.meta[LEASE_KEY] = fingerprint
+        self.track(request, fingerprint)
+        assign_identity = getattr(self.spider, "assign_identity", None)
+        if assign_identity is not None:
+            request = assign_identity(request)
+        self.leases[fingerprint] = 1
+        self.stats.inc_value("frontier/leased", spider=self.spider)
+        return request
+
+    def track(self, request, fingerprint):
+        """
+        Wrap the callback and errback of a leased request, so that the lease
+        is released once either of them has finished, and the requests that
+        it found have been scheduled.
+        """
+        spider = self.spider
+        callback = request.callback or getattr(spider, "_parse", None) or spider.parse
+        errback = request.errback
+
+        def acked_callback(response, **kwargs):
+            "Run the callback, and release the lease after its output."
+            try:
+                output = callback(response, **kwargs)
+            except Exception:
+                self.release(fingerprint)
+                raise
+            if inspect.isasyncgen(output) or inspect.iscoroutine(output):
+                # like the rules of a CrawlSpider, in newer versions of Scrapy
+                if inspect.isasyncgen(output):
+                    output = collect_asyncgen(output)
+                collected = deferred_from_coro(output)
+                collected.addCallbacks(
+                    lambda result: self.acked_output(result, fingerprint),
+                    lambda failure: self.release(fingerprint) or failure,
+                )
+                return collected
+            return self.acked_output(output, fingerprint)
+
+        def acked_errback(failure):
+            "Run the errback, and then release the lease."
+            try:
+                if errback is not None:
+                    return errback(failure)
+                return None
+            finally:
+                self.release(fingerprint)
+
+        request.callback = acked_callback
+        request.errback = acked_errback
+
+    def acked_output(self, output, fingerprint):
+        """
+        Yield the output of a callback, and then release the lease of the
+        request that it was for. The scraper schedules each request as it's
+        yielded, so they are all in the frontier before the lease is
+        acknowledged. Items hold on to the lease until they're done.
+        """
+        try:
+            for result in iterate_spider_output(output):
+                if not isinstance(result, Request) and fingerprint in self.leases:
+                    self.leases[fingerprint] += 1
+                    self.items[id(result)] = fingerprint
+                yield result
+        finally:
+            self.release(fingerprint)
+
+    def item_done(self, item, spider, **kwargs):  # pylint: disable=unused-argument
+        "An item has been through the item pipelines, or dropped by one."
+        fingerprint = self.items.pop(id(item), None)
+        if fingerprint is not None:
+            self.release(fingerprint)
+
+    def claim_page(self, url, item=None):
+        """
+        Claim the page at the given (normalized) URL, for the lease that the
+        given item belongs to (or else for this node). Returns False if it
+        was already claimed by something else.
+        """
+        owner = self.items.get(id(item)) if item is not None else None
+        return self.store.claim(u"page:" + url, owner or self.node)
+
+    def release(self, fingerprint):
+        "One of the things that a lease is waiting for is done."
+        if fingerprint not in self.leases:
+            return
+        self.leases[fingerprint] -= 1
+        if self.leases[fingerprint] <= 0:
+            self.ack(fingerprint)
+
+    def ack(self, fingerprint):
+        "Tell the frontier that a leased request is done."
+        if self.leases.pop(fingerprint, None) is None:
+            return
+        self.store.ack(self.node, fingerprint)
+        self.stats.inc_value("frontier/acked", spider=self.spider)
+
+    def spider_idle(self, spider):
+        """
+        If this node is idle, no request that it leased can still be in
+        progress, so any lease that is left was lost along the way (for
+        instance, when a downloader middleware dropped the request).
+        """
+        if spider is not self.spider or not self.leases:
+            return
+        logger.warning(u"Acknowledging %d lost leases", len(self.leases))
+        self.stats.inc_value("frontier/lost_leases", len(self.leases), spider=spider)
+        for fingerprint in list(self.leases):
+            self.ack(fingerprint)
+        self.items.clear()
+
+    def has_pending_requests(self):
+        if super(FrontierScheduler, self).has_pending_requests():
+            return True
+        # other nodes may still discover more requests
+        if self.shared_pending or self.others_working:
+            return True
+        # the counts may be out of date, and the node shouldn't finish
+        # because of that
+        self.refresh_counts()
+        return bool(self.shared_pending or self.others_working)
+
+    def __len__(self):
+        return super(FrontierScheduler, self).__len__() + self.shared_pending
@@ -0,0 +1,458 @@
+# -*- coding: utf-8 -*-
+"""
+Stores for a crawl frontier that is shared by several crawler processes:
+the requests waiting to be crawled, the requests that each node has leased,
+the fingerprints of every request that has been seen, and who claimed
+each page.
+
+Every store has the same interface. A node leases the requests that it
+pops, and keeps its leases alive by sending heartbeats. If a node stops
+sending heartbeats (because it died), any node can put its leased requests
+back in the queue with `requeue_expired()`.
+"""
+import time
+import socket
+import sqlite3
+try:
+    from urllib.parse import urlparse, unquote
+except ImportError:  # Python 2
+    from urlparse import urlparse
+    from urllib import unquote
+
+
+class SQLiteStore(object):
+    """
+    A frontier in an SQLite database, for nodes that share a filesystem
+    (which must support file locking). Requests are popped in order of
+    priority, and then in the order they were pushed.
+    """
+    def __init__(self, path, timeout=60):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS seen (
+                fingerprint TEXT PRIMARY KEY
+            );
+            CREATE TABLE IF NOT EXISTS requests (
+                fingerprint TEXT PRIMARY KEY,
+                priority INTEGER NOT NULL,
+                payload BLOB NOT NULL,
+                node TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS requests_pending
+                ON requests (node, priority);
+            CREATE TABLE IF NOT EXISTS claims (
+                key TEXT PRIMARY KEY,
+                owner TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS nodes (
+                node TEXT PRIMARY KEY,
+                expires REAL NOT NULL,
+                busy INTEGER NOT NULL DEFAULT 0,
+                acked INTEGER NOT NULL DEFAULT 0
+            );
+        """)
+
+    def _transaction(self):
+        "Start a transaction that holds the write lock until it's committed."
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def seen(self, fingerprint):
+        """
+        Record that a request with the given fingerprint was seen. Returns
+        True if it had already been seen.
+        """
+        cursor = self.conn.execute(
+            "INSERT OR IGNORE INTO seen (fingerprint) VALUES (?)", (fingerprint,),
+        )
+        return cursor.rowcount == 0
+
+    def claim(self, key, owner):
+        """
+        Claim the given key for `owner`. Returns True if it wasn't claimed
+        yet, or was already claimed by the same owner.
+        """
+        self.conn.execute(
+            "INSERT OR IGNORE INTO claims (key, owner) VALUES (?, ?)", (key, owner),
+        )
+        return self.conn.execute(
+            "SELECT owner FROM claims WHERE key = ?", (key,),
+        ).fetchone()[0] == owner
+
+    def push(self, fingerprint, payload, priority=0):
+        "Add a serialized request to the queue."
+        self.conn.execute(
+            "INSERT OR REPLACE INTO requests (fingerprint, priority, payload) "
+            "VALUES (?, ?, ?)",
+            (fingerprint, priority, sqlite3.Binary(payload)),
+        )
+
+    def pop(self, node):
+        """
+        Lease the next request in the queue to the given node. Returns its
+        fingerprint and payload, or None if the queue is empty.
+        """
+        conn = self._transaction()
+        try:
+            row = conn.execute(
+                "SELECT fingerprint, payload FROM requests WHERE node IS NULL "
+                "ORDER BY priority DESC, rowid LIMIT 1"
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE requests SET node = ? WHERE fingerprint = ?", (node, row[0]),
+                )
+                conn.execute(
+                    "INSERT OR IGNORE INTO nodes (node, expires) VALUES (?, 0)", (node,),
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        return row[0], bytes(row[1])
+
+    def ack(self, node, fingerprint):
+        "Mark a request that the given node leased as done."
+        conn = self._transaction()
+        try:
+            cursor = conn.execute(
+                "DELETE FROM requests WHERE fingerprint = ? AND node = ?", (fingerprint, node),
+            )
+            if cursor.rowcount:
+                conn.execute("UPDATE nodes SET acked = acked + 1 WHERE node = ?", (node,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def heartbeat(self, node, lease_timeout, busy=False):
+        """
+        Keep the given node's leases alive for another `lease_timeout`
+        seconds, and record whether it has work of its own in progress.
+        """
+        self.conn.execute(
+            "INSERT OR IGNORE INTO nodes (node, expires) VALUES (?, 0)", (node,),
+        )
+        self.conn.execute(
+            "UPDATE nodes SET expires = ?, busy = ? WHERE node = ?",
+            (time.time() + lease_timeout, int(bool(busy)), node),
+        )
+
+    def _requeue(self, conn, nodes, max_attempts=None):
+        requeued = dropped = 0
+        for node in nodes:
+            if max_attempts:
+                conn.execute(
+                    "UPDATE requests SET attempts = attempts + 1 WHERE node = ?", (node,),
+                )
+                dropped += conn.execute(
+                    "DELETE FROM requests WHERE node = ? AND attempts >= ?",
+                    (node, max_attempts),
+                ).rowcount
+            requeued += conn.execute(
+                "UPDATE requests SET node = NULL WHERE node = ?", (node,),
+            ).rowcount
+            conn.execute("UPDATE nodes SET busy = 0 WHERE node = ?", (node,))
+        return requeued, dropped
+
+    def requeue_expired(self, max_attempts=3):
+        """
+        Put the requests leased by nodes that stopped sending heartbeats
+        back in the queue, unless they have already been leased
+        `max_attempts` times, in which case they are dropped. Returns the
+        number of requests requeued and dropped.
+        """
+        conn = self._transaction()
+        try:
+            expired = [row[0] for row in conn.execute(
+                "SELECT DISTINCT requests.node FROM requests JOIN nodes "
+                "ON requests.node = nodes.node WHERE nodes.expires < ?",
+                (time.time(),),
+            )]
+            counts = self._requeue(conn, expired, max_attempts)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return counts
+
+    def release(self, node):
+        """
+        Put the requests leased by the given node back in the queue, for a
+        node that is stopping before it's done.
+        """
+        conn = self._transaction()
+        try:
+            requeued, _ = self._requeue(conn, [node])
+            conn.execute("UPDATE nodes SET expires = 0 WHERE node = ?", (node,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return requeued
+
+    def pending(self):
+        "The number of requests in the queue."
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM requests WHERE node IS NULL"
+        ).fetchone()[0]
+
+    def in_progress(self, exclude=None):
+        "The number of requests leased by any node except `exclude`."
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM requests WHERE node IS NOT NULL AND node IS NOT ?",
+            (exclude,),
+        ).fetchone()[0]
+
+    def busy_nodes(self, exclude=None):
+        "The number of live nodes, except `exclude`, with work of their own."
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM nodes WHERE busy AND expires >= ? AND node IS NOT ?",
+            (time.time(), exclude),
+        ).fetchone()[0]
+
+    def node_counts(self):
+        "The number of requests that each node has finished."
+        return dict(self.conn.execute("SELECT node, acked FROM nodes"))
+
+    def close(self):
+        "Close the database connection."
+        self.conn.close()
+
+
+class RedisError(Exception):
+    "An error reply from a Redis server."
+    pass
+
+
+class RedisConnection(object):
+    """
+    A minimal client for the Redis protocol (RESP), with just enough of it
+    for the RedisStore, so that pa11ycrawler doesn't need a Redis library.
+    """
+    def __init__(self, host="localhost", port=6379, db=0, password=None, timeout=30):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.reader = self.sock.makefile("rb")
+        if password:
+            self.execute("AUTH", password)
+        if db:
+            self.execute("SELECT", db)
+
+    def execute(self, *args):
+        "Send a command, and return its reply."
+        parts = [u"*{}\r\n".format(len(args)).encode("ascii")]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = u"{}".format(arg).encode("utf8")
+            parts.append(u"${}\r\n".format(len(arg)).encode("ascii"))
+            parts.append(arg + b"\r\n")
+        self.sock.sendall(b"".join(parts))
+        return self._read_reply()
+
+    def _read_reply(self):
+        line = self.reader.readline()
+        if not line:
+            raise RedisError(u"Connection closed by the server")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode("utf8")
+        if kind == b"-":
+            raise RedisError(rest.decode("utf8"))
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            length = int(rest)
+            if length < 0:
+                return None
+            data = self.reader.read(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            length = int(rest)
+            if length < 0:
+                return None
+            return [self._read_reply() for _ in range(length)]
+        raise RedisError(u"Unexpected reply from the server: {!r}".format(line))
+
+    def close(self):
+        "Close the connection."
+        self.reader.close()
+        self.sock.close()
+
+
+class RedisStore(object):
+    """
+    A frontier in a Redis server. Requests are popped in the order they were
+    pushed (priorities are ignored), using the reliable queue pattern: each
+    request is atomically moved from the queue to a list of the requests
+    that the node has leased. A node's leases expire along with a key that
+    its heartbeats keep alive.
+    """
+    def __init__(self, connection, key="pa11ycrawler"):
+        self.redis = connection
+        self.key = key
+
+    def _key(self, *parts):
+        return u":".join((self.key,) + parts)
+
+    def seen(self, fingerprint):
+        """
+        Record that a request with the given fingerprint was seen. Returns
+        True if it had already been seen.
+        """
+        return not self.redis.execute("SADD", self._key("seen"), fingerprint)
+
+    def claim(self, key, owner):
+        """
+        Claim the given key for `owner`. Returns True if it wasn't claimed
+        yet, or was already claimed by the same owner.
+        """
+        if self.redis.execute("HSETNX", self._key("claims"), key, owner):
+            return True
+        claimed_by = self.redis.execute("HGET", self._key("claims"), key)
+        return claimed_by == owner.encode("utf8")
+
+    def push(self, fingerprint, payload, priority=0):  # pylint: disable=unused-argument
+        "Add a serialized request to the queue."
+        self.redis.execute("HSET", self._key("requests"), fingerprint, payload)
+        self.redis.execute("LPUSH", self._key("pending"), fingerprint)
+
+    def pop(self, node):
+        """
+        Lease the next request in the queue to the given node. Returns its
+        fingerprint and payload, or None if the queue is empty.
+        """
+        leased = self._key("leased", node)
+        self.redis.execute("SADD", self._key("nodes"), node)
+        while True:
+            fingerprint = self.redis.execute("RPOPLPUSH", self._key("pending"), leased)
+            if fingerprint is None:
+                return None
+            payload = self.redis.execute("HGET", self._key("requests"), fingerprint)
+            if payload is not None:
+                return fingerprint.decode("ascii"), payload
+            # the request was dropped after too many attempts
+            self.redis.execute("LREM", leased, 0, fingerprint)
+
+    def ack(self, node, fingerprint):
+        "Mark a request that the given node leased as done."
+        if self.redis.execute("LREM", self._key("leased", node), 0, fingerprint):
+            self.redis.execute("HDEL", self._key("requests"), fingerprint)
+            self.redis.execute("HDEL", self._key("attempts"), fingerprint)
+            self.redis.execute("HINCRBY", self._key("acked"), node, 1)
+
+    def heartbeat(self, node, lease_timeout, busy=False):
+        """
+        Keep the given node's leases alive for another `lease_timeout`
+        seconds, and record whether it has work of its own in progress.
+        """
+        self.redis.execute("SADD", self._key("nodes"), node)
+        self.redis.execute(
+            "SET", self._key("alive", node), int(bool(busy)),
+            "PX", int(lease_timeout * 1000),
+        )
+
+    def _requeue(self, node, max_attempts=None):
+        requeued = dropped = 0
+        leased = self._key("leased", node)
+        while True:
+            fingerprint = self.redis.execute("RPOPLPUSH", leased, self._key("pending"))
+            if fingerprint is None:
+                break
+            requeued += 1
+            if not max_attempts:
+                continue
+            attempts = self.redis.execute("HINCRBY", self._key("attempts"), fingerprint, 1)
+            if attempts >= max_attempts:
+                self.redis.execute("LREM", self._key("pending"), 0, fingerprint)
+                self.redis.execute("HDEL", self._key("requests"), fingerprint)
+                requeued -= 1
+                dropped += 1
+        return requeued, dropped
+
+    def requeue_expired(self, max_attempts=3):
+        """
+        Put the requests leased by nodes that stopped sending heartbeats
+        back in the queue, unless they have already been leased
+        `max_attempts` times, in which case they are dropped. Returns the
+        number of requests requeued and dropped.
+        """
+        requeued = dropped = 0
+        for node in self.redis.execute("SMEMBERS", self._key("nodes")):
+            node = node.decode("utf8")
+            if self.redis.execute("EXISTS", self._key("alive", node)):
+                continue
+            node_requeued, node_dropped = self._requeue(node, max_attempts)
+            requeued += node_requeued
+            dropped += node_dropped
+        return requeued, dropped
+
+    def release(self, node):
+        """
+        Put the requests leased by the given node back in the queue, for a
+        node that is stopping before it's done.
+        """
+        self.redis.execute("DEL", self._key("alive", node))
+        return self._requeue(node)[0]
+
+    def pending(self):
+        "The number of requests in the queue."
+        return self.redis.execute("LLEN", self._key("pending"))
+
+    def _nodes(self, exclude=None):
+        return [
+            node for node in
+            (node.decode("utf8") for node in self.redis.execute("SMEMBERS", self._key("nodes")))
+            if node != exclude
+        ]
+
+    def in_progress(self, exclude=None):
+        "The number of requests leased by any node except `exclude`."
+        return sum(
+            self.redis.execute("LLEN", self._key("leased", node))
+            for node in self._nodes(exclude)
+        )
+
+    def busy_nodes(self, exclude=None):
+        "The number of live nodes, except `exclude`, with work of their own."
+        return sum(
+            1 for node in self._nodes(exclude)
+            if self.redis.execute("GET", self._key("alive", node)) == b"1"
+        )
+
+    def node_counts(self):
+        "The number of requests that each node has finished."
+        reply = self.redis.execute("HGETALL", self._key("acked"))
+        return {
+            reply[index].decode("utf8"): int(reply[index + 1])
+            for index in range(0, len(reply), 2)
+        }
+
+    def close(self):
+        "Close the connection to the server."
+        self.redis.close()
+
+
+def open_store(url, key="pa11ycrawler"):
+    """
+    Open the frontier store at the given URL, which is either
+    `sqlite:///path/to/frontier.db` or `redis://[:password@]host[:port][/db]`.
+    `key` is the prefix of the keys that the Redis store uses.
+    """
+    parsed = urlparse(url)
+    if parsed.scheme == "sqlite":
+        path = unquote(parsed.netloc + parsed.path)
+        return SQLiteStore(path)
+    if parsed.scheme == "redis":
+        db = parsed.path.strip("/")
+        connection = RedisConnection(
+            host=parsed.hostname or "localhost",
+            port=parsed.port or 6379,
+            db=int(db) if db else 0,
+            password=parsed.password,
+        )
+        return RedisStore(connection, key=key)
+    raise ValueError(u"Unknown frontier URL {url}".format(url=url))
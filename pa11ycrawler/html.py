@@ -4,13 +4,19 @@ report.
 """
 import re
 import argparse
-import json
 import logging
 import collections
 import hashlib
 from path import Path
-from jinja2 import Environment, PackageLoader
-from pa11ycrawler.util import pa11y_counts
+from pa11ycrawler.assets import remove_precompressed, write_assets, write_precompressed
+from pa11ycrawler.util import normalize_url, pa11y_counts, result_files, write_atomic
+from pa11ycrawler.manifest import latest_entries, load_manifest
+from pa11ycrawler.profiling import Profiler
+from pa11ycrawler.runstats import load_runs
+from pa11ycrawler.violations import ViolationStore, load_result
+from pa11ycrawler.ignore import (
+    IgnoreRules, NO_IGNORE_RULES, load_pa11y_ignore_rules, load_saved_ignore_rules
+)
 
 log = logging.getLogger(__name__)
 
@@ -19,6 +25,9 @@ REPO_DIR = PARENT_DIR.parent
 INDEX_TEMPLATE = 'index.html'
 DETAIL_TEMPLATE = 'detail.html'
 UNIQUE_TEMPLATE = 'unique.html'
+PERFORMANCE_TEMPLATE = 'performance.html'
+# how many of the most recent runs the performance page shows
+DEFAULT_PERFORMANCE_RUNS = 10
 
 # A WCAG ref consists of one or more uppercase letters followed by one or more
 # digits. For example, "F77", "G73", "ARIA1".
@@ -41,6 +50,33 @@ def make_parser():
         "--output-dir", default="html",
         help=u"Directory to output the resulting HTML files [%(default)s]"
     )
+    parser.add_argument(
+        "--pa11y-ignore-rules-file", default=None,
+        help=u"YAML file containing pa11y ignore rules to apply, instead of "
+             u"the rules that were used when crawling"
+    )
+    parser.add_argument(
+        "--pa11y-ignore-rules-url", default=None,
+        help=u"URL of a YAML file containing pa11y ignore rules to apply, "
+             u"instead of the rules that were used when crawling"
+    )
+    parser.add_argument(
+        "--no-ignore-rules", action="store_true",
+        help=u"Report every pa11y result, without applying any ignore rules"
+    )
+    parser.add_argument(
+        "--profile", default=None, metavar="DIR",
+        help=u"Profile the report generation, and write the profile to this directory"
+    )
+    parser.add_argument(
+        "--no-compress", action="store_true",
+        help=u"Don't write gzip and brotli compressed copies of each file"
+    )
+    parser.add_argument(
+        "--performance-runs", type=int, default=DEFAULT_PERFORMANCE_RUNS, metavar="N",
+        help=u"How many of the most recent crawls to show on the performance page "
+             u"[%(default)s]"
+    )
     return parser
 
 
@@ -54,15 +90,37 @@ def main():
     if not data_dir.isdir():  # pylint: disable=no-value-for-parameter
         msg = u"Data directory {dir} does not exist".format(dir=args.data_dir)
         raise ValueError(msg)
-    data_filenames = [name for name in data_dir.files()  # pylint: disable=no-value-for-parameter
-                      if name.endswith(".json")]
-    if not data_filenames:
-        msg = u"Data directory {dir} contains no JSON files".format(dir=args.data_dir)
+    if not result_files(data_dir):
+        msg = u"Data directory {dir} contains no pa11y results".format(dir=args.data_dir)
         raise ValueError(msg)
     output_dir = Path(args.output_dir).expand()
     output_dir.makedirs_p()  # pylint: disable=no-value-for-parameter
 
-    return render_html(data_dir, output_dir)
+    if args.no_ignore_rules:
+        ignore_rules = NO_IGNORE_RULES
+    elif args.pa11y_ignore_rules_file or args.pa11y_ignore_rules_url:
+        ignore_rules = IgnoreRules(load_pa11y_ignore_rules(
+            file=args.pa11y_ignore_rules_file, url=args.pa11y_ignore_rules_url,
+        ))
+    else:
+        ignore_rules = None
+
+    kwargs = dict(
+        ignore_rules=ignore_rules,
+        performance_runs=args.performance_runs,
+        compress=not args.no_compress,
+    )
+    if not args.profile:
+        return render_html(data_dir, output_dir, **kwargs)
+
+    profiler = Profiler(targets=["pa11ycrawler.html.render_html"])
+    profiler.install()
+    try:
+        return render_html(data_dir, output_dir, **kwargs)
+    finally:
+        profiler.uninstall()
+        for path in profiler.save(args.profile, "render_html"):
+            log.info(u"Wrote profile to %s", path)
 
 
 def wcag_refs(code):
@@ -79,83 +137,272 @@ def wcag_refs(code):
     return []
 
 
-def render_template(env, html_path, template_filename, context):
+def sparkline(values, width, height):
+    """
+    The points of an SVG polyline that plots `values` (oldest first) across
+    a `width` by `height` box, scaled between their smallest and largest
+    values. Missing values are left out.
     """
-    Render a template file into the given output location.
+    points = [(i, value) for i, value in enumerate(values) if value is not None]
+    if len(points) < 2:
+        return u""
+    low = min(value for _, value in points)
+    high = max(value for _, value in points)
+    x_step = width / float(max(len(values) - 1, 1))
+    y_scale = (height - 2) / float(high - low) if high > low else 0
+    return u" ".join(
+        u"{:.1f},{:.1f}".format(i * x_step, height - 1 - (value - low) * y_scale)
+        for i, value in points
+    )
+
+
+def format_duration(seconds):
+    "A number of seconds, as hours, minutes and seconds: `1h 02m 03s`."
+    if seconds is None:
+        return u"-"
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return u"{}h {:02d}m {:02d}s".format(hours, minutes, seconds)
+    if minutes:
+        return u"{}m {:02d}s".format(minutes, seconds)
+    return u"{}s".format(seconds)
+
+
+def render_template(env, html_path, template_filename, context, compress=False):
+    """
+    Render a template file into the given output location. The file is
+    replaced in one step, so a report that is being updated can be read.
+    If `compress` is True, its gzip and brotli compressed copies are written
+    too; otherwise, any old compressed copies are removed.
     """
     template = env.get_template(template_filename)
     rendered_html = template.render(**context)  # pylint: disable=no-member
-    html_path.write_text(rendered_html, encoding='utf-8')
+    write_atomic(html_path, rendered_html)
+    if compress:
+        write_precompressed(html_path, rendered_html)
+    else:
+        remove_precompressed(html_path)
 
 
-def render_html(data_dir, output_dir):
+def group_page(grouped_violations, counter, data):
     """
-    The main workhorse of this script. Finds all the JSON data files
-    from pa11ycrawler, and transforms them into HTML files via Jinja2 templating.
+    Add the pa11y results of one page to the groups made by
+    `group_violations`. Returns the `(type, group ID)` of each result.
+    """
+    keys = []
+    for violation in data['pa11y']:
+        violation_id = hashlib.md5(
+            (violation['selector'] + violation['code']).encode('utf-8')
+        ).hexdigest()
+
+        if violation_id not in grouped_violations[violation['type']]:
+            violation['pages'] = []
+            grouped_violations[violation['type']][violation_id] = violation
+            counter[violation['type']] += 1
+
+        grouped_violations[violation['type']][violation_id]['pages'].append({
+            'url': data['url'],
+            'page_title': data['page_title']
+        })
+        keys.append((violation['type'], violation_id))
+    return keys
+
+
+def group_violations(pages):
+    """
+    Group the pa11y results from all of the given pages, so that results
+    with the same selector and code are reported once, along with every page
+    that they were found on. Returns a mapping of result type to groups
+    (keyed by an ID made from the selector and code), and a Counter of the
+    number of groups of each type.
     """
-    env = Environment(loader=PackageLoader('pa11ycrawler', 'templates'))
-    env.globals["wcag_refs"] = wcag_refs
-    pages = []
     counter = collections.Counter()
     grouped_violations = collections.defaultdict(dict)
+    for data in pages:
+        group_page(grouped_violations, counter, data)
+    return grouped_violations, counter
+
+
+class RecordedIgnoreRules(object):  # pylint: disable=too-few-public-methods
+    """
+    Looks up the ignore rules that were recorded with each result when
+    crawling, loading each version of the rules only once.
+    """
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.versions = {}
+
+    def for_result(self, data):
+        "Returns the ignore rules that were recorded with this result."
+        version = data.get('pa11y_ignore_rules_version')
+        if not version:
+            return NO_IGNORE_RULES
+        if version not in self.versions:
+            rules = load_saved_ignore_rules(self.data_dir, version)
+            if rules is None:
+                log.warning(u"Ignore rules version %s not found in %s", version, self.data_dir)
+                rules = NO_IGNORE_RULES
+            self.versions[version] = rules
+        return self.versions[version]
+
+
+class Report(object):
+    """
+    An HTML report of the latest pa11y result for each page in a data
+    directory: a detail page for each result, an index of the pages, and a
+    page of the unique violations of each type, along with a page of how the
+    last `performance_runs` crawls performed.
+
+    Results are added one at a time, and replace the earlier result for the
+    same page, so the report can be kept up to date while crawling. Each
+    result's detail page is rendered as soon as it's added; the index and
+    unique violations pages are rendered by `write()`.
+
+    If `ignore_rules` (an `IgnoreRules` instance) is given, it is applied to
+    every result. Otherwise, each result is filtered with the ignore rules
+    that were in use when it was crawled, and the index is made from the
+    counts in the manifest.
+
+    The report's CSS and JavaScript are copied into its `assets` directory
+    when it's made. If `compress` is True, every file is written with gzip
+    and brotli compressed copies next to it.
+    """
+    def __init__(self, data_dir, output_dir, ignore_rules=None,
+                 performance_runs=DEFAULT_PERFORMANCE_RUNS, compress=True):
+        # jinja2 is only imported here, since pa11ycrawler-diff uses this module
+        from jinja2 import Environment, PackageLoader
+        self.env = Environment(loader=PackageLoader('pa11ycrawler', 'templates'))
+        self.env.globals["wcag_refs"] = wcag_refs
+        self.env.globals["sparkline"] = sparkline
+        self.env.globals["format_duration"] = format_duration
+        self.env.globals["asset"] = write_assets(output_dir, compress=compress).__getitem__
+        self.data_dir = data_dir
+        self.output_dir = output_dir
+        self.ignore_rules = ignore_rules
+        self.performance_runs = performance_runs
+        self.compress = compress
+        self.recorded_rules = RecordedIgnoreRules(data_dir)
+        self.store = ViolationStore(data_dir)
+        # the index entry of each page, and the groups of its violations,
+        # keyed by normalized URL; only the violations are kept, not the
+        # rest of every page's data
+        self.pages = collections.OrderedDict()
+        self.page_groups = {}
+        self.grouped_violations = collections.defaultdict(dict)
+        self.counter = collections.Counter()
+        # whether a result was added since the last `write()`
+        self.changed = False
 
-    # render detail templates
-    for data_file in data_dir.files('*.json'):
-        data = json.load(data_file.open())
+    def add(self, entry, render=True):
+        """
+        Add the result listed by a manifest entry, unless there is a newer
+        result for the same page already. If `render` is False, its detail
+        page is only rendered if it doesn't exist yet.
+        """
+        url = normalize_url(entry["url"])
+        previous = self.pages.get(url)
+        if previous is not None and previous["accessed_at"] > entry["accessed_at"]:
+            return
+        data_file = self.data_dir / entry["filename"]
+        data = load_result(data_file, self.store)
+        rules = self.ignore_rules
+        if rules is None:
+            rules = self.recorded_rules.for_result(data)
+        data['pa11y'] = rules.filter(data['pa11y'], data['url'])
         num_error, num_warning, num_notice = pa11y_counts(data['pa11y'])
 
         data["num_error"] = num_error
         data["num_warning"] = num_warning
         data["num_notice"] = num_notice
         fname = data_file.namebase + ".html"
-        html_path = output_dir / fname
-        render_template(env, html_path, 'detail.html', data)
-
-        data["filename"] = fname
-        pages.append(data)
-
-        for violation in data['pa11y']:
-            violation_id = hashlib.md5(
-                (violation['selector'] + violation['code']).encode('utf-8')
-            ).hexdigest()
-
-            if violation_id not in grouped_violations[violation['type']]:
-                violation['pages'] = []
-                grouped_violations[violation['type']][violation_id] = violation
-                counter[violation['type']] += 1
-
-            grouped_violations[violation['type']][violation_id]['pages'].append({
-                'url': data['url'],
-                'page_title': data['page_title']
-            })
-
-    def extract_nums(page):
-        "Used to sort pages by violation counts"
-        return (
-            page["num_error"],
-            page["num_warning"],
-            page["num_notice"],
-        )
-
-    index_path = output_dir / INDEX_TEMPLATE
-    render_template(env, index_path, INDEX_TEMPLATE, {
-        "pages": sorted(pages, key=extract_nums, reverse=True),
-        "num_error": counter["error"],
-        "num_warning": counter["warning"],
-        "num_notice": counter["notice"]
-    })
-
-    for violation_type in grouped_violations:
-        unique_path = output_dir / u'{}s.html'.format(violation_type)
-        render_template(env, unique_path, UNIQUE_TEMPLATE, {
-            "grouped_violations": sorted(
-                grouped_violations[violation_type].values(),
-                key=lambda item: len(item['pages']),
-                reverse=True
-            ),
-            "current_type": violation_type,
-            "violation_counts": counter
-        })
+        html_path = self.output_dir / fname
+        if render or not html_path.exists():
+            render_template(self.env, html_path, DETAIL_TEMPLATE, data, compress=self.compress)
+
+        page = entry
+        if self.ignore_rules is not None or entry["num_error"] is None:
+            page = dict(entry, num_error=num_error, num_warning=num_warning,
+                        num_notice=num_notice)
+        self.remove(url)
+        self.pages[url] = dict(page, filename=fname)
+        self.page_groups[url] = group_page(self.grouped_violations, self.counter, data)
+        self.changed = True
+
+    def add_manifest(self, render=True):
+        "Add the latest result for each page in the data directory's manifest."
+        for entry in latest_entries(load_manifest(self.data_dir)):
+            self.add(entry, render=render)
+
+    def remove(self, url):
+        "Remove the result for a page (by normalized URL), if there is one."
+        page = self.pages.pop(url, None)
+        if page is None:
+            return
+        for violation_type, group_id in set(self.page_groups.pop(url)):
+            groups = self.grouped_violations[violation_type]
+            group = groups[group_id]
+            group['pages'] = [other for other in group['pages'] if other['url'] != page['url']]
+            if not group['pages']:
+                del groups[group_id]
+                self.counter[violation_type] -= 1
+        self.changed = True
+
+    def write(self):
+        """
+        Render the index, the unique violations page of each type, and the
+        performance page.
+        """
+        def extract_nums(page):
+            "Used to sort pages by violation counts"
+            return (
+                page["num_error"],
+                page["num_warning"],
+                page["num_notice"],
+            )
+
+        index_path = self.output_dir / INDEX_TEMPLATE
+        render_template(self.env, index_path, INDEX_TEMPLATE, {
+            "pages": sorted(self.pages.values(), key=extract_nums, reverse=True),
+            "num_error": self.counter["error"],
+            "num_warning": self.counter["warning"],
+            "num_notice": self.counter["notice"]
+        }, compress=self.compress)
+
+        for violation_type in self.grouped_violations:
+            unique_path = self.output_dir / u'{}s.html'.format(violation_type)
+            render_template(self.env, unique_path, UNIQUE_TEMPLATE, {
+                "grouped_violations": sorted(
+                    self.grouped_violations[violation_type].values(),
+                    key=lambda item: len(item['pages']),
+                    reverse=True
+                ),
+                "current_type": violation_type,
+                "violation_counts": self.counter
+            }, compress=self.compress)
+        self.write_performance()
+        self.changed = False
+
+    def write_performance(self):
+        "Render the performance page, from the stats of the recent runs."
+        performance_path = self.output_dir / PERFORMANCE_TEMPLATE
+        render_template(self.env, performance_path, PERFORMANCE_TEMPLATE, {
+            "runs": load_runs(self.data_dir, limit=self.performance_runs),
+        }, compress=self.compress)
+
+
+def render_html(data_dir, output_dir, ignore_rules=None,
+                performance_runs=DEFAULT_PERFORMANCE_RUNS, compress=True):
+    """
+    The main workhorse of this script. Finds the latest JSON data file
+    from pa11ycrawler for each page, using the data directory's manifest,
+    and transforms them into HTML files via Jinja2 templating. See `Report`
+    for how the other arguments are used.
+    """
+    report = Report(data_dir, output_dir, ignore_rules=ignore_rules,
+                    performance_runs=performance_runs, compress=compress)
+    report.add_manifest()
+    report.write()
 
 
 if __name__ == "__main__":
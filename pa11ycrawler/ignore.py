@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+"""
+Loading and matching pa11y ignore rules.
+
+Ignore rules are a mapping of URL globs to lists of rules. Each rule is a
+mapping of pa11y result attributes to globs, and it matches a result if
+*all* of its attributes match.
+"""
+import re
+import json
+import fnmatch
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from path import Path
+
+from pa11ycrawler.util import write_atomic
+
+log = logging.getLogger(__name__)
+
+IGNORE_RULES_DIRNAME = "ignore-rules"
+# how long to wait for the server that serves the ignore rules, in seconds
+DEFAULT_FETCH_TIMEOUT = 30
+# how many URLs to remember the relevant rules of. A crawl audits each page
+# once, so this only needs to cover the pages that are being audited at
+# the same time, and reports that filter the same URL several times.
+DEFAULT_URL_CACHE_SIZE = 10000
+
+
+def fetch_pa11y_ignore_rules(url, cache_dir=None, timeout=DEFAULT_FETCH_TIMEOUT):
+    """
+    Fetch the pa11y ignore rules from the given URL. If a `cache_dir` is
+    given, the last rules that were fetched from the URL are kept there,
+    along with their ETag and Last-Modified headers, so that they are only
+    downloaded again if they changed. If the URL can't be fetched, or
+    doesn't return valid YAML, the cached rules are used instead.
+    """
+    # yaml and requests take a while to import, and most crawls and
+    # reports don't fetch rules from a URL
+    import yaml
+    import requests
+    text_path = meta_path = None
+    is_cached = False
+    headers = {}
+    if cache_dir:
+        key = hashlib.sha1(url.encode('utf8')).hexdigest()[:16]
+        text_path = Path(cache_dir).expand() / key + ".yaml"
+        meta_path = Path(cache_dir).expand() / key + ".json"
+        is_cached = text_path.isfile() and meta_path.isfile()
+    if is_cached:
+        meta = json.loads(meta_path.text())
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    def cached(reason):
+        "The cached rules, if there are any; otherwise, raise `reason`."
+        if not is_cached:
+            raise reason
+        log.warning(u"Using the cached pa11y ignore rules for %s: %s", url, reason)
+        return yaml.safe_load(text_path.text())
+
+    try:
+        resp = requests.get(url, headers=headers, timeout=timeout)
+    except requests.RequestException as err:
+        return cached(err)
+    if resp.status_code == 304 and is_cached:
+        return yaml.safe_load(text_path.text())
+    if not resp.ok:
+        msg = (
+            u"pa11y_ignore_rules_url specified, but failed to fetch URL. status={status}"
+        ).format(status=resp.status_code)
+        err = RuntimeError(msg)
+        err.response = resp
+        return cached(err)
+    try:
+        rules = yaml.safe_load(resp.text)
+    except yaml.YAMLError as err:
+        return cached(err)
+    if cache_dir:
+        # the rules are written before the headers, so the headers never
+        # describe rules that weren't cached
+        write_atomic(text_path, resp.text)
+        write_atomic(meta_path, json.dumps({
+            "url": url,
+            "etag": resp.headers.get("ETag"),
+            "last_modified": resp.headers.get("Last-Modified"),
+        }))
+    return rules
+
+
+def load_pa11y_ignore_rules(file=None, url=None, cache_dir=None,  # pylint: disable=redefined-builtin
+                            timeout=DEFAULT_FETCH_TIMEOUT):
+    """
+    Load the pa11y ignore rules from the given file or URL. Rules from a
+    URL are fetched with `fetch_pa11y_ignore_rules`.
+    """
+    if not file and not url:
+        return None
+
+    if file:
+        file = Path(file)
+        if not file.isfile():
+            msg = (
+                u"pa11y_ignore_rules_file specified, but file does not exist! {file}"
+            ).format(file=file)
+            raise ValueError(msg)
+        import yaml
+        return yaml.safe_load(file.text())
+
+    # must be URL
+    return fetch_pa11y_ignore_rules(url, cache_dir=cache_dir, timeout=timeout)
+
+
+class IgnoreRulesSource(object):
+    """
+    The pa11y ignore rules from a file or URL. Rules from a file are loaded
+    right away, so a missing or broken file is an error before the crawl
+    starts. Rules from a URL are fetched in a background thread once
+    `start()` is called, so that a slow server doesn't hold up the start of
+    a crawl, and `rules` waits for them. They can be loaded again with
+    `reload()` during a long crawl: new rules replace the old ones in a
+    single assignment, so a page is always audited with one rule set or
+    the other.
+    """
+    def __init__(self, file=None, url=None, cache_dir=None,  # pylint: disable=redefined-builtin
+                 timeout=DEFAULT_FETCH_TIMEOUT):
+        self.file = file
+        self.url = url
+        self.cache_dir = cache_dir
+        self.timeout = timeout
+        self._rules = None
+        self._error = None
+        self._loaded = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        if file:
+            self._rules = self.load()
+            self._loaded.set()
+        elif not url:
+            self._loaded.set()
+
+    def load(self):
+        "Load the rules, in the calling thread."
+        return load_pa11y_ignore_rules(
+            file=self.file, url=self.url, cache_dir=self.cache_dir, timeout=self.timeout,
+        )
+
+    def _load_first(self):
+        "Load the rules for the first time, keeping any error for `rules`."
+        try:
+            self._rules = self.load()
+        except Exception as err:  # pylint: disable=broad-except
+            self._error = err
+        finally:
+            self._loaded.set()
+
+    def start(self):
+        "Start loading the rules in a background thread, if they aren't loaded."
+        with self._lock:
+            if self._thread is not None or self._loaded.is_set():
+                return
+            self._thread = threading.Thread(target=self._load_first, name="ignore-rules")
+            self._thread.daemon = True
+            self._thread.start()
+
+    @property
+    def rules(self):
+        """
+        The ignore rules, waiting for them to be loaded if they aren't yet.
+        If they couldn't be loaded, the error is raised.
+        """
+        if not self._loaded.is_set():
+            self.start()
+            self._loaded.wait()
+        if self._error is not None:
+            raise self._error
+        return self._rules
+
+    def reload(self):
+        """
+        Load the rules again, and use them from now on if they changed.
+        If they can't be loaded, the current rules are kept. Returns
+        whether the rules changed.
+        """
+        try:
+            rules = self.load()
+        except Exception as err:  # pylint: disable=broad-except
+            log.warning(u"Couldn't reload the pa11y ignore rules: %s", err)
+            return False
+        if self._loaded.is_set() and self._error is None and (
+                ignore_rules_version(rules) == ignore_rules_version(self._rules)):
+            return False
+        self._rules = rules
+        self._error = None
+        self._loaded.set()
+        return True
+
+
+def ignore_rules_version(rules):
+    """
+    Returns a short, stable identifier for a set of ignore rules, or None
+    if there are no rules.
+    """
+    if not rules:
+        return None
+    canonical = json.dumps(rules, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(canonical.encode('utf8')).hexdigest()[:12]
+
+
+def compile_glob(glob):
+    "Compile a glob into a function that checks if a string matches it."
+    return re.compile(fnmatch.translate(glob)).match
+
+
+class IgnoreRules(object):
+    """
+    A compiled set of ignore rules. The globs are compiled once, and the
+    rules that apply to each URL are cached, so that filtering a large
+    number of results is fast. Only the `url_cache_size` most recently used
+    URLs are remembered.
+    """
+    def __init__(self, rules=None, url_cache_size=DEFAULT_URL_CACHE_SIZE):
+        self.rules = rules or {}
+        self.version = ignore_rules_version(self.rules)
+        self._compiled = [
+            (
+                compile_glob(url_glob),
+                [
+                    [(attr, compile_glob(u"{}".format(value)))
+                     for attr, value in rule.items()]
+                    for rule in (rule_list or [])
+                ],
+            )
+            for url_glob, rule_list in self.rules.items()
+        ]
+        # URL => the compiled rules that apply to it, least recently used
+        # first
+        self._url_cache = OrderedDict()
+        self.url_cache_size = url_cache_size
+        self._saved_to = set()
+
+    def __bool__(self):
+        return bool(self._compiled)
+
+    __nonzero__ = __bool__  # Python 2
+
+    def rules_for_url(self, url):
+        """
+        Returns the compiled rules that are relevant to the given URL.
+        """
+        rules = self._url_cache.pop(url, None)
+        if rules is None:
+            rules = [
+                rule
+                for url_match, rule_list in self._compiled
+                if url_match(url)
+                for rule in rule_list
+            ]
+        self._url_cache[url] = rules
+        while len(self._url_cache) > self.url_cache_size:
+            self._url_cache.popitem(last=False)
+        return rules
+
+    def clear_cache(self):
+        "Forget the rules that apply to each URL."
+        self._url_cache.clear()
+
+    @staticmethod
+    def rule_matches(rule, result):
+        "Does this compiled rule match this pa11y result?"
+        for attr, match in rule:
+            value = result.get(attr)
+            if value is None or not match(u"{}".format(value)):
+                return False
+        return True
+
+    def is_ignored(self, result, url):
+        "Should this pa11y result for this URL be ignored?"
+        return any(
+            self.rule_matches(rule, result)
+            for rule in self.rules_for_url(url)
+        )
+
+    def filter(self, results, url):
+        """
+        Returns the given pa11y results for the given URL, without the
+        ones that should be ignored.
+        """
+        rules = self.rules_for_url(url)
+        if not rules:
+            return results
+        return [
+            result for result in results
+            if not any(self.rule_matches(rule, result) for rule in rules)
+        ]
+
+    def save(self, data_dir):
+        """
+        Save this rule set into the data directory, named after its version,
+        so that reports can re-apply it later.
+        """
+        if not self.version or data_dir in self._saved_to:
+            return
+        rules_dir = Path(data_dir) / IGNORE_RULES_DIRNAME
+        path = rules_dir / self.version + ".json"
+        if not path.isfile():
+            rules_dir.makedirs_p()
+            path.write_text(json.dumps(self.rules, sort_keys=True))
+        self._saved_to.add(data_dir)
+
+
+def load_saved_ignore_rules(data_dir, version):
+    """
+    Load a rule set that was saved into the data directory by
+    `IgnoreRules.save()`. Returns None if it can't be found.
+    """
+    path = Path(data_dir) / IGNORE_RULES_DIRNAME / version + ".json"
+    if not path.isfile():
+        return None
+    return IgnoreRules(json.loads(path.text()))
+
+
+NO_IGNORE_RULES = IgnoreRules()
+_LAST_COMPILED = [None, NO_IGNORE_RULES]
+
+
+def compile_ignore_rules(rules):
+    """
+    Returns the compiled form of the given ignore rules. The most recently
+    compiled rule set is cached by identity, since the same rules object is
+    used for every page in a crawl. When the rules are swapped (like when
+    they're reloaded), the URL cache of the old rule set is cleared.
+    """
+    if not rules:
+        return NO_IGNORE_RULES
+    last_rules, last_compiled = _LAST_COMPILED
+    if last_rules is not rules:
+        last_compiled.clear_cache()
+        last_compiled = IgnoreRules(rules)
+        _LAST_COMPILED[:] = [rules, last_compiled]
+    return last_compiled
@@ -17,3 +17,12 @@ class A11yItem(Item):
     request_headers = Field()
     accessed_at = Field()
     page_title = Field()
+    # digest of the page body in the snapshot store, if snapshots are enabled
+    snapshot = Field()
+    # the URL that pa11y should audit, if it isn't `url` itself -- for
+    # example, when replaying a snapshot from a loopback server.
+    # It is not written to the results.
+    audit_url = Field()
+    # the manifest entry of the pa11y result, once the Pa11yPipeline has
+    # written it, for the pipelines after it. It is not written to the results.
+    result = Field()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Link extractors that know about the layout of Open edX pages.
+See: http://doc.scrapy.org/en/latest/topics/link-extractors.html
+"""
+import re
+import time
+import hashlib
+from collections import OrderedDict
+from scrapy.linkextractors import LinkExtractor
+from scrapy.utils.python import unique as unique_list
+from scrapy.utils.response import get_base_url
+
+# The parts of a page that hold its own content. Links are always extracted
+# from these regions.
+DEFAULT_CONTENT_REGIONS = [
+    "#course-content",
+    ".sequence-nav",
+    "main",
+]
+
+# The parts of a page that are shared between many pages, like the site
+# header and footer. Links are only extracted from these regions the first
+# time that a region with the same HTML is seen.
+DEFAULT_CHROME_REGIONS = [
+    "header",
+    "footer",
+    "nav",
+]
+
+# How many distinct chrome regions to remember. Chrome that changes from
+# page to page (like a nav with the current page highlighted) would otherwise
+# make the cache grow for the whole crawl.
+DEFAULT_CHROME_CACHE_SIZE = 1000
+
+
+def combine_patterns(patterns):
+    """
+    Compile a list of regular expressions into a single regular expression
+    that matches anything that any of them would match, so that each URL is
+    only scanned once.
+    """
+    return re.compile("|".join(
+        u"(?:{pattern})".format(pattern=pattern) for pattern in patterns
+    ))
+
+
+class RegionLinkExtractor(LinkExtractor):
+    """
+    A link extractor that only looks at the regions of a page where new
+    links are likely to be found. Links are extracted from the page's content
+    regions every time, and from its chrome regions only if that chrome
+    hasn't been seen before. If a page has no content regions at all, links
+    are extracted from the whole page, like a regular link extractor.
+
+    Only the `chrome_cache_size` most recently seen chrome regions are
+    remembered; chrome that was forgotten is extracted again.
+
+    The time spent extracting links is recorded in the Scrapy stats
+    collector, if one is available.
+    """
+    def __init__(self, deny=(), content_regions=None, chrome_regions=None,
+                 stats=None, chrome_cache_size=DEFAULT_CHROME_CACHE_SIZE, **kwargs):
+        super(RegionLinkExtractor, self).__init__(
+            deny=[combine_patterns(deny)] if deny else (), **kwargs
+        )
+        if content_regions is None:
+            content_regions = DEFAULT_CONTENT_REGIONS
+        if chrome_regions is None:
+            chrome_regions = DEFAULT_CHROME_REGIONS
+        self.content_regions = list(content_regions)
+        self.chrome_regions = list(chrome_regions)
+        self.stats = stats
+        # hash of a chrome region's HTML => links extracted from it, from
+        # the least to the most recently seen
+        self.chrome_links = OrderedDict()
+        self.chrome_cache_size = chrome_cache_size
+
+    def _links_from(self, doc, response, base_url):
+        links = self._extract_links(doc, response.url, response.encoding, base_url)
+        return self._process_links(links)
+
+    def _region_links(self, response, base_url):
+        """
+        Extract links from the content regions of the page, and from any
+        chrome regions that haven't been seen before. Returns None if the
+        page has no content regions.
+        """
+        content_docs = [
+            doc for selector in self.content_regions
+            for doc in response.css(selector)
+        ]
+        if not content_docs:
+            return None
+
+        links = []
+        for doc in content_docs:
+            links.extend(self._links_from(doc, response, base_url))
+        for selector in self.chrome_regions:
+            for doc in response.css(selector):
+                key = hashlib.md5(doc.extract().encode('utf8')).hexdigest()
+                if key in self.chrome_links:
+                    self._inc_stat("link_extraction/chrome_cache_hits")
+                    # move it to the end, as the most recently seen
+                    self.chrome_links[key] = self.chrome_links.pop(key)
+                    continue
+                chrome_links = self._links_from(doc, response, base_url)
+                self.chrome_links[key] = chrome_links
+                while len(self.chrome_links) > self.chrome_cache_size:
+                    self.chrome_links.popitem(last=False)
+                links.extend(chrome_links)
+        return links
+
+    def _inc_stat(self, key, count=1):
+        if self.stats is not None:
+            self.stats.inc_value(key, count=count)
+
+    def extract_links(self, response):
+        """
+        Returns a list of links from the relevant regions of the response.
+        """
+        start = time.time()
+        base_url = get_base_url(response)
+        links = self._region_links(response, base_url)
+        if links is None:
+            self._inc_stat("link_extraction/whole_page")
+            links = self._links_from(response.selector, response, base_url)
+        links = unique_list(links, key=lambda link: link.url)
+
+        elapsed = time.time() - start
+        self._inc_stat("link_extraction/responses")
+        self._inc_stat("link_extraction/links", count=len(links))
+        self._inc_stat("link_extraction/time", count=elapsed)
+        if self.stats is not None:
+            self.stats.max_value("link_extraction/time_max", elapsed)
+        return links
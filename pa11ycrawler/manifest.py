@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+The manifest of a data directory: an append-only index of the pa11y results
+in it, with one line of JSON per result, holding its URL, when and in which
+run it was crawled, its file name, and how many errors, warnings and notices
+it has (after the ignore rules that were in use when it was crawled).
+
+The manifest lets the report generator pick the latest result for each URL
+without parsing every result file, and lets old results be pruned with
+`pa11ycrawler-compact`.
+"""
+import os
+import json
+import argparse
+import logging
+from datetime import datetime, timedelta
+from path import Path
+
+from pa11ycrawler.util import normalize_url, pa11y_counts, result_files, write_atomic
+from pa11ycrawler.violations import ViolationStore, load_result
+
+log = logging.getLogger(__name__)
+
+MANIFEST_FILENAME = "manifest.jsonl"
+
+
+def make_run_id(started_at=None):
+    "An ID for a crawl that started at the given time (by default, now)."
+    return (started_at or datetime.utcnow()).strftime("%Y%m%dT%H%M%S")
+
+
+def manifest_entry(data, filename, run_id=None, counted_results=None):
+    """
+    The manifest entry for a result, given the data in its file. The
+    counts are of `counted_results` if given, or else of all of its results.
+    """
+    accessed_at = data["accessed_at"]
+    if isinstance(accessed_at, datetime):
+        accessed_at = accessed_at.isoformat()
+    results = data["pa11y"] if counted_results is None else counted_results
+    num_error, num_warning, num_notice = pa11y_counts(results)
+    return {
+        "url": data["url"],
+        "page_title": data.get("page_title"),
+        "accessed_at": accessed_at,
+        "run_id": run_id,
+        "filename": filename,
+        "pa11y_ignore_rules_version": data.get("pa11y_ignore_rules_version"),
+        "num_error": num_error,
+        "num_warning": num_warning,
+        "num_notice": num_notice,
+    }
+
+
+def append_entry(data_dir, entry):
+    """
+    Append an entry to the manifest of a data directory. Each entry is
+    written with a single call, so that concurrent writers don't interleave.
+    """
+    line = json.dumps(entry, sort_keys=True) + "\n"
+    with open(data_dir / MANIFEST_FILENAME, "ab") as manifest:
+        manifest.write(line.encode("utf8"))
+
+
+def read_manifest(data_dir):
+    """
+    The entries in the manifest of a data directory, in the order they were
+    written. A line that can't be parsed (like a line that was cut off when
+    the crawler was killed) is skipped.
+    """
+    path = data_dir / MANIFEST_FILENAME
+    if not path.isfile():
+        return []
+    entries = []
+    with open(path, "rb") as manifest:
+        for number, line in enumerate(manifest, 1):
+            try:
+                entries.append(json.loads(line.decode("utf8")))
+            except ValueError:
+                log.warning(u"Skipping unreadable line %d of %s", number, path)
+    return entries
+
+
+def load_manifest(data_dir):
+    """
+    The manifest entries of every result in a data directory. Results that
+    aren't in the manifest (because they were written before the manifest
+    existed, or copied in by hand) are parsed to make their entries, and
+    entries for results that no longer exist are left out.
+    """
+    files = {path.name: path for path in result_files(data_dir)}
+    entries = [entry for entry in read_manifest(data_dir) if entry["filename"] in files]
+    listed = set(entry["filename"] for entry in entries)
+    unlisted = sorted(name for name in files if name not in listed)
+    if unlisted:
+        log.info(u"%d results in %s aren't in its manifest", len(unlisted), data_dir)
+    store = ViolationStore(data_dir)
+    for name in unlisted:
+        data = load_result(files[name], store)
+        entry = manifest_entry(data, name)
+        if data.get("pa11y_ignore_rules_version") and not data.get("pa11y_filtered"):
+            # counting the results that aren't ignored means loading the
+            # rules; the report generator counts them while rendering
+            for key in ("num_error", "num_warning", "num_notice"):
+                entry[key] = None
+        entries.append(entry)
+    return entries
+
+
+def latest_entries(entries):
+    """
+    Only the latest entry for each page, using the same URL normalization as
+    the DuplicatesPipeline. Returns them in the order they were crawled.
+    """
+    latest = {}
+    for entry in entries:
+        url = normalize_url(entry["url"])
+        previous = latest.get(url)
+        if previous is None or previous["accessed_at"] <= entry["accessed_at"]:
+            latest[url] = entry
+    return sorted(latest.values(), key=lambda entry: entry["accessed_at"])
+
+
+def write_manifest(data_dir, entries):
+    "Replace the manifest of a data directory with the given entries."
+    text = u"".join(json.dumps(entry, sort_keys=True) + u"\n" for entry in entries)
+    write_atomic(data_dir / MANIFEST_FILENAME, text)
+
+
+def runs(entries):
+    """
+    The IDs of the runs that the given entries came from, from the newest
+    to the oldest (by when each run crawled its last page). Entries without
+    a run ID are left out.
+    """
+    finished = {}
+    for entry in entries:
+        run_id = entry.get("run_id")
+        if run_id is not None:
+            finished[run_id] = max(finished.get(run_id, ""), entry["accessed_at"])
+    return sorted(finished, key=finished.get, reverse=True)
+
+
+def compact(data_dir, keep_runs=1, keep_days=None, dry_run=False, now=None):
+    """
+    Delete the results in a data directory that have been superseded by a
+    later result for the same page, unless they are from one of the
+    `keep_runs` most recent runs, or were crawled in the last `keep_days`
+    days. The latest result for each page is always kept. The manifest is
+    rewritten to list only the results that are kept, and the violation
+    store, if there is one, to hold only the violations that they refer to.
+
+    Returns the entries of the results that were deleted (or that would be,
+    if `dry_run` is set).
+    """
+    data_dir = Path(data_dir)
+    entries = load_manifest(data_dir)
+    keep = set(entry["filename"] for entry in latest_entries(entries))
+    recent_runs = set(runs(entries)[:keep_runs]) if keep_runs else set()
+    cutoff = None
+    if keep_days is not None:
+        cutoff = ((now or datetime.utcnow()) - timedelta(days=keep_days)).isoformat()
+    for entry in entries:
+        if entry.get("run_id") is not None and entry["run_id"] in recent_runs:
+            keep.add(entry["filename"])
+        elif cutoff is not None and entry["accessed_at"] >= cutoff:
+            keep.add(entry["filename"])
+
+    pruned = [entry for entry in entries if entry["filename"] not in keep]
+    if dry_run:
+        return pruned
+    # write the manifest first, so that it never lists a deleted result
+    write_manifest(data_dir, [entry for entry in entries if entry["filename"] in keep])
+    for entry in pruned:
+        os.remove(data_dir / entry["filename"])
+    store = ViolationStore(data_dir)
+    if store.path.isfile():
+        removed = store.keep_only(referenced_violations(data_dir))
+        log.info(u"Removed %d violations that no result refers to", removed)
+    return pruned
+
+
+def referenced_violations(data_dir):
+    "The IDs of the violations that the results in a data directory refer to."
+    ids = set()
+    for path in result_files(data_dir):
+        with open(path) as result_file:
+            data = json.load(result_file)
+        ids.update(vid for vid, _ in data.get("pa11y_refs", ()))
+    return ids
+
+
+def make_parser():
+    """
+    Returns an argparse instance for this script.
+    """
+    parser = argparse.ArgumentParser(
+        description="delete superseded pa11y results from a data directory",
+    )
+    parser.add_argument(
+        "--data-dir", default="data",
+        help=u"Directory containing JSON data from crawler [%(default)s]"
+    )
+    parser.add_argument(
+        "--keep-runs", type=int, default=1,
+        help=u"Keep every result from this many of the most recent runs [%(default)s]"
+    )
+    parser.add_argument(
+        "--keep-days", type=float, default=None,
+        help=u"Keep every result crawled in this many days"
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true",
+        help=u"Only list the results that would be deleted"
+    )
+    return parser
+
+
+def main():
+    """
+    Validates script arguments and calls the compact() function with them.
+    """
+    logging.basicConfig(level=logging.INFO)
+    parser = make_parser()
+    args = parser.parse_args()
+    data_dir = Path(args.data_dir).expand()
+    if not data_dir.isdir():  # pylint: disable=no-value-for-parameter
+        msg = u"Data directory {dir} does not exist".format(dir=args.data_dir)
+        raise ValueError(msg)
+    pruned = compact(
+        data_dir, keep_runs=args.keep_runs, keep_days=args.keep_days, dry_run=args.dry_run,
+    )
+    for entry in pruned:
+        log.info(u"%s %s (%s)", entry["filename"], entry["url"], entry["accessed_at"])
+    log.info(
+        u"%s %d superseded results",
+        "Would delete" if args.dry_run else "Deleted", len(pruned),
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+Histograms of how long each stage of a crawl takes, and how deep its queues
+get, with exporters for JSON and for the Prometheus text format.
+
+Stages record their timings through `spider.metrics`, which the
+`StageMetrics` extension sets up. When the extension is disabled (or when
+the pipelines are run outside of Scrapy), `metrics_for(spider)` returns
+`NO_METRICS`, which records nothing.
+"""
+import time
+import json
+import bisect
+import functools
+from contextlib import contextmanager
+
+# seconds, from a fast in-process call up to a pa11y run that times out
+TIME_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1, 2.5, 5, 10, 25, 60, 120,
+)
+# number of requests or items waiting in a queue
+DEPTH_BUCKETS = (
+    0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000,
+)
+PERCENTILES = (50, 95, 99)
+
+
+class Histogram(object):
+    """
+    Counts observations into fixed buckets, like a Prometheus histogram, so
+    that it uses the same amount of memory no matter how many observations
+    it gets. Percentiles are estimated by interpolating within a bucket.
+    """
+    def __init__(self, buckets=TIME_BUCKETS):
+        self.buckets = tuple(buckets)
+        # the last count is for observations above the largest bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        "Record an observation."
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, pct):
+        """
+        Estimate the given percentile of the observations, or return None
+        if there haven't been any.
+        """
+        if not self.count:
+            return None
+        rank = self.count * pct / 100.0
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if not count or seen + count < rank:
+                seen += count
+                continue
+            lower = self.buckets[index - 1] if index else self.min
+            upper = self.buckets[index] if index < len(self.buckets) else self.max
+            lower = max(lower, self.min)
+            upper = min(upper, self.max)
+            return lower + (upper - lower) * (rank - seen) / count
+        return self.max
+
+    def summary(self):
+        "The count, sum, extremes and percentiles of the observations."
+        summary = {
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min,
+            "max": self.max,
+        }
+        for pct in PERCENTILES:
+            summary["p{}".format(pct)] = self.percentile(pct)
+        return summary
+
+    def to_dict(self):
+        "The buckets and counts of the histogram, suitable for JSON."
+        return {
+            "buckets": list(self.buckets),
+            "counts": list(self.counts),
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min,
+            "max": self.max,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        "Rebuild a histogram from `to_dict()`."
+        histogram = cls(data["buckets"])
+        histogram.counts = list(data["counts"])
+        histogram.count = data["count"]
+        histogram.sum = data["sum"]
+        histogram.min = data["min"]
+        histogram.max = data["max"]
+        return histogram
+
+    def merge(self, other):
+        "Add the observations of another histogram with the same buckets."
+        if tuple(other.buckets) != self.buckets:
+            raise ValueError(u"Can't merge histograms with different buckets")
+        self.counts = [mine + theirs for mine, theirs in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+        for value in (other.min, other.max):
+            if value is None:
+                continue
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def cumulative_counts(self):
+        """
+        Yields `(upper bound, count)` pairs, where the count includes every
+        observation up to that bound, ending with `("+Inf", total)`.
+        """
+        running = 0
+        for bound, count in zip(self.buckets, self.counts):
+            running += count
+            yield bound, running
+        yield "+Inf", self.count
+
+
+class Metrics(object):
+    """
+    A set of named histograms: stage timings in seconds, and queue depths.
+    """
+    def __init__(self):
+        self.stages = {}
+        self.depths = {}
+
+    def __bool__(self):
+        return True
+
+    __nonzero__ = __bool__  # Python 2
+
+    def observe(self, stage, seconds):
+        "Record how long one run of the given stage took."
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            histogram = self.stages[stage] = Histogram(TIME_BUCKETS)
+        histogram.observe(seconds)
+
+    def observe_depth(self, queue, depth):
+        "Record how many entries were waiting in the given queue."
+        histogram = self.depths.get(queue)
+        if histogram is None:
+            histogram = self.depths[queue] = Histogram(DEPTH_BUCKETS)
+        histogram.observe(depth)
+
+    @contextmanager
+    def timer(self, stage):
+        "Time the body of a `with` statement as a run of the given stage."
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.time() - start)
+
+    def summary(self):
+        "A summary of every histogram, suitable for JSON."
+        return {
+            "stages": {name: hist.summary() for name, hist in self.stages.items()},
+            "queues": {name: hist.summary() for name, hist in self.depths.items()},
+        }
+
+    def to_json(self, stats=None):
+        "The summary of every histogram, and the given stats, as JSON."
+        data = self.summary()
+        if stats is not None:
+            data["stats"] = numeric_stats(stats)
+        return json.dumps(data, indent=2, sort_keys=True)
+
+    def to_prometheus(self, stats=None, prefix="pa11ycrawler"):
+        """
+        Every histogram, and the given stats, in the Prometheus text
+        exposition format, for the node exporter's textfile collector.
+        """
+        lines = []
+        for metric, label, histograms in (
+                ("stage_seconds", "stage", self.stages),
+                ("queue_depth", "queue", self.depths)):
+            if not histograms:
+                continue
+            name = u"{}_{}".format(prefix, metric)
+            lines.append(u"# TYPE {} histogram".format(name))
+            for key in sorted(histograms):
+                histogram = histograms[key]
+                for bound, count in histogram.cumulative_counts():
+                    lines.append(u'{}_bucket{{{}="{}",le="{}"}} {}'.format(
+                        name, label, key, bound, count,
+                    ))
+                lines.append(u'{}_sum{{{}="{}"}} {}'.format(name, label, key, histogram.sum))
+                lines.append(u'{}_count{{{}="{}"}} {}'.format(name, label, key, histogram.count))
+        if stats is not None:
+            name = u"{}_stat".format(prefix)
+            lines.append(u"# TYPE {} gauge".format(name))
+            for key, value in sorted(numeric_stats(stats).items()):
+                key = key.replace("\\", "\\\\").replace('"', '\\"')
+                lines.append(u'{}{{name="{}"}} {}'.format(name, key, value))
+        return u"\n".join(lines) + u"\n"
+
+
+class NullMetrics(Metrics):
+    "Metrics that record nothing, for when instrumentation is disabled."
+    def __bool__(self):
+        return False
+
+    __nonzero__ = __bool__  # Python 2
+
+    def observe(self, stage, seconds):
+        pass
+
+    def observe_depth(self, queue, depth):
+        pass
+
+
+NO_METRICS = NullMetrics()
+
+
+def metrics_for(spider):
+    "The metrics that the given spider is recording, if any."
+    metrics = getattr(spider, "metrics", None)
+    if not isinstance(metrics, Metrics):
+        return NO_METRICS
+    return metrics
+
+
+def numeric_stats(stats):
+    "The stats that have numeric values."
+    return {
+        key: value for key, value in stats.items()
+        if isinstance(value, (int, float)) and not isinstance(value, bool)
+    }
+
+
+def timed_stage(stage):
+    """
+    Decorates an item pipeline's `process_item(self, item, spider)` method,
+    recording how long each call takes as a run of the given stage.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, item, spider):
+            metrics = metrics_for(spider)
+            if not metrics:
+                return func(self, item, spider)
+            with metrics.timer(stage):
+                return func(self, item, spider)
+        return wrapper
+    return decorator
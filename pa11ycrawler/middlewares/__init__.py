@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+"""
+Downloader middlewares. Middlewares are enabled via the
+DOWNLOADER_MIDDLEWARES setting.
+See: http://doc.scrapy.org/en/latest/topics/downloader-middleware.html
+"""
+from .content import ContentTypeFilterMiddleware
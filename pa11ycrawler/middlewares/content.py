@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+Contains the ContentTypeFilterMiddleware, and all supporting functions.
+"""
+import numbers
+import logging
+import collections
+from urlobject import URLObject
+
+from scrapy import signals
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from scrapy.linkextractors import IGNORED_EXTENSIONS
+from pa11ycrawler.util import url_template
+
+try:
+    from scrapy.exceptions import StopDownload
+except ImportError:  # Scrapy < 2.2
+    StopDownload = None
+
+log = logging.getLogger(__name__)
+
+# Extensions that Open edX uses for course content that isn't a web page,
+# on top of the ones that Scrapy's link extractors already ignore.
+EXTRA_IGNORED_EXTENSIONS = ['srt', 'sjson', 'vtt', 'tgz', 'gz', 'csv', 'txt']
+
+
+def url_extension(url):
+    """
+    Returns the lowercased file extension of the last path segment of
+    the given URL, or an empty string if it doesn't have one. Handles
+    double extensions like `.tar.gz`.
+    """
+    segments = URLObject(url).path.segments
+    if not segments:
+        return ""
+    name = segments[-1].lower()
+    if name.endswith(".tar.gz"):
+        return "tar.gz"
+    _, dot, ext = name.rpartition(".")
+    return ext if dot else ""
+
+
+def media_type(headers):
+    """
+    Returns the media type from the Content-Type header, without any
+    parameters, or None if there is no Content-Type header.
+    """
+    content_type = headers.get("Content-Type")
+    if not content_type:
+        return None
+    return content_type.decode('ascii', 'replace').split(";")[0].strip().lower()
+
+
+class ContentTypeFilterMiddleware(object):
+    """
+    A downloader middleware that skips responses that aren't web pages,
+    since pa11y can't audit them. Requests are skipped before they are sent
+    if their URL has a known non-HTML file extension, or if every previous
+    response for the same URL template was non-HTML. Optionally, a HEAD
+    request is sent first for URL templates that haven't been seen yet.
+    Otherwise, the download is stopped as soon as a non-HTML Content-Type
+    header arrives, so that the body is never transferred. Downloads larger
+    than CONTENT_FILTER_MAX_BODY_SIZE bytes are stopped as well, as soon as
+    the Content-Length header or the bytes received so far show it, and
+    skipped like any other page that can't be audited (rather than failing
+    like Scrapy's DOWNLOAD_MAXSIZE, which logs an error).
+
+    Requests with `dont_filter_content` set in their meta (like the spider's
+    own requests to the login and course blocks APIs) are left alone.
+    """
+    def __init__(self, stats, allowed_types, deny_extensions,
+                 head_probes=False, cache_threshold=3, max_body_size=0):
+        self.stats = stats
+        self.allowed_types = set(allowed_types)
+        self.deny_extensions = set(ext.lower() for ext in deny_extensions)
+        self.head_probes = head_probes
+        self.cache_threshold = cache_threshold
+        self.max_body_size = max_body_size
+        # URL template => counter of "html" and "other" responses
+        self.template_types = collections.defaultdict(collections.Counter)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        "Build the middleware from the CONTENT_FILTER_* settings."
+        settings = crawler.settings
+        if not settings.getbool("CONTENT_FILTER_ENABLED", True):
+            raise NotConfigured("CONTENT_FILTER_ENABLED is off")
+        deny_extensions = settings.getlist("CONTENT_FILTER_DENY_EXTENSIONS")
+        if not deny_extensions:
+            deny_extensions = IGNORED_EXTENSIONS + EXTRA_IGNORED_EXTENSIONS
+        middleware = cls(
+            stats=crawler.stats,
+            allowed_types=settings.getlist(
+                "CONTENT_FILTER_ALLOWED_TYPES",
+                ["text/html", "application/xhtml+xml"],
+            ),
+            deny_extensions=deny_extensions,
+            head_probes=settings.getbool("CONTENT_FILTER_HEAD_PROBES", False),
+            cache_threshold=settings.getint("CONTENT_FILTER_CACHE_THRESHOLD", 3),
+            max_body_size=settings.getint("CONTENT_FILTER_MAX_BODY_SIZE", 0),
+        )
+        if hasattr(signals, "headers_received") and StopDownload:
+            crawler.signals.connect(
+                middleware.headers_received, signal=signals.headers_received,
+            )
+            crawler.signals.connect(
+                middleware.bytes_received, signal=signals.bytes_received,
+            )
+        return middleware
+
+    def skip(self, request, reason, num_bytes=0):
+        "Record that a request was skipped, and stop processing it."
+        self.stats.inc_value("content_filter/skipped_requests")
+        self.stats.inc_value(u"content_filter/skipped/{}".format(reason))
+        if num_bytes:
+            self.stats.inc_value("content_filter/skipped_bytes", count=num_bytes)
+        raise IgnoreRequest(
+            u"Skipping non-HTML url {url} ({reason})".format(
+                url=request.url, reason=reason,
+            )
+        )
+
+    def is_allowed(self, mtype):
+        "Can pa11y audit a response with the given media type?"
+        return mtype is None or mtype in self.allowed_types
+
+    def known_non_html(self, template):
+        """
+        Returns True if enough responses for this URL template have been
+        seen to be confident that it never returns HTML.
+        """
+        counts = self.template_types.get(template)
+        return bool(
+            counts and not counts["html"] and
+            counts["other"] >= self.cache_threshold
+        )
+
+    def record(self, url, mtype):
+        "Remember what kind of content this URL returned."
+        kind = "html" if self.is_allowed(mtype) else "other"
+        self.template_types[url_template(url)][kind] += 1
+
+    def process_request(self, request, spider):  # pylint: disable=unused-argument
+        """
+        Skip requests that are known to be non-HTML, and send a HEAD request
+        first for requests that might be.
+        """
+        if request.meta.get("dont_filter_content"):
+            return None
+        if request.meta.get("content_probe"):
+            return None
+
+        if url_extension(request.url) in self.deny_extensions:
+            self.skip(request, "extension")
+        template = url_template(request.url)
+        if self.known_non_html(template):
+            self.skip(request, "cache")
+
+        probe_needed = (
+            self.head_probes and
+            request.method == "GET" and
+            not request.meta.get("content_probed") and
+            template not in self.template_types
+        )
+        if probe_needed:
+            self.stats.inc_value("content_filter/probes")
+            meta = dict(request.meta, content_probe=request, frontier_local=True)
+            return request.replace(method="HEAD", meta=meta, dont_filter=True)
+        return None
+
+    def headers_received(self, headers, body_length, request, spider):  # pylint: disable=unused-argument
+        """
+        Stop the download as soon as a non-HTML Content-Type header arrives,
+        or as soon as the Content-Length header shows that the body is too
+        large. The (empty) response is still passed on to `process_response`,
+        which will skip it.
+        """
+        if request.meta.get("dont_filter_content") or request.method == "HEAD":
+            return
+        # without a Content-Length header, the length is Twisted's
+        # UNKNOWN_LENGTH, and `bytes_received` has to count the body instead
+        if not isinstance(body_length, numbers.Integral):
+            body_length = None
+        if not self.is_allowed(media_type(headers)):
+            reason = "content_type"
+        elif self.max_body_size and body_length is not None and body_length > self.max_body_size:
+            reason = "too_large"
+        else:
+            return
+        self.stop(request, reason, body_length)
+
+    def bytes_received(self, data, request, spider):  # pylint: disable=unused-argument
+        """
+        Stop the download once more than CONTENT_FILTER_MAX_BODY_SIZE bytes
+        of the body have arrived, for responses that didn't say how large
+        they are.
+        """
+        if not self.max_body_size or request.meta.get("dont_filter_content"):
+            return
+        received = request.meta.get("content_filter_received", 0) + len(data)
+        request.meta["content_filter_received"] = received
+        if received > self.max_body_size:
+            # how much more there was to download isn't known
+            self.stop(request, "too_large", None)
+
+    def stop(self, request, reason, expected_size):
+        """
+        Stop a download of a body of `expected_size` bytes (or None, if it
+        isn't known). The response so far is still passed on to
+        `process_response`, which will skip it.
+        """
+        if reason == "too_large":
+            log.info(
+                u"Not downloading %s: it's larger than %d bytes",
+                request.url, self.max_body_size,
+            )
+        request.meta["content_filter_stopped"] = reason
+        request.meta["content_filter_expected_size"] = expected_size
+        raise StopDownload(fail=False)
+
+    def process_response(self, request, response, spider):  # pylint: disable=unused-argument
+        """
+        Skip responses that aren't HTML, and turn successful HEAD probes
+        back into the GET request that they stand in for.
+        """
+        if request.meta.get("dont_filter_content") or 300 <= response.status < 400:
+            return response
+
+        mtype = media_type(response.headers)
+        if request.meta.get("content_filter_stopped") != "too_large":
+            self.record(response.url, mtype)
+
+        original = request.meta.get("content_probe")
+        if original is not None:
+            if not self.is_allowed(mtype):
+                length = int(response.headers.get("Content-Length") or 0)
+                self.skip(original, "probe", length)
+            meta = dict(original.meta, content_probed=True, frontier_local=True)
+            return original.replace(meta=meta, dont_filter=True)
+
+        stopped = request.meta.get("content_filter_stopped")
+        if stopped is None and not self.is_allowed(mtype):
+            # the whole body was downloaded before we could stop it
+            stopped = "content_type"
+        if stopped:
+            # the size of the body that wasn't downloaded, if it's known
+            expected = request.meta.get("content_filter_expected_size")
+            if not isinstance(expected, numbers.Integral):
+                expected = 0
+            self.skip(request, stopped, expected)
+        return response
@@ -6,14 +6,19 @@ See: http://doc.scrapy.org/en/latest/topics/item-pipeline.html
 from urlobject import URLObject
 from scrapy.exceptions import DropItem
 
+from pa11ycrawler.frontier import frontier_for
+from pa11ycrawler.metrics import timed_stage
+from pa11ycrawler.util import is_sequence_start_page, normalize_url
 from .pa11y import Pa11yPipeline
+from .report import ReportPipeline
 
 
 class DuplicatesPipeline(object):
     """
     Ensures that we only process each URL once. Assume that if two URLs
     differ only by their querystring, they should be treated as the same
-    URL, and only one should be processed.
+    URL, and only one should be processed. When crawling with a shared
+    frontier, each URL is only processed once across every node.
     """
     def __init__(self):
         self.urls_seen = set()
@@ -31,27 +36,24 @@ class DuplicatesPipeline(object):
         This will return the same page as the pattern
         /courses/{coursename}/courseware/{block_id}/{section_id}.
         """
-        return (
-            len(url.path.segments) == 6 and
-            url.path.segments[0] == 'courses' and
-            url.path.segments[2] == 'courseware' and
-            url.path.segments[5] == '1'
-        )
+        return is_sequence_start_page(url)
 
-    def process_item(self, item, spider):  # pylint: disable=unused-argument
+    @timed_stage("pipeline/duplicates")
+    def process_item(self, item, spider):
         """
         Stops processing item if we've already seen this URL before.
         """
-        url = self.clean_url(item["url"])
-
-        if self.is_sequence_start_page(url):
-            url = url.parent
+        url = normalize_url(item["url"])
 
         if url in self.urls_seen:
             raise DropItem(u"Dropping duplicate url {url}".format(url=item["url"]))
-        else:
-            self.urls_seen.add(url)
-            return item
+        self.urls_seen.add(url)
+        frontier = frontier_for(spider)
+        if frontier is not None and not frontier.claim_page(url, item):
+            raise DropItem(u"Dropping url {url}, another node processed it".format(
+                url=item["url"],
+            ))
+        return item
 
 
 class DropDRFPipeline(object):
@@ -59,6 +61,7 @@ class DropDRFPipeline(object):
     Drop pages that are generated from Django Rest Framework (DRF), so that
     they don't get processed by pa11y later in the pipeline.
     """
+    @timed_stage("pipeline/drop_drf")
     def process_item(self, item, spider):  # pylint: disable=unused-argument
         "Check for DRF urls."
         url = URLObject(item["url"])
@@ -4,63 +4,90 @@ Contains the Pa11yPipeline, and all supporting functions.
 """
 import os
 import json
-import fnmatch
+import time
 import subprocess as sp
 import tempfile
 import hashlib
-import itertools
-from lxml import html
+import collections
 from path import Path
+try:
+    from shutil import which
+except ImportError:  # Python 2
+    from distutils.spawn import find_executable as which
 
+from twisted.internet import defer, threads
 from scrapy.exceptions import DropItem, NotConfigured
-from pa11ycrawler.util import DateTimeEncoder, pa11y_counts
+from pa11ycrawler.signals import crawl_cancelled
+from pa11ycrawler.util import DateTimeEncoder, pa11y_counts, write_atomic
+from pa11ycrawler.ignore import compile_ignore_rules
+from pa11ycrawler.manifest import append_entry, make_run_id, manifest_entry
+from pa11ycrawler.metrics import metrics_for
+from pa11ycrawler.violations import ViolationStore
+from pa11ycrawler.supervisor import AuditSupervisor
 
 DEVNULL = open(os.devnull, 'wb')
 
 
-def ignore_rules_for_url(spider, url):
+def executable_key(executable):
     """
-    Returns a list of ignore rules from the given spider,
-    that are relevant to the given URL.
+    Identifies an installed executable by its real path, size and
+    modification time, which change when it's upgraded. Returns None if
+    the executable can't be found.
     """
-    ignore_rules = getattr(spider, "pa11y_ignore_rules", {}) or {}
-    return itertools.chain.from_iterable(
-        rule_list
-        for url_glob, rule_list
-        in ignore_rules.items()
-        if fnmatch.fnmatch(url, url_glob)
-    )
+    found = which(executable)
+    if not found:
+        return None
+    path = os.path.realpath(found)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return u"{path}:{size}:{mtime}".format(path=path, size=stat.st_size, mtime=stat.st_mtime)
 
 
-def ignore_rule_matches_result(ignore_rule, pa11y_result):
+def probe_executable(args, cache_file=None):
     """
-    Returns a boolean result of whether the given ignore rule matches
-    the given pa11y result. The rule only matches the result if *all*
-    attributes of the rule match.
+    Check that an executable works by running it with the given arguments
+    (like `["pa11y", "--version"]`). Raises OSError if it isn't installed.
+
+    If a `cache_file` is given, successful checks are recorded in it, and
+    aren't run again until the executable changes, since starting node or
+    phantomjs takes a noticeable part of a short crawl.
     """
-    return all(
-        fnmatch.fnmatch(pa11y_result.get(attr), ignore_rule.get(attr))
-        for attr in ignore_rule.keys()
-    )
+    key = executable_key(args[0]) if cache_file else None
+    cache = {}
+    if key:
+        cache_file = Path(cache_file).expand()
+        try:
+            cache = json.loads(cache_file.text())
+        except (IOError, OSError, ValueError):
+            cache = {}
+        if cache.get(key) == args[1:]:
+            return
+    sp.check_call(args, stdout=DEVNULL, stderr=DEVNULL)
+    if key:
+        cache[key] = args[1:]
+        write_atomic(cache_file, json.dumps(cache, sort_keys=True))
 
 
-def load_pa11y_results(stdout, spider, url):
+def parse_pa11y_output(stdout):
     """
-    Load output from pa11y, filtering out the ignored messages.
+    Parse the raw output from pa11y, without filtering anything out.
     The `stdout` parameter is a bytestring, not a unicode string.
     """
     if not stdout:
         return []
+    return json.loads(stdout.decode('utf8'))
 
-    results = json.loads(stdout.decode('utf8'))
 
-    ignore_rules = ignore_rules_for_url(spider, url)
-    for rule in ignore_rules:
-        results = [
-            result for result in results
-            if not ignore_rule_matches_result(rule, result)
-        ]
-    return results
+def load_pa11y_results(stdout, spider, url):
+    """
+    Load output from pa11y, filtering out the ignored messages.
+    The `stdout` parameter is a bytestring, not a unicode string.
+    """
+    results = parse_pa11y_output(stdout)
+    ignore_rules = compile_ignore_rules(getattr(spider, "pa11y_ignore_rules", None))
+    return ignore_rules.filter(results, url)
 
 
 def write_pa11y_config(item):
@@ -101,6 +128,10 @@ def check_title_match(expected_title, pa11y_results, logger):
         return
     title_errs = [err for err in pa11y_results
                   if err["context"].startswith("<title")]
+    if not title_errs:
+        return
+    # lxml is only needed for the few pages with title errors
+    from lxml import html
     for err in title_errs:
         title_elmt = html.fragment_fromstring(err["context"])
         # pa11ycrawler will elide the title, so grab whatever true
@@ -138,12 +169,31 @@ def track_pa11y_stats(pa11y_results, spider):
     stats.inc_value("pa11y/notice", count=num_notice, spider=spider)
 
 
-def write_pa11y_results(item, pa11y_results, data_dir):
+def write_pa11y_results(item, pa11y_results, data_dir, ignore_rules=None, filtered=False,
+                        run_id=None, violation_store=None, audit_seconds=None):
     """
-    Write the output from pa11y into a data file.
+    Write the output from pa11y into a data file, and add it to the data
+    directory's manifest, as part of the run with the given ID. If ignore
+    rules are given, their version is recorded alongside the results, and
+    the rules are saved into the data directory, so that the report
+    generator can apply them later. `filtered` records whether they have
+    already been applied. If a `violation_store` is given, the violations
+    are stored in it, and the data file only refers to them. How long the
+    audit took, `audit_seconds`, is recorded in the manifest entry, which is
+    returned.
     """
     data = dict(item)
-    data['pa11y'] = pa11y_results
+    data.pop('audit_url', None)
+    data.pop('result', None)
+    if violation_store is not None:
+        data['pa11y_refs'] = violation_store.pack(pa11y_results)
+    else:
+        data['pa11y'] = pa11y_results
+    if ignore_rules:
+        data['pa11y_ignore_rules_version'] = ignore_rules.version
+        ignore_rules.save(data_dir)
+    if filtered:
+        data['pa11y_filtered'] = True
 
     # it would be nice to use the URL as the filename,
     # but that gets complicated (long URLs, special characters, etc)
@@ -160,26 +210,147 @@ def write_pa11y_results(item, pa11y_results, data_dir):
     text = json.dumps(data, cls=DateTimeEncoder)
     filepath.write_text(text)
 
+    if ignore_rules and not filtered:
+        counted = ignore_rules.filter(pa11y_results, item["url"])
+    else:
+        counted = pa11y_results
+    entry = manifest_entry(data, filename, run_id, counted_results=counted)
+    if audit_seconds is not None:
+        entry['audit_seconds'] = round(audit_seconds, 3)
+    append_entry(data_dir, entry)
+    return entry
+
+
+# the outcome of running pa11y on a page: whether it succeeded (or timed
+# out), its output, how long each attempt took, and how long it took in all
+AuditRun = collections.namedtuple(
+    "AuditRun", "succeeded timed_out stdout stderr run_seconds seconds",
+)
+
+
+class AuditSlots(object):
+    """
+    Runs audits in the reactor's thread pool, up to `limit` at a time, in
+    the order that they were submitted. The limit can be changed, and the
+    audits paused and resumed, while the crawl is running; audits that have
+    already started aren't affected.
+    """
+    # threads to leave in the reactor's pool for DNS lookups
+    spare_threads = 2
+
+    def __init__(self, limit=1):
+        self.limit = None
+        self.running = 0
+        self.paused = False
+        self.waiting = collections.deque()
+        self.set_limit(limit)
+
+    def set_limit(self, limit):
+        "Change how many audits can run at once, and start waiting audits."
+        # importing the reactor installs it, so wait until Scrapy has
+        from twisted.internet import reactor
+        self.limit = max(int(limit), 1)
+        pool = reactor.getThreadPool()
+        if pool.max < self.limit + self.spare_threads:
+            pool.adjustPoolsize(maxthreads=self.limit + self.spare_threads)
+        self.start_waiting()
+
+    def pause(self):
+        "Don't start any more audits until `resume()` is called."
+        self.paused = True
+
+    def resume(self):
+        "Start auditing again, after `pause()`."
+        self.paused = False
+        self.start_waiting()
+
+    def run(self, func, *args):
+        """
+        Call `func(*args)` in a thread, once a slot is free. Returns a
+        Deferred that fires with its result.
+        """
+        result = defer.Deferred()
+        self.waiting.append((result, func, args))
+        self.start_waiting()
+        return result
+
+    def start_waiting(self):
+        "Start as many waiting audits as there are free slots."
+        while self.waiting and not self.paused and self.running < self.limit:
+            result, func, args = self.waiting.popleft()
+            self.running += 1
+            audit = threads.deferToThread(func, *args)
+            audit.addBoth(self.finished)
+            audit.chainDeferred(result)
+
+    def finished(self, result):
+        "Free the slot of an audit that finished."
+        self.running -= 1
+        self.start_waiting()
+        return result
+
 
 class Pa11yPipeline(object):
     """
     Runs the Pa11y CLI against `item['url']`, using the same request headers
     used by Scrapy.
+
+    The raw pa11y results are written to the data directory, along with the
+    version of the ignore rules that applied to them, so that the rules can
+    be applied (or changed) when generating a report. Set the
+    PA11Y_FILTER_AT_CRAWL_TIME setting to write only the results that
+    aren't ignored instead. Each result is listed in the data directory's
+    manifest, under the RUN_ID of the crawl. Set the
+    PA11Y_DEDUPLICATE_VIOLATIONS setting to store each distinct violation
+    only once, in the data directory's `ViolationStore`.
+
+    pa11y is started by an `AuditSupervisor`, which applies the AUDIT_*
+    resource limits and timeout to it. If AUDIT_CONCURRENCY is set, up to
+    that many pages are audited at once, in threads, so that the reactor
+    isn't blocked while pa11y runs; if it's 0 (the default), or the pipeline
+    is used outside of Scrapy, `process_item` audits the page before
+    returning. If the crawl
+    is cancelled, the pa11y processes that are running (if any) are killed,
+    and the items that haven't been audited yet are dropped.
     """
     pa11y_path = "node_modules/.bin/pa11y"
     cli_flags = {
         "reporter": "json-oldnode",
     }
 
-    def __init__(self):
+    @classmethod
+    def from_crawler(cls, crawler):
+        "Build the pipeline from the crawler settings."
+        pipeline = cls(
+            filter_at_crawl_time=crawler.settings.getbool("PA11Y_FILTER_AT_CRAWL_TIME"),
+            pa11y_path=crawler.settings.get("PA11Y_PATH"),
+            run_id=crawler.settings.get("RUN_ID"),
+            deduplicate_violations=crawler.settings.getbool("PA11Y_DEDUPLICATE_VIOLATIONS"),
+            probe_cache=crawler.settings.get("TOOLCHAIN_PROBE_CACHE"),
+            supervisor=AuditSupervisor.from_settings(crawler.settings, crawler.stats),
+            audit_concurrency=crawler.settings.getint("AUDIT_CONCURRENCY"),
+        )
+        crawler.signals.connect(pipeline.crawl_cancelled, signal=crawl_cancelled)
+        return pipeline
+
+    def __init__(self, filter_at_crawl_time=False, pa11y_path=None, run_id=None,
+                 deduplicate_violations=False, probe_cache=None, supervisor=None,
+                 audit_concurrency=0):
         """
         Check to be sure that `pa11y` and `phantomjs` are installed properly.
+        The checks are cached in the `probe_cache` file, if it's given.
         """
+        self.filter_at_crawl_time = filter_at_crawl_time
+        self.run_id = run_id or make_run_id()
+        self.deduplicate_violations = deduplicate_violations
+        self.violation_store = None
+        self.supervisor = supervisor or AuditSupervisor()
+        self.slots = AuditSlots(audit_concurrency) if audit_concurrency else None
+        self.cancelled = None
+        if pa11y_path:
+            self.pa11y_path = pa11y_path
         try:
-            sp.check_call(
-                ["phantomjs", "--version"],
-                stdout=DEVNULL, stderr=DEVNULL,
-            )
+            probe_executable(["phantomjs", "--version"], probe_cache)
         except OSError:
             # No such file or directory
             msg = (
@@ -188,10 +359,7 @@ class Pa11yPipeline(object):
             )
             raise NotConfigured(msg)
         try:
-            sp.check_call(
-                [self.pa11y_path, "--version"],
-                stdout=DEVNULL, stderr=DEVNULL,
-            )
+            probe_executable([self.pa11y_path, "--version"], probe_cache)
         except OSError:
             # No such file or directory
             msg = (
@@ -199,57 +367,155 @@ class Pa11yPipeline(object):
             ).format(path=self.pa11y_path)
             raise NotConfigured(msg)
 
+    def violation_store_for(self, data_dir):
+        "The violation store of the data directory, if violations are deduplicated."
+        if not self.deduplicate_violations:
+            return None
+        if self.violation_store is None or self.violation_store.data_dir != data_dir:
+            self.violation_store = ViolationStore(data_dir)
+        return self.violation_store
+
+    def open_spider(self, spider):
+        "Kill the audits left behind by earlier crawls, and create the cgroup."
+        self.supervisor.open()
+
+    def close_spider(self, spider):
+        "Kill the audits that are still running."
+        self.supervisor.close()
+
+    def crawl_cancelled(self, spider, reason):
+        "Stop auditing pages, and kill pa11y if it's running."
+        self.cancelled = reason
+        self.supervisor.kill_all("cancelled")
+        if self.slots is not None:
+            # let the waiting items through, so they can be dropped
+            self.slots.resume()
+
     def process_item(self, item, spider):
         """
-        Use the Pa11y command line tool to get an a11y report.
+        Audit the page, in a thread if audits are run concurrently. Only
+        pa11y runs in the thread: its results are recorded in the reactor
+        thread, which is the only one that touches the stats and metrics.
         """
+        self.check_cancelled(item)
+        # if the rules can't be loaded, there's no point in running pa11y
+        ignore_rules = compile_ignore_rules(getattr(spider, "pa11y_ignore_rules", None))
+        if self.slots is None:
+            return self.record_audit(self.run_pa11y(item, spider), item, spider, ignore_rules)
+        audit = self.slots.run(self.run_pa11y, item, spider)
+        audit.addCallback(self.record_audit, item, spider, ignore_rules)
+        return audit
+
+    def check_cancelled(self, item, started=False):
+        "Drop the item if the crawl was cancelled."
+        if not self.cancelled:
+            return
+        msg = u"Stopped auditing {url}" if started else u"Not auditing {url}"
+        raise DropItem((msg + u": the crawl was cancelled ({reason})").format(
+            url=item['url'], reason=self.cancelled,
+        ))
+
+    def run_pa11y(self, item, spider):
+        """
+        Run the pa11y command line tool on the page, trying again if it
+        fails, and return an `AuditRun`. This may run in a thread.
+        """
+        start = time.time()
         config_file = write_pa11y_config(item)
         args = [
             self.pa11y_path,
-            item["url"],
+            item.get("audit_url") or item["url"],
             '--config={file}'.format(file=config_file.name),
         ]
         for flag, value in self.cli_flags.items():
             args.append("--{flag}={value}".format(flag=flag, value=value))
 
+        run_seconds = []
         retries_remaining = 3
-        while retries_remaining:
-            logline = " ".join(args)
-            if retries_remaining != 3:
-                logline += u"  # (retry {num})".format(num=3-retries_remaining)
-            spider.logger.info(logline)
-
-            proc = sp.Popen(
-                args, shell=False,
-                stdout=sp.PIPE, stderr=sp.PIPE,
-            )
-            stdout, stderr = proc.communicate()
-            if proc.returncode in (0, 2):
-                # `pa11y` ran successfully!
-                # Return code 0 means no a11y errors.
-                # Return code 2 means `pa11y` identified a11y errors.
-                # Either way, we're done, so break out of the `while` loop
-                break
-            else:
-                # `pa11y` did _not_ run successfully!
-                # We sometimes get the error "Truffler timed out":
-                # truffler is what accesses the web page for `pa11y1`.
-                # https://www.npmjs.com/package/truffler
-                # If this is the error, we can resolve it just by trying again,
-                # so decrement the retries_remaining and start over.
-                retries_remaining -= 1
-
-        if retries_remaining == 0:
+        try:
+            while retries_remaining:
+                logline = " ".join(args)
+                if retries_remaining != 3:
+                    logline += u"  # (retry {num})".format(num=3-retries_remaining)
+                spider.logger.info(logline)
+
+                run_start = time.time()
+                proc = self.supervisor.popen(
+                    args, shell=False,
+                    stdout=sp.PIPE, stderr=sp.PIPE,
+                )
+                stdout, stderr = self.supervisor.communicate(proc)
+                run_seconds.append(time.time() - run_start)
+                if self.cancelled:
+                    break
+                if proc.returncode in (0, 2):
+                    # `pa11y` ran successfully!
+                    # Return code 0 means no a11y errors.
+                    # Return code 2 means `pa11y` identified a11y errors.
+                    # Either way, we're done, so break out of the `while` loop
+                    break
+                elif proc.timed_out:
+                    # the page is unlikely to load any faster the next time
+                    retries_remaining = 0
+                else:
+                    # `pa11y` did _not_ run successfully!
+                    # We sometimes get the error "Truffler timed out":
+                    # truffler is what accesses the web page for `pa11y1`.
+                    # https://www.npmjs.com/package/truffler
+                    # If this is the error, we can resolve it just by trying again,
+                    # so decrement the retries_remaining and start over.
+                    retries_remaining -= 1
+        finally:
+            os.remove(config_file.name)
+        return AuditRun(
+            succeeded=bool(retries_remaining), timed_out=proc.timed_out,
+            stdout=stdout, stderr=stderr, run_seconds=run_seconds,
+            seconds=time.time() - start,
+        )
+
+    def record_audit(self, run, item, spider, ignore_rules):
+        """
+        Record the results of a pa11y run: count them in the stats, and
+        write them into the data directory. The results are filtered with
+        `ignore_rules`, the rules that were in use when the audit started.
+        """
+        metrics = metrics_for(spider)
+        for seconds in run.run_seconds:
+            metrics.observe("pa11y/run", seconds)
+        failures = len(run.run_seconds) - (1 if run.succeeded or run.timed_out else 0)
+        if failures:
+            spider.crawler.stats.inc_value("pa11y/retries", count=failures, spider=spider)
+        self.check_cancelled(item, started=True)
+
+        if not run.succeeded:
+            metrics.observe("pipeline/pa11y", run.seconds)
+            if run.timed_out:
+                raise DropItem(u"pa11y timed out on {url}, after {timeout} seconds".format(
+                    url=item['url'], timeout=self.supervisor.timeout,
+                ))
             raise DropItem(
                 u"Couldn't get pa11y results for {url}. Error:\n{err}".format(
                     url=item['url'],
-                    err=stderr,
+                    err=run.stderr,
                 )
             )
 
-        pa11y_results = load_pa11y_results(stdout, spider, item['url'])
+        write_start = time.time()
+        raw_results = parse_pa11y_output(run.stdout)
+        pa11y_results = ignore_rules.filter(raw_results, item['url'])
         check_title_match(item['page_title'], pa11y_results, spider.logger)
         track_pa11y_stats(pa11y_results, spider)
-        os.remove(config_file.name)
-        write_pa11y_results(item, pa11y_results, Path(spider.data_dir))
+        data_dir = Path(spider.data_dir)
+        with metrics.timer("pa11y/write"):
+            item["result"] = write_pa11y_results(
+                item,
+                pa11y_results if self.filter_at_crawl_time else raw_results,
+                data_dir,
+                ignore_rules=ignore_rules,
+                filtered=self.filter_at_crawl_time,
+                run_id=self.run_id,
+                violation_store=self.violation_store_for(data_dir),
+                audit_seconds=run.seconds,
+            )
+        metrics.observe("pipeline/pa11y", run.seconds + time.time() - write_start)
         return item
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Contains the ReportPipeline, which keeps an HTML report up to date while
+crawling.
+"""
+from path import Path
+from twisted.internet import task
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+
+from pa11ycrawler.html import Report
+from pa11ycrawler.metrics import timed_stage
+
+
+class ReportPipeline(object):
+    """
+    Keeps the same HTML report that `pa11ycrawler-html` makes in the
+    REPORT_OUTPUT_DIR directory, while crawling. It must come after the
+    Pa11yPipeline, which gives each item the manifest entry of its result.
+
+    When the spider opens, the results that are already in the data
+    directory are added to the report (their detail pages are only rendered
+    if they're missing). Each page's detail page is then rendered as soon as
+    it's audited, and the index and unique violations pages are rendered
+    every REPORT_FLUSH_INTERVAL seconds, if anything changed, and when the
+    spider closes. The performance page is rendered again once the RunStats
+    extension has written the stats of the crawl.
+    """
+    def __init__(self, output_dir, flush_interval=60, compress=True):
+        self.output_dir = Path(output_dir).expand()
+        self.flush_interval = flush_interval
+        self.compress = compress
+        self.report = None
+        self.task = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        "Build the pipeline from the crawler settings."
+        settings = crawler.settings
+        if not settings.get("REPORT_OUTPUT_DIR"):
+            raise NotConfigured
+        pipeline = cls(
+            settings.get("REPORT_OUTPUT_DIR"),
+            flush_interval=settings.getfloat("REPORT_FLUSH_INTERVAL", 60),
+            compress=settings.getbool("REPORT_COMPRESS", True),
+        )
+        # the RunStats extension writes the run's stats on spider_closed,
+        # after the pipelines are closed; it's connected first, so this
+        # handler runs after it
+        crawler.signals.connect(pipeline.spider_closed, signal=signals.spider_closed)
+        return pipeline
+
+    def open_spider(self, spider):
+        "Start the report with the results that are already in the data directory."
+        self.output_dir.makedirs_p()
+        self.report = Report(Path(spider.data_dir), self.output_dir, compress=self.compress)
+        self.report.add_manifest(render=False)
+        self.report.write()
+        if self.flush_interval:
+            self.task = task.LoopingCall(self.flush)
+            self.task.start(self.flush_interval, now=False)
+
+    @timed_stage("pipeline/report")
+    def process_item(self, item, spider):  # pylint: disable=unused-argument
+        "Add the page's result to the report."
+        entry = item.get("result")
+        if entry is not None:
+            self.report.add(entry)
+        return item
+
+    def flush(self):
+        "Render the index and unique violations pages, if they changed."
+        if self.report.changed:
+            self.report.write()
+
+    def close_spider(self, spider):  # pylint: disable=unused-argument
+        "Render the final report."
+        if self.task is not None and self.task.running:
+            self.task.stop()
+        self.flush()
+
+    def spider_closed(self, spider):  # pylint: disable=unused-argument
+        "Render the performance page, with the stats of this crawl."
+        if self.report is not None:
+            self.report.write_performance()
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+Profiling of selected functions, without profiling everything else that
+runs in the same process (like the Twisted reactor).
+
+The functions to profile are named by their dotted paths, like
+`pa11ycrawler.pipelines.Pa11yPipeline.process_item`, and are wrapped in
+place while the profiler is installed. There are two modes:
+
+* "deterministic" uses cProfile, which is only enabled while one of the
+  functions is running, and writes a `.pstats` file.
+* "sample" records the stack of the running function every few
+  milliseconds, starting from the profiled function, and writes a
+  `.folded` file of collapsed stacks, which flamegraph tools can draw.
+
+The functions can run in any thread (like the audits, which can run in the
+reactor's thread pool): each thread is profiled separately while it runs
+one of them, and the profiles are combined when they're saved.
+"""
+import os
+import sys
+import time
+import pstats
+import cProfile
+import threading
+import functools
+import importlib
+import collections
+
+DEFAULT_TARGETS = [
+    "pa11ycrawler.spiders.edx.EdxSpider.parse_item",
+    "pa11ycrawler.spiders.edx.EdxSpider.analyze_url_list",
+    "pa11ycrawler.pipelines.DuplicatesPipeline.process_item",
+    "pa11ycrawler.pipelines.DropDRFPipeline.process_item",
+    "pa11ycrawler.pipelines.Pa11yPipeline.process_item",
+    # with AUDIT_CONCURRENCY, pa11y runs in a thread, and its results are
+    # recorded in a callback, outside of `process_item`
+    "pa11ycrawler.pipelines.Pa11yPipeline.run_pa11y",
+    "pa11ycrawler.pipelines.Pa11yPipeline.record_audit",
+]
+MODES = ("deterministic", "sample")
+
+
+def resolve_target(path):
+    """
+    Find the object that holds the function with the given dotted path.
+    Returns the object (a module or a class) and the function's name.
+    """
+    bits = path.split(".")
+    for split in range(len(bits) - 1, 0, -1):
+        try:
+            owner = importlib.import_module(".".join(bits[:split]))
+        except ImportError:
+            continue
+        for name in bits[split:-1]:
+            owner = getattr(owner, name)
+        if not hasattr(owner, bits[-1]):
+            break
+        return owner, bits[-1]
+    raise ValueError(u"Can't find {path} to profile".format(path=path))
+
+
+def frame_label(frame):
+    "How a stack frame is named in collapsed stacks."
+    code = frame.f_code
+    return u"{func} ({file}:{line})".format(
+        func=code.co_name,
+        file=os.path.basename(code.co_filename),
+        line=code.co_firstlineno,
+    )
+
+
+class Profiler(object):
+    """
+    Profiles the functions with the given dotted paths, from when it is
+    installed until it is uninstalled, or until `window` seconds have
+    passed since the first profiled call, or until `max_calls` calls have
+    been profiled. `on_finish` is called when one of those limits is hit.
+    """
+    def __init__(self, targets=None, mode="deterministic", interval=0.005,
+                 window=None, max_calls=None, on_finish=None):
+        if mode not in MODES:
+            raise ValueError(u"Unknown profiling mode {mode}".format(mode=mode))
+        self.targets = list(targets or DEFAULT_TARGETS)
+        self.mode = mode
+        self.interval = interval
+        self.window = window
+        self.max_calls = max_calls
+        self.on_finish = on_finish
+        # the cProfile profile of each thread, by thread ID
+        self.profiles = {}
+        self.stacks = collections.Counter()
+        self.calls = 0
+        self.started_at = None
+        self.finished = False
+        self._originals = []
+        self._lock = threading.Lock()
+        # how deep each thread is in profiled calls
+        self._local = threading.local()
+        # the threads that are running a profiled function
+        self._active_threads = set()
+        # the frames of the profiler itself, which are left out of stacks
+        self._wrapper_codes = {self._profiled.__code__}
+        self._sampler = None
+
+    def _enter(self):
+        depth = self._local.depth = getattr(self._local, "depth", 0) + 1
+        if depth > 1:
+            return
+        thread_id = threading.current_thread().ident
+        with self._lock:
+            if self.started_at is None:
+                self.started_at = time.time()
+            if self.mode == "deterministic" and thread_id not in self.profiles:
+                self.profiles[thread_id] = cProfile.Profile()
+            self._active_threads.add(thread_id)
+        if self.mode == "deterministic":
+            try:
+                self.profiles[thread_id].enable()
+                self._local.enabled = True
+            except ValueError:
+                # since Python 3.12, only one profiler can run at a time
+                self._local.enabled = False
+
+    def _exit(self):
+        self._local.depth -= 1
+        if self._local.depth:
+            return
+        thread_id = threading.current_thread().ident
+        if self.mode == "deterministic" and self._local.enabled:
+            self.profiles[thread_id].disable()
+        with self._lock:
+            self._active_threads.discard(thread_id)
+        if self._limit_reached():
+            self.finish()
+
+    def _limit_reached(self):
+        if self.max_calls and self.calls >= self.max_calls:
+            return True
+        return bool(self.window and time.time() - self.started_at >= self.window)
+
+    def _profiled(self, func, *args, **kwargs):
+        "Call a function, profiling it unless profiling has finished."
+        if self.finished:
+            return func(*args, **kwargs)
+        self._enter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self._exit()
+
+    def _wrap(self, func):
+        profiler = self
+
+        def profiled_generator(gen):
+            "Profile the generator while it runs, but not its consumer."
+            while True:
+                try:
+                    value = profiler._profiled(next, gen)  # pylint: disable=protected-access
+                except StopIteration:
+                    return
+                yield value
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if profiler.finished:
+                return func(*args, **kwargs)
+            with profiler._lock:  # pylint: disable=protected-access
+                profiler.calls += 1
+            result = profiler._profiled(func, *args, **kwargs)  # pylint: disable=protected-access
+            if hasattr(result, "__next__") or hasattr(result, "next"):
+                return profiled_generator(result)
+            return result
+        self._wrapper_codes.add(wrapper.__code__)
+        self._wrapper_codes.add(profiled_generator.__code__)
+        return wrapper
+
+    def install(self):
+        "Start profiling the target functions."
+        for path in self.targets:
+            owner, name = resolve_target(path)
+            original = owner.__dict__.get(name, getattr(owner, name))
+            self._originals.append((owner, name, original))
+            setattr(owner, name, self._wrap(original))
+        if self.mode == "sample":
+            self._sampler = threading.Thread(target=self._sample_loop, name="profiler")
+            self._sampler.daemon = True
+            self._sampler.start()
+
+    def _stop_sampler(self):
+        if self._sampler is not None:
+            self._sampler.join()
+            self._sampler = None
+
+    def uninstall(self):
+        "Stop profiling, and put the target functions back."
+        self.finished = True
+        for owner, name, original in reversed(self._originals):
+            setattr(owner, name, original)
+        self._originals = []
+        self._stop_sampler()
+
+    def finish(self):
+        "Stop profiling when a limit is hit."
+        with self._lock:
+            if self.finished:
+                return
+            self.finished = True
+        self._stop_sampler()
+        if self.on_finish is not None:
+            self.on_finish(self)
+
+    def _sample_loop(self):
+        while not self.finished:
+            time.sleep(self.interval)
+            with self._lock:
+                thread_ids = list(self._active_threads)
+            frames = sys._current_frames()  # pylint: disable=protected-access
+            for thread_id in thread_ids:
+                self._sample(frames.get(thread_id))
+
+    def _sample(self, frame):
+        "Record the stack of a thread that is running a profiled function."
+        stack = []
+        # walk up to the outermost profiled call, leaving out the frames of
+        # whatever called it
+        outermost = 0
+        while frame is not None:
+            if frame.f_code in self._wrapper_codes:
+                outermost = len(stack)
+            else:
+                stack.append(frame_label(frame))
+            frame = frame.f_back
+        if outermost:
+            self.stacks[u";".join(reversed(stack[:outermost]))] += 1
+
+    def save(self, output_dir, name="profile"):
+        """
+        Write out the profile into the given directory. Returns the paths
+        of the files that were written.
+        """
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        paths = []
+        profiles = list(self.profiles.values())
+        if profiles:
+            path = os.path.join(output_dir, name + ".pstats")
+            stats = pstats.Stats(profiles[0])
+            for profile in profiles[1:]:
+                stats.add(profile)
+            stats.dump_stats(path)
+            paths.append(path)
+        if self.stacks:
+            path = os.path.join(output_dir, name + ".folded")
+            with open(path, "w") as folded:
+                for stack, count in self.stacks.most_common():
+                    folded.write(u"{} {}\n".format(stack, count))
+            paths.append(path)
+        return paths
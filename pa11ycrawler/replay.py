@@ -0,0 +1,217 @@
+"""
+This script re-runs pa11y audits against page snapshots stored by the
+crawler, without touching the LMS. The snapshots are served from a loopback
+HTTP server, and audited through the same code path as a live crawl.
+"""
+import argparse
+import logging
+import threading
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+# the HTTP server library depends on Python version
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+from path import Path
+from urlobject import URLObject
+from scrapy.exceptions import DropItem
+
+from pa11ycrawler.items import A11yItem
+from pa11ycrawler.pipelines import Pa11yPipeline
+from pa11ycrawler.snapshots import SnapshotStore
+from pa11ycrawler.ignore import load_pa11y_ignore_rules
+
+log = logging.getLogger(__name__)
+
+
+def make_parser():
+    """
+    Returns an argparse instance for this script.
+    """
+    parser = argparse.ArgumentParser(description="re-run pa11y against stored page snapshots")
+    parser.add_argument(
+        "--snapshot-dir", default="data/snapshots",
+        help=u"Directory containing page snapshots from the crawler [%(default)s]"
+    )
+    parser.add_argument(
+        "--data-dir", default="replay-data",
+        help=u"Directory to output the resulting JSON data [%(default)s]"
+    )
+    parser.add_argument(
+        "--pa11y-ignore-rules-file", default=None,
+        help=u"YAML file containing pa11y ignore rules"
+    )
+    parser.add_argument(
+        "--pa11y-ignore-rules-url", default=None,
+        help=u"URL of a YAML file containing pa11y ignore rules"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=4,
+        help=u"Number of pa11y processes to run at once [%(default)s]"
+    )
+    return parser
+
+
+def snapshot_path(url):
+    "The part of a URL that the loopback server uses to find its snapshot."
+    url = URLObject(url)
+    return url.path + (u"?" + url.query if url.query else u"")
+
+
+class ReplayStats(object):
+    """
+    A thread-safe stand-in for the Scrapy stats collector, for the parts of
+    its API that the pipelines use.
+    """
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def get_value(self, key, default=None, spider=None):  # pylint: disable=unused-argument
+        "Return the value of a stat."
+        return self._stats.get(key, default)
+
+    def get_stats(self, spider=None):  # pylint: disable=unused-argument
+        "Return all stats."
+        return dict(self._stats)
+
+    def inc_value(self, key, count=1, start=0, spider=None):  # pylint: disable=unused-argument
+        "Increment the value of a stat."
+        with self._lock:
+            self._stats[key] = self._stats.get(key, start) + count
+
+    def max_value(self, key, value, spider=None):  # pylint: disable=unused-argument
+        "Set a stat to the given value, if it's larger than the current one."
+        with self._lock:
+            self._stats[key] = max(self._stats.get(key, value), value)
+
+
+class ReplayCrawler(object):  # pylint: disable=too-few-public-methods
+    "Just enough of a Scrapy crawler to give the pipelines their stats."
+    def __init__(self):
+        self.stats = ReplayStats()
+
+
+class ReplaySpider(object):  # pylint: disable=too-few-public-methods
+    """
+    Stands in for the EdxSpider when running the pipelines outside of
+    Scrapy, providing the attributes that the pipelines read.
+    """
+    name = 'replay'
+
+    def __init__(self, data_dir, pa11y_ignore_rules=None):
+        self.data_dir = data_dir
+        self.pa11y_ignore_rules = pa11y_ignore_rules
+        self.crawler = ReplayCrawler()
+        self.logger = log
+
+
+class SnapshotServer(ThreadingMixIn, HTTPServer):
+    """
+    A loopback HTTP server that serves stored snapshots at the path
+    and querystring of the URL that they were taken from.
+    """
+    daemon_threads = True
+
+    def __init__(self, store, pages):
+        self.store = store
+        self.pages = {snapshot_path(page["url"]): page for page in pages}
+        HTTPServer.__init__(self, ("127.0.0.1", 0), SnapshotRequestHandler)
+
+    @property
+    def base_url(self):
+        "The URL that this server is listening on."
+        return u"http://127.0.0.1:{port}".format(port=self.server_address[1])
+
+
+class SnapshotRequestHandler(BaseHTTPRequestHandler):
+    "Serves a snapshot, or a 404 for anything that wasn't snapshotted."
+    def do_GET(self):  # pylint: disable=invalid-name
+        "Serve the snapshot for this path, if there is one."
+        page = self.server.pages.get(self.path)
+        if page is None:
+            self.send_error(404)
+            return
+        body = self.server.store.get(page["snapshot"])
+        content_type = "text/html"
+        if page.get("encoding"):
+            content_type += "; charset=" + page["encoding"]
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        log.debug(format, *args)
+
+
+def replay(store, data_dir, pa11y_ignore_rules=None, workers=4):
+    """
+    The main workhorse of this script. Serves every stored snapshot from a
+    loopback server, and runs it through the Pa11yPipeline. Returns the
+    stats from the run.
+    """
+    pages = store.pages()
+    spider = ReplaySpider(data_dir, pa11y_ignore_rules)
+    pipeline = Pa11yPipeline()
+    server = SnapshotServer(store, pages)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    def audit(page):
+        "Audit one snapshot, reporting results under its original URL."
+        item = A11yItem(
+            url=page["url"],
+            audit_url=server.base_url + snapshot_path(page["url"]),
+            request_headers={},
+            accessed_at=datetime.utcnow(),
+            page_title=page.get("page_title"),
+            snapshot=page["snapshot"],
+        )
+        try:
+            pipeline.process_item(item, spider)
+        except DropItem as err:
+            log.error(u"%s", err)
+        spider.crawler.stats.inc_value("replay/pages")
+
+    pool = ThreadPool(max(workers, 1))
+    try:
+        pool.map(audit, pages)
+    finally:
+        pool.close()
+        pool.join()
+        server.shutdown()
+        server.server_close()
+    return spider.crawler.stats.get_stats()
+
+
+def main():
+    """
+    Validates script arguments and calls the replay() function with them.
+    """
+    logging.basicConfig(level=logging.INFO)
+    parser = make_parser()
+    args = parser.parse_args()
+    snapshot_dir = Path(args.snapshot_dir).expand()
+    if not snapshot_dir.isdir():  # pylint: disable=no-value-for-parameter
+        msg = u"Snapshot directory {dir} does not exist".format(dir=args.snapshot_dir)
+        raise ValueError(msg)
+    store = SnapshotStore(snapshot_dir)
+    ignore_rules = load_pa11y_ignore_rules(
+        file=args.pa11y_ignore_rules_file, url=args.pa11y_ignore_rules_url,
+    )
+    stats = replay(
+        store, str(Path(args.data_dir).expand()),
+        pa11y_ignore_rules=ignore_rules, workers=args.workers,
+    )
+    for key in sorted(stats):
+        log.info(u"%s: %s", key, stats[key])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+The performance stats of each crawl (or "run"): how long it took, how fast
+it audited pages, how much it downloaded, and how much memory it used,
+along with which pages and URL templates took the longest to audit.
+
+The `RunStats` extension writes them when a crawl ends, to a small JSON
+file per run in the `runs` directory of the data directory (one per shard,
+for a sharded crawl), so that the report can show how the crawl performs
+over time without reading any results.
+"""
+import json
+import heapq
+import logging
+import collections
+
+from pa11ycrawler.metrics import TIME_BUCKETS, Histogram
+from pa11ycrawler.util import DateTimeEncoder, url_template, write_atomic
+
+log = logging.getLogger(__name__)
+
+RUNS_DIRNAME = "runs"
+# how many of the slowest pages and URL templates are recorded
+DEFAULT_TOP = 10
+# the stats that are added up across the shards of a run
+SUMMED_STATS = ("pages", "dropped", "requests", "retries", "response_bytes")
+# the stats that are the largest of any shard
+MAX_STATS = ("duration", "peak_rss_mb", "peak_children_rss_mb")
+
+
+class RunRecorder(object):
+    """
+    Records how long each page took to audit: a histogram of the times, the
+    `top` slowest pages, and the total time of every URL template.
+    """
+    def __init__(self, top=DEFAULT_TOP):
+        self.top = top
+        self.audits = Histogram(TIME_BUCKETS)
+        # a heap of (seconds, url)
+        self.slowest = []
+        # template: [pages, total seconds, max seconds]
+        self.templates = {}
+
+    def observe(self, url, seconds):
+        "Record how long a page took to audit."
+        self.audits.observe(seconds)
+        if len(self.slowest) < self.top:
+            heapq.heappush(self.slowest, (seconds, url))
+        elif seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (seconds, url))
+        totals = self.templates.setdefault(url_template(url), [0, 0.0, 0.0])
+        totals[0] += 1
+        totals[1] += seconds
+        totals[2] = max(totals[2], seconds)
+
+    def to_dict(self):
+        "The audit times that were recorded, suitable for JSON."
+        return {
+            "audit": self.audits.to_dict(),
+            "slowest_urls": slowest_urls(
+                {"url": url, "seconds": seconds} for seconds, url in self.slowest
+            ),
+            "url_templates": slowest_templates(
+                {"template": template, "pages": pages, "seconds": total, "max": longest}
+                for template, (pages, total, longest) in self.templates.items()
+            ),
+        }
+
+
+def slowest_urls(pages, top=DEFAULT_TOP):
+    "The `top` slowest of the given `{url, seconds}` pages, slowest first."
+    return sorted(pages, key=lambda page: page["seconds"], reverse=True)[:top]
+
+
+def slowest_templates(templates, top=DEFAULT_TOP):
+    """
+    The `top` URL templates that took the longest to audit in total, of the
+    given `{template, pages, seconds, max}` totals, slowest first.
+    """
+    return sorted(templates, key=lambda template: template["seconds"], reverse=True)[:top]
+
+
+def run_stats_path(data_dir, run_id, shard_index=None):
+    "The file that the stats of a run (or one shard of it) are written to."
+    name = run_id if shard_index is None else u"{}.shard{}".format(run_id, shard_index)
+    return data_dir / RUNS_DIRNAME / (name + ".json")
+
+
+def write_run_stats(data_dir, stats):
+    "Write the stats of a run into the data directory."
+    path = run_stats_path(data_dir, stats["run_id"], stats.get("shard_index"))
+    write_atomic(path, json.dumps(stats, cls=DateTimeEncoder, indent=2, sort_keys=True))
+    return path
+
+
+def combine_shards(shards):
+    """
+    Combine the stats of each shard of a run into the stats of the whole
+    run, and work out its throughput and audit time percentiles.
+    """
+    run = dict(shards[0])
+    if len(shards) > 1:
+        run.pop("shard_index", None)
+        run["shards"] = len(shards)
+        run["started_at"] = min(shard["started_at"] for shard in shards)
+        run["finished_at"] = max(shard["finished_at"] for shard in shards)
+        run["finish_reason"] = u", ".join(sorted(set(
+            shard.get("finish_reason") or u"" for shard in shards
+        )))
+        for key in SUMMED_STATS:
+            run[key] = sum(shard.get(key) or 0 for shard in shards)
+        for key in MAX_STATS:
+            run[key] = max(shard.get(key) or 0 for shard in shards)
+        audits = Histogram.from_dict(shards[0]["audit"])
+        for shard in shards[1:]:
+            audits.merge(Histogram.from_dict(shard["audit"]))
+        run["audit"] = audits.to_dict()
+        run["slowest_urls"] = slowest_urls(
+            page for shard in shards for page in shard.get("slowest_urls", [])
+        )
+        templates = collections.OrderedDict()
+        for shard in shards:
+            for template in shard.get("url_templates", []):
+                totals = templates.setdefault(
+                    template["template"],
+                    {"template": template["template"], "pages": 0, "seconds": 0, "max": 0},
+                )
+                totals["pages"] += template["pages"]
+                totals["seconds"] += template["seconds"]
+                totals["max"] = max(totals["max"], template["max"])
+        run["url_templates"] = slowest_templates(templates.values())
+
+    duration = run.get("duration")
+    run["pages_per_second"] = (run.get("pages") or 0) / float(duration) if duration else None
+    run["audit_summary"] = Histogram.from_dict(run["audit"]).summary()
+    return run
+
+
+def load_runs(data_dir, limit=None):
+    """
+    The stats of the runs recorded in a data directory, from the oldest to
+    the newest (by when they finished), or only the last `limit` of them.
+    Files that can't be read are skipped.
+    """
+    runs_dir = data_dir / RUNS_DIRNAME
+    if not runs_dir.isdir():
+        return []
+    shards = collections.OrderedDict()
+    for path in sorted(runs_dir.files("*.json")):
+        try:
+            stats = json.loads(path.text())
+            stats.setdefault("audit", Histogram(TIME_BUCKETS).to_dict())
+            stats.setdefault("finished_at", u"")
+            # so the report can chart stats that older runs didn't record
+            for key in SUMMED_STATS + MAX_STATS:
+                stats.setdefault(key, None)
+            shards.setdefault(stats["run_id"], []).append(stats)
+        except (IOError, OSError, ValueError, KeyError) as err:
+            log.warning(u"Skipping the run stats in %s: %s", path, err)
+    runs = [combine_shards(run_shards) for run_shards in shards.values()]
+    runs.sort(key=lambda run: run["finished_at"])
+    return runs[-limit:] if limit else runs
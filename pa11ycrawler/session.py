@@ -0,0 +1,151 @@
+"""
+Keeps track of the crawler's logged-in session, so that when the session
+expires, exactly one re-login runs at a time.
+"""
+import re
+import time
+from email.utils import parsedate_tz, mktime_tz
+
+SESSION_COOKIE_NAME = "sessionid"
+
+
+def get_session_expiry(response, cookie_name=SESSION_COOKIE_NAME, now=None):
+    """
+    Extract the expiry time of the session cookie out of the "Set-Cookie"
+    header of a response, as a Unix timestamp. Returns None if the response
+    does not set the session cookie, or if the cookie has no known expiry.
+    """
+    if now is None:
+        now = time.time()
+    cookie_headers = [
+        h.decode('ascii') for h in response.headers.getlist("Set-Cookie")
+    ]
+    session_headers = [
+        h for h in cookie_headers if h.startswith(cookie_name + "=")
+    ]
+    if not session_headers:
+        return None
+    header = session_headers[-1]
+
+    # Max-Age takes precedence over Expires, as per RFC 6265
+    match = re.search(r";\s*max-age=(-?\d+)", header, re.IGNORECASE)
+    if match:
+        return now + int(match.group(1))
+    match = re.search(r";\s*expires=([^;]+)", header, re.IGNORECASE)
+    if match:
+        parsed = parsedate_tz(match.group(1).strip())
+        if parsed:
+            return mktime_tz(parsed)
+    return None
+
+
+class SessionManager(object):
+    """
+    Coordinates re-logins for a spider. Only one re-login may be in progress
+    at any given time: requests that need authentication while a re-login is
+    in progress are parked, and handed back once the re-login finishes so
+    that they can be replayed with the fresh session cookies.
+
+    Re-login counts and the time that requests spent parked are recorded
+    in the Scrapy stats collector, if one is available.
+    """
+    def __init__(self, stats=None, refresh_margin=300):
+        self.stats = stats
+        self.refresh_margin = refresh_margin
+        self.relogin_in_progress = False
+        self.expires_at = None
+        self.parked = []
+
+    def _inc_stat(self, key, count=1):
+        if self.stats is not None:
+            self.stats.inc_value(key, count=count)
+
+    def begin_relogin(self, proactive=False):
+        """
+        Claim the right to log in again. Returns True if the caller should
+        send a login request, or False if another re-login is already
+        in progress.
+        """
+        if self.relogin_in_progress:
+            return False
+        self.relogin_in_progress = True
+        self._inc_stat("session/relogin_count")
+        if proactive:
+            self._inc_stat("session/proactive_refresh_count")
+        return True
+
+    def park(self, request):
+        """
+        Hold on to a request until the current re-login finishes.
+        """
+        self.parked.append((request, time.time()))
+        self._inc_stat("session/parked_requests")
+
+    def _release(self):
+        """
+        Return all parked requests, and record how long they waited.
+        """
+        now = time.time()
+        requests = []
+        max_wait = 0
+        for request, parked_at in self.parked:
+            wait = now - parked_at
+            max_wait = max(max_wait, wait)
+            self._inc_stat("session/parked_wait_time", count=wait)
+            requests.append(request)
+        if self.stats is not None and self.parked:
+            self.stats.max_value("session/parked_wait_time_max", max_wait)
+        self.parked = []
+        self.relogin_in_progress = False
+        return requests
+
+    def finish_relogin(self, expires_at=None):
+        """
+        Mark the re-login as successful, and return the parked requests
+        so that they can be replayed.
+        """
+        self.expires_at = expires_at
+        return self._release()
+
+    def fail_relogin(self):
+        """
+        Mark the re-login as failed, and return the parked requests that
+        will not be replayed.
+        """
+        self._inc_stat("session/relogin_failed")
+        return self._release()
+
+    def set_expiry(self, expires_at):
+        "Record when the current session is known to expire."
+        self.expires_at = expires_at
+
+    def needs_refresh(self, now=None):
+        """
+        Returns True if the current session will expire within the refresh
+        margin, and a re-login is not already in progress.
+        """
+        if self.expires_at is None or self.relogin_in_progress:
+            return False
+        if now is None:
+            now = time.time()
+        return now >= self.expires_at - self.refresh_margin
+
+
+class Identity(object):
+    """
+    A user that the crawler crawls as. Each identity has its own Scrapy
+    cookiejar, so that its session is kept separate from the others, and
+    its own session manager, so that it can log in again independently.
+    """
+    def __init__(self, cookiejar, email=None, password=None):
+        self.cookiejar = cookiejar
+        self.email = email
+        self.password = password
+        self.session = SessionManager()
+        self.ready = False
+        self.failed = False
+
+    @property
+    def settled(self):
+        "Has this identity either logged in, or failed to?"
+        return self.ready or self.failed
@@ -21,6 +21,24 @@ ITEM_PIPELINES = {
     'pa11ycrawler.pipelines.DuplicatesPipeline': 200,
     'pa11ycrawler.pipelines.DropDRFPipeline': 250,
     'pa11ycrawler.pipelines.Pa11yPipeline': 300,
+    'pa11ycrawler.pipelines.ReportPipeline': 400,
+}
+
+# Configure extensions
+# See http://scrapy.readthedocs.org/en/latest/topics/extensions.html
+EXTENSIONS = {
+    'pa11ycrawler.extensions.StageMetrics': 500,
+    'pa11ycrawler.extensions.Profiling': 510,
+    'pa11ycrawler.extensions.MemoryTracker': 520,
+    'pa11ycrawler.extensions.FailFast': 530,
+    'pa11ycrawler.extensions.StatusServer': 540,
+    'pa11ycrawler.extensions.RunStats': 550,
+}
+
+# Configure downloader middlewares
+# See http://scrapy.readthedocs.org/en/latest/topics/downloader-middleware.html
+DOWNLOADER_MIDDLEWARES = {
+    'pa11ycrawler.middlewares.ContentTypeFilterMiddleware': 520,
 }
 
 # Other items you are likely to want to override ---------------
@@ -38,3 +56,181 @@ COMMANDS_MODULE = 'pa11ycrawler.commands'
 FAILURE_CATEGORIES = [
     'log_count/ERROR',
 ]
+# Performance budgets for `scrapy test`, as a dictionary with any of
+# max_wall_time (seconds), min_pages_per_second, max_audit_p95 (seconds),
+# max_retry_rate (0 to 1), and max_peak_rss_mb. Going over a budget fails the
+# process unless PERFORMANCE_BUDGETS_ENFORCE is False. The results are written
+# to PERFORMANCE_BUDGETS_FILE (by default, budgets.json in the data directory).
+PERFORMANCE_BUDGETS = {}
+PERFORMANCE_BUDGETS_ENFORCE = True
+PERFORMANCE_BUDGETS_FILE = None
+
+# Cancel the crawl as soon as any of the stats in FAIL_FAST_THRESHOLDS reaches
+# its threshold. `scrapy test --fail-fast` turns this on.
+FAIL_FAST_ENABLED = False
+FAIL_FAST_THRESHOLDS = {
+    'pa11y/error': 1,
+}
+FAIL_FAST_CHECK_INTERVAL = 1
+
+# Write the performance stats of each crawl to the `runs` directory of the
+# data directory, for the report's performance page, including the
+# RUN_STATS_TOP slowest pages and URL templates.
+RUN_STATS_ENABLED = True
+RUN_STATS_TOP = 10
+
+# Serve the status of the crawl as JSON at http://STATUS_HOST:STATUS_PORT/,
+# and accept commands to pause auditing or change the concurrency at
+# /control. If STATUS_TOKEN is set, requests must send it as a bearer token.
+STATUS_ENABLED = False
+STATUS_HOST = "127.0.0.1"
+STATUS_PORT = 6080
+STATUS_TOKEN = None
+
+# To crawl with several crawler processes at once, sharing one queue and one
+# set of seen requests, set SCHEDULER to
+# 'pa11ycrawler.frontier.FrontierScheduler', and FRONTIER_URL to the store:
+# either sqlite:///path/to/frontier.db (on a filesystem that every process
+# shares) or redis://host:port/db. Each crawl needs a store of its own (or,
+# for Redis, its own FRONTIER_KEY). A process that stops sending heartbeats
+# for FRONTIER_LEASE_TIMEOUT seconds has its requests given to the others.
+FRONTIER_URL = None
+FRONTIER_KEY = 'pa11ycrawler'
+FRONTIER_NODE = None
+FRONTIER_LEASE_TIMEOUT = 120
+FRONTIER_HEARTBEAT_INTERVAL = 10
+FRONTIER_MAX_ATTEMPTS = 3
+
+# Log in again this many seconds before the session cookie is known to expire
+SESSION_REFRESH_MARGIN = 300
+# Give up on a page after it was redirected to the login page this many
+# times, even though the crawler logged in again each time
+SESSION_MAX_REPLAYS = 3
+
+# Skip responses that pa11y can't audit, like PDFs, videos, and downloads
+CONTENT_FILTER_ENABLED = True
+CONTENT_FILTER_ALLOWED_TYPES = ['text/html', 'application/xhtml+xml']
+# Defaults to the extensions ignored by Scrapy's link extractors,
+# plus a few more that Open edX uses
+CONTENT_FILTER_DENY_EXTENSIONS = []
+# Send a HEAD request before the first GET request for each URL template
+CONTENT_FILTER_HEAD_PROBES = False
+# Skip a URL template once it has returned this many non-HTML responses,
+# and no HTML responses
+CONTENT_FILTER_CACHE_THRESHOLD = 3
+# Stop downloading any response larger than this many bytes (0 for no limit)
+CONTENT_FILTER_MAX_BODY_SIZE = 10 * 1024 * 1024
+
+# CSS selectors for the regions of a page that links are extracted from.
+# Links in the content regions are extracted from every page; links in the
+# chrome regions (header, footer, navigation) only the first time that the
+# same chrome is seen. Pages without any content region are scanned in full.
+# Leave these empty to use the defaults in pa11ycrawler.linkextractors.
+LINK_CONTENT_REGIONS = []
+LINK_CHROME_REGIONS = []
+# How many distinct chrome regions to remember
+LINK_CHROME_CACHE_SIZE = 1000
+
+# Store the body of every page that is audited in <data_dir>/snapshots,
+# so that the audits can be re-run with `pa11ycrawler-replay`
+SNAPSHOTS_ENABLED = False
+
+# Keep the HTML report in this directory up to date while crawling, like
+# `pa11ycrawler-html --output-dir` would make it after the crawl. The index
+# and unique violations pages are rendered every REPORT_FLUSH_INTERVAL
+# seconds, and when the crawl ends. Unless REPORT_COMPRESS is False, every
+# file is written with gzip and brotli compressed copies next to it.
+REPORT_OUTPUT_DIR = None
+REPORT_FLUSH_INTERVAL = 60
+REPORT_COMPRESS = True
+
+# Where to find the pa11y executable (defaults to node_modules/.bin/pa11y)
+PA11Y_PATH = None
+
+# Where to record that pa11y and phantomjs work, so that they aren't started
+# just to check them every time the crawler starts, until they change
+TOOLCHAIN_PROBE_CACHE = "~/.cache/pa11ycrawler/toolchain.json"
+
+# Limits for each pa11y process, and the phantomjs that it starts (see
+# pa11ycrawler/supervisor.py). An audit that takes longer than
+# AUDIT_TIMEOUT seconds is killed, and isn't retried. The memory limit
+# caps the address space of each process, which is usually much larger
+# than the memory that it uses, so it's off by default. Audits run with a
+# lower priority than the crawler, by AUDIT_NICENESS. 0 or None turns a
+# limit off.
+AUDIT_TIMEOUT = 120
+AUDIT_MAX_MEMORY_MB = None
+AUDIT_MAX_CPU_SECONDS = 600
+AUDIT_NICENESS = 10
+# How many pages are audited at once, in threads. 0 audits each page in the
+# reactor thread, which stops the crawler from doing anything else meanwhile.
+AUDIT_CONCURRENCY = 0
+
+# To run the audits in a cgroup with CPU and memory quotas, set
+# AUDIT_CGROUP_PARENT to a cgroup v2 directory that the crawler can write
+# to, like a systemd delegated cgroup. AUDIT_CGROUP_CPUS can be fractional.
+AUDIT_CGROUP_PARENT = None
+AUDIT_CGROUP_CPUS = None
+AUDIT_CGROUP_MEMORY_MB = None
+
+# Write only the pa11y results that aren't ignored, instead of writing the
+# raw results and applying the ignore rules when generating the report
+PA11Y_FILTER_AT_CRAWL_TIME = False
+
+# Where to cache the pa11y ignore rules from a pa11y_ignore_rules_url. The
+# rules are only downloaded again if they changed, and the cached copy is
+# used if the URL can't be fetched within PA11Y_IGNORE_RULES_TIMEOUT seconds.
+# Set PA11Y_IGNORE_RULES_RELOAD_INTERVAL to a number of seconds to load the
+# rules again that often during a crawl.
+PA11Y_IGNORE_RULES_CACHE_DIR = "~/.cache/pa11ycrawler/ignore-rules"
+PA11Y_IGNORE_RULES_TIMEOUT = 30
+PA11Y_IGNORE_RULES_RELOAD_INTERVAL = 0
+
+# Store each distinct pa11y violation only once, in violations.jsonl in the
+# data directory, and have each result refer to its violations by ID
+PA11Y_DEDUPLICATE_VIOLATIONS = False
+
+# The ID that the results of this crawl are recorded under in the data
+# directory's manifest; by default, the time that the crawl started. Give
+# every shard or frontier node of one crawl the same ID.
+RUN_ID = None
+
+# Record histograms of how long each stage of the crawl takes, and how deep
+# the queues get. They are written as JSON to METRICS_JSON_FILE (by default,
+# metrics.json in the data directory) and, if METRICS_PROMETHEUS_FILE is set,
+# in the Prometheus text format, for the node exporter's textfile collector.
+METRICS_ENABLED = True
+METRICS_SAMPLE_INTERVAL = 5
+METRICS_DUMP_INTERVAL = 60
+METRICS_JSON_FILE = None
+METRICS_PROMETHEUS_FILE = None
+
+# Profile the functions in PROFILE_TARGETS (by default, parse_item,
+# analyze_url_list, and every pipeline's process_item), and write the profile
+# to the `profiles` directory in the data directory. PROFILE_MODE is either
+# "deterministic" (cProfile, written as .pstats) or "sample" (stack samples
+# every PROFILE_INTERVAL seconds, written as collapsed stacks for
+# flamegraphs). Profiling stops after PROFILE_WINDOW seconds or
+# PROFILE_MAX_CALLS calls, if either is set.
+PROFILE_ENABLED = False
+PROFILE_TARGETS = []
+PROFILE_MODE = "deterministic"
+PROFILE_INTERVAL = 0.005
+PROFILE_WINDOW = 0
+PROFILE_MAX_CALLS = 0
+
+# Track the memory use of the crawler and of pa11y. Every
+# MEMORY_CHECK_INTERVAL seconds, the RSS is recorded in the stats, and if it's
+# over MEMORY_SOFT_LIMIT_MB (when set), the crawl is paused until it drops
+# below MEMORY_RESUME_RATIO of the limit, or for MEMORY_MAX_PAUSE seconds.
+# Every MEMORY_TRACKING_INTERVAL seconds, the allocation sites and object types
+# that grew the most are written to memory-report.jsonl in the data directory.
+MEMORY_TRACKING_ENABLED = False
+MEMORY_CHECK_INTERVAL = 10
+MEMORY_TRACKING_INTERVAL = 300
+MEMORY_TRACKING_TOP = 10
+MEMORY_TRACKING_FRAMES = 1
+MEMORY_OBJECT_COUNTS = True
+MEMORY_SOFT_LIMIT_MB = 0
+MEMORY_RESUME_RATIO = 0.9
+MEMORY_MAX_PAUSE = 60
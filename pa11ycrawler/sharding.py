@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Static sharding of a crawl across several crawler processes, and merging
+the data directories of the shards back together.
+
+Every page belongs to exactly one of `shard_count` shards, decided by a
+stable hash of its normalized URL (the same form that the
+DuplicatesPipeline uses), so every shard agrees on who audits what without
+talking to the others. Each shard still follows the links on every page
+it downloads, since a page may only be linked to from pages that belong to
+other shards, but it only runs pa11y on its own pages, which is where a
+crawl spends most of its time.
+"""
+import shutil
+import hashlib
+import argparse
+import logging
+from path import Path
+
+from pa11ycrawler.ignore import IGNORE_RULES_DIRNAME
+from pa11ycrawler.manifest import load_manifest, write_manifest
+from pa11ycrawler.runstats import RUNS_DIRNAME
+from pa11ycrawler.snapshots import INDEX_FILENAME
+from pa11ycrawler.util import normalize_url, result_files
+from pa11ycrawler.violations import VIOLATIONS_FILENAME, ViolationStore
+
+log = logging.getLogger(__name__)
+
+SNAPSHOTS_DIRNAME = "snapshots"
+
+
+def shard_for(url, shard_count):
+    "The index of the shard that the given URL belongs to."
+    digest = hashlib.md5(normalize_url(url).encode('utf8')).hexdigest()
+    return int(digest[:8], 16) % shard_count
+
+
+def check_shard(shard_index, shard_count):
+    """
+    Parse and validate the `shard_index` and `shard_count` spider arguments.
+    Returns them as integers.
+    """
+    shard_count = int(shard_count) if shard_count else 1
+    shard_index = int(shard_index) if shard_index else 0
+    if shard_count < 1:
+        raise ValueError(u"shard_count must be at least 1")
+    if not 0 <= shard_index < shard_count:
+        raise ValueError(u"shard_index must be between 0 and {max}".format(
+            max=shard_count - 1,
+        ))
+    return shard_index, shard_count
+
+
+def copy_tree(source, dest, skip=()):
+    """
+    Copy the files in the `source` directory into `dest`, recursively,
+    skipping files that already exist, and files whose paths (relative to
+    `source`) are in `skip`. Returns the number of files copied.
+    """
+    copied = 0
+    for path in source.walkfiles():
+        relpath = source.relpathto(path)
+        target = dest / relpath
+        if relpath in skip or target.exists():
+            continue
+        target.parent.makedirs_p()
+        shutil.copy2(path, target)
+        copied += 1
+    return copied
+
+
+def merge_data_dirs(sources, output_dir):
+    """
+    Merge the data directories of several shards into `output_dir`, so that
+    they can be made into one report. If a page was audited by more than
+    one shard (which can only happen if the shards were run with different
+    shard counts, or the same shard was run twice), only its latest result
+    is kept. The manifests, saved ignore rules, violation stores, snapshots
+    and run stats of every shard are merged as well.
+
+    Returns a dictionary of counts of what was merged.
+    """
+    output_dir = Path(output_dir)
+    sources = [Path(source) for source in sources]
+    if any(source.abspath() == output_dir.abspath() for source in sources):
+        raise ValueError(u"The output directory can't be one of the shards")
+    if output_dir.isdir() and result_files(output_dir):
+        msg = u"Output directory {dir} already contains pa11y results".format(dir=output_dir)
+        raise ValueError(msg)
+
+    stats = {
+        "results": 0, "duplicates": 0, "ignore_rules": 0, "violations": 0, "snapshots": 0,
+        "runs": 0,
+    }
+    latest = {}
+    for source in sources:
+        for entry in load_manifest(source):
+            url = normalize_url(entry["url"])
+            previous = latest.get(url)
+            if previous is not None:
+                stats["duplicates"] += 1
+                if previous[0]["accessed_at"] >= entry["accessed_at"]:
+                    continue
+            latest[url] = (entry, source / entry["filename"])
+
+    output_dir.makedirs_p()
+    for _, data_file in latest.values():
+        shutil.copy2(data_file, output_dir / data_file.name)
+    write_manifest(output_dir, sorted(
+        (entry for entry, _ in latest.values()), key=lambda entry: entry["accessed_at"],
+    ))
+    stats["results"] = len(latest)
+
+    violation_store = ViolationStore(output_dir)
+    for source in sources:
+        rules_dir = source / IGNORE_RULES_DIRNAME
+        if rules_dir.isdir():
+            stats["ignore_rules"] += copy_tree(rules_dir, output_dir / IGNORE_RULES_DIRNAME)
+
+        # each shard writes its own file for a run, which the report combines
+        runs_dir = source / RUNS_DIRNAME
+        if runs_dir.isdir():
+            stats["runs"] += copy_tree(runs_dir, output_dir / RUNS_DIRNAME)
+
+        if (source / VIOLATIONS_FILENAME).isfile():
+            for _, violation in ViolationStore(source).items():
+                violation_store.put(violation)
+
+        snapshot_dir = source / SNAPSHOTS_DIRNAME
+        if snapshot_dir.isdir():
+            out_snapshots = output_dir / SNAPSHOTS_DIRNAME
+            out_snapshots.makedirs_p()
+            stats["snapshots"] += copy_tree(
+                snapshot_dir, out_snapshots, skip=(INDEX_FILENAME,),
+            )
+            # the snapshots are content-addressed, but each shard has its
+            # own index of which page was served which snapshot
+            index = snapshot_dir / INDEX_FILENAME
+            if index.isfile():
+                with open(out_snapshots / INDEX_FILENAME, "a") as out_index:
+                    out_index.write(index.text())
+    if violation_store.path.isfile():
+        stats["violations"] = len(violation_store)
+    return stats
+
+
+def make_parser():
+    """
+    Returns an argparse instance for this script.
+    """
+    parser = argparse.ArgumentParser(
+        description="merge the data directories of a sharded crawl",
+    )
+    parser.add_argument(
+        "shards", nargs="+", metavar="SHARD_DATA_DIR",
+        help=u"Data directory of each shard",
+    )
+    parser.add_argument(
+        "--output-dir", default="data",
+        help=u"Directory to write the merged data to [%(default)s]"
+    )
+    return parser
+
+
+def main():
+    """
+    Validates script arguments and calls the merge_data_dirs() function
+    with them.
+    """
+    logging.basicConfig(level=logging.INFO)
+    parser = make_parser()
+    args = parser.parse_args()
+    shards = [Path(shard).expand() for shard in args.shards]
+    for shard in shards:
+        if not shard.isdir():  # pylint: disable=no-value-for-parameter
+            msg = u"Data directory {dir} does not exist".format(dir=shard)
+            raise ValueError(msg)
+    stats = merge_data_dirs(shards, Path(args.output_dir).expand())
+    for key in sorted(stats):
+        log.info(u"%s: %s", key, stats[key])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+"""
+Signals sent by pa11ycrawler, in addition to Scrapy's own.
+See: http://doc.scrapy.org/en/latest/topics/signals.html
+"""
+
+# Sent when the crawl is being cancelled before it's done, with `spider` and
+# `reason` arguments, so that work that's still queued can be skipped.
+crawl_cancelled = object()
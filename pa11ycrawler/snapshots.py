@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+A content-addressed store for the bodies of the pages that the crawler
+audits, so that the audits can be replayed later without the LMS.
+"""
+import os
+import json
+import gzip
+import hashlib
+import tempfile
+from datetime import datetime
+from path import Path
+
+from pa11ycrawler.util import DateTimeEncoder
+
+INDEX_FILENAME = "index.jsonl"
+
+
+class SnapshotStore(object):
+    """
+    Stores page bodies as gzipped files named after the SHA-1 hash of their
+    content, so that identical bodies are only stored once. An index file
+    records which URL was served which body, and when.
+    """
+    def __init__(self, root):
+        self.root = Path(root)
+        self.index_path = self.root / INDEX_FILENAME
+
+    def path_for(self, digest):
+        "Where the body with the given digest is stored."
+        return self.root / digest[:2] / digest + ".gz"
+
+    def __contains__(self, digest):
+        return self.path_for(digest).isfile()
+
+    def put(self, body):
+        """
+        Store the given body (a bytestring), unless an identical body is
+        already stored. Returns the digest of the body.
+        """
+        digest = hashlib.sha1(body).hexdigest()
+        path = self.path_for(digest)
+        if not path.isfile():
+            path.parent.makedirs_p()
+            # write to a temporary file first, so that a crash never
+            # leaves a truncated snapshot behind
+            fd, tmp_name = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+            with os.fdopen(fd, "wb") as tmp_file:
+                with gzip.GzipFile(fileobj=tmp_file, mode="wb") as gz_file:
+                    gz_file.write(body)
+            os.rename(tmp_name, path)
+        return digest
+
+    def get(self, digest):
+        "Returns the body with the given digest, as a bytestring."
+        with gzip.open(self.path_for(digest), "rb") as gz_file:
+            return gz_file.read()
+
+    def put_page(self, url, body, encoding=None, page_title=None, accessed_at=None):
+        """
+        Store the body of a page, and record it in the index.
+        Returns the digest of the body.
+        """
+        digest = self.put(body)
+        entry = {
+            "url": url,
+            "snapshot": digest,
+            "encoding": encoding,
+            "page_title": page_title,
+            "accessed_at": accessed_at or datetime.utcnow(),
+        }
+        self.root.makedirs_p()
+        with open(self.index_path, "a") as index_file:
+            index_file.write(json.dumps(entry, cls=DateTimeEncoder) + "\n")
+        return digest
+
+    def pages(self):
+        """
+        Returns the index entry of the latest snapshot of each URL.
+        """
+        latest = {}
+        if not self.index_path.isfile():
+            return []
+        with open(self.index_path) as index_file:
+            for line in index_file:
+                line = line.strip()
+                if not line:
+                    continue
+                entry = json.loads(line)
+                previous = latest.get(entry["url"])
+                if previous is None or entry["accessed_at"] >= previous["accessed_at"]:
+                    latest[entry["url"]] = entry
+        return list(latest.values())
@@ -4,28 +4,48 @@ A spider that can crawl an Open edX instance.
 import os
 import re
 import json
+import time
+import itertools
 from datetime import datetime
 # urlparse library depends on Python version
 try:
     from urllib.parse import urlparse
 except ImportError:
     from urlparse import urlparse
-from path import Path
-import yaml
-import requests
 from urlobject import URLObject
 import scrapy
+from scrapy import signals
 from scrapy.spiders import CrawlSpider, Rule
-from scrapy.linkextractors import LinkExtractor
 from scrapy.spidermiddlewares.httperror import HttpError
+from scrapy.exceptions import IgnoreRequest
+from twisted.internet import task, threads
 from twisted.internet.error import DNSLookupError
 from pa11ycrawler.items import A11yItem
+from pa11ycrawler.ignore import IgnoreRulesSource
+from pa11ycrawler.linkextractors import RegionLinkExtractor
+from pa11ycrawler.metrics import metrics_for
+from pa11ycrawler.session import Identity, get_session_expiry
+from pa11ycrawler.sharding import check_shard, shard_for
+from pa11ycrawler.snapshots import SnapshotStore
 
 LOGIN_HTML_PATH = "/login"
 LOGIN_API_PATH = "/user_api/v1/account/login_session/"
 AUTO_AUTH_PATH = "/auto_auth"
 COURSE_BLOCKS_API_PATH = "/api/courses/v1/blocks/"
 LOGIN_FAILURE_MSG = "We couldn't sign you in."
+LINK_DENY_PATTERNS = [
+    # don't crawl logout links
+    r"/logout/",
+    # don't crawl xblock links
+    r"://[^/]+/xblock/",
+    # don't crawl anything that returns an archive
+    r"\?_accept=application/x-tgz",
+]
+# login requests must jump ahead of the requests waiting for them
+LOGIN_PRIORITY = 100
+# how many times a request that was redirected to the login page is sent
+# again, by default
+MAX_REPLAYS = 3
 
 
 def get_csrf_token(response):
@@ -46,56 +66,52 @@ def get_csrf_token(response):
     return match.group(1)
 
 
-def load_pa11y_ignore_rules(file=None, url=None):  # pylint: disable=redefined-builtin
+def make_identities(email=None, password=None, count=None, single_url=None):
     """
-    Load the pa11y ignore rules from the given file or URL.
+    Build the list of identities that the crawler will crawl as.
+    `email` and `password` may be comma-separated lists, to crawl as several
+    existing users. If they are unset, or there is no password, each
+    identity will be created via the "auto auth" feature instead, and the
+    emails are ignored. `count` is the number of identities to
+    use: it defaults to the number of emails given, or 1. If there are more
+    identities than emails, the credentials are reused, with each identity
+    getting its own session.
     """
-    if not file and not url:
-        return None
+    emails = email.split(",") if email else []
+    passwords = password.split(",") if password else []
+    if not passwords:
+        # there's no way to log in as these users: use auto auth
+        emails = []
+    if len(emails) != len(passwords):
+        if len(passwords) != 1:
+            raise ValueError(
+                u"Got {emails} emails but {passwords} passwords".format(
+                    emails=len(emails), passwords=len(passwords),
+                )
+            )
+        passwords = passwords * len(emails)
 
-    if file:
-        file = Path(file)
-        if not file.isfile():
-            msg = (
-                u"pa11y_ignore_rules_file specified, but file does not exist! {file}"
-            ).format(file=file)
-            raise ValueError(msg)
-        return yaml.safe_load(file.text())
-
-    # must be URL
-    resp = requests.get(url)
-    if not resp.ok:
-        msg = (
-            u"pa11y_ignore_rules_url specified, but failed to fetch URL. status={status}"
-        ).format(status=resp.status_code)
-        err = RuntimeError(msg)
-        err.response = resp
-        raise err
-    return yaml.safe_load(resp.text)
+    if single_url:
+        # there's no load to spread when auditing a single page
+        count = 1
+    count = int(count) if count else max(len(emails), 1)
+    if count < 1:
+        raise ValueError(u"identities must be at least 1")
+
+    identities = []
+    for index in range(count):
+        identity = Identity(cookiejar=index)
+        if emails:
+            identity.email = emails[index % len(emails)]
+            identity.password = passwords[index % len(passwords)]
+        identities.append(identity)
+    return identities
 
 
 class EdxSpider(CrawlSpider):
     "A Scrapy spider that can crawl an Open edX instance."
     name = 'edx'
 
-    rules = (
-        Rule(
-            LinkExtractor(
-                deny=[
-                    # don't crawl logout links
-                    r"/logout/",
-                    # don't crawl xblock links
-                    r"://[^/]+/xblock/",
-                    # don't crawl anything that returns an archive
-                    r"\?_accept=application/x-tgz",
-                ],
-                unique=True,
-            ),
-            callback='parse_item',
-            follow=True,
-        ),
-    )
-
     def __init__(
             self,
             domain="localhost",
@@ -109,11 +125,25 @@ class EdxSpider(CrawlSpider):
             pa11y_ignore_rules_url=None,
             data_dir="data",
             single_url=None,
+            identities=None,
+            shard_index=None,
+            shard_count=None,
         ):  # noqa
+        # the rules must exist before CrawlSpider compiles them
+        self.link_extractor = RegionLinkExtractor(
+            deny=LINK_DENY_PATTERNS,
+            unique=True,
+        )
+        self.rules = (
+            Rule(
+                self.link_extractor,
+                callback='parse_item',
+                follow=True,
+                process_request='assign_identity',
+            ),
+        )
         super(EdxSpider, self).__init__()
 
-        self.login_email = email
-        self.login_password = password
         self.domain = domain
         self.port = int(port)
         self.course_key = course_key
@@ -121,9 +151,19 @@ class EdxSpider(CrawlSpider):
         self.http_pass = http_pass
         self.data_dir = os.path.abspath(os.path.expanduser(data_dir))
         self.single_url = single_url
-        self.pa11y_ignore_rules = load_pa11y_ignore_rules(
+        self.ignore_rules_source = IgnoreRulesSource(
             file=pa11y_ignore_rules_file, url=pa11y_ignore_rules_url,
         )
+        self.ignore_rules_reload_interval = 0
+        self.ignore_rules_reload_task = None
+        self.identities = make_identities(
+            email, password, identities, single_url=single_url,
+        )
+        self._identity_cycle = itertools.cycle(self.identities)
+        self.shard_index, self.shard_count = check_shard(shard_index, shard_count)
+        self._crawl_started = False
+        self.snapshots = None
+        self.max_replays = MAX_REPLAYS
 
         if single_url:
             self.start_urls = [single_url]
@@ -143,12 +183,170 @@ class EdxSpider(CrawlSpider):
             self.start_urls = [api_url]
         self.allowed_domains = [domain]
 
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super(EdxSpider, cls).from_crawler(crawler, *args, **kwargs)
+        settings = crawler.settings
+        crawler.signals.connect(spider.attach_stats, signal=signals.spider_opened)
+        if settings.getlist("LINK_CONTENT_REGIONS"):
+            spider.link_extractor.content_regions = settings.getlist("LINK_CONTENT_REGIONS")
+        if settings.getlist("LINK_CHROME_REGIONS"):
+            spider.link_extractor.chrome_regions = settings.getlist("LINK_CHROME_REGIONS")
+        spider.link_extractor.chrome_cache_size = settings.getint(
+            "LINK_CHROME_CACHE_SIZE", spider.link_extractor.chrome_cache_size,
+        )
+        if settings.getbool("SNAPSHOTS_ENABLED"):
+            spider.snapshots = SnapshotStore(
+                os.path.join(spider.data_dir, "snapshots")
+            )
+        refresh_margin = settings.getint("SESSION_REFRESH_MARGIN", 300)
+        for identity in spider.identities:
+            identity.session.refresh_margin = refresh_margin
+        spider.max_replays = settings.getint("SESSION_MAX_REPLAYS", MAX_REPLAYS)
+
+        source = spider.ignore_rules_source
+        source.cache_dir = settings.get("PA11Y_IGNORE_RULES_CACHE_DIR")
+        source.timeout = settings.getfloat("PA11Y_IGNORE_RULES_TIMEOUT", 30)
+        # the rules aren't needed until the first page is audited
+        source.start()
+        spider.ignore_rules_reload_interval = settings.getfloat(
+            "PA11Y_IGNORE_RULES_RELOAD_INTERVAL"
+        )
+        crawler.signals.connect(spider.start_reloading_ignore_rules, signal=signals.spider_opened)
+        crawler.signals.connect(spider.stop_reloading_ignore_rules, signal=signals.spider_closed)
+        return spider
+
+    @property
+    def pa11y_ignore_rules(self):
+        """
+        The pa11y ignore rules that pages are audited with. The first time,
+        this waits for them to be loaded.
+        """
+        return self.ignore_rules_source.rules
+
+    def reload_ignore_rules(self):
+        """
+        Load the ignore rules again, in a thread. Pages that are audited
+        after they've been loaded are audited with the new rules.
+        """
+        def reloaded(changed):
+            "Log the new rules."
+            if changed:
+                self.logger.info(u"Reloaded the pa11y ignore rules")
+                self.crawler.stats.inc_value("pa11y/ignore_rules_reloads", spider=self)
+        return threads.deferToThread(self.ignore_rules_source.reload).addCallback(reloaded)
+
+    def start_reloading_ignore_rules(self, spider):
+        """
+        Reload the ignore rules every PA11Y_IGNORE_RULES_RELOAD_INTERVAL
+        seconds, if it's set and there are rules to reload.
+        """
+        source = self.ignore_rules_source
+        if spider is not self or self.ignore_rules_reload_interval <= 0:
+            return
+        if not source.file and not source.url:
+            return
+        self.ignore_rules_reload_task = task.LoopingCall(self.reload_ignore_rules)
+        self.ignore_rules_reload_task.start(self.ignore_rules_reload_interval, now=False)
+
+    def stop_reloading_ignore_rules(self, spider):
+        "Stop reloading the ignore rules when the spider closes."
+        reload_task = self.ignore_rules_reload_task
+        if spider is self and reload_task is not None and reload_task.running:
+            reload_task.stop()
+
+    def attach_stats(self, spider):
+        """
+        Give the link extractor and the sessions the stats collector.
+        Newer versions of Scrapy only create it once the crawl starts,
+        so this can't happen in `from_crawler()`.
+        """
+        if spider is not self:
+            return
+        stats = self.crawler.stats
+        self.link_extractor.stats = stats
+        for identity in self.identities:
+            identity.session.stats = stats
+
+    # The first identity is the one that the crawler was configured with.
+    # These properties exist so that single-identity crawls can keep
+    # treating the spider as if it only had one set of credentials.
+    @property
+    def login_email(self):
+        "The email address of the first identity."
+        return self.identities[0].email
+
+    @login_email.setter
+    def login_email(self, value):
+        self.identities[0].email = value
+
+    @property
+    def login_password(self):
+        "The password of the first identity."
+        return self.identities[0].password
+
+    @login_password.setter
+    def login_password(self, value):
+        self.identities[0].password = value
+
+    @property
+    def session(self):
+        "The session manager of the first identity."
+        return self.identities[0].session
+
+    @property
+    def crawl_started(self):
+        """
+        Has the crawl of pages started? Until then, the FrontierScheduler
+        doesn't give this spider any pages that other nodes found, since
+        they would be redirected to the login page.
+        """
+        return self._crawl_started
+
+    def identity_for(self, request_or_response):
+        """
+        Returns the identity that the given request was sent as, or that
+        the given response was received as.
+        """
+        try:
+            meta = request_or_response.meta
+        except AttributeError:
+            # a response that isn't tied to a request has no meta
+            meta = {}
+        return self.identities[meta.get("cookiejar", 0)]
+
+    def assign_identity(self, request, response=None):  # pylint: disable=unused-argument
+        """
+        Distribute requests across all the identities that are logged in,
+        in round-robin order. Requests that were already assigned an
+        identity keep it.
+        """
+        if "cookiejar" in request.meta:
+            return request
+        for _ in self.identities:
+            identity = next(self._identity_cycle)
+            if not identity.failed:
+                break
+        request.meta["cookiejar"] = identity.cookiejar
+        return request
+
+    def in_shard(self, url):
+        "Does the given URL belong to this spider's shard of the crawl?"
+        if self.shard_count == 1 or self.single_url:
+            return True
+        return shard_for(url, self.shard_count) == self.shard_index
+
     def handle_error(self, failure):
         """
         Provides basic error information for bad requests.
         If the error was an HttpError or DNSLookupError, it
-        prints more specific information.
+        prints more specific information. Requests that were deliberately
+        ignored, like non-HTML pages, are not errors.
         """
+        if failure.check(IgnoreRequest):
+            self.logger.debug(failure.getErrorMessage())
+            return
+
         self.logger.error(repr(failure))
 
         if failure.check(HttpError):
@@ -169,12 +367,13 @@ class EdxSpider(CrawlSpider):
         """
         Gets the spider started.
         If both `self.login_email` and `self.login_password` are set,
-        this method generates a request to login with those credentials.
+        this method generates a request to login with those credentials,
+        for each identity.
         Otherwise, this method generates a request to go to the "auto auth"
-        page and get credentials from there. Either way, this method
-        doesn't actually generate requests from `self.start_urls` -- that is
-        handled by the `after_initial_login()` and `after_auto_auth()`
-        methods.
+        page and get credentials from there, for each identity. Either way,
+        this method doesn't actually generate requests from `self.start_urls`
+        -- that is handled by the `after_initial_login()` and
+        `after_auto_auth()` methods, once every identity has logged in.
         """
         if self.single_url:
             port = urlparse(self.single_url).port
@@ -183,6 +382,7 @@ class EdxSpider(CrawlSpider):
                     self.port = port
             else:
                 # No need for credentials
+                self._crawl_started = True
                 yield scrapy.Request(
                     self.single_url,
                     callback=self.parse_item,
@@ -190,42 +390,54 @@ class EdxSpider(CrawlSpider):
                 )
                 return
 
-        if self.login_email and self.login_password:
-            login_url = (
-                URLObject("http://")
-                .with_hostname(self.domain)
-                .with_port(self.port)
-                .with_path(LOGIN_HTML_PATH)
-            )
-            yield scrapy.Request(
-                login_url,
-                callback=self.after_initial_csrf,
-                errback=self.handle_error
-            )
-        else:
-            self.logger.info(
-                "email/password unset, fetching credentials via auto_auth"
-            )
-            auth_url = (
-                URLObject("http://")
-                .with_hostname(self.domain)
-                .with_port(self.port)
-                .with_path(AUTO_AUTH_PATH)
-                .set_query_params(
-                    staff='true',
-                    course_id=self.course_key,
-                )
-            )
-            # make sure to request a parseable JSON response
-            headers = {
-                b"Accept": b"application/json",
+        for identity in self.identities:
+            # logins belong to this crawler, even when it shares a frontier
+            # with others
+            meta = {
+                "cookiejar": identity.cookiejar,
+                "dont_filter_content": True,
+                "frontier_local": True,
             }
-            yield scrapy.Request(
-                auth_url,
-                headers=headers,
-                callback=self.after_auto_auth,
-                errback=self.handle_error
-            )
+            if identity.email and identity.password:
+                login_url = (
+                    URLObject("http://")
+                    .with_hostname(self.domain)
+                    .with_port(self.port)
+                    .with_path(LOGIN_HTML_PATH)
+                )
+                yield scrapy.Request(
+                    login_url,
+                    meta=meta,
+                    callback=self.after_initial_csrf,
+                    errback=self.handle_initial_login_error,
+                )
+            else:
+                self.logger.info(
+                    "email/password unset, fetching credentials via auto_auth"
+                )
+                auth_url = (
+                    URLObject("http://")
+                    .with_hostname(self.domain)
+                    .with_port(self.port)
+                    .with_path(AUTO_AUTH_PATH)
+                    .set_query_params(
+                        staff='true',
+                        course_id=self.course_key,
+                    )
+                )
+                # make sure to request a parseable JSON response
+                headers = {
+                    b"Accept": b"application/json",
+                }
+                yield scrapy.Request(
+                    auth_url,
+                    headers=headers,
+                    meta=meta,
+                    callback=self.after_auto_auth,
+                    errback=self.handle_initial_login_error,
+                    # every identity requests the same auto_auth URL
+                    dont_filter=True,
+                )
 
     def after_initial_csrf(self, response):
         """
@@ -236,6 +448,16 @@ class EdxSpider(CrawlSpider):
         and uses it to make a login request. The response to this login
         request will be handled by the `after_initial_login` method.
         """
+        request = self.make_login_request(response, callback=self.after_initial_login)
+        yield request.replace(errback=self.handle_initial_login_error)
+
+    def make_login_request(self, response, callback):
+        """
+        Build a request that logs in with the email and password
+        credentials of the identity that received the given response,
+        using the CSRF token from that response.
+        """
+        identity = self.identity_for(response)
         login_url = (
             URLObject("http://")
             .with_hostname(self.domain)
@@ -243,18 +465,25 @@ class EdxSpider(CrawlSpider):
             .with_path(LOGIN_API_PATH)
         )
         credentials = {
-            "email": self.login_email,
-            "password": self.login_password,
+            "email": identity.email,
+            "password": identity.password,
         }
         headers = {
             b"X-CSRFToken": get_csrf_token(response),
         }
-        yield scrapy.FormRequest(
+        return scrapy.FormRequest(
             login_url,
             formdata=credentials,
             headers=headers,
-            callback=self.after_initial_login,
-            errback=self.handle_error
+            meta={
+                "cookiejar": identity.cookiejar,
+                "dont_filter_content": True,
+                "frontier_local": True,
+            },
+            callback=callback,
+            errback=self.handle_error,
+            # every identity logs in at the same URL
+            dont_filter=True,
         )
 
     def after_initial_login(self, response):
@@ -262,72 +491,112 @@ class EdxSpider(CrawlSpider):
         This method is called *only* if the crawler is started with an
         email and password combination.
         It verifies that the login request was successful,
-        and then generates requests from `self.start_urls`.
+        and then generates requests from `self.start_urls`
+        if every identity has logged in.
         """
+        identity = self.identity_for(response)
         if LOGIN_FAILURE_MSG in response.text:
             self.logger.error(
                 "Credentials failed. Either add/update the current credentials "
                 "or remove them to enable auto auth"
             )
-            return
-
-        self.logger.info("successfully completed initial login")
-
-        if self.single_url:
-            yield scrapy.Request(
-                self.single_url,
-                callback=self.parse_item,
-                errback=self.handle_error
-            )
+            identity.failed = True
         else:
-            for url in self.start_urls:
-                yield scrapy.Request(
-                    url,
-                    callback=self.analyze_url_list,
-                    errback=self.handle_error
-                )
+            self.logger.info("successfully completed initial login")
+            identity.session.set_expiry(get_session_expiry(response))
+            identity.ready = True
+
+        for request in self.start_crawl():
+            yield request
 
     def after_auto_auth(self, response):
         """
         This method is called *only* if the crawler is started without an
         email and password combination. It parses the response from the
         "auto auth" feature, and saves the email and password combination.
-        Then it generates requests from `self.start_urls`.
+        Then it generates requests from `self.start_urls`
+        if every identity has logged in.
         """
+        identity = self.identity_for(response)
         result = json.loads(response.text)
-        self.login_email = result["email"]
-        self.login_password = result["password"]
+        identity.email = result["email"]
+        identity.password = result["password"]
         msg = (
             u"Obtained credentials via auto_auth! email={email} password={password}"
         ).format(**result)
         self.logger.info(msg)
+        identity.session.set_expiry(get_session_expiry(response))
+        identity.ready = True
+
+        for request in self.start_crawl():
+            yield request
+
+    def handle_initial_login_error(self, failure):
+        """
+        An identity failed to log in. The crawl goes on without it, as long
+        as at least one other identity logs in.
+        """
+        self.handle_error(failure)
+        self.identity_for(failure.request).failed = True
+        for request in self.start_crawl():
+            yield request
+
+    def start_crawl(self):
+        """
+        Once every identity has either logged in or failed to, generate
+        requests from `self.start_urls`. This happens only once per crawl.
+        """
+        if not all(identity.settled for identity in self.identities):
+            return
+        if not any(identity.ready for identity in self.identities):
+            return
+        if self._crawl_started:
+            return
+        self._crawl_started = True
 
         if self.single_url:
-            yield scrapy.Request(
+            yield self.assign_identity(scrapy.Request(
                 self.single_url,
                 callback=self.parse_item,
                 errback=self.handle_error
-            )
+            ))
         else:
             for url in self.start_urls:
-                yield scrapy.Request(
+                yield self.assign_identity(scrapy.Request(
                     url,
+                    meta={"dont_filter_content": True},
                     callback=self.analyze_url_list,
                     errback=self.handle_error
-                )
+                ))
 
     def analyze_url_list(self, response):
         """
         Parse JSON response for the beginning url(s) for
         the crawler.
         """
-        response = json.loads(response.text)
-        for _, block in response['blocks'].items():
-            for attribute in block:
-                parsed = urlparse(block[attribute])
-                # find urls in the JSON response
-                if parsed.scheme and parsed.netloc:
-                    yield self.make_requests_from_url(block[attribute])
+        # if the session expired, the blocks API redirects to the login
+        # page too: log in again, and ask for the blocks again after that
+        if URLObject(response.url).path == LOGIN_HTML_PATH:
+            for req in self.handle_unexpected_redirect_to_login_page(response):
+                yield req
+            return
+
+        requests = []
+        with metrics_for(self).timer("seed"):
+            response = json.loads(response.text)
+            for _, block in response['blocks'].items():
+                for attribute in block:
+                    parsed = urlparse(block[attribute])
+                    # find urls in the JSON response
+                    if parsed.scheme and parsed.netloc:
+                        requests.append(self.assign_identity(
+                            scrapy.Request(block[attribute], dont_filter=True)
+                        ))
+        if getattr(self, "crawler", None) is not None:
+            # how many pages the crawl starts with, for estimating its progress
+            self.crawler.stats.inc_value("seed/pages", count=len(requests), spider=self)
+        for request in requests:
+            yield request
 
     def parse_item(self, response):
         """
@@ -339,12 +608,30 @@ class EdxSpider(CrawlSpider):
         @returns requests 0 0
         @scrapes url request_headers accessed_at page_title
         """
-        # if we got redirected to a login page, then login
+        # if we got redirected to a login page, then login, and replay
+        # the original request once the login is done. The login page
+        # itself isn't worth auditing.
         if URLObject(response.url).path == LOGIN_HTML_PATH:
             reqs = self.handle_unexpected_redirect_to_login_page(response)
             for req in reqs:
                 yield req
+            return
+
+        # if our session is about to expire, refresh it before it does
+        identity = self.identity_for(response)
+        if identity.email and identity.password and identity.session.needs_refresh():
+            for req in self.refresh_session(identity):
+                yield req
+
+        # pages that belong to another shard are audited by that shard,
+        # but their links are still followed, since they may be the only
+        # way to find pages that belong to this one
+        if not self.in_shard(response.url):
+            if getattr(self, "crawler", None) is not None:
+                self.crawler.stats.inc_value("shard/skipped_pages", spider=self)
+            return
 
+        start = time.time()
         title = response.xpath("//title/text()").extract_first()
         if title:
             title = title.strip()
@@ -359,6 +646,9 @@ class EdxSpider(CrawlSpider):
         # We also need to convert bytes to ASCII. In practice, headers can
         # only contain ASCII characters: see
         # http://stackoverflow.com/questions/5423223/how-to-send-non-english-unicode-string-using-http-header
+        #
+        # Since each identity has its own cookiejar, these headers carry
+        # the session cookie of the identity that crawled this page.
         request_headers = {key.decode('ascii'): value[0].decode('ascii')
                            for key, value
                            in response.request.headers.items()}
@@ -368,6 +658,14 @@ class EdxSpider(CrawlSpider):
             accessed_at=datetime.utcnow(),
             page_title=title,
         )
+        if self.snapshots is not None:
+            item["snapshot"] = self.snapshots.put_page(
+                response.url, response.body,
+                encoding=response.encoding,
+                page_title=title,
+                accessed_at=item["accessed_at"],
+            )
+        metrics_for(self).observe("parse_item", time.time() - start)
         yield item
 
     def handle_unexpected_redirect_to_login_page(self, response):
@@ -377,47 +675,143 @@ class EdxSpider(CrawlSpider):
         logged-in user, the crawler will be redirected to a login page,
         with the originally-requested URL as the `next` query parameter.
 
-        This method simply causes the crawler to log back in using the saved
-        email and password credentials. We rely on the fact that the login
-        page will redirect the user to the URL in the `next` query parameter
-        if the login is successful -- this will allow the crawl to resume
-        where it left off.
+        Many in-flight requests can be redirected to the login page at once,
+        but only one of them logs the identity back in using its saved
+        email and password credentials. The originally-requested URLs are
+        parked with the identity's session manager, and replayed by
+        `after_login()` once the login is successful.
+
+        A request that is still redirected after it was replayed
+        `max_replays` times is given up on: logging in again isn't helping.
+        """
+        replays = response.meta.get("login_replays", 0)
+        if replays >= self.max_replays:
+            url = (response.meta.get("redirect_urls") or [response.url])[0]
+            self.logger.error(
+                u"Still redirected to the login page after logging in again "
+                u"%d times, giving up on %s", replays, url,
+            )
+            if getattr(self, "crawler", None) is not None:
+                self.crawler.stats.inc_value("session/abandoned_requests", spider=self)
+            return
+
+        session = self.identity_for(response).session
+        replay = self.make_replay_request(response)
+        if replay is not None:
+            session.park(replay)
+
+        if session.begin_relogin():
+            self.logger.info("session expired, logging in again")
+            request = self.make_login_request(response, callback=self.after_login)
+            yield request.replace(
+                priority=LOGIN_PRIORITY,
+                errback=self.handle_relogin_error,
+            )
 
-        This is method is very much like the `get_initial_login()` method,
-        but the callback is `self.after_login` instead of
-        `self.after_initial_login`.
+    def make_replay_request(self, response):
+        """
+        Given a response that was redirected to the login page, build a
+        request for the URL that was originally requested, so that it can
+        be sent again after logging in. Returns None if the original URL
+        can't be determined. The replay counts how many times the request
+        has been replayed in its `login_replays` meta key.
         """
         next_url = URLObject(response.url).query_dict.get("next")
+        redirect_urls = response.meta.get("redirect_urls")
+        if next_url:
+            url = response.urljoin(next_url)
+        elif redirect_urls:
+            url = redirect_urls[0]
+        else:
+            return None
+
+        request = response.request
+        meta = {
+            key: value for key, value in request.meta.items()
+            if not key.startswith("redirect_")
+        }
+        meta["login_replays"] = request.meta.get("login_replays", 0) + 1
+        # it's parked until this crawler's identity has logged in again
+        meta["frontier_local"] = True
+        replay = request.replace(url=url, meta=meta, dont_filter=True)
+        # drop the stale session cookie, so that the cookies middleware
+        # sends the fresh one instead
+        replay.headers.pop("Cookie", None)
+        return replay
+
+    def refresh_session(self, identity):
+        """
+        Log the given identity in again before its current session expires,
+        so that requests don't get redirected to the login page in the
+        first place.
+        """
+        if not identity.session.begin_relogin(proactive=True):
+            return
+        self.logger.info("session about to expire, refreshing it")
         login_url = (
             URLObject("http://")
             .with_hostname(self.domain)
             .with_port(self.port)
-            .with_path(LOGIN_API_PATH)
+            .with_path(LOGIN_HTML_PATH)
         )
-        if next_url:
-            login_url = login_url.set_query_param("next", next_url)
-
-        credentials = {
-            "email": self.login_email,
-            "password": self.login_password,
-        }
-        headers = {
-            b"X-CSRFToken": get_csrf_token(response),
-        }
-        yield scrapy.FormRequest(
+        yield scrapy.Request(
             login_url,
-            formdata=credentials,
-            headers=headers,
-            callback=self.after_login,
-            errback=self.handle_error
+            meta={
+                "cookiejar": identity.cookiejar,
+                "dont_filter_content": True,
+                "frontier_local": True,
+            },
+            callback=self.after_refresh_csrf,
+            errback=self.handle_relogin_error,
+            dont_filter=True,
+            priority=LOGIN_PRIORITY,
         )
 
+    def after_refresh_csrf(self, response):
+        """
+        Use the CSRF token from the login page to log in again,
+        as part of a proactive session refresh.
+        """
+        request = self.make_login_request(response, callback=self.after_login)
+        yield request.replace(
+            priority=LOGIN_PRIORITY,
+            errback=self.handle_relogin_error,
+        )
+
+    def handle_relogin_error(self, failure):
+        """
+        A re-login request failed: report the error, and give up on the
+        requests that were waiting for it.
+        """
+        self.handle_error(failure)
+        self.abandon_relogin(self.identity_for(failure.request))
+
+    def abandon_relogin(self, identity):
+        """
+        Give up on the requests that were waiting for a failed re-login.
+        """
+        dropped = identity.session.fail_relogin()
+        if dropped:
+            self.logger.error(
+                u"Re-login failed, dropping %d parked requests", len(dropped)
+            )
+
     def after_login(self, response):
         """
         This is very much like the `after_initial_login()` method, but
-        it searches for links in the response instead of generating
-        requests from `self.start_urls`.
+        it replays the requests that were parked while logging in again,
+        instead of generating requests from `self.start_urls`.
         """
-        # delegate to the `parse_item()` method, which handles normal responses.
-        for item in self.parse_item(response):
-            yield item
+        identity = self.identity_for(response)
+        if LOGIN_FAILURE_MSG in response.text:
+            self.logger.error(
+                "Credentials failed. Either add/update the current credentials "
+                "or remove them to enable auto auth"
+            )
+            self.abandon_relogin(identity)
+            return
+
+        self.logger.info("successfully logged in again")
+        replays = identity.session.finish_relogin(get_session_expiry(response))
+        for request in replays:
+            yield request
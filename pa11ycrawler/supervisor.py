@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+"""
+Starts and supervises the pa11y processes that audit each page.
+
+pa11y runs phantomjs, which can use gigabytes of memory on a heavy page, or
+hang forever. Each pa11y process is started in a process group of its own,
+so that it can be killed along with its phantomjs, and optionally:
+
+* with resource limits on its address space and CPU time, which are
+  inherited by phantomjs;
+* in a cgroup with CPU and memory quotas, on Linux with a cgroup v2
+  hierarchy that the crawler is allowed to write to;
+* with a lower priority than the crawler, so the Twisted reactor stays
+  responsive while pages are audited.
+
+A watchdog kills any audit that takes longer than its timeout. The
+processes are all marked with an environment variable holding the
+crawler's process ID, so that processes left behind by a crawler that
+crashed can be found and killed the next time the crawler starts.
+"""
+import os
+import sys
+import errno
+import signal
+import logging
+import threading
+import subprocess as sp
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+from pa11ycrawler.util import call_in_reactor
+
+log = logging.getLogger(__name__)
+
+# the environment variable that marks a process as started by a crawler
+MARKER_ENV = "PA11YCRAWLER_SUPERVISOR"
+PROC_DIR = "/proc"
+# the period for the CPU quota of the cgroup, in microseconds
+CGROUP_CPU_PERIOD = 100000
+# whether the limits can be applied to a process after it's started
+# (Linux, with Python 3), rather than between fork and exec
+PRLIMIT = hasattr(resource, "prlimit") and hasattr(os, "setpriority")
+
+
+def process_exists(pid):
+    "Is there a process with the given ID?"
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno == errno.EPERM
+    return True
+
+
+def kill_group(pgid):
+    """
+    Kill every process in the given process group. Returns False if the
+    group no longer exists.
+    """
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except OSError as err:
+        if err.errno == errno.ESRCH:
+            return False
+        raise
+    return True
+
+
+def marked_processes(proc_dir=PROC_DIR):
+    """
+    Yield `(pid, supervisor pid)` pairs for every process that was started
+    by a crawler, by reading their environments from `/proc`. Processes
+    whose environments can't be read are skipped. Yields nothing if there
+    is no `/proc`.
+    """
+    marker = MARKER_ENV.encode("ascii") + b"="
+    if not os.path.isdir(proc_dir):
+        return
+    for name in os.listdir(proc_dir):
+        if not name.isdigit():
+            continue
+        try:
+            with open(os.path.join(proc_dir, name, "environ"), "rb") as environ:
+                variables = environ.read().split(b"\0")
+        except (IOError, OSError):
+            continue
+        for variable in variables:
+            if variable.startswith(marker):
+                try:
+                    yield int(name), int(variable[len(marker):])
+                except ValueError:
+                    pass
+                break
+
+
+def peak_children_rss_mb():
+    """
+    The peak resident set size of the largest child process that has
+    exited so far (including phantomjs, which pa11y waits for), in MB.
+    """
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    if sys.platform == "darwin":
+        return maxrss / (1024.0 * 1024.0)
+    return maxrss / 1024.0
+
+
+class AuditCgroup(object):
+    """
+    A cgroup (v2) for the audit processes, created inside `parent`, with a
+    CPU quota of `cpus` CPUs and a memory limit of `memory_mb` MB.
+    """
+    def __init__(self, parent, cpus=None, memory_mb=None):
+        self.path = os.path.join(parent, "pa11ycrawler-{}".format(os.getpid()))
+        self.cpus = cpus
+        self.memory_mb = memory_mb
+
+    def create(self):
+        "Create the cgroup, and set its quotas."
+        if not os.path.isdir(self.path):
+            os.mkdir(self.path)
+        if self.cpus:
+            self.write("cpu.max", "{quota} {period}".format(
+                quota=int(self.cpus * CGROUP_CPU_PERIOD), period=CGROUP_CPU_PERIOD,
+            ))
+        if self.memory_mb:
+            self.write("memory.max", str(int(self.memory_mb * 1024 * 1024)))
+            # don't swap instead of being killed
+            self.write("memory.swap.max", "0", required=False)
+
+    def write(self, name, value, required=True):
+        "Write a value into one of the cgroup's files."
+        try:
+            with open(os.path.join(self.path, name), "w") as control:
+                control.write(value)
+        except (IOError, OSError):
+            if required:
+                raise
+
+    def add(self, pid):
+        "Move a process into the cgroup."
+        self.write("cgroup.procs", str(pid))
+
+    def remove(self):
+        "Remove the cgroup, once there are no processes left in it."
+        try:
+            os.rmdir(self.path)
+        except OSError as err:
+            log.warning(u"Couldn't remove the cgroup %s: %s", self.path, err)
+
+
+class AuditSupervisor(object):
+    """
+    Starts the audit processes, applies their limits, and kills them when
+    they take too long, when the crawl is closed, or when they were left
+    behind by a crawler that crashed.
+
+    Limits of 0 or None aren't applied. `stats` is a Scrapy stats collector,
+    which records how many processes were started and killed, and the peak
+    memory use of the largest one, under `pa11y/children/`.
+    """
+    def __init__(self, max_memory_mb=None, max_cpu_seconds=None, timeout=None,
+                 niceness=0, cgroup=None, stats=None):
+        self.max_memory_mb = max_memory_mb
+        self.max_cpu_seconds = max_cpu_seconds
+        self.timeout = timeout
+        self.niceness = niceness
+        self.cgroup = cgroup
+        self.stats = stats
+        self.children = {}
+        # why each of the processes that we killed was killed
+        self.kill_reasons = {}
+        self.lock = threading.Lock()
+        self.spawn_lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, settings, stats=None):
+        "Build the supervisor from the crawler settings."
+        cgroup = None
+        if settings.get("AUDIT_CGROUP_PARENT"):
+            cgroup = AuditCgroup(
+                settings.get("AUDIT_CGROUP_PARENT"),
+                cpus=settings.getfloat("AUDIT_CGROUP_CPUS"),
+                memory_mb=settings.getint("AUDIT_CGROUP_MEMORY_MB"),
+            )
+        return cls(
+            max_memory_mb=settings.getint("AUDIT_MAX_MEMORY_MB"),
+            max_cpu_seconds=settings.getint("AUDIT_MAX_CPU_SECONDS"),
+            timeout=settings.getfloat("AUDIT_TIMEOUT"),
+            niceness=settings.getint("AUDIT_NICENESS"),
+            cgroup=cgroup,
+            stats=stats,
+        )
+
+    def inc_stat(self, key, count=1):
+        """
+        Increment one of the `pa11y/children/` stats. Audits can run in
+        threads, so this is done in the reactor's thread.
+        """
+        if self.stats is not None:
+            call_in_reactor(self.stats.inc_value, "pa11y/children/" + key, count=count)
+
+    def open(self):
+        """
+        Get ready to start processes: kill the processes that crawlers that
+        are no longer running left behind, and create the cgroup.
+        """
+        self.kill_orphans()
+        if self.cgroup is not None:
+            try:
+                self.cgroup.create()
+            except (IOError, OSError) as err:
+                log.warning(
+                    u"Auditing without a cgroup: couldn't create %s: %s", self.cgroup.path, err,
+                )
+                self.cgroup = None
+
+    def rlimits(self):
+        "The resource limits of the audit processes, as `(resource, (soft, hard))` pairs."
+        limits = []
+        if resource is None:
+            return limits
+        if self.max_memory_mb:
+            limit = self.max_memory_mb * 1024 * 1024
+            limits.append((resource.RLIMIT_AS, (limit, limit)))
+        if self.max_cpu_seconds:
+            # SIGXCPU at the soft limit, and SIGKILL a second later
+            limits.append(
+                (resource.RLIMIT_CPU, (self.max_cpu_seconds, self.max_cpu_seconds + 1)),
+            )
+        return limits
+
+    def limit_child(self):
+        """
+        Runs in each child process before pa11y starts, where the limits
+        can't be applied from outside (without `resource.prlimit`): puts it
+        in a process group of its own, and applies the limits. The crawler
+        may be running other threads, so this only makes system calls.
+        """
+        os.setsid()
+        for limit, value in self.rlimits():
+            resource.setrlimit(limit, value)
+        if self.niceness:
+            os.nice(self.niceness)
+
+    def limit_started(self, pid):
+        """
+        Apply the limits to a process that was just started, and add it to
+        the cgroup. pa11y (a node script) takes much longer to start than
+        this does, so the phantomjs that it starts inherits them.
+        """
+        try:
+            if PRLIMIT:
+                for limit, value in self.rlimits():
+                    resource.prlimit(pid, limit, value)
+                if self.niceness:
+                    os.setpriority(
+                        os.PRIO_PROCESS, pid, os.getpriority(os.PRIO_PROCESS, pid) + self.niceness,
+                    )
+            if self.cgroup is not None:
+                self.cgroup.add(pid)
+        except (IOError, OSError) as err:
+            # it exited already, or the cgroup can't be written to
+            if err.errno != errno.ESRCH:
+                log.warning(u"Couldn't limit pa11y (pid %s): %s", pid, err)
+
+    def popen(self, args, **kwargs):
+        """
+        Start an audit process, with `subprocess.Popen`. This can be called
+        from several threads at once.
+        """
+        env = dict(kwargs.pop("env", None) or os.environ)
+        env[MARKER_ENV] = str(os.getpid())
+        if PRLIMIT:
+            proc = sp.Popen(args, env=env, start_new_session=True, **kwargs)
+        else:
+            # running Python code between fork and exec isn't safe while
+            # other threads are starting processes
+            with self.spawn_lock:
+                proc = sp.Popen(args, env=env, preexec_fn=self.limit_child, **kwargs)
+        self.limit_started(proc.pid)
+        with self.lock:
+            self.children[proc.pid] = proc
+        self.inc_stat("started")
+        return proc
+
+    def communicate(self, proc):
+        """
+        Wait for an audit process to finish, and return its output, like
+        `Popen.communicate()`. If it runs for longer than the timeout, its
+        process group is killed, and `proc.timed_out` is set. Processes that
+        were killed are counted in the stats, by the reason they were killed.
+        """
+        watchdog = None
+        if self.timeout:
+            watchdog = threading.Timer(self.timeout, self.kill_timed_out, [proc])
+            watchdog.daemon = True
+            watchdog.start()
+        try:
+            stdout, stderr = proc.communicate()
+        finally:
+            if watchdog is not None:
+                watchdog.cancel()
+            with self.lock:
+                self.children.pop(proc.pid, None)
+                reason = self.kill_reasons.pop(proc.pid, None)
+        proc.timed_out = reason == "timeout"
+        if reason:
+            self.inc_stat("killed_" + reason)
+        elif proc.returncode is not None and proc.returncode < 0:
+            # killed by a signal that wasn't ours, like SIGKILL from the
+            # kernel's out-of-memory killer, or SIGXCPU from the CPU limit
+            self.inc_stat("killed_signal")
+        return stdout, stderr
+
+    def kill_timed_out(self, proc):
+        "Kill an audit that is taking too long."
+        log.warning(u"Killing pa11y (pid %s): it ran for more than %s seconds", proc.pid, self.timeout)
+        self.kill(proc, "timeout")
+
+    def kill(self, proc, reason=None):
+        """
+        Kill an audit process, and every process in its group. The `reason`
+        is counted in the stats once the process has been waited for.
+        """
+        if reason:
+            with self.lock:
+                self.kill_reasons[proc.pid] = reason
+        proc.kill()
+        kill_group(proc.pid)
+
+    def kill_all(self, reason=None):
+        "Kill every audit process that is running. Returns how many there were."
+        with self.lock:
+            children = list(self.children.values())
+        for proc in children:
+            log.warning(u"Killing pa11y (pid %s): the crawl is %s", proc.pid, reason or "closing")
+            self.kill(proc, reason)
+        return len(children)
+
+    def kill_orphans(self, proc_dir=PROC_DIR, own=False):
+        """
+        Kill the processes left behind by crawlers that are no longer
+        running or, if `own` is set, by this one (like a phantomjs that
+        outlived its pa11y). Returns how many were killed.
+        """
+        running = {os.getpid(): not own}
+        killed = 0
+        for pid, supervisor in marked_processes(proc_dir):
+            if supervisor not in running:
+                running[supervisor] = process_exists(supervisor)
+            if running[supervisor]:
+                continue
+            log.warning(u"Killing pid %s, left behind by crawler pid %s", pid, supervisor)
+            try:
+                os.kill(pid, signal.SIGKILL)
+                killed += 1
+            except OSError:
+                pass
+        if killed:
+            self.inc_stat("orphans_killed", killed)
+        return killed
+
+    def close(self):
+        """
+        Kill the audit processes that are still running, record the peak
+        memory use of the audits, and remove the cgroup.
+        """
+        killed = self.kill_all()
+        if killed:
+            self.inc_stat("killed_closed", killed)
+        self.kill_orphans(own=True)
+        peak = peak_children_rss_mb()
+        if peak is not None and self.stats is not None:
+            self.stats.max_value("pa11y/children/peak_rss_mb", int(peak))
+        if self.cgroup is not None:
+            self.cgroup.remove()
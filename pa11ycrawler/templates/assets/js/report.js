@@ -0,0 +1,19 @@
+$(document).ready(function(){
+    // Add a label to the seach bar.
+    var label = $('<label class="sr-only" for="search-field">Filter Results:</label>'),
+        search_input = $('.search input').attr('id', 'search-field');
+    label.insertBefore(search_input);
+
+    $("#summary-toolbar").prependTo(".fixed-table-toolbar");
+
+    $('.filterby-btn').click(function(){
+        var filterBy = this.getAttribute('data-filterby');
+        var options = {}
+        if(filterBy) {
+            options.type = filterBy;
+        }
+        $('.table').bootstrapTable('filterBy', options);
+        $('.filterby-btn.current').removeClass('current').attr('aria-pressed', 'false');
+        $(this).addClass('current').attr('aria-pressed', 'true');
+    });
+});
@@ -1,8 +1,17 @@
 """
 Miscellaneous utilities for the crawler
 """
+import os
+import re
+import tempfile
 from json import JSONEncoder
 from datetime import datetime
+from urlobject import URLObject
+
+IDENTIFIER_RE = re.compile(r"[0-9:+@]")
+# pa11y results are named after the MD5 hash of their URL and access time;
+# other JSON files in the data directory (like metrics.json) aren't results
+RESULT_FILENAME_RE = re.compile(r"^[0-9a-f]{32}\.json$")
 
 
 class DateTimeEncoder(JSONEncoder):
@@ -29,3 +38,94 @@ def pa11y_counts(results):
         elif result['type'] == 'notice':
             num_notice += 1
     return num_error, num_warning, num_notice
+
+
+def is_sequence_start_page(url):
+    """
+    Does this URL (a URLObject) represent the first page in a section
+    sequence? E.g.
+    /courses/{coursename}/courseware/{block_id}/{section_id}/1
+    This will return the same page as the pattern
+    /courses/{coursename}/courseware/{block_id}/{section_id}.
+    """
+    return (
+        len(url.path.segments) == 6 and
+        url.path.segments[0] == 'courses' and
+        url.path.segments[2] == 'courseware' and
+        url.path.segments[5] == '1'
+    )
+
+
+def normalize_url(url):
+    """
+    Reduce a URL to the form that decides whether two URLs are the same
+    page: the querystring is removed, and the first page of a sequence is
+    the same as the sequence itself.
+    """
+    url = URLObject(url).without_query()
+    if is_sequence_start_page(url):
+        url = url.parent
+    return url
+
+
+def result_files(data_dir):
+    "The pa11y result files in a data directory (a `path.Path`)."
+    return [
+        path for path in data_dir.files("*.json")
+        if RESULT_FILENAME_RE.match(path.name)
+    ]
+
+
+def url_template(url):
+    """
+    Reduce a URL to a template that groups similar pages together, by
+    replacing each path segment that looks like an identifier (anything
+    containing digits, or the `:`, `+` and `@` characters used in Open edX
+    course and block keys) with `*`. File names are replaced with `*`, but
+    their extensions are kept. The querystring is dropped. For example,
+    /courses/course-v1:edX+Test101+course/courseware/1a2b/3c4d/2
+    becomes /courses/*/courseware/*/*/*.
+    """
+    segments = []
+    for segment in URLObject(url).path.segments:
+        base, dot, ext = segment.rpartition(".")
+        if not dot or not ext.isalnum():
+            base, ext = segment, ""
+        if ext or IDENTIFIER_RE.search(base):
+            base = "*"
+        segments.append(base + ("." + ext if ext else ""))
+    return "/" + "/".join(segments)
+
+
+def call_in_reactor(func, *args, **kwargs):
+    """
+    Call `func` in the reactor's thread, which is the only one that may
+    touch the crawl's stats and metrics: right away if this is that thread
+    (or the reactor isn't running), and otherwise with `reactor.callFromThread`.
+    """
+    from twisted.python import threadable
+    if threadable.ioThread is None or threadable.isInIOThread():
+        return func(*args, **kwargs)
+    # importing the reactor installs it, so this is only done from a thread
+    from twisted.internet import reactor
+    reactor.callFromThread(func, *args, **kwargs)
+    return None
+
+
+def write_atomic(path, text):
+    """
+    Write text (or bytes) to a file by writing a temporary file next to it,
+    and renaming it into place, so that readers never see a partial file.
+    """
+    path = os.path.abspath(path)
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, tmp_name = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    if not isinstance(text, bytes):
+        text = text.encode('utf8')
+    with os.fdopen(fd, "wb") as tmp_file:
+        tmp_file.write(text)
+    # temporary files are private, but other processes need to read this
+    os.chmod(tmp_name, 0o644)
+    os.rename(tmp_name, path)
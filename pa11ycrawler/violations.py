@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+A content-addressed store for the bodies of pa11y violations, shared by
+every result in a data directory.
+
+The same violation (with the same code, message, selector and HTML context)
+is usually found on many pages, and again in every run. When the crawler is
+run with `PA11Y_DEDUPLICATE_VIOLATIONS = True`, the body of each distinct
+violation is written once, to `violations.jsonl` in the data directory,
+under an ID made from a hash of its content. Each result then lists the IDs
+of its violations in `pa11y_refs`, as `[id, count]` pairs, instead of
+listing the violations themselves in `pa11y`.
+
+Use `load_result` to read a result file of either kind: references are
+resolved to the full violations as the result is loaded. The first result
+that is resolved with a store reads the whole store into memory, and the
+results after it reuse it, so a store should be shared by all the results
+that are read from one data directory.
+
+Nothing is ever removed from the file while crawling: `keep_only` rewrites
+it with just the violations that are still referred to, which
+`pa11ycrawler-compact` does after deleting old results.
+"""
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from pa11ycrawler.util import write_atomic
+
+log = logging.getLogger(__name__)
+
+VIOLATIONS_FILENAME = "violations.jsonl"
+# a 64-bit prefix of the SHA-1 hash is plenty to tell apart the distinct
+# violations in one data directory, and keeps the references short
+ID_LENGTH = 16
+
+
+def violation_id(violation):
+    "The ID of a violation: a hash of its content, as JSON with sorted keys."
+    text = json.dumps(violation, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(text.encode("utf8")).hexdigest()[:ID_LENGTH]
+
+
+class ViolationStore(object):
+    """
+    The violation bodies of a data directory, keyed by their IDs. The store
+    is an append-only file with one line of JSON per body, which is read
+    into memory in full the first time that a body is looked up or added. Each line is written
+    with a single call, so several crawlers can share one store; if they
+    both add the same body, the second copy is ignored when reading it.
+    """
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.path = data_dir / VIOLATIONS_FILENAME
+        self.bodies = None
+        # the IDs of the violations that have been stored, keyed by their
+        # items, so that repeated violations don't need to be hashed again
+        self.ids = {}
+        self.lock = threading.Lock()
+        # whether the last line of the file was cut off, so the next line
+        # that is appended needs to start on a line of its own
+        self.needs_newline = False
+
+    def load(self):
+        "Read the store into memory, if it hasn't been read yet."
+        if self.bodies is not None:
+            return
+        self.bodies = {}
+        if not self.path.isfile():
+            return
+        line = b""
+        with open(self.path, "rb") as store:
+            for number, line in enumerate(store, 1):
+                try:
+                    vid, body = json.loads(line.decode("utf8"))
+                except ValueError:
+                    log.warning(u"Skipping unreadable line %d of %s", number, self.path)
+                    continue
+                self.bodies.setdefault(vid, body)
+        self.needs_newline = bool(line) and not line.endswith(b"\n")
+
+    def __contains__(self, vid):
+        self.load()
+        return vid in self.bodies
+
+    def __len__(self):
+        self.load()
+        return len(self.bodies)
+
+    def items(self):
+        "The (ID, body) pairs in the store."
+        self.load()
+        return list(self.bodies.items())
+
+    def id_for(self, violation):
+        "The ID of a violation, looked up if it was stored before."
+        try:
+            key = tuple(sorted(violation.items()))
+        except TypeError:
+            # a value that isn't hashable, like a list
+            return violation_id(violation)
+        vid = self.ids.get(key)
+        if vid is None:
+            vid = self.ids[key] = violation_id(violation)
+        return vid
+
+    def add(self, violations):
+        """
+        Store the given violations, except those that are already stored,
+        with a single write. Returns the ID of each violation.
+        """
+        ids = []
+        lines = []
+        with self.lock:
+            self.load()
+            for violation in violations:
+                vid = self.id_for(violation)
+                if vid not in self.bodies:
+                    self.bodies[vid] = dict(violation)
+                    lines.append(json.dumps([vid, violation], sort_keys=True) + "\n")
+                ids.append(vid)
+            if lines:
+                if self.needs_newline:
+                    lines.insert(0, "\n")
+                    self.needs_newline = False
+                self.data_dir.makedirs_p()
+                with open(self.path, "ab") as store:
+                    store.write("".join(lines).encode("utf8"))
+        return ids
+
+    def put(self, violation):
+        """
+        Store a violation, unless an identical one is already stored.
+        Returns its ID.
+        """
+        return self.add([violation])[0]
+
+    def get(self, vid):
+        "Returns the violation with the given ID, or None if it isn't stored."
+        self.load()
+        return self.bodies.get(vid)
+
+    def pack(self, violations):
+        """
+        Store the given violations, and return references to them: a list of
+        `[id, count]` pairs, in the order that each violation first appears.
+        """
+        counts = OrderedDict()
+        for vid in self.add(violations):
+            counts[vid] = counts.get(vid, 0) + 1
+        return [[vid, count] for vid, count in counts.items()]
+
+    def keep_only(self, ids):
+        """
+        Rewrite the store with only the bodies that have the given IDs,
+        replacing the file in one step. Returns how many bodies were removed.
+        """
+        ids = set(ids)
+        with self.lock:
+            self.load()
+            kept = [(vid, body) for vid, body in self.bodies.items() if vid in ids]
+            removed = len(self.bodies) - len(kept)
+            if not removed:
+                return 0
+            write_atomic(self.path, u"".join(
+                json.dumps([vid, body], sort_keys=True) + u"\n" for vid, body in kept
+            ))
+            self.bodies = dict(kept)
+            self.ids = {key: vid for key, vid in self.ids.items() if vid in ids}
+            self.needs_newline = False
+        return removed
+
+    def unpack(self, refs):
+        """
+        Resolve a list of references to a list of violations. Each violation
+        is a new dictionary, so callers can change them without changing the
+        store. References to violations that aren't stored are left out.
+        """
+        violations = []
+        for vid, count in refs:
+            body = self.get(vid)
+            if body is None:
+                log.warning(u"Violation %s not found in %s", vid, self.path)
+                continue
+            violations.extend(dict(body) for _ in range(count))
+        return violations
+
+
+def load_result(path, store=None):
+    """
+    Load a pa11y result file, resolving its violation references (if any)
+    with the given store, or the store in the same data directory. The
+    violations are always in `pa11y`.
+    """
+    with open(path) as result_file:
+        data = json.load(result_file)
+    refs = data.pop("pa11y_refs", None)
+    if refs is not None:
+        if store is None:
+            store = ViolationStore(path.parent)
+        data["pa11y"] = store.unpack(refs)
+    return data
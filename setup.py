@@ -39,6 +39,7 @@ setup(
             'templates/*.*',
             'templates/assets/js/*.*',
             'templates/assets/css/*.*',
+            'templates/assets/fonts/*.*',
         ]
     },
     packages=[
@@ -46,9 +47,16 @@ setup(
         'pa11ycrawler.pipelines',
         'pa11ycrawler.spiders',
         'pa11ycrawler.commands',
+        'pa11ycrawler.middlewares',
+        'pa11ycrawler.extensions',
+        'pa11ycrawler.frontier',
     ],
     install_requires=get_requirements("requirements.txt"),
     tests_require=get_requirements("dev-requirements.txt"),
+    extras_require={
+        # writes brotli compressed copies of the report's files
+        'brotli': ['brotli'],
+    },
     license="Apache-2.0",
     classifiers=['Development Status :: 5 - Production/Stable',
                  'Environment :: Console',
@@ -68,6 +76,10 @@ setup(
     entry_points={
         'console_scripts': [
             'pa11ycrawler-html=pa11ycrawler.html:main',
+            'pa11ycrawler-replay=pa11ycrawler.replay:main',
+            'pa11ycrawler-merge=pa11ycrawler.sharding:main',
+            'pa11ycrawler-compact=pa11ycrawler.manifest:main',
+            'pa11ycrawler-diff=pa11ycrawler.diff:main',
         ]
     }
 )
@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+"""
+Fixtures shared by the tests.
+"""
+import pytest
+
+from fake_redis import FakeRedisServer
+
+
+@pytest.fixture
+def redis_server(request):
+    "A fake Redis server, running in a background thread during the test."
+    server = FakeRedisServer()
+    server.start()
+    request.addfinalizer(server.stop)
+    return server
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+A small stand-in for a Redis server, with just the commands that the
+frontier's RedisStore uses, for testing crawls with several nodes without a
+real Redis. The `redis_server` fixture in conftest.py runs one for a test;
+to run one by hand, `python tests/fake_redis.py [port]`.
+"""
+import time
+import threading
+# the socket server library depends on Python version
+try:
+    from socketserver import ThreadingMixIn, TCPServer, StreamRequestHandler
+except ImportError:
+    from SocketServer import ThreadingMixIn, TCPServer, StreamRequestHandler
+
+
+class RedisData(object):
+    "The keys of a fake Redis server, with one lock for every command."
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.expires = {}
+
+    def get(self, key, default=None):
+        "The value of a key, unless it has expired."
+        expires = self.expires.get(key)
+        if expires is not None and expires <= time.time():
+            self.values.pop(key, None)
+            self.expires.pop(key, None)
+        return self.values.get(key, default)
+
+    def run(self, command, args):  # pylint: disable=too-many-return-statements,too-many-branches
+        "Run a command, and return its reply."
+        command = command.upper()
+        if command in (b"PING", b"SELECT", b"AUTH"):
+            return u"PONG" if command == b"PING" else u"OK"
+        if command == b"FLUSHDB":
+            self.values.clear()
+            self.expires.clear()
+            return u"OK"
+        key = args[0]
+        if command == b"SET":
+            self.values[key] = args[1]
+            self.expires.pop(key, None)
+            if len(args) > 3 and args[2].upper() == b"PX":
+                self.expires[key] = time.time() + int(args[3]) / 1000.0
+            return u"OK"
+        if command == b"GET":
+            return self.get(key)
+        if command == b"EXISTS":
+            return int(self.get(key) is not None)
+        if command == b"DEL":
+            return sum(1 for name in args if self.values.pop(name, None) is not None)
+        if command == b"SADD":
+            members = self.values.setdefault(key, set())
+            added = [member for member in args[1:] if member not in members]
+            members.update(added)
+            return len(added)
+        if command == b"SMEMBERS":
+            return sorted(self.get(key, set()))
+        if command in (b"LPUSH", b"RPUSH"):
+            items = self.values.setdefault(key, [])
+            for item in args[1:]:
+                if command == b"LPUSH":
+                    items.insert(0, item)
+                else:
+                    items.append(item)
+            return len(items)
+        if command == b"RPOPLPUSH":
+            items = self.get(key, [])
+            if not items:
+                return None
+            item = items.pop()
+            self.values.setdefault(args[1], []).insert(0, item)
+            return item
+        if command == b"LREM":
+            items = self.get(key, [])
+            count = int(args[1])
+            removed = 0
+            while args[2] in items and (count == 0 or removed < abs(count)):
+                items.remove(args[2])
+                removed += 1
+            return removed
+        if command == b"LLEN":
+            return len(self.get(key, []))
+        if command == b"HSET":
+            fields = self.values.setdefault(key, {})
+            added = int(args[1] not in fields)
+            fields[args[1]] = args[2]
+            return added
+        if command == b"HSETNX":
+            fields = self.values.setdefault(key, {})
+            if args[1] in fields:
+                return 0
+            fields[args[1]] = args[2]
+            return 1
+        if command == b"HGET":
+            return self.get(key, {}).get(args[1])
+        if command == b"HDEL":
+            fields = self.get(key, {})
+            return sum(1 for field in args[1:] if fields.pop(field, None) is not None)
+        if command == b"HINCRBY":
+            fields = self.values.setdefault(key, {})
+            value = int(fields.get(args[1], 0)) + int(args[2])
+            fields[args[1]] = str(value).encode("ascii")
+            return value
+        if command == b"HGETALL":
+            reply = []
+            for field, value in sorted(self.get(key, {}).items()):
+                reply.extend([field, value])
+            return reply
+        return Exception(u"ERR unknown command '{}'".format(command.decode("ascii")))
+
+
+class FakeRedisRequestHandler(StreamRequestHandler):
+    "Reads commands in the Redis protocol, and writes their replies."
+    def read_command(self):
+        "Read one command, as a list of bytestrings, or None at the end."
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def write_reply(self, reply):
+        "Write a reply in the Redis protocol."
+        if reply is None:
+            self.wfile.write(b"$-1\r\n")
+        elif isinstance(reply, Exception):
+            self.wfile.write(u"-{}\r\n".format(reply).encode("utf8"))
+        elif isinstance(reply, bool) or isinstance(reply, int):
+            self.wfile.write(u":{}\r\n".format(int(reply)).encode("ascii"))
+        elif isinstance(reply, bytes):
+            self.wfile.write(u"${}\r\n".format(len(reply)).encode("ascii") + reply + b"\r\n")
+        elif isinstance(reply, list):
+            self.wfile.write(u"*{}\r\n".format(len(reply)).encode("ascii"))
+            for item in reply:
+                self.write_reply(item)
+        else:
+            self.wfile.write(u"+{}\r\n".format(reply).encode("utf8"))
+
+    def handle(self):
+        data = self.server.data
+        while True:
+            args = self.read_command()
+            if args is None:
+                return
+            with data.lock:
+                reply = data.run(args[0], args[1:])
+            self.write_reply(reply)
+            self.wfile.flush()
+
+
+class FakeRedisServer(ThreadingMixIn, TCPServer):
+    "A threaded fake Redis server, listening on a free local port."
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0):
+        self.data = RedisData()
+        TCPServer.__init__(self, ("127.0.0.1", port), FakeRedisRequestHandler)
+
+    @property
+    def port(self):
+        "The port that this server is listening on."
+        return self.server_address[1]
+
+    def start(self):
+        "Start serving requests in a background thread."
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stop(self):
+        "Stop serving requests."
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == "__main__":
+    import sys
+    SERVER = FakeRedisServer(port=int(sys.argv[1]) if len(sys.argv) > 1 else 6379)
+    print(u"Listening on port {}".format(SERVER.port))
+    SERVER.serve_forever()
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+import gzip
+from path import Path
+import pytest
+from pa11ycrawler import assets
+from pa11ycrawler.assets import BUNDLED_ASSETS, remove_precompressed, write_assets
+
+
+def test_write_assets(tmpdir):
+    output_dir = Path(tmpdir)
+    urls = write_assets(output_dir)
+    assert sorted(urls) == sorted(BUNDLED_ASSETS)
+    jquery = output_dir / urls["js/jquery.min.js"]
+    assert jquery.parent == output_dir / "assets" / "js"
+    assert jquery.name.startswith("jquery.min.") and jquery.name.endswith(".js")
+    data = jquery.bytes()
+    assert b"sourceMappingURL" not in data
+    with gzip.open(jquery + ".gz", "rb") as gz_file:
+        assert gz_file.read() == data
+    # fonts that are compressed already aren't compressed again
+    assert not Path(output_dir / urls["fonts/glyphicons-halflings-regular.woff2"] + ".gz").exists()
+
+    # the stylesheets refer to the fingerprinted fonts
+    css = (output_dir / urls["css/bootstrap.min.css"]).bytes()
+    font = Path(urls["fonts/glyphicons-halflings-regular.woff2"]).name
+    assert u"url(../fonts/{})".format(font).encode("ascii") in css
+
+    # the assets are only copied once
+    jquery.write_bytes(b"changed")
+    assert write_assets(output_dir) == urls
+    assert jquery.bytes() == b"changed"
+
+    # without compression, the old compressed copies are removed
+    write_assets(output_dir, compress=False)
+    assert not Path(jquery + ".gz").exists()
+    assert not Path(jquery + ".br").exists()
+
+
+def test_write_precompressed(tmpdir, monkeypatch):
+    path = Path(tmpdir) / "index.html"
+    path.write_text(u"<html>☃</html>", encoding="utf8")
+    brotli = pytest.importorskip("brotli")
+    assets.write_precompressed(path, u"<html>☃</html>")
+    assert brotli.decompress((path + ".br").bytes()) == path.bytes()
+    # a copy from when brotli was installed is removed
+    monkeypatch.setattr(assets, "brotli", None)
+    assets.write_precompressed(path, u"<html>☃</html>")
+    assert (path + ".gz").exists()
+    assert not (path + ".br").exists()
+    remove_precompressed(path)
+    assert not (path + ".gz").exists()
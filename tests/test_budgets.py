@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+import pytest
+from pa11ycrawler.budgets import budgets_from_settings, check_budgets
+
+
+STATS = {
+    "start_time": datetime(2016, 1, 1, 0, 0, 0),
+    "finish_time": datetime(2016, 1, 1, 0, 1, 40),
+    "item_scraped_count": 50,
+    "downloader/request_count": 60,
+    "retry/count": 3,
+    "pa11y/retries": 2,
+    "metrics/pipeline/pa11y/p95": 4.5,
+    "memusage/max": 300 * 1024 * 1024,
+}
+
+
+def test_check_budgets():
+    budgets = {
+        "max_wall_time": 120,
+        "min_pages_per_second": 1,
+        "max_audit_p95": 5,
+        "max_retry_rate": 0.01,
+        "max_peak_rss_mb": 500,
+    }
+    results = {result["budget"]: result for result in check_budgets(budgets, STATS)}
+    assert results["max_wall_time"]["value"] == 100
+    assert results["max_wall_time"]["status"] == "pass"
+    assert results["min_pages_per_second"]["value"] == 0.5
+    assert results["min_pages_per_second"]["status"] == "fail"
+    assert results["max_audit_p95"]["status"] == "pass"
+    # 5 retries out of 60 downloads and 52 pa11y runs
+    assert results["max_retry_rate"]["value"] == pytest.approx(5 / 112.0)
+    assert results["max_retry_rate"]["status"] == "fail"
+    assert results["max_peak_rss_mb"]["value"] == 300
+    assert results["max_peak_rss_mb"]["status"] == "pass"
+
+
+def test_check_budgets_unknown():
+    stats = {"memory/rss_mb_max": 700}
+    results = check_budgets({"max_audit_p95": 5, "max_peak_rss_mb": 500}, stats)
+    assert [result["status"] for result in results] == ["unknown", "fail"]
+
+
+def test_budgets_from_settings():
+    assert budgets_from_settings({}) == {}
+    assert budgets_from_settings({
+        "PERFORMANCE_BUDGETS": '{"max_wall_time": 60, "max_retry_rate": null}',
+    }) == {"max_wall_time": 60}
+    with pytest.raises(ValueError):
+        budgets_from_settings({"PERFORMANCE_BUDGETS": {"max_speed": 1}})
@@ -1,3 +1,4 @@
+import json
 import pytest
 from optparse import OptionParser
 from scrapy.crawler import CrawlerRunner
@@ -107,3 +108,49 @@ def test_passthrough_process_options_called(mocker):
 
     assert crawl_instance.process_options.call_count == 1
     process_options_spy.assert_called_with(fake_args, fake_opts)
+
+def test_run_performance_budgets(mocker, tmpdir):
+    """
+    Simulate a test run that goes over one of its performance budgets, and
+    ensure the process fails and writes a summary of the budgets.
+    """
+    from datetime import datetime
+    from scrapy.settings import Settings
+    mocker.patch('scrapy.commands.crawl.Command')
+    summary_file = tmpdir.join("budgets.json")
+    crawler = mocker.Mock()
+    crawler.settings = Settings({
+        'FAILURE_CATEGORIES': ['log_count/ERROR'],
+        'PERFORMANCE_BUDGETS': '{"max_wall_time": 60, "min_pages_per_second": 1}',
+        'PERFORMANCE_BUDGETS_FILE': str(summary_file),
+    })
+    crawler.stats = MemoryStatsCollector(crawler)
+    crawler.stats.set_value("start_time", datetime(2016, 1, 1, 0, 0, 0))
+    crawler.stats.set_value("finish_time", datetime(2016, 1, 1, 0, 0, 30))
+    crawler.stats.set_value("item_scraped_count", 15)
+    runner_instance = mocker.Mock()
+    runner_instance.create_crawler.return_value = crawler
+
+    from pa11ycrawler.commands.test import Command as TestCommand
+    tc = TestCommand()
+    tc.crawler_process = runner_instance
+    tc.run(['edx'], {})
+    assert tc.exitcode == 1
+    # the crawl runs the crawler whose stats are checked
+    tc.existing_crawl_command.run.assert_called_with([crawler], {})
+
+    summary = json.loads(summary_file.read())
+    assert summary["passed"] is False
+    assert summary["failure_categories"] == {'log_count/ERROR': 0}
+    assert [(b["budget"], b["status"]) for b in summary["budgets"]] == [
+        ("max_wall_time", "pass"),
+        ("min_pages_per_second", "fail"),
+    ]
+
+    # budgets can be reported without failing the process
+    crawler.settings.set('PERFORMANCE_BUDGETS_ENFORCE', False)
+    tc = TestCommand()
+    tc.crawler_process = runner_instance
+    tc.run(['edx'], {})
+    assert tc.exitcode == 0
+    assert json.loads(summary_file.read())["enforced"] is False
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+import sys
+import json
+from datetime import datetime
+from path import Path
+from pa11ycrawler import diff
+from pa11ycrawler.diff import diff_runs, merge_join, sorted_unique, INDEX_DIRNAME
+from pa11ycrawler.ignore import IgnoreRules
+from pa11ycrawler.pipelines.pa11y import write_pa11y_results
+
+
+def violation(selector, type_="error", code="WCAG2AA.H63", context="<th>"):
+    return {"type": type_, "code": code, "selector": selector, "context": context}
+
+
+def write_result(data_dir, url, accessed_at, run_id, results, ignore_rules=None):
+    item = {
+        "url": url,
+        "page_title": "Page",
+        "request_headers": {},
+        "accessed_at": accessed_at,
+    }
+    write_pa11y_results(item, results, data_dir, ignore_rules=ignore_rules, run_id=run_id)
+
+
+def write_runs(data_dir):
+    "Two nightly runs, with some violations fixed, and some new."
+    rules = IgnoreRules({"*": [{"selector": "#ignored"}]})
+    night1, night2 = datetime(2016, 1, 1), datetime(2016, 1, 2)
+    write_result(data_dir, "http://localhost/a", night1, "run1", [
+        violation("#fixed"), violation("#kept"), violation("#ignored"),
+    ], ignore_rules=rules)
+    write_result(data_dir, "http://localhost/gone", night1, "run1", [violation("#kept")])
+    write_result(data_dir, "http://localhost/a?x=1", night2, "run2", [
+        violation("#kept"), violation("#new"), violation("#ignored"),
+        # the same element, with different HTML
+        violation("#kept", context="<th scope='col'>"),
+        violation("#new", type_="notice", code="WCAG2AA.G141"),
+    ], ignore_rules=rules)
+
+
+def test_sorted_unique():
+    lines = [u"b\n", u"a\n", u"c\n", u"a\n", u"☃\n", u"b\n", u"d\n"]
+    expected = [u"a\n", u"b\n", u"c\n", u"d\n", u"☃\n"]
+    assert list(sorted_unique(lines)) == expected
+    # sorted in chunks, and merged
+    assert list(sorted_unique(lines, chunk_size=2)) == expected
+
+
+def test_merge_join():
+    base = [("a", "error"), ("b", "error"), ("d", "notice")]
+    head = [("b", "error"), ("c", "error"), ("d", "notice"), ("e", "warning")]
+    assert list(merge_join(iter(base), iter(head))) == [
+        ("fixed", ("a", "error")),
+        ("persisting", ("b", "error")),
+        ("new", ("c", "error")),
+        ("persisting", ("d", "notice")),
+        ("new", ("e", "warning")),
+    ]
+
+
+def test_diff_runs(tmpdir):
+    data_dir = Path(tmpdir)
+    write_runs(data_dir)
+    summary = diff_runs(data_dir, "run1", data_dir, "run2")
+    assert summary["counts"] == {
+        "new": {"error": 2, "notice": 1},
+        "fixed": {"error": 1},
+        "persisting": {"error": 1},
+        # the page wasn't audited again, so its violation isn't fixed
+        "unaudited": {"error": 1},
+    }
+    assert summary["head"]["pages"] == 1
+    new_errors = [group for group in summary["new"] if group["type"] == "error"]
+    assert sorted(group["selector"] for group in new_errors) == ["#kept", "#new"]
+    assert summary["fixed"][0]["selector"] == "#fixed"
+    assert summary["fixed"][0]["example_url"] == "http://localhost/a"
+    assert (data_dir / INDEX_DIRNAME / "run1.tsv").isfile()
+    assert u"Most common new violations" in diff.format_summary(summary)
+
+
+def test_diff_index_is_reused(tmpdir, mocker):
+    data_dir = Path(tmpdir)
+    write_runs(data_dir)
+    diff_runs(data_dir, "run1", data_dir, "run2")
+    build_index = mocker.spy(diff, "build_index")
+    diff_runs(data_dir, "run1", data_dir, "run2")
+    assert not build_index.called
+
+    # the run wasn't done when its index was built
+    write_result(data_dir, "http://localhost/b", datetime(2016, 1, 2), "run2", [])
+    summary = diff_runs(data_dir, "run1", data_dir, "run2")
+    assert build_index.call_count == 1
+    assert summary["head"]["pages"] == 2
+
+
+def test_main(tmpdir, mocker, capsys):
+    data_dir = Path(tmpdir)
+    write_runs(data_dir)
+    json_file = data_dir / "diff.json"
+    mocker.patch.object(sys, "argv", [
+        "pa11ycrawler-diff", "--data-dir", data_dir, "--json", json_file,
+    ])
+    # the latest run is compared with the one before it
+    assert diff.main() == 1
+    assert u"run1 with run2" in capsys.readouterr()[0]
+    assert json.loads(json_file.text())["counts"]["new"]["error"] == 2
+
+    mocker.patch.object(sys, "argv", [
+        "pa11ycrawler-diff", "--data-dir", data_dir, "--fail-on", "warning",
+    ])
+    assert diff.main() == 0
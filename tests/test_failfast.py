@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+import pytest
+from scrapy.exceptions import NotConfigured
+from scrapy.statscollectors import MemoryStatsCollector
+from scrapy.utils.test import get_crawler
+from pa11ycrawler.extensions import FailFast
+from pa11ycrawler.signals import crawl_cancelled
+
+
+def test_fail_fast_disabled():
+    with pytest.raises(NotConfigured):
+        FailFast.from_crawler(get_crawler())
+
+
+def test_fail_fast(mocker):
+    crawler = get_crawler(settings_dict={
+        "FAIL_FAST_ENABLED": True,
+        "FAIL_FAST_THRESHOLDS": {"pa11y/error": 3, "log_count/ERROR": 1},
+    })
+    crawler.stats = MemoryStatsCollector(crawler)
+    crawler.engine = mocker.Mock()
+    ext = FailFast.from_crawler(crawler)
+    cancelled = mocker.Mock()
+    crawler.signals.connect(cancelled, signal=crawl_cancelled)
+    spider = mocker.Mock()
+
+    crawler.stats.inc_value("pa11y/error", 2)
+    ext.check(spider)
+    assert not crawler.engine.close_spider.called
+
+    crawler.stats.inc_value("pa11y/error", 5)
+    ext.check(spider)
+    crawler.engine.close_spider.assert_called_once_with(spider, "fail_fast")
+    assert crawler.stats.get_value("fail_fast/stat") == "pa11y/error"
+    assert cancelled.call_count == 1
+    assert cancelled.call_args[1]["reason"] == "fail_fast"
+
+    # the crawl is only cancelled once
+    ext.check(spider)
+    assert crawler.engine.close_spider.call_count == 1
@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+import pytest
+from scrapy import FormRequest, Request, Spider
+from scrapy.exceptions import DropItem
+from scrapy.http import TextResponse
+from scrapy.utils.test import get_crawler
+from pa11ycrawler.frontier import FrontierScheduler, RedisStore, RedisConnection, open_store
+from pa11ycrawler.frontier.scheduler import LEASE_KEY, load_request
+from pa11ycrawler.pipelines import DuplicatesPipeline
+from pa11ycrawler.spiders.edx import EdxSpider
+
+
+@pytest.fixture(params=["sqlite", "redis"])
+def store_factory(request, tmpdir):
+    "Opens stores that share one frontier."
+    stores = []
+    if request.param == "redis":
+        server = request.getfixturevalue("redis_server")
+        url = "redis://127.0.0.1:{}/0".format(server.port)
+    else:
+        url = "sqlite:///" + str(tmpdir.join("frontier.db"))
+
+    def factory():
+        store = open_store(url, key="test")
+        stores.append(store)
+        return store
+
+    yield factory
+    for store in stores:
+        store.close()
+
+
+def test_store_seen(store_factory):
+    store = store_factory()
+    other = store_factory()
+    assert store.seen("a") is False
+    assert store.seen("a") is True
+    assert other.seen("a") is True
+    assert other.seen("b") is False
+
+
+def test_store_push_pop_ack(store_factory):
+    store = store_factory()
+    other = store_factory()
+    store.push("a", b"request a")
+    store.push("b", b"request b")
+    assert store.pending() == 2
+
+    assert store.pop("node1") == ("a", b"request a")
+    assert other.pop("node2") == ("b", b"request b")
+    assert store.pop("node1") is None
+    assert store.pending() == 0
+    assert store.in_progress() == 2
+    assert store.in_progress(exclude="node1") == 1
+
+    store.ack("node1", "a")
+    # only the node that leased a request can acknowledge it
+    store.ack("node1", "b")
+    assert store.in_progress() == 1
+    other.ack("node2", "b")
+    assert store.in_progress() == 0
+    assert store.node_counts() == {"node1": 1, "node2": 1}
+
+
+def test_store_claim(store_factory):
+    store = store_factory()
+    other = store_factory()
+    assert store.claim("page:a", "lease1")
+    assert store.claim("page:a", "lease1")
+    assert not other.claim("page:a", "lease2")
+    assert other.claim("page:b", "lease2")
+
+
+def test_store_requeue_expired(store_factory):
+    store = store_factory()
+    store.push("a", b"request a")
+    store.heartbeat("node1", lease_timeout=0.05)
+    store.heartbeat("node2", lease_timeout=60, busy=True)
+    assert store.pop("node1") == ("a", b"request a")
+    # node1 is still alive
+    assert store.requeue_expired(max_attempts=2) == (0, 0)
+    assert store.busy_nodes() == 1
+    assert store.busy_nodes(exclude="node2") == 0
+
+    time.sleep(0.1)
+    assert store.requeue_expired(max_attempts=2) == (1, 0)
+    assert store.pending() == 1
+    assert store.pop("node2") == ("a", b"request a")
+
+    store.heartbeat("node2", lease_timeout=0.05)
+    time.sleep(0.1)
+    # the second attempt failed as well, so the request is dropped
+    assert store.requeue_expired(max_attempts=2) == (0, 1)
+    assert store.pending() == 0
+    assert store.in_progress() == 0
+    assert store.pop("node1") is None
+
+
+def test_store_release(store_factory):
+    store = store_factory()
+    store.heartbeat("node1", lease_timeout=60, busy=True)
+    store.push("a", b"request a")
+    store.pop("node1")
+    assert store.release("node1") == 1
+    assert store.pending() == 1
+    assert store.busy_nodes() == 0
+
+
+def test_open_store():
+    with pytest.raises(ValueError):
+        open_store("mysql://localhost/frontier")
+
+
+def test_redis_store_keys(redis_server):
+    store = RedisStore(RedisConnection(port=redis_server.port), key="crawl")
+    store.push("a", b"request a")
+    assert store.pop("node1") == ("a", b"request a")
+    assert redis_server.data.values[b"crawl:leased:node1"] == [b"a"]
+    store.close()
+
+
+class FrontierSpider(Spider):
+    name = "test"
+
+    def parse(self, response):
+        yield {"url": "http://localhost/a"}
+        yield Request("http://localhost/c")
+
+
+def make_scheduler(tmpdir, node, spidercls=FrontierSpider, **kwargs):
+    "Make a frontier scheduler for the given node, and open it."
+    crawler = get_crawler(spidercls, {
+        "FRONTIER_URL": "sqlite:///" + str(tmpdir.join("frontier.db")),
+        "FRONTIER_NODE": node,
+        "JOBDIR": None,
+    })
+    spider = crawler._create_spider("test", **kwargs)  # pylint: disable=protected-access
+    scheduler = FrontierScheduler.from_crawler(crawler)
+    scheduler.open(spider)
+    return scheduler
+
+
+def test_scheduler_shares_requests(tmpdir):
+    scheduler1 = make_scheduler(tmpdir, "node1")
+    scheduler2 = make_scheduler(tmpdir, "node2")
+    try:
+        assert scheduler1.enqueue_request(Request("http://localhost/a"))
+        # both nodes found the same link
+        assert not scheduler2.enqueue_request(Request("http://localhost/a"))
+        assert scheduler2.has_pending_requests()
+
+        request = scheduler2.next_request()
+        assert request.url == "http://localhost/a"
+        assert request.meta[LEASE_KEY]
+        assert scheduler1.next_request() is None
+        # node1 waits for node2 to finish its request
+        assert scheduler1.has_pending_requests()
+
+        output = list(request.callback(None))
+        assert len(output) == 2
+        assert scheduler2.enqueue_request(output[1])
+        # the item still holds the lease, until it's through the pipelines
+        assert scheduler2.leases
+        assert scheduler1.has_pending_requests()
+        scheduler2.item_done(output[0], scheduler2.spider)
+        assert not scheduler2.leases
+        # node1 picks up the link that node2 found
+        request = scheduler1.next_request()
+        assert request.url == "http://localhost/c"
+        assert scheduler2.has_pending_requests()
+        request.errback(None)
+        # the cached counts are out of date until the next heartbeat
+        scheduler2.heartbeat()
+        assert not scheduler2.has_pending_requests()
+        assert scheduler2.stats.get_value("frontier/acked") == 1
+    finally:
+        scheduler1.close("finished")
+        scheduler2.close("finished")
+
+
+def test_scheduler_payloads(tmpdir):
+    scheduler = make_scheduler(tmpdir, "node1")
+    try:
+        request = FormRequest(
+            "http://localhost/form", formdata={"name": u"\xe9"},
+            callback=scheduler.spider.parse, meta={"depth": 2},
+        )
+        assert scheduler.enqueue_request(request)
+        _, payload = scheduler.store.pop("node1")
+        # requests are shared as JSON, not pickles
+        data = json.loads(payload.decode("utf-8"))
+        assert data["url"] == "http://localhost/form"
+        assert data["callback"] == "parse"
+
+        rebuilt = load_request(payload, scheduler.spider)
+        assert isinstance(rebuilt, FormRequest)
+        assert rebuilt.body == request.body
+        assert rebuilt.headers == request.headers
+        assert rebuilt.callback == scheduler.spider.parse
+        assert rebuilt.meta == {"depth": 2}
+
+        data["_class"] = "subprocess.Popen"
+        with pytest.raises(ValueError):
+            load_request(json.dumps(data).encode("utf-8"), scheduler.spider)
+    finally:
+        scheduler.close("finished")
+
+
+def test_scheduler_local_requests(tmpdir):
+    scheduler = make_scheduler(tmpdir, "node1")
+    try:
+        login = Request("http://localhost/login", meta={"frontier_local": True})
+        assert scheduler.enqueue_request(login)
+        assert scheduler.store.pending() == 0
+        assert scheduler.next_request() is login
+
+        # `dont_filter` alone doesn't keep a request on this node
+        assert scheduler.enqueue_request(Request("http://localhost/c", dont_filter=True))
+        assert scheduler.store.pending() == 1
+        assert not scheduler.enqueue_request(Request("http://localhost/c", dont_filter=True))
+        shared = scheduler.next_request()
+        assert shared.url == "http://localhost/c"
+        shared.errback(None)
+
+        # a redirect of a leased request stays on the node that leased it
+        scheduler.enqueue_request(Request("http://localhost/a"))
+        leased = scheduler.next_request()
+        redirect = leased.replace(url="http://localhost/b")
+        assert scheduler.enqueue_request(redirect)
+        assert scheduler.store.pending() == 0
+        assert scheduler.next_request().url == "http://localhost/b"
+
+        # the errback acknowledges the lease too
+        assert scheduler.leases
+        leased.errback(None)
+        assert not scheduler.leases
+    finally:
+        scheduler.close("finished")
+
+
+def test_scheduler_splits_seeded_pages(tmpdir):
+    urls = [
+        "http://localhost:8000/courses/course/jump_to/block-{}".format(index)
+        for index in range(10)
+    ]
+    blocks = {
+        "blocks": {
+            "block-{}".format(index): {"lms_web_url": url}
+            for index, url in enumerate(urls)
+        }
+    }
+    nodes = [
+        make_scheduler(tmpdir, node, EdxSpider, email="abc@def.com", password="xyz")
+        for node in ("node1", "node2")
+    ]
+    try:
+        # both nodes read the blocks API once they have logged in, and queue
+        # every page it lists
+        for scheduler in nodes:
+            scheduler.spider._crawl_started = True  # pylint: disable=protected-access
+            response = TextResponse(
+                url="http://localhost:8000/api/courses/v1/blocks/",
+                body=json.dumps(blocks).encode("utf-8"),
+            )
+            for request in scheduler.spider.analyze_url_list(response):
+                scheduler.enqueue_request(request)
+        assert nodes[0].store.pending() == len(urls)
+
+        # the nodes take turns pulling pages
+        pulled = {"node1": [], "node2": []}
+        for _ in range(len(urls)):
+            for scheduler in nodes:
+                request = scheduler.next_request()
+                if request is not None:
+                    pulled[scheduler.node].append(request.url)
+        assert pulled["node1"] and pulled["node2"]
+        assert sorted(pulled["node1"] + pulled["node2"]) == sorted(urls)
+    finally:
+        for scheduler in nodes:
+            scheduler.close("finished")
+
+
+def test_scheduler_caches_counts(tmpdir, mocker):
+    scheduler = make_scheduler(tmpdir, "node1")
+    other = make_scheduler(tmpdir, "node2")
+    try:
+        pending = mocker.spy(scheduler.store, "pending")
+        assert scheduler.enqueue_request(Request("http://localhost/a"))
+        assert scheduler.enqueue_request(Request("http://localhost/b"))
+        for _ in range(10):
+            assert scheduler.has_pending_requests()
+            assert len(scheduler) == 2
+        # the engine's ticks don't ask the store
+        assert pending.call_count == 0
+
+        # another node took one of them: the heartbeat finds out
+        assert other.next_request() is not None
+        scheduler.heartbeat()
+        assert len(scheduler) == 1
+        assert scheduler.others_working
+        assert pending.call_count == 1
+
+        # when the cached counts say the crawl is done, the store is asked
+        # before finishing
+        scheduler.shared_pending = 0
+        scheduler.others_working = False
+        assert scheduler.has_pending_requests()
+        assert pending.call_count == 2
+    finally:
+        scheduler.close("finished")
+        other.close("finished")
+
+
+def test_duplicates_pipeline_claims_pages(tmpdir):
+    scheduler1 = make_scheduler(tmpdir, "node1")
+    scheduler2 = make_scheduler(tmpdir, "node2")
+    try:
+        scheduler1.enqueue_request(Request("http://localhost/a"))
+        scheduler1.enqueue_request(Request("http://localhost/a?x=1"))
+        request1 = scheduler1.next_request()
+        request2 = scheduler2.next_request()
+        item1 = list(request1.callback(None))[0]
+        item2 = list(request2.callback(None))[0]
+
+        pipeline1 = DuplicatesPipeline()
+        pipeline2 = DuplicatesPipeline()
+        assert pipeline1.process_item(item1, scheduler1.spider) is item1
+        # the same page, found by a different request on another node
+        with pytest.raises(DropItem):
+            pipeline2.process_item(item2, scheduler2.spider)
+
+        # if node1 stops before the page is audited, its request is
+        # retried by another node, which can still claim the page
+        scheduler1.store.release("node1")
+        retried = scheduler2.next_request()
+        assert retried.url == "http://localhost/a"
+        item = list(retried.callback(None))[0]
+        assert DuplicatesPipeline().process_item(item, scheduler2.spider) is item
+    finally:
+        scheduler1.close("finished")
+        scheduler2.close("finished")
@@ -5,8 +5,10 @@ from path import Path
 
 import pytest
 
-from pa11ycrawler.html import render_html
+from pa11ycrawler.html import Report, render_html, group_violations, sparkline
+from pa11ycrawler.ignore import IgnoreRules, NO_IGNORE_RULES
 from pa11ycrawler.pipelines.pa11y import write_pa11y_results
+from pa11ycrawler.runstats import RunRecorder, write_run_stats
 
 
 @pytest.fixture(params=["Snowman", u"\u2603"])
@@ -41,8 +43,143 @@ def test_render_html(item, tmpdir_factory):
         "selector": "#fake > div",
     }]
     write_pa11y_results(item, pa11y_data, tmp_data_dir)
+    # other JSON files that the crawler writes aren't results
+    (tmp_data_dir / "metrics.json").write_text(u'{"stages": {}}')
     render_html(tmp_data_dir, tmp_data_dir)
     assert os.path.isfile(os.path.join(tmp_data_dir, 'index.html'))
     assert os.path.isfile(os.path.join(tmp_data_dir, 'errors.html'))
     assert os.path.isfile(os.path.join(tmp_data_dir, 'warnings.html'))
     assert os.path.isfile(os.path.join(tmp_data_dir, 'notices.html'))
+    # the report doesn't need internet access
+    index = (tmp_data_dir / 'index.html').text(encoding="utf8")
+    assert "cdnjs" not in index
+    assert 'src="assets/js/jquery.min.' in index
+    assert os.path.isfile(os.path.join(tmp_data_dir, 'index.html.gz'))
+
+
+@pytest.mark.parametrize("report_rules,expected", [
+    # the rules recorded while crawling are applied by default
+    (None, False),
+    # but they can be overridden when generating the report
+    (NO_IGNORE_RULES, True),
+    (IgnoreRules({"*": [{"type": "warning"}]}), True),
+])
+def test_render_html_ignore_rules(item, tmpdir_factory, report_rules, expected):
+    tmp_data_dir = Path(tmpdir_factory.mktemp('data'))
+    pa11y_data = [{
+        "message": "Table cell has an invalid scope attribute.",
+        "code": "WCAG2AA.Principle2.Guideline2_4.2_4_2.H63.1",
+        "type": "error",
+        "context": "<th class=\"label\" scope=\"column\">Email</th>",
+        "selector": "#fake > th",
+    }]
+    crawl_rules = IgnoreRules({"*/fakepage": [{"code": "*.H63.1"}]})
+    write_pa11y_results(item, pa11y_data, tmp_data_dir, ignore_rules=crawl_rules)
+    render_html(tmp_data_dir, tmp_data_dir, ignore_rules=report_rules)
+    assert os.path.isfile(os.path.join(tmp_data_dir, 'index.html'))
+    assert os.path.isfile(os.path.join(tmp_data_dir, 'errors.html')) == expected
+
+
+def test_render_html_latest_results(item, tmpdir_factory):
+    tmp_data_dir = Path(tmpdir_factory.mktemp('data'))
+    error = {
+        "message": "Table cell has an invalid scope attribute.",
+        "code": "WCAG2AA.Principle2.Guideline2_4.2_4_2.H63.1",
+        "type": "error",
+        "context": "<th class=\"label\" scope=\"column\">Email</th>",
+        "selector": "#fake > th",
+    }
+    write_pa11y_results(item, [error], tmp_data_dir, run_id="run1")
+    # the error was fixed by the next run
+    fixed = dict(item, accessed_at=datetime(2016, 8, 21, 14, 12, 45))
+    write_pa11y_results(fixed, [], tmp_data_dir, run_id="run2")
+    output_dir = Path(tmpdir_factory.mktemp('html'))
+    render_html(tmp_data_dir, output_dir)
+    # the index, the performance page, and one detail page
+    assert len(output_dir.files("*.html")) == 3
+    assert not (output_dir / 'errors.html').exists()
+
+
+def test_group_violations():
+    def violation(selector, type_="error"):
+        return {"selector": selector, "code": "WCAG2AA.H63.1", "type": type_}
+    pages = [
+        {"url": "/one", "page_title": "One", "pa11y": [violation("#a"), violation("#b")]},
+        {"url": "/two", "page_title": "Two", "pa11y": [violation("#a"), violation("#c", "notice")]},
+    ]
+    grouped, counter = group_violations(pages)
+    assert counter == {"error": 2, "notice": 1}
+    shared = [group for group in grouped["error"].values() if group["selector"] == "#a"]
+    assert shared[0]["pages"] == [
+        {"url": "/one", "page_title": "One"},
+        {"url": "/two", "page_title": "Two"},
+    ]
+
+
+def test_report_replaces_results(tmpdir):
+    data_dir = Path(tmpdir.mkdir("data"))
+    output_dir = Path(tmpdir.mkdir("html"))
+
+    def violation(selector, type_="error"):
+        return {"selector": selector, "code": "WCAG2AA.H63.1", "type": type_,
+                "message": "Oops", "context": "<p>"}
+
+    def audit(url, day, violations):
+        item = {"url": url, "page_title": url, "request_headers": {},
+                "accessed_at": datetime(2016, 8, day)}
+        return write_pa11y_results(item, violations, data_dir)
+
+    report = Report(data_dir, output_dir)
+    report.add(audit("http://localhost/one", 2, [violation("#a"), violation("#b")]))
+    report.add(audit("http://localhost/two", 2, [violation("#a")]))
+    assert report.counter == {"error": 2}
+    # an older result for the same page doesn't replace a newer one
+    report.add(audit("http://localhost/one?x=1", 1, []))
+    assert report.counter == {"error": 2}
+    report.write()
+    assert not report.changed
+
+    # a newer one does, and its violations that were fixed go away
+    report.add(audit("http://localhost/one", 3, [violation("#c", "notice")]))
+    assert report.changed
+    assert report.counter == {"error": 1, "notice": 1}
+    pages = list(report.grouped_violations["error"].values())[0]["pages"]
+    assert pages == [{"url": "http://localhost/two", "page_title": "http://localhost/two"}]
+    report.write()
+
+    # the same report as making it from scratch
+    full_dir = Path(tmpdir.mkdir("full"))
+    render_html(data_dir, full_dir)
+    for name in ("index.html", "errors.html", "notices.html"):
+        assert (output_dir / name).text(encoding="utf8") == (full_dir / name).text(encoding="utf8")
+
+
+def test_render_performance(item, tmpdir_factory):
+    data_dir = Path(tmpdir_factory.mktemp('data'))
+    write_pa11y_results(item, [], data_dir)
+    render_html(data_dir, data_dir)
+    assert "No crawl stats" in (data_dir / "performance.html").text(encoding="utf8")
+
+    for day, pages in ((1, 10), (2, 12), (3, 15)):
+        recorder = RunRecorder()
+        recorder.observe("http://localhost/courses/course-v1:edX+Demo/slow", day * 10.0)
+        run = {
+            "run_id": "run{}".format(day), "finish_reason": "finished",
+            "started_at": datetime(2016, 8, day), "finished_at": datetime(2016, 8, day, 1),
+            "duration": 3600, "pages": pages, "retries": 0,
+        }
+        run.update(recorder.to_dict())
+        write_run_stats(data_dir, run)
+    render_html(data_dir, data_dir, performance_runs=2)
+    html = (data_dir / "performance.html").text(encoding="utf8")
+    assert "Latest Run: run3" in html
+    assert "run2" in html
+    assert "run1" not in html
+    assert "/courses/*/slow" in html
+    assert "performance.html" in (data_dir / "index.html").text(encoding="utf8")
+
+
+def test_sparkline():
+    assert sparkline([None, 1], 100, 10) == u""
+    assert sparkline([1, None, 3], 100, 10) == u"0.0,9.0 100.0,1.0"
+    assert sparkline([2, 2], 100, 10) == u"0.0,9.0 100.0,9.0"
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+import pytest
+import requests
+from path import Path
+from pa11ycrawler.ignore import (
+    IgnoreRules, IgnoreRulesSource, compile_ignore_rules, fetch_pa11y_ignore_rules,
+    ignore_rules_version, load_saved_ignore_rules, NO_IGNORE_RULES,
+)
+
+RULES = {
+    "*": [
+        {"message": "*overlords"},
+    ],
+    "*/starcraft": [
+        {"type": "notice"},
+        {"message": "*attack*", "type": "warning"},
+    ],
+}
+
+
+def test_filter():
+    rules = IgnoreRules(RULES)
+    results = [
+        {"type": "error", "message": "spawn more overlords"},
+        {"type": "warning", "message": "our units are under attack"},
+        {"type": "error", "message": "observers cannot attack"},
+        {"type": "notice", "message": "construction finished"},
+        {"type": "warning", "code": "no message here"},
+    ]
+    assert rules.filter(results, "http://x/starcraft") == [
+        {"type": "error", "message": "observers cannot attack"},
+        {"type": "warning", "code": "no message here"},
+    ]
+    assert rules.filter(results, "http://x/warcraft") == results[1:]
+    assert rules.is_ignored(results[0], "http://x/warcraft")
+    assert not rules.is_ignored(results[1], "http://x/warcraft")
+
+
+def test_no_rules():
+    assert not NO_IGNORE_RULES
+    assert NO_IGNORE_RULES.version is None
+    assert compile_ignore_rules(None) is NO_IGNORE_RULES
+    results = [{"type": "error", "message": "anything"}]
+    assert NO_IGNORE_RULES.filter(results, "http://x/") is results
+
+
+def test_version_is_stable():
+    reordered = {
+        "*/starcraft": [
+            {"type": "warning", "message": "*attack*"},
+            {"type": "notice"},
+        ][::-1],
+        "*": [{"message": "*overlords"}],
+    }
+    assert ignore_rules_version(RULES) == ignore_rules_version(reordered)
+    assert ignore_rules_version(RULES) != ignore_rules_version({"*": []})
+    assert len(ignore_rules_version(RULES)) == 12
+
+
+def test_compile_caches_by_identity():
+    compiled = compile_ignore_rules(RULES)
+    assert compile_ignore_rules(RULES) is compiled
+    assert compile_ignore_rules(dict(RULES)) is not compiled
+
+
+def test_compile_clears_url_cache_on_swap():
+    compiled = compile_ignore_rules(RULES)
+    assert compiled.rules_for_url("http://localhost/starcraft")
+    assert compiled._url_cache  # pylint: disable=protected-access
+
+    reloaded = {"*": [{"type": "error"}]}
+    swapped = compile_ignore_rules(reloaded)
+    assert not compiled._url_cache  # pylint: disable=protected-access
+    # only the reloaded rules apply
+    assert not swapped.is_ignored({"type": "notice"}, "http://localhost/starcraft")
+    assert swapped.is_ignored({"type": "error"}, "http://localhost/starcraft")
+
+
+def test_url_cache_is_bounded():
+    rules = IgnoreRules(RULES, url_cache_size=2)
+    for page in ("a", "b", "a", "c"):
+        rules.rules_for_url(u"http://localhost/" + page)
+    # "b" was the least recently used
+    assert list(rules._url_cache) == [  # pylint: disable=protected-access
+        "http://localhost/a", "http://localhost/c",
+    ]
+    assert len(rules.rules_for_url("http://localhost/starcraft")) == 3
+
+
+def test_save_and_load(tmpdir):
+    data_dir = Path(str(tmpdir))
+    rules = IgnoreRules(RULES)
+    rules.save(data_dir)
+    loaded = load_saved_ignore_rules(data_dir, rules.version)
+    assert loaded.rules == RULES
+    assert loaded.version == rules.version
+    assert load_saved_ignore_rules(data_dir, "missing") is None
+
+
+RULES_YAML = u"""
+"*":
+  - message: "*overlords"
+"""
+
+
+def fake_response(mocker, status=200, text=RULES_YAML, headers=None):
+    return mocker.Mock(
+        status_code=status, ok=status < 400, text=text, headers=headers or {},
+    )
+
+
+def test_fetch_rules_cache(mocker, tmpdir):
+    cache_dir = Path(str(tmpdir))
+    url = "http://rules.example.com/ignore.yaml"
+    get = mocker.patch("requests.get", return_value=fake_response(
+        mocker, headers={"ETag": '"v1"', "Last-Modified": "Sat, 20 Aug 2016 14:12:45 GMT"},
+    ))
+    expected = {"*": [{"message": "*overlords"}]}
+    assert fetch_pa11y_ignore_rules(url, cache_dir=cache_dir, timeout=5) == expected
+    get.assert_called_once_with(url, headers={}, timeout=5)
+
+    # the cached rules are only downloaded again if they changed
+    get.return_value = fake_response(mocker, status=304, text=u"")
+    assert fetch_pa11y_ignore_rules(url, cache_dir=cache_dir, timeout=5) == expected
+    get.assert_called_with(url, timeout=5, headers={
+        "If-None-Match": '"v1"', "If-Modified-Since": "Sat, 20 Aug 2016 14:12:45 GMT",
+    })
+
+    # if the URL can't be fetched, or returns something broken, the last
+    # good copy is used
+    get.side_effect = requests.Timeout("too slow")
+    assert fetch_pa11y_ignore_rules(url, cache_dir=cache_dir) == expected
+    get.side_effect = None
+    get.return_value = fake_response(mocker, status=500, text=u"oops")
+    assert fetch_pa11y_ignore_rules(url, cache_dir=cache_dir) == expected
+    get.return_value = fake_response(mocker, text=u"*: [")
+    assert fetch_pa11y_ignore_rules(url, cache_dir=cache_dir) == expected
+
+    # without a cached copy, the error is raised
+    get.side_effect = requests.Timeout("too slow")
+    with pytest.raises(requests.Timeout):
+        fetch_pa11y_ignore_rules(url + "?other")
+    get.side_effect = None
+    get.return_value = fake_response(mocker, status=500, text=u"oops")
+    with pytest.raises(RuntimeError):
+        fetch_pa11y_ignore_rules(url)
+
+
+def test_ignore_rules_source(mocker, tmpdir):
+    rule_file = Path(str(tmpdir)) / "ignore.yaml"
+    rule_file.write_text(RULES_YAML)
+    source = IgnoreRulesSource(file=rule_file)
+    source.start()
+    rules = source.rules
+    assert rules == {"*": [{"message": "*overlords"}]}
+
+    assert not source.reload()
+    assert source.rules is rules
+    rule_file.write_text(u'"*": [{"type": "notice"}]')
+    assert source.reload()
+    assert source.rules == {"*": [{"type": "notice"}]}
+
+    # rules that can't be loaded don't replace the rules in use
+    rule_file.remove()
+    assert not source.reload()
+    assert source.rules == {"*": [{"type": "notice"}]}
+
+    # a file is loaded right away, so a missing one is an error up front
+    with pytest.raises(ValueError):
+        IgnoreRulesSource(file=rule_file)
+
+    # an error fetching the rules the first time is raised when they're used
+    mocker.patch(
+        "pa11ycrawler.ignore.fetch_pa11y_ignore_rules",
+        side_effect=RuntimeError("no rules"),
+    )
+    source = IgnoreRulesSource(url="http://localhost/ignore.yaml")
+    source.start()
+    with pytest.raises(RuntimeError):
+        source.rules  # pylint: disable=pointless-statement
+
+    assert IgnoreRulesSource().rules is None
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import textwrap
+from scrapy.http import HtmlResponse
+from scrapy.statscollectors import MemoryStatsCollector
+from pa11ycrawler.linkextractors import RegionLinkExtractor, combine_patterns
+
+PAGE_HTML = textwrap.dedent(u"""
+    <html>
+      <body>
+        <header><a href="/dashboard">Dashboard</a><a href="/logout/">Sign out</a></header>
+        <main>
+          <a href="/courses/foo/courseware/{unit}/">Unit</a>
+          <a href="/courses/foo/progress">Progress</a>
+        </main>
+        <aside><a href="/ignored">Not in any region</a></aside>
+        <footer><a href="/tos">Terms of Service</a></footer>
+      </body>
+    </html>
+""")
+
+
+def make_response(url, body):
+    return HtmlResponse(url=url, body=body.encode('utf8'), encoding='utf-8')
+
+
+def link_urls(links):
+    return sorted(link.url for link in links)
+
+
+def test_combine_patterns():
+    regex = combine_patterns([r"/logout/", r"\?_accept=application/x-tgz"])
+    assert regex.search("http://x/logout/")
+    assert regex.search("http://x/export?_accept=application/x-tgz")
+    assert not regex.search("http://x/courses/")
+
+
+def test_chrome_links_extracted_once(mocker):
+    stats = MemoryStatsCollector(mocker.Mock())
+    extractor = RegionLinkExtractor(deny=[r"/logout/"], stats=stats)
+
+    first = extractor.extract_links(make_response(
+        "http://x/courses/foo/courseware/a/", PAGE_HTML.format(unit="a"),
+    ))
+    assert link_urls(first) == [
+        "http://x/courses/foo/courseware/a/",
+        "http://x/courses/foo/progress",
+        "http://x/dashboard",
+        "http://x/tos",
+    ]
+
+    # same header and footer: only the content links are extracted
+    second = extractor.extract_links(make_response(
+        "http://x/courses/foo/courseware/b/", PAGE_HTML.format(unit="b"),
+    ))
+    assert link_urls(second) == [
+        "http://x/courses/foo/courseware/b/",
+        "http://x/courses/foo/progress",
+    ]
+    assert stats.get_value("link_extraction/chrome_cache_hits") == 2
+    assert stats.get_value("link_extraction/responses") == 2
+    assert stats.get_value("link_extraction/links") == 6
+    assert stats.get_value("link_extraction/time") >= 0
+    assert stats.get_value("link_extraction/time_max") >= 0
+
+
+def test_chrome_cache_size():
+    extractor = RegionLinkExtractor(chrome_regions=["header"], chrome_cache_size=2)
+    page = u"<header><a href='/{header}'>Home</a></header><main></main>"
+
+    def chrome_extracted(header):
+        links = extractor.extract_links(make_response("http://x/", page.format(header=header)))
+        return "http://x/" + header in link_urls(links)
+
+    assert chrome_extracted("a")
+    assert chrome_extracted("b")
+    assert not chrome_extracted("a")
+    # "b" is the least recently seen, so it's forgotten to make room for "c"
+    assert chrome_extracted("c")
+    assert len(extractor.chrome_links) == 2
+    assert not chrome_extracted("a")
+    assert chrome_extracted("b")
+
+
+def test_whole_page_without_content_regions():
+    extractor = RegionLinkExtractor(content_regions=["#course-content"])
+    links = extractor.extract_links(make_response(
+        "http://x/dashboard", PAGE_HTML.format(unit="a"),
+    ))
+    assert "http://x/ignored" in link_urls(links)
+    assert "http://x/logout/" in link_urls(links)
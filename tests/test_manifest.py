@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+from path import Path
+from pa11ycrawler.ignore import IgnoreRules
+from pa11ycrawler.manifest import (
+    MANIFEST_FILENAME, compact, latest_entries, load_manifest, read_manifest, runs,
+)
+from pa11ycrawler.pipelines.pa11y import write_pa11y_results
+from pa11ycrawler.util import result_files
+from pa11ycrawler.violations import ViolationStore, load_result
+
+
+def write_result(data_dir, url, accessed_at, run_id=None, results=(), ignore_rules=None):
+    item = {
+        "url": url,
+        "page_title": "Page",
+        "request_headers": {},
+        "accessed_at": accessed_at,
+    }
+    write_pa11y_results(item, list(results), data_dir, ignore_rules=ignore_rules, run_id=run_id)
+
+
+def test_manifest_entries(tmpdir):
+    data_dir = Path(tmpdir)
+    rules = IgnoreRules({"*": [{"code": "WCAG2AA.H30"}]})
+    write_result(data_dir, "http://localhost/a", datetime(2016, 1, 1), "run1", [
+        {"type": "error", "code": "WCAG2AA.H30"},
+        {"type": "error", "code": "WCAG2AA.H63"},
+        {"type": "notice", "code": "WCAG2AA.G141"},
+    ], ignore_rules=rules)
+    write_result(data_dir, "http://localhost/b", datetime(2016, 1, 1, 0, 1), "run1")
+
+    entries = read_manifest(data_dir)
+    assert [entry["url"] for entry in entries] == ["http://localhost/a", "http://localhost/b"]
+    # the counts leave out the results that are ignored
+    assert (entries[0]["num_error"], entries[0]["num_warning"], entries[0]["num_notice"]) == (1, 0, 1)
+    assert entries[0]["run_id"] == "run1"
+    assert entries[0]["accessed_at"] == "2016-01-01T00:00:00"
+    assert entries[0]["pa11y_ignore_rules_version"] == rules.version
+    assert sorted(entry["filename"] for entry in entries) == sorted(
+        path.name for path in result_files(data_dir)
+    )
+
+
+def test_load_manifest(tmpdir):
+    data_dir = Path(tmpdir)
+    write_result(data_dir, "http://localhost/a", datetime(2016, 1, 1), "run1")
+    write_result(data_dir, "http://localhost/b", datetime(2016, 1, 1), "run1")
+    lines = (data_dir / MANIFEST_FILENAME).text().splitlines(True)
+    # a result that isn't in the manifest, and a line that was cut off
+    (data_dir / MANIFEST_FILENAME).write_text(lines[0] + u'{"url": "http://loc')
+
+    entries = load_manifest(data_dir)
+    assert sorted(entry["url"] for entry in entries) == [
+        "http://localhost/a", "http://localhost/b",
+    ]
+    unlisted = [entry for entry in entries if entry["url"] == "http://localhost/b"][0]
+    assert unlisted["run_id"] is None
+    assert unlisted["num_error"] == 0
+
+    # results that were deleted by hand are left out
+    (data_dir / entries[0]["filename"]).remove()
+    assert [entry["url"] for entry in load_manifest(data_dir)] == ["http://localhost/b"]
+
+
+def test_latest_entries():
+    entries = [
+        {"url": "http://localhost/a", "accessed_at": "2016-01-02T00:00:00"},
+        {"url": "http://localhost/a?x=1", "accessed_at": "2016-01-03T00:00:00"},
+        {"url": "http://localhost/b", "accessed_at": "2016-01-01T00:00:00"},
+        {"url": "http://localhost/a", "accessed_at": "2016-01-01T00:00:00"},
+    ]
+    assert latest_entries(entries) == [entries[2], entries[1]]
+
+
+def write_runs(data_dir):
+    "Three nightly runs, that each crawled a different set of pages."
+    write_result(data_dir, "http://localhost/a", datetime(2016, 1, 1), "run1")
+    write_result(data_dir, "http://localhost/b", datetime(2016, 1, 1), "run1")
+    write_result(data_dir, "http://localhost/a", datetime(2016, 1, 2), "run2")
+    write_result(data_dir, "http://localhost/a", datetime(2016, 1, 3), "run3")
+    write_result(data_dir, "http://localhost/c", datetime(2016, 1, 3), "run3")
+
+
+def test_runs(tmpdir):
+    data_dir = Path(tmpdir)
+    write_runs(data_dir)
+    assert runs(read_manifest(data_dir)) == ["run3", "run2", "run1"]
+
+
+def test_compact(tmpdir):
+    data_dir = Path(tmpdir)
+    write_runs(data_dir)
+
+    pruned = compact(data_dir, keep_runs=1, dry_run=True)
+    assert sorted((entry["url"], entry["run_id"]) for entry in pruned) == [
+        ("http://localhost/a", "run1"), ("http://localhost/a", "run2"),
+    ]
+    assert len(result_files(data_dir)) == 5
+
+    assert len(compact(data_dir, keep_runs=2)) == 1
+    assert len(result_files(data_dir)) == 4
+    assert len(read_manifest(data_dir)) == 4
+
+    # the latest result for each page is always kept, even from an old run
+    compact(data_dir, keep_runs=0)
+    remaining = sorted(
+        (entry["url"], entry["run_id"]) for entry in read_manifest(data_dir)
+    )
+    assert remaining == [
+        ("http://localhost/a", "run3"), ("http://localhost/b", "run1"), ("http://localhost/c", "run3"),
+    ]
+    assert sorted(path.name for path in result_files(data_dir)) == sorted(
+        entry["filename"] for entry in read_manifest(data_dir)
+    )
+
+
+def test_compact_violation_store(tmpdir):
+    data_dir = Path(tmpdir)
+    store = ViolationStore(data_dir)
+    for day, code in ((1, "old"), (2, "new")):
+        item = {
+            "url": "http://localhost/a", "page_title": "Page", "request_headers": {},
+            "accessed_at": datetime(2016, 1, day),
+        }
+        results = [{"type": "error", "code": code}, {"type": "error", "code": "both"}]
+        write_pa11y_results(item, results, data_dir, run_id="run{}".format(day), violation_store=store)
+    assert len(ViolationStore(data_dir)) == 3
+
+    compact(data_dir, keep_runs=0, dry_run=True)
+    assert len(ViolationStore(data_dir)) == 3
+    compact(data_dir, keep_runs=0)
+    # only the violations of the remaining result are kept
+    store = ViolationStore(data_dir)
+    assert sorted(body["code"] for _, body in store.items()) == ["both", "new"]
+    result, = result_files(data_dir)
+    assert [v["code"] for v in load_result(result)["pa11y"]] == ["new", "both"]
+
+
+def test_compact_keep_days(tmpdir):
+    data_dir = Path(tmpdir)
+    write_runs(data_dir)
+    pruned = compact(data_dir, keep_runs=0, keep_days=1.5, now=datetime(2016, 1, 3, 12))
+    assert [(entry["url"], entry["run_id"]) for entry in pruned] == [("http://localhost/a", "run1")]
+    assert len(result_files(data_dir)) == 4
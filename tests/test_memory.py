@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import json
+import subprocess as sp
+import sys
+import tracemalloc
+import pytest
+from scrapy.utils.test import get_crawler
+from scrapy.statscollectors import MemoryStatsCollector
+from pa11ycrawler.extensions import MemoryTracker
+from pa11ycrawler.extensions import memory
+
+
+def test_growth():
+    previous = {"dict": 10, "Request": 5, "list": 3}
+    counts = {"dict": 12, "Request": 50, "list": 1, "A11yItem": 4}
+    assert memory.growth(counts, previous, top=2) == [
+        ("Request", 50, 45), ("A11yItem", 4, 4),
+    ]
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="needs /proc")
+def test_rss_and_children():
+    assert memory.rss_mb() > 0
+    proc = sp.Popen([sys.executable, "-c", "import time; time.sleep(5)"])
+    try:
+        assert proc.pid in memory.child_pids()
+        assert memory.children_rss_mb() > 0
+    finally:
+        proc.kill()
+        proc.wait()
+
+
+def test_allocation_growth():
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        hoard = [bytearray(1024) for _ in range(1000)]  # pylint: disable=unused-variable
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    sites = memory.allocation_growth(after, before, top=1)
+    assert sites[0]["site"].startswith(__file__.rstrip("c"))
+    assert sites[0]["size_diff_kb"] >= 1000
+
+
+@pytest.fixture
+def tracker(mocker, tmpdir):
+    crawler = get_crawler(settings_dict={
+        "MEMORY_TRACKING_ENABLED": True,
+        "MEMORY_SOFT_LIMIT_MB": 500,
+        "MEMORY_MAX_PAUSE": 60,
+    })
+    crawler.stats = MemoryStatsCollector(crawler)
+    crawler.engine = mocker.Mock()
+    crawler.spider = mocker.Mock()
+    ext = MemoryTracker.from_crawler(crawler)
+    ext.report_path = str(tmpdir.join("memory-report.jsonl"))
+    mocker.patch.object(memory, "children_rss_mb", return_value=40.0)
+    return ext
+
+
+def test_soft_limit(tracker, mocker):
+    rss = mocker.patch.object(memory, "rss_mb", return_value=400.0)
+    tracker.check()
+    assert not tracker.crawler.engine.pause.called
+    assert tracker.stats.get_value("memory/children_rss_mb") == 40.0
+
+    rss.return_value = 600.0
+    tracker.check()
+    tracker.crawler.engine.pause.assert_called_once_with()
+    # still over the resume threshold, so stay paused
+    rss.return_value = 460.0
+    tracker.check()
+    assert not tracker.crawler.engine.unpause.called
+
+    rss.return_value = 300.0
+    tracker.check()
+    tracker.crawler.engine.unpause.assert_called_once_with()
+    assert tracker.stats.get_value("memory/paused_count") == 1
+    assert tracker.stats.get_value("memory/rss_mb_max") == 600.0
+
+
+def test_forced_resume(tracker, mocker):
+    mocker.patch.object(memory, "rss_mb", return_value=600.0)
+    tracker.check()
+    tracker.paused_at -= 61
+    tracker.check()
+    tracker.crawler.engine.unpause.assert_called_once_with()
+    assert tracker.stats.get_value("memory/forced_resume_count") == 1
+
+
+class Hoarded(object):
+    pass
+
+
+def test_report(tracker):
+    tracemalloc.start()
+    try:
+        tracker.track()
+        hoard = [Hoarded() for _ in range(5000)]  # pylint: disable=unused-variable
+        tracker.track(final=True)
+    finally:
+        tracemalloc.stop()
+    with open(tracker.report_path) as report:
+        entries = [json.loads(line) for line in report]
+    assert len(entries) == 2
+    assert "rss_mb" in entries[0]
+    assert entries[1]["top_types"][0] == {"type": "Hoarded", "count": 5000, "growth": 5000}
+    assert entries[1]["top_sites"]
+    assert entries[1]["top_sites_since_start"]
+    assert tracker.stats.get_value("memory/top_growth_type") == "Hoarded"
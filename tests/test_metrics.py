@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import json
+import pytest
+from scrapy import Request
+from scrapy.http import Response
+from scrapy.utils.test import get_crawler
+from pa11ycrawler.metrics import (
+    Histogram, Metrics, NO_METRICS, metrics_for, timed_stage
+)
+from pa11ycrawler.extensions import StageMetrics
+
+
+def test_histogram_percentiles():
+    histogram = Histogram(buckets=(1, 2, 5, 10))
+    assert histogram.percentile(50) is None
+    for value in range(1, 101):
+        histogram.observe(value / 10.0)
+    assert histogram.count == 100
+    assert histogram.min == 0.1
+    assert histogram.max == 10
+    # estimates are interpolated within buckets
+    assert 4.5 <= histogram.percentile(50) <= 5.5
+    assert 9 <= histogram.percentile(95) <= 10
+    assert histogram.percentile(100) == 10
+    assert list(histogram.cumulative_counts()) == [
+        (1, 10), (2, 20), (5, 50), (10, 100), ("+Inf", 100),
+    ]
+
+
+def test_histogram_overflow():
+    histogram = Histogram(buckets=(1,))
+    histogram.observe(0.5)
+    histogram.observe(300)
+    assert histogram.percentile(99) <= 300
+    assert list(histogram.cumulative_counts()) == [(1, 1), ("+Inf", 2)]
+
+
+def test_histogram_merge():
+    first = Histogram(buckets=(1, 2, 5))
+    second = Histogram(buckets=(1, 2, 5))
+    for value in (0.5, 1.5):
+        first.observe(value)
+    for value in (4, 30):
+        second.observe(value)
+    merged = Histogram.from_dict(json.loads(json.dumps(first.to_dict())))
+    merged.merge(second)
+    assert merged.count == 4
+    assert merged.sum == 36
+    assert (merged.min, merged.max) == (0.5, 30)
+    assert list(merged.cumulative_counts()) == [(1, 1), (2, 2), (5, 3), ("+Inf", 4)]
+    with pytest.raises(ValueError):
+        merged.merge(Histogram(buckets=(1,)))
+
+
+def test_exporters():
+    metrics = Metrics()
+    metrics.observe("parse_item", 0.002)
+    metrics.observe_depth("items", 3)
+    stats = {"pa11y/error": 4, "start_time": "not a number", 'weird"key': 1}
+
+    data = json.loads(metrics.to_json(stats))
+    assert data["stages"]["parse_item"]["count"] == 1
+    assert data["queues"]["items"]["max"] == 3
+    assert data["stats"] == {"pa11y/error": 4, 'weird"key': 1}
+
+    text = metrics.to_prometheus(stats)
+    assert '# TYPE pa11ycrawler_stage_seconds histogram' in text
+    assert 'pa11ycrawler_stage_seconds_bucket{stage="parse_item",le="0.0025"} 1' in text
+    assert 'pa11ycrawler_stage_seconds_count{stage="parse_item"} 1' in text
+    assert 'pa11ycrawler_queue_depth_bucket{queue="items",le="+Inf"} 1' in text
+    assert 'pa11ycrawler_stat{name="pa11y/error"} 4' in text
+    assert 'pa11ycrawler_stat{name="weird\\"key"} 1' in text
+
+
+def test_timed_stage(mocker):
+    class Pipeline(object):
+        @timed_stage("pipeline/test")
+        def process_item(self, item, spider):
+            return item
+
+    spider = mocker.Mock(metrics=Metrics())
+    assert Pipeline().process_item("item", spider) == "item"
+    assert spider.metrics.stages["pipeline/test"].count == 1
+    # spiders without metrics aren't instrumented
+    assert metrics_for(mocker.Mock()) is NO_METRICS
+    assert Pipeline().process_item("item", object()) == "item"
+
+
+def test_stage_metrics_extension(mocker, tmpdir):
+    prom_file = tmpdir.join("pa11ycrawler.prom")
+    crawler = get_crawler(settings_dict={
+        "METRICS_ENABLED": True,
+        "METRICS_PROMETHEUS_FILE": str(prom_file),
+    })
+    crawler.stats = mocker.Mock(get_stats=lambda: {"pa11y/error": 2})
+    ext = StageMetrics.from_crawler(crawler)
+    mocker.patch("twisted.internet.task.LoopingCall")
+    spider = mocker.Mock(data_dir=str(tmpdir))
+    ext.spider_opened(spider)
+    assert spider.metrics is ext.metrics
+
+    request = Request("http://x/", meta={"download_latency": 0.2})
+    ext.response_received(Response("http://x/"), request, spider)
+    spider.metrics.observe("pipeline/pa11y", 1.5)
+    ext.spider_closed(spider, "finished")
+
+    crawler.stats.set_value.assert_any_call("metrics/download/p50", 0.2)
+    data = json.load(tmpdir.join("metrics.json"))
+    assert data["stages"]["pipeline/pa11y"]["count"] == 1
+    assert data["stats"] == {"pa11y/error": 2}
+    assert 'stage="download"' in prom_file.read()
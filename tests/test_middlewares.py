@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+import pytest
+from scrapy import Request
+from scrapy.http import HtmlResponse, Response
+from scrapy.http.headers import Headers
+from scrapy.exceptions import IgnoreRequest, StopDownload
+from scrapy.statscollectors import MemoryStatsCollector
+from twisted.web.iweb import UNKNOWN_LENGTH
+from pa11ycrawler.middlewares import ContentTypeFilterMiddleware
+from pa11ycrawler.middlewares.content import url_extension
+
+
+@pytest.fixture
+def middleware(mocker):
+    stats = MemoryStatsCollector(mocker.Mock())
+    return ContentTypeFilterMiddleware(
+        stats=stats,
+        allowed_types=["text/html"],
+        deny_extensions=["pdf", "mp4", "tar.gz"],
+        cache_threshold=2,
+        max_body_size=1000,
+    )
+
+
+def test_url_extension():
+    assert url_extension("http://x/a/b.PDF?foo=bar") == "pdf"
+    assert url_extension("http://x/a/export.tar.gz") == "tar.gz"
+    assert url_extension("http://x/courses/") == ""
+    assert url_extension("http://x") == ""
+
+
+def test_skip_by_extension(middleware):
+    spider = object()
+    with pytest.raises(IgnoreRequest):
+        middleware.process_request(Request("http://x/handout.pdf"), spider)
+    assert middleware.stats.get_value("content_filter/skipped_requests") == 1
+    assert middleware.stats.get_value("content_filter/skipped/extension") == 1
+
+    request = Request("http://x/courses/")
+    assert middleware.process_request(request, spider) is None
+    # the body size is limited by stopping the download, not by Scrapy
+    assert "download_maxsize" not in request.meta
+
+
+def test_dont_filter_content(middleware):
+    spider = object()
+    request = Request("http://x/export.tar.gz", meta={"dont_filter_content": True})
+    assert middleware.process_request(request, spider) is None
+    response = Response(
+        "http://x/export.tar.gz", request=request,
+        headers={"Content-Type": "application/x-tgz"},
+    )
+    assert middleware.process_response(request, response, spider) is response
+
+
+def test_stop_download_on_headers(middleware):
+    spider = object()
+    request = Request("http://x/transcript/download")
+    headers = Headers({"Content-Type": "application/octet-stream"})
+    with pytest.raises(StopDownload):
+        middleware.headers_received(headers, 5000, request, spider)
+
+    response = Response(
+        request.url, request=request, headers=headers, body=b"",
+    )
+    with pytest.raises(IgnoreRequest):
+        middleware.process_response(request, response, spider)
+    assert middleware.stats.get_value("content_filter/skipped/content_type") == 1
+    assert middleware.stats.get_value("content_filter/skipped_bytes") == 5000
+
+    # HTML headers don't stop the download
+    request = Request("http://x/courses/")
+    headers = Headers({"Content-Type": "text/html; charset=utf-8"})
+    middleware.headers_received(headers, 500, request, spider)
+
+    # ...unless the body is too large
+    with pytest.raises(StopDownload):
+        middleware.headers_received(headers, 5000, request, spider)
+    response = Response(request.url, request=request, headers=headers)
+    with pytest.raises(IgnoreRequest):
+        middleware.process_response(request, response, spider)
+    assert middleware.stats.get_value("content_filter/skipped/too_large") == 1
+    # the body that wasn't downloaded is counted
+    assert middleware.stats.get_value("content_filter/skipped_bytes") == 10000
+
+
+def test_stop_download_without_content_length(middleware):
+    spider = object()
+    request = Request("http://x/handout/download")
+    headers = Headers({"Content-Type": "application/pdf"})
+    with pytest.raises(StopDownload):
+        middleware.headers_received(headers, UNKNOWN_LENGTH, request, spider)
+    response = Response(request.url, request=request, headers=headers, body=b"%PDF")
+    # skipped, without counting bytes that it doesn't know about
+    with pytest.raises(IgnoreRequest):
+        middleware.process_response(request, response, spider)
+    assert middleware.stats.get_value("content_filter/skipped/content_type") == 1
+    assert middleware.stats.get_value("content_filter/skipped_bytes") is None
+
+
+def test_stop_download_on_bytes(middleware):
+    spider = object()
+    # without a Content-Length header, the body is counted as it arrives
+    request = Request("http://x/courses/")
+    headers = Headers({"Content-Type": "text/html"})
+    middleware.headers_received(headers, UNKNOWN_LENGTH, request, spider)
+    middleware.bytes_received(b"x" * 600, request, spider)
+    with pytest.raises(StopDownload):
+        middleware.bytes_received(b"x" * 600, request, spider)
+    response = HtmlResponse(request.url, request=request, body=b"x" * 1200)
+    with pytest.raises(IgnoreRequest):
+        middleware.process_response(request, response, spider)
+    assert middleware.stats.get_value("content_filter/skipped/too_large") == 1
+    # how much more there was isn't known
+    assert middleware.stats.get_value("content_filter/skipped_bytes") is None
+
+    request = Request("http://x/export", meta={"dont_filter_content": True})
+    middleware.bytes_received(b"x" * 2000, request, spider)
+
+
+def test_template_cache(middleware):
+    spider = object()
+    for block in ("abc1", "abc2"):
+        request = Request("http://x/transcripts/{}/download".format(block))
+        response = Response(
+            request.url, request=request,
+            headers={"Content-Type": "text/plain"},
+        )
+        with pytest.raises(IgnoreRequest):
+            middleware.process_response(request, response, spider)
+
+    # two non-HTML responses for this template: skip it from now on
+    with pytest.raises(IgnoreRequest):
+        middleware.process_request(Request("http://x/transcripts/abc3/download"), spider)
+    assert middleware.stats.get_value("content_filter/skipped/cache") == 1
+
+
+def test_head_probe(middleware):
+    spider = object()
+    middleware.head_probes = True
+    request = Request("http://x/courses/course-v1:a+b+c/pdfbook/0/")
+
+    probe = middleware.process_request(request, spider)
+    assert probe.method == "HEAD"
+    assert probe.meta["content_probe"] is request
+    assert middleware.process_request(probe, spider) is None
+
+    response = HtmlResponse(probe.url, request=probe, body=b"")
+    followup = middleware.process_response(probe, response, spider)
+    assert followup.method == "GET"
+    assert followup.url == request.url
+    assert followup.dont_filter
+    assert middleware.process_request(followup, spider) is None
+
+    # the template has been seen now, so there's no need to probe again
+    other = Request("http://x/courses/course-v1:a+b+c/pdfbook/1/")
+    assert middleware.process_request(other, spider) is None
+
+    pdf = Request("http://x/courses/course-v1:a+b+c/asset/1/")
+    probe = middleware.process_request(pdf, spider)
+    response = Response(
+        probe.url, request=probe,
+        headers={"Content-Type": "application/pdf", "Content-Length": "2048"},
+    )
+    with pytest.raises(IgnoreRequest):
+        middleware.process_response(probe, response, spider)
+    assert middleware.stats.get_value("content_filter/skipped/probe") == 1
+    assert middleware.stats.get_value("content_filter/skipped_bytes") == 2048
@@ -1,13 +1,22 @@
 # -*- coding: utf-8 -*-
+import os
+import signal
+import threading
 import pytest
 import json
+from twisted.internet import defer
 from datetime import datetime
 import subprocess as sp
+from path import Path
 from scrapy.exceptions import DropItem, NotConfigured
 from pa11ycrawler.pipelines import (
-    DuplicatesPipeline, DropDRFPipeline, Pa11yPipeline
+    DuplicatesPipeline, DropDRFPipeline, Pa11yPipeline, ReportPipeline
 )
-from pa11ycrawler.pipelines.pa11y import DEVNULL, load_pa11y_results
+from pa11ycrawler.pipelines.pa11y import (
+    DEVNULL, AuditSlots, load_pa11y_results, probe_executable, write_pa11y_results,
+)
+from pa11ycrawler.violations import ViolationStore
+from pa11ycrawler.supervisor import MARKER_ENV, AuditSupervisor
 try:
     from StringIO import StringIO
 except ImportError:  # Python 3
@@ -156,21 +165,31 @@ def test_pa11y_happy_path(mocker, tmpdir):
     assert item == processed
 
     # pa11y should be called correctly
-    mock_Popen.assert_called_with(
+    args, kwargs = mock_Popen.call_args
+    assert args == (
         ["node_modules/.bin/pa11y", "http://courses.edx.org/fakepage",
          "--config=mockconfig.json", "--reporter=json-oldnode"],
-        shell=False, stdout=sp.PIPE, stderr=sp.PIPE
     )
+    assert kwargs["shell"] is False
+    assert kwargs["stdout"] == kwargs["stderr"] == sp.PIPE
+    # marked as started by this crawler, and limited by the supervisor
+    assert kwargs["env"][MARKER_ENV] == str(os.getpid())
+    assert kwargs["start_new_session"] is True
 
     # title matcher didn't see a problem
     assert not spider.logger.error.called
 
-    # one data file should be output correctly
-    data_files = data_dir.listdir()
+    # one data file should be output correctly, and listed in the manifest
+    data_files = data_dir.listdir("*.json")
     assert len(data_files) == 1
     data_file = data_files[0]
+    manifest = data_dir.join("manifest.jsonl").readlines()
+    assert len(manifest) == 1
+    assert json.loads(manifest[0])["filename"] == data_file.basename
     assert data_file.basename == 'c13d12d109449354e331b1b2f062dcb6.json'
     data_from_file = json.load(data_file)
+    # the item carries its manifest entry, for the pipelines after this one
+    assert item.pop("result") == json.loads(manifest[0])
     item["pa11y"] = fake_pa11y_data
     item["accessed_at"] = item["accessed_at"].isoformat()
     assert data_from_file == item
@@ -357,3 +376,265 @@ def test_ignore_rules(mocker):
         {"type": "error", 'message': 'observers cannot attack'},
         {"type": "warning", 'message': 'mineral field depleted'},
     ]
+
+
+def run_pa11y_pipeline(mocker, tmpdir, fake_pa11y_data, ignore_rules, **kwargs):
+    """
+    Run the Pa11yPipeline on a fake page with the given pa11y output,
+    and return the data that it wrote and the data directory.
+    """
+    item = {
+        "url": "http://courses.edx.org/starcraft",
+        "page_title": "StarCraft",
+        "request_headers": {"Cookie": "nocookieforyou"},
+        "accessed_at": datetime(2016, 8, 26, 14, 12, 45),
+    }
+    data_dir = tmpdir.mkdir("data")
+    spider = mocker.Mock(data_dir=str(data_dir), pa11y_ignore_rules=ignore_rules)
+    mocker.patch("subprocess.check_call")
+    pa11y_process = mocker.Mock(name="run-Popen", returncode=2)
+    pa11y_process.communicate.return_value = (
+        json.dumps(fake_pa11y_data).encode('utf8'), b"",
+    )
+    mocker.patch("subprocess.Popen", return_value=pa11y_process)
+    mocker.patch("tempfile.NamedTemporaryFile")
+    mocker.patch("os.remove")
+
+    Pa11yPipeline(**kwargs).process_item(item, spider)
+    data_file, = data_dir.listdir("*.json")
+    return json.load(data_file), data_dir, spider
+
+
+def test_pa11y_raw_results_with_rules_version(mocker, tmpdir):
+    fake_pa11y_data = [
+        {"type": "error", "message": "spawn more overlords", "context": ""},
+        {"type": "error", "message": "observers cannot attack", "context": ""},
+    ]
+    ignore_rules = {"*": [{"message": "*overlords"}]}
+    data, data_dir, spider = run_pa11y_pipeline(
+        mocker, tmpdir, fake_pa11y_data, ignore_rules,
+    )
+
+    # every result is written, along with the version of the rules...
+    assert data["pa11y"] == fake_pa11y_data
+    version = data["pa11y_ignore_rules_version"]
+    assert "pa11y_filtered" not in data
+    # ...and the rules themselves are saved
+    saved = json.load(data_dir.join("ignore-rules", version + ".json"))
+    assert saved == ignore_rules
+    # but ignored results aren't counted
+    spider.crawler.stats.inc_value.assert_any_call(
+        "pa11y/error", count=1, spider=spider,
+    )
+
+
+def test_pa11y_filter_at_crawl_time(mocker, tmpdir):
+    fake_pa11y_data = [
+        {"type": "error", "message": "spawn more overlords", "context": ""},
+        {"type": "error", "message": "observers cannot attack", "context": ""},
+    ]
+    ignore_rules = {"*": [{"message": "*overlords"}]}
+    data, _, _ = run_pa11y_pipeline(
+        mocker, tmpdir, fake_pa11y_data, ignore_rules, filter_at_crawl_time=True,
+    )
+    assert data["pa11y"] == fake_pa11y_data[1:]
+    assert data["pa11y_filtered"] is True
+    assert data["pa11y_ignore_rules_version"]
+
+
+def test_pa11y_deduplicate_violations(mocker, tmpdir):
+    fake_pa11y_data = [
+        {"type": "error", "message": "observers cannot attack", "context": ""},
+        {"type": "error", "message": "observers cannot attack", "context": ""},
+    ]
+    data, data_dir, _ = run_pa11y_pipeline(
+        mocker, tmpdir, fake_pa11y_data, None, deduplicate_violations=True,
+    )
+    assert "pa11y" not in data
+    (vid, count), = data["pa11y_refs"]
+    assert count == 2
+    store = ViolationStore(Path(str(data_dir)))
+    assert store.get(vid) == fake_pa11y_data[0]
+
+
+def test_pa11y_path_setting(mocker):
+    check_call = mocker.patch("subprocess.check_call")
+    pipeline = Pa11yPipeline(pa11y_path="/opt/fake/pa11y")
+    assert pipeline.pa11y_path == "/opt/fake/pa11y"
+    check_call.assert_any_call(
+        ["/opt/fake/pa11y", "--version"], stdout=mocker.ANY, stderr=mocker.ANY,
+    )
+    # without a setting, the default is used
+    assert Pa11yPipeline().pa11y_path == "node_modules/.bin/pa11y"
+
+
+def test_probe_executable_cache(mocker, tmpdir):
+    check_call = mocker.patch("subprocess.check_call")
+    executable = tmpdir.join("pa11y")
+    executable.write("#!/bin/sh\n")
+    executable.chmod(0o755)
+    cache_file = str(tmpdir.join("cache", "toolchain.json"))
+
+    probe_executable([str(executable), "--version"], cache_file)
+    probe_executable([str(executable), "--version"], cache_file)
+    assert check_call.call_count == 1
+
+    # an upgraded executable is checked again
+    executable.write("#!/bin/sh\n# upgraded\n")
+    probe_executable([str(executable), "--version"], cache_file)
+    assert check_call.call_count == 2
+
+    # a failed check isn't cached
+    check_call.side_effect = OSError("not installed")
+    with pytest.raises(OSError):
+        probe_executable([str(tmpdir.join("missing")), "--version"], cache_file)
+    with pytest.raises(OSError):
+        probe_executable([str(tmpdir.join("missing")), "--version"], cache_file)
+
+
+def test_pa11y_crawl_cancelled(mocker, tmpdir):
+    item = {
+        "url": "http://courses.edx.org/starcraft",
+        "page_title": "StarCraft",
+        "request_headers": {"Cookie": "nocookieforyou"},
+        "accessed_at": datetime(2016, 8, 26, 14, 12, 45),
+    }
+    data_dir = tmpdir.mkdir("data")
+    spider = mocker.Mock(data_dir=str(data_dir), pa11y_ignore_rules=None)
+    mocker.patch("subprocess.check_call")
+    mocker.patch("tempfile.NamedTemporaryFile")
+    mocker.patch("os.remove")
+    killpg = mocker.patch("os.killpg")
+    pipeline = Pa11yPipeline()
+
+    # the crawl is cancelled while pa11y is running
+    pa11y_process = mocker.Mock(name="run-Popen", returncode=None, pid=123)
+    pa11y_process.poll.return_value = None
+
+    def mock_communicate():
+        pipeline.crawl_cancelled(spider, "fail_fast")
+        pa11y_process.returncode = -9
+        return b"", b""
+    pa11y_process.communicate.side_effect = mock_communicate
+    mock_Popen = mocker.patch("subprocess.Popen", return_value=pa11y_process)
+    with pytest.raises(DropItem):
+        pipeline.process_item(item, spider)
+    assert pa11y_process.kill.called
+    killpg.assert_called_with(123, signal.SIGKILL)
+    assert mock_Popen.call_count == 1
+
+    # pages that are still waiting aren't audited at all
+    with pytest.raises(DropItem):
+        pipeline.process_item(dict(item, url="http://courses.edx.org/zerg"), spider)
+    assert mock_Popen.call_count == 1
+    assert not data_dir.listdir()
+
+
+
+def test_audit_slots(mocker):
+    running = []
+
+    def fake_deferToThread(func, *args):
+        result = defer.Deferred()
+        result.addCallback(lambda _: func(*args))
+        running.append(result)
+        return result
+    mocker.patch("twisted.internet.threads.deferToThread", side_effect=fake_deferToThread)
+    slots = AuditSlots(limit=2)
+    results = []
+    for page in range(5):
+        slots.run(lambda page: page * 10, page).addCallback(results.append)
+    assert (slots.running, len(slots.waiting)) == (2, 3)
+
+    # a finished audit frees its slot for the next one
+    running[0].callback(None)
+    assert results == [0]
+    assert (slots.running, len(slots.waiting)) == (2, 2)
+
+    # while paused, no new audits start
+    slots.pause()
+    running[1].callback(None)
+    assert (slots.running, len(slots.waiting)) == (1, 2)
+    slots.resume()
+    assert (slots.running, len(slots.waiting)) == (2, 1)
+
+    # raising the limit starts the waiting audits right away
+    slots.set_limit(4)
+    assert (slots.running, len(slots.waiting)) == (3, 0)
+    for audit in running[2:]:
+        audit.callback(None)
+    assert results == [0, 10, 20, 30, 40]
+    assert slots.running == 0
+
+
+def test_threaded_audit_bookkeeping(mocker, tmpdir):
+    from twisted.internet import reactor
+    from twisted.python import threadable
+    # as if the reactor were running
+    mocker.patch.object(threadable, "ioThread", threadable.getThreadID())
+    call_from_thread = mocker.patch.object(reactor, "callFromThread")
+
+    def fake_deferToThread(func, *args):
+        results = []
+        thread = threading.Thread(target=lambda: results.append(func(*args)))
+        thread.start()
+        thread.join()
+        return defer.succeed(results[0])
+    mocker.patch("twisted.internet.threads.deferToThread", side_effect=fake_deferToThread)
+    mocker.patch("subprocess.check_call")
+    mocker.patch("tempfile.NamedTemporaryFile")
+    mocker.patch("os.remove")
+    failed = mocker.Mock(name="failed-Popen", returncode=1, pid=1)
+    failed.communicate.return_value = (b"", b"Truffler timed out")
+    succeeded = mocker.Mock(name="run-Popen", returncode=0, pid=2)
+    succeeded.communicate.return_value = (b"[]", b"")
+    mocker.patch("subprocess.Popen", side_effect=[failed, succeeded])
+
+    data_dir = tmpdir.mkdir("data")
+    spider = mocker.Mock(data_dir=str(data_dir), pa11y_ignore_rules=None)
+    stats = spider.crawler.stats
+    callers = []
+    stats.inc_value.side_effect = lambda *args, **kwargs: callers.append(threading.current_thread())
+    pipeline = Pa11yPipeline(audit_concurrency=1, supervisor=AuditSupervisor(stats=stats))
+    results = []
+    pipeline.process_item({
+        "url": "http://courses.edx.org/zerg", "page_title": "Zerg",
+        "request_headers": {}, "accessed_at": datetime(2016, 8, 26),
+    }, spider).addCallback(results.append)
+
+    item, = results
+    assert item["result"]["num_error"] == 0
+    # the stats are only touched in the reactor's thread...
+    stats.inc_value.assert_any_call("pa11y/retries", count=1, spider=spider)
+    assert callers and all(caller is threading.main_thread() for caller in callers)
+    # ...and the supervisor's stats are sent there from the audit thread
+    call_from_thread.assert_any_call(stats.inc_value, "pa11y/children/started", count=1)
+
+
+def test_report_pipeline(mocker, tmpdir):
+    data_dir = tmpdir.mkdir("data")
+    output_dir = tmpdir.join("html")
+    spider = mocker.Mock(data_dir=str(data_dir))
+    # a result from an earlier crawl
+    write_pa11y_results({
+        "url": "http://courses.edx.org/old", "page_title": "Old",
+        "request_headers": {}, "accessed_at": datetime(2016, 8, 1),
+    }, [{"type": "error", "code": "X.H1", "selector": "#x", "message": "", "context": ""}],
+        Path(data_dir))
+
+    pipeline = ReportPipeline(str(output_dir), flush_interval=0)
+    pipeline.open_spider(spider)
+    assert "courses.edx.org/old" in output_dir.join("index.html").read_text("utf8")
+
+    item = {
+        "url": "http://courses.edx.org/new", "page_title": "New",
+        "request_headers": {}, "accessed_at": datetime(2016, 8, 2),
+    }
+    item["result"] = write_pa11y_results(item, [], Path(data_dir))
+    assert pipeline.process_item(item, spider) is item
+    detail = output_dir.join(item["result"]["filename"].replace(".json", ".html"))
+    assert detail.check()
+    # the index is only rendered when it's flushed
+    assert "courses.edx.org/new" not in output_dir.join("index.html").read_text("utf8")
+    pipeline.close_spider(spider)
+    assert "courses.edx.org/new" in output_dir.join("index.html").read_text("utf8")
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import glob
+import json
+import time
+import pstats
+import threading
+import subprocess
+import collections
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+import pytest
+from path import Path
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.test import get_crawler
+from pa11ycrawler import util
+from pa11ycrawler.profiling import Profiler, resolve_target
+from pa11ycrawler.extensions import Profiling
+
+
+def test_resolve_target():
+    assert resolve_target("pa11ycrawler.util.url_template") == (util, "url_template")
+    owner, name = resolve_target("pa11ycrawler.pipelines.Pa11yPipeline.run_pa11y")
+    assert owner.__name__ == "Pa11yPipeline"
+    assert name == "run_pa11y"
+    with pytest.raises(ValueError):
+        resolve_target("pa11ycrawler.util.nope")
+
+
+def test_deterministic_profile(tmpdir):
+    original = util.pa11y_counts
+    finished = []
+    profiler = Profiler(
+        targets=["pa11ycrawler.util.pa11y_counts"], max_calls=2,
+        on_finish=finished.append,
+    )
+    profiler.install()
+    assert util.pa11y_counts is not original
+    for _ in range(3):
+        util.pa11y_counts([{"type": "error"}])
+    # profiling stops after max_calls
+    assert finished == [profiler]
+    assert profiler.calls == 2
+    profiler.uninstall()
+    assert util.pa11y_counts is original
+
+    path, = profiler.save(str(tmpdir))
+    assert path.endswith(".pstats")
+    stats = pstats.Stats(path)
+    counted = [func for func in stats.stats if func[2] == "pa11y_counts"]
+    assert stats.stats[counted[0]][1] == 2
+
+
+def test_sampled_profile(tmpdir, monkeypatch):
+    def slow_pages():
+        for page in range(3):
+            time.sleep(0.02)
+            yield page
+    monkeypatch.setattr(util, "slow_pages", slow_pages, raising=False)
+    profiler = Profiler(
+        targets=["pa11ycrawler.util.slow_pages"], mode="sample", interval=0.002,
+    )
+    profiler.install()
+    assert list(util.slow_pages()) == [0, 1, 2]
+    profiler.uninstall()
+
+    path, = profiler.save(str(tmpdir))
+    assert path.endswith(".folded")
+    lines = open(path).read().splitlines()
+    assert lines
+    # stacks start at the profiled function, not at this test
+    assert all(line.startswith("slow_pages (") for line in lines)
+
+
+def test_profiling_disabled():
+    with pytest.raises(NotConfigured):
+        Profiling.from_crawler(get_crawler(settings_dict={"PROFILE_ENABLED": False}))
+
+
+@pytest.mark.parametrize("mode", ["deterministic", "sample"])
+def test_profile_in_threads(tmpdir, monkeypatch, mode):
+    def audit(page):
+        time.sleep(0.02)
+        return page
+    monkeypatch.setattr(util, "audit", audit, raising=False)
+    profiler = Profiler(targets=["pa11ycrawler.util.audit"], mode=mode, interval=0.002)
+    profiler.install()
+    threads = [threading.Thread(target=util.audit, args=(page,)) for page in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    util.audit(2)
+    profiler.uninstall()
+    assert profiler.calls == 3
+
+    path, = profiler.save(str(tmpdir))
+    if mode == "deterministic":
+        # the calls in the threads are in the profile too
+        stats = pstats.Stats(path)
+        counted = [func for func in stats.stats if func[2] == "audit"]
+        assert stats.stats[counted[0]][1] == 3
+    else:
+        lines = open(path).read().splitlines()
+        assert all(line.startswith("audit (") for line in lines)
+        assert sum(int(line.rsplit(" ", 1)[1]) for line in lines) > 15
+
+
+CRAWL_SCRIPT = u"""
+import sys
+from scrapy.crawler import CrawlerProcess
+from scrapy.utils.project import get_project_settings
+from pa11ycrawler.spiders.edx import EdxSpider
+
+settings = get_project_settings()
+settings.setdict({
+    "ITEM_PIPELINES": {
+        "pa11ycrawler.pipelines.DuplicatesPipeline": 200,
+        "pa11ycrawler.pipelines.DropDRFPipeline": 250,
+    },
+    "EXTENSIONS": {"pa11ycrawler.extensions.Profiling": 510},
+    "PROFILE_ENABLED": True,
+    "LOG_LEVEL": "INFO",
+}, priority="cmdline")
+process = CrawlerProcess(settings)
+process.crawl(EdxSpider, domain="127.0.0.1", port=sys.argv[1], data_dir=sys.argv[2])
+process.start()
+"""
+
+
+class FakeLMSHandler(BaseHTTPRequestHandler):
+    "Just enough of an LMS for the spider to log in and find a few pages."
+    def do_GET(self):  # pylint: disable=invalid-name
+        path = self.path.split("?")[0]
+        if path == "/auto_auth":
+            body = json.dumps({"email": "staff@example.com", "password": "edx"})
+        elif path == "/api/courses/v1/blocks/":
+            page = "http://127.0.0.1:{}/courses/x/{}/"
+            body = json.dumps({"blocks": {
+                "a": {"lms_web_url": page.format(self.server.server_port, "a")},
+                "b": {"lms_web_url": page.format(self.server.server_port, "b")},
+            }})
+        else:
+            body = (
+                u"<html><head><title>Page</title></head>"
+                u"<body><main><a href='/courses/x/{}/'>Next</a></main></body></html>"
+            ).format(len(path))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json" if body.startswith("{") else "text/html")
+        self.end_headers()
+        self.wfile.write(body.encode("utf8"))
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+def test_profile_crawl(tmpdir):
+    server = HTTPServer(("127.0.0.1", 0), FakeLMSHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        subprocess.check_call(
+            [sys.executable, "-c", CRAWL_SCRIPT, str(server.server_port), str(tmpdir)],
+            cwd=str(Path(__file__).abspath().parent.parent),
+        )
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    path, = glob.glob(str(tmpdir.join("profiles", "*.pstats")))
+    stats = pstats.Stats(path)
+    calls = collections.Counter()
+    for (filename, _, name), (_, ncalls, _, _, _) in stats.stats.items():
+        calls[(os.path.basename(filename), name)] += ncalls
+    # the spider's rule callback, and the pipelines that were built before
+    # the spider was opened, are profiled too
+    assert calls[("edx.py", "analyze_url_list")] >= 1
+    assert calls[("edx.py", "parse_item")] >= 2
+    assert calls[("__init__.py", "process_item")] >= 4
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import json
+import threading
+from path import Path
+try:
+    from urllib.request import urlopen
+    from urllib.error import HTTPError
+except ImportError:
+    from urllib2 import urlopen, HTTPError
+import pytest
+from pa11ycrawler.snapshots import SnapshotStore
+from pa11ycrawler.replay import SnapshotServer, replay, snapshot_path
+
+
+@pytest.fixture
+def store(tmpdir):
+    store = SnapshotStore(Path(str(tmpdir)) / "snapshots")
+    store.put_page(
+        "http://courses.edx.org/courses/foo/about?bar=baz",
+        b"<html><title>About Foo</title></html>",
+        encoding="utf-8", page_title="About Foo",
+    )
+    return store
+
+
+def test_snapshot_path():
+    assert snapshot_path("http://x/a/b?c=d") == "/a/b?c=d"
+    assert snapshot_path("http://x/a/b") == "/a/b"
+
+
+def test_snapshot_server(store):
+    server = SnapshotServer(store, store.pages())
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        response = urlopen(server.base_url + "/courses/foo/about?bar=baz")
+        assert response.read() == b"<html><title>About Foo</title></html>"
+        assert response.info()["Content-Type"] == "text/html; charset=utf-8"
+
+        with pytest.raises(HTTPError):
+            urlopen(server.base_url + "/courses/foo/other")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_replay(store, tmpdir, mocker):
+    mocker.patch("subprocess.check_call")
+    pa11y_process = mocker.Mock(name="run-Popen", returncode=0)
+    pa11y_process.communicate.return_value = (b"[]", b"")
+    mock_Popen = mocker.patch("subprocess.Popen", return_value=pa11y_process)
+    data_dir = str(tmpdir.mkdir("replay-data"))
+
+    stats = replay(store, data_dir, workers=2)
+
+    assert stats["replay/pages"] == 1
+    args = mock_Popen.call_args[0][0]
+    assert args[1].startswith("http://127.0.0.1:")
+    assert args[1].endswith("/courses/foo/about?bar=baz")
+
+    results = Path(data_dir).files("*.json")
+    assert len(results) == 1
+    data = json.loads(results[0].text())
+    assert data["url"] == "http://courses.edx.org/courses/foo/about?bar=baz"
+    assert data["page_title"] == "About Foo"
+    assert "audit_url" not in data
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+import json
+from datetime import datetime
+from path import Path
+from scrapy.utils.test import get_crawler
+from pa11ycrawler.extensions import RunStats
+from pa11ycrawler.runstats import RunRecorder, load_runs, write_run_stats
+
+
+def make_run(run_id, finished_at, pages, seconds, shard_index=None):
+    recorder = RunRecorder(top=2)
+    for i, value in enumerate(seconds):
+        recorder.observe(u"http://localhost/courses/{}/page/{}".format(run_id, i), value)
+    run = {
+        "run_id": run_id,
+        "shard_index": shard_index,
+        "started_at": datetime(2016, 1, 1),
+        "finished_at": finished_at,
+        "finish_reason": "finished",
+        "duration": 100.0,
+        "pages": pages,
+        "retries": 1,
+        "response_bytes": 1000,
+        "peak_rss_mb": 50,
+    }
+    run.update(recorder.to_dict())
+    return run
+
+
+def test_run_recorder():
+    recorder = RunRecorder(top=2)
+    recorder.observe("http://localhost/courses/abc1/info", 3)
+    recorder.observe("http://localhost/courses/abc2/info", 1)
+    recorder.observe("http://localhost/dashboard", 2)
+    data = recorder.to_dict()
+    assert data["audit"]["count"] == 3
+    assert data["slowest_urls"] == [
+        {"url": "http://localhost/courses/abc1/info", "seconds": 3},
+        {"url": "http://localhost/dashboard", "seconds": 2},
+    ]
+    assert data["url_templates"][0] == {
+        "template": "/courses/*/info", "pages": 2, "seconds": 4, "max": 3,
+    }
+
+
+def test_load_runs(tmpdir):
+    data_dir = Path(tmpdir)
+    assert load_runs(data_dir) == []
+    write_run_stats(data_dir, make_run("new", datetime(2016, 1, 3), 10, [1, 2]))
+    write_run_stats(data_dir, make_run("old", datetime(2016, 1, 2), 20, [5]))
+    (data_dir / "runs" / "broken.json").write_text(u"{")
+
+    runs = load_runs(data_dir)
+    assert [run["run_id"] for run in runs] == ["old", "new"]
+    assert runs[1]["pages_per_second"] == 0.1
+    assert runs[1]["audit_summary"]["count"] == 2
+    assert [run["run_id"] for run in load_runs(data_dir, limit=1)] == ["new"]
+
+
+def test_load_sharded_runs(tmpdir):
+    data_dir = Path(tmpdir)
+    for shard_index, seconds in ((0, [1, 9]), (1, [4])):
+        finished_at = datetime(2016, 1, 2, shard_index)
+        write_run_stats(data_dir, make_run("sharded", finished_at, 10, seconds, shard_index))
+    assert len((data_dir / "runs").files()) == 2
+
+    run, = load_runs(data_dir)
+    assert run["shards"] == 2
+    assert run["pages"] == 20
+    assert run["pages_per_second"] == 0.2
+    assert run["finished_at"].startswith("2016-01-02T01")
+    assert run["audit_summary"]["count"] == 3
+    assert [page["seconds"] for page in run["slowest_urls"]] == [9, 4, 1]
+    assert run["url_templates"][0]["pages"] == 3
+
+
+def test_run_stats_extension(mocker, tmpdir):
+    crawler = get_crawler(settings_dict={"RUN_STATS_ENABLED": True})
+    crawler.stats = mocker.Mock(get_stats=lambda: {
+        "item_scraped_count": 2,
+        "pa11y/retries": 1,
+        "pa11y/children/peak_rss_mb": 300,
+    })
+    ext = RunStats.from_crawler(crawler)
+    spider = mocker.Mock(data_dir=str(tmpdir), shard_count=None)
+    ext.spider_opened(spider)
+    for url, seconds in (("http://localhost/a", 2.5), ("http://localhost/b", 0.5)):
+        ext.item_scraped({"result": {
+            "url": url, "run_id": "20160101T000000", "audit_seconds": seconds,
+        }}, spider)
+    # items that weren't audited are ignored
+    ext.item_scraped({"url": "http://localhost/c"}, spider)
+    ext.spider_closed(spider, "finished")
+
+    data = json.load(tmpdir.join("runs", "20160101T000000.json"))
+    assert data["pages"] == 2
+    assert data["retries"] == 1
+    assert data["finish_reason"] == "finished"
+    assert data["peak_children_rss_mb"] == 300
+    assert data["audit"]["count"] == 2
+    assert data["slowest_urls"][0] == {"url": "http://localhost/a", "seconds": 2.5}
@@ -0,0 +1,65 @@
+from scrapy.http.response.html import HtmlResponse
+from scrapy.statscollectors import MemoryStatsCollector
+from pa11ycrawler.session import SessionManager, get_session_expiry
+
+
+def make_response(set_cookie):
+    return HtmlResponse(
+        url="http://localhost:8000/user_api/v1/account/login_session/",
+        body=b"",
+        encoding="utf-8",
+        headers={"Set-Cookie": set_cookie},
+    )
+
+
+def test_session_expiry_max_age():
+    response = make_response("sessionid=abc; Max-Age=3600; Path=/")
+    assert get_session_expiry(response, now=1000) == 4600
+
+
+def test_session_expiry_expires():
+    response = make_response(
+        "sessionid=abc; expires=Fri, 25-Aug-2017 18:55:05 GMT; Path=/"
+    )
+    assert get_session_expiry(response) == 1503687305
+
+
+def test_session_expiry_missing():
+    response = make_response("csrftoken=abc; Max-Age=3600; Path=/")
+    assert get_session_expiry(response) is None
+
+
+def test_single_flight(mocker):
+    stats = MemoryStatsCollector(mocker.Mock())
+    session = SessionManager(stats=stats)
+
+    assert session.begin_relogin()
+    assert not session.begin_relogin()
+    session.park("first")
+    session.park("second")
+
+    assert session.finish_relogin(expires_at=5000) == ["first", "second"]
+    assert not session.relogin_in_progress
+    assert session.expires_at == 5000
+    assert stats.get_value("session/relogin_count") == 1
+    assert stats.get_value("session/parked_requests") == 2
+    assert stats.get_value("session/parked_wait_time") >= 0
+    assert stats.get_value("session/parked_wait_time_max") >= 0
+
+    assert session.begin_relogin()
+    session.park("third")
+    assert session.fail_relogin() == ["third"]
+    assert stats.get_value("session/relogin_count") == 2
+    assert stats.get_value("session/relogin_failed") == 1
+
+
+def test_needs_refresh():
+    session = SessionManager(refresh_margin=60)
+    assert not session.needs_refresh(now=1000)
+
+    session.set_expiry(2000)
+    assert not session.needs_refresh(now=1000)
+    assert session.needs_refresh(now=1950)
+
+    session.begin_relogin(proactive=True)
+    assert not session.needs_refresh(now=1950)
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import json
+from datetime import datetime
+import pytest
+from path import Path
+from pa11ycrawler.ignore import IgnoreRules
+from pa11ycrawler.manifest import read_manifest
+from pa11ycrawler.pipelines.pa11y import write_pa11y_results
+from pa11ycrawler.sharding import shard_for, merge_data_dirs
+from pa11ycrawler.runstats import write_run_stats
+from pa11ycrawler.snapshots import SnapshotStore
+from pa11ycrawler.util import result_files
+
+
+def test_shard_for():
+    url = "http://localhost:8000/courses/course-v1:edX+Test101+course/courseware/a/b/1"
+    shard = shard_for(url, 4)
+    assert 0 <= shard < 4
+    # URLs that are the same page for the DuplicatesPipeline are in the same shard
+    assert shard_for(url + "?activate_block_id=x", 4) == shard
+    assert shard_for(url[:-2], 4) == shard
+    assert shard_for(url, 1) == 0
+
+
+def write_result(data_dir, url, accessed_at, results=()):
+    item = {
+        "url": url,
+        "page_title": "Page",
+        "request_headers": {},
+        "accessed_at": accessed_at,
+    }
+    rules = IgnoreRules({"*": [{"code": "WCAG2AA.H30"}]})
+    write_pa11y_results(item, list(results), data_dir, ignore_rules=rules)
+
+
+def test_merge_data_dirs(tmpdir):
+    shard0 = Path(tmpdir.mkdir("shard0"))
+    shard1 = Path(tmpdir.mkdir("shard1"))
+    write_result(shard0, "http://localhost/a", datetime(2016, 1, 1))
+    write_result(shard0, "http://localhost/b", datetime(2016, 1, 1))
+    write_result(shard1, "http://localhost/c", datetime(2016, 1, 1))
+    # the same page, audited by both shards
+    write_result(shard1, "http://localhost/a?x=1", datetime(2016, 1, 2), [{"type": "error"}])
+    SnapshotStore(shard0 / "snapshots").put_page("http://localhost/a", b"<html>a</html>")
+    SnapshotStore(shard1 / "snapshots").put_page("http://localhost/c", b"<html>c</html>")
+    (shard0 / "metrics.json").write_text(u"{}")
+    for index, shard in enumerate((shard0, shard1)):
+        write_run_stats(shard, {"run_id": "run", "shard_index": index})
+
+    output = Path(tmpdir) / "merged"
+    stats = merge_data_dirs([shard0, shard1], output)
+    assert stats["results"] == 3
+    assert stats["duplicates"] == 1
+    assert stats["ignore_rules"] == 1
+    assert stats["snapshots"] == 2
+    assert stats["runs"] == 2
+
+    merged = [json.load(open(path)) for path in result_files(output)]
+    assert sorted(data["url"] for data in merged) == [
+        "http://localhost/a?x=1", "http://localhost/b", "http://localhost/c",
+    ]
+    assert len(SnapshotStore(output / "snapshots").pages()) == 2
+    assert sorted(entry["url"] for entry in read_manifest(output)) == [
+        "http://localhost/a?x=1", "http://localhost/b", "http://localhost/c",
+    ]
+    assert not (output / "metrics.json").exists()
+
+    # merging again would mix two merges together
+    with pytest.raises(ValueError):
+        merge_data_dirs([shard0, shard1], output)
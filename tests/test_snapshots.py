@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+from path import Path
+from pa11ycrawler.snapshots import SnapshotStore
+
+
+def test_put_and_get(tmpdir):
+    store = SnapshotStore(Path(str(tmpdir)) / "snapshots")
+    body = u"<html><title>☃</title></html>".encode("utf8")
+
+    digest = store.put(body)
+    assert digest in store
+    assert store.get(digest) == body
+
+    # identical bodies are only stored once
+    assert store.put(body) == digest
+    stored = [f for f in store.root.walkfiles("*.gz")]
+    assert len(stored) == 1
+
+
+def test_pages_latest_per_url(tmpdir):
+    store = SnapshotStore(Path(str(tmpdir)))
+    store.put_page(
+        "http://x/a", b"old", encoding="utf-8", page_title="A",
+        accessed_at=datetime(2016, 1, 1),
+    )
+    new = store.put_page(
+        "http://x/a", b"new", encoding="utf-8", page_title="A",
+        accessed_at=datetime(2016, 1, 2),
+    )
+    other = store.put_page("http://x/b", b"new", accessed_at=datetime(2016, 1, 1))
+    assert new == other
+
+    pages = sorted(store.pages(), key=lambda page: page["url"])
+    assert [(page["url"], page["snapshot"]) for page in pages] == [
+        ("http://x/a", new), ("http://x/b", new),
+    ]
+    assert pages[0]["page_title"] == "A"
+    assert pages[0]["accessed_at"] == "2016-01-02T00:00:00"
+
+
+def test_pages_empty(tmpdir):
+    assert SnapshotStore(Path(str(tmpdir)) / "missing").pages() == []
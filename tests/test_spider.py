@@ -1,14 +1,17 @@
 import pytest
 import json
+import collections
+import time
 from datetime import datetime
 import scrapy
 from scrapy.http.response.html import HtmlResponse
 from scrapy.spidermiddlewares.httperror import HttpError
+from scrapy.utils.test import get_crawler
 from twisted.internet.error import DNSLookupError
 import textwrap
-from freezegun import freeze_time
 from urlobject import URLObject
-from pa11ycrawler.spiders.edx import EdxSpider, load_pa11y_ignore_rules
+from pa11ycrawler.ignore import load_pa11y_ignore_rules
+from pa11ycrawler.spiders.edx import EdxSpider, make_identities, LOGIN_FAILURE_MSG
 try:
     from urllib.parse import parse_qs
 except ImportError:
@@ -136,6 +139,77 @@ def test_auto_auth_response(mocker):
     assert request.headers == {}
 
 
+def test_multiple_identities_auto_auth():
+    spider = EdxSpider(email=None, password=None, identities="3")
+    requests = list(spider.start_requests())
+    assert len(requests) == 3
+    assert [req.meta["cookiejar"] for req in requests] == [0, 1, 2]
+    assert all(req.dont_filter for req in requests)
+
+    # the crawl only starts once every identity has logged in
+    for index, request in enumerate(requests):
+        fake_result = {
+            "email": "user{}@example.com".format(index),
+            "password": "pass{}".format(index),
+        }
+        fake_response = HtmlResponse(
+            url=request.url,
+            request=request,
+            body=json.dumps(fake_result).encode('utf8'),
+            encoding="utf-8",
+        )
+        started = list(spider.after_auto_auth(fake_response))
+        if index < 2:
+            assert started == []
+        else:
+            assert len(started) == 1
+
+    assert [identity.email for identity in spider.identities] == [
+        "user0@example.com", "user1@example.com", "user2@example.com",
+    ]
+    # the first identity is the spider's own
+    assert spider.login_email == "user0@example.com"
+
+
+def test_assign_identity_round_robin():
+    spider = EdxSpider(email=None, password=None, identities="3")
+    spider.identities[1].failed = True
+
+    requests = [
+        spider.assign_identity(scrapy.Request("http://localhost:8000/{}".format(i)))
+        for i in range(4)
+    ]
+    assert [req.meta["cookiejar"] for req in requests] == [0, 2, 0, 2]
+
+    # requests that already have an identity keep it
+    request = scrapy.Request("http://localhost:8000/", meta={"cookiejar": 1})
+    assert spider.assign_identity(request).meta["cookiejar"] == 1
+
+
+def test_make_identities():
+    identities = make_identities("a@example.com,b@example.com", "secret")
+    assert [(i.email, i.password) for i in identities] == [
+        ("a@example.com", "secret"), ("b@example.com", "secret"),
+    ]
+
+    identities = make_identities("a@example.com", "secret", count="3")
+    assert [i.cookiejar for i in identities] == [0, 1, 2]
+    assert all(i.email == "a@example.com" for i in identities)
+
+    identities = make_identities(count="4", single_url="http://localhost/")
+    assert len(identities) == 1
+
+    with pytest.raises(ValueError):
+        make_identities("a@example.com,b@example.com", "x,y,z")
+
+    # without a password, the identities are created with auto auth
+    identity, = make_identities("a@example.com")
+    assert identity.email is None and identity.password is None
+    spider = EdxSpider(email="a@example.com", password=None)
+    request, = list(spider.start_requests())
+    assert URLObject(request.url).path == "/auto_auth"
+
+
 def test_analyze_urls(mocker):
     spider = EdxSpider(email=None, password=None)
     fake_json = {
@@ -159,36 +233,102 @@ def test_analyze_urls(mocker):
     url_one = "http://localhost:8003/xblock/block-coursename+course+type@course+block@course"
     url_two = "http://localhost:8003/courses/course-coursename/jump_to/block-coursename+course+type@course+block@course"
 
+    spider.crawler = mocker.Mock()
     requests = list(spider.analyze_url_list(fake_response))
 
     assert any(request.url == url_one for request in requests)
     assert any(request.url == url_two for request in requests)
     assert all(isinstance(request,scrapy.Request) for request in requests)
+    # the seeded pages are counted, to estimate how long the crawl will take
+    spider.crawler.stats.inc_value.assert_called_with("seed/pages", count=2, spider=spider)
 
 
-
-@freeze_time("2016-01-01")
-def test_log_back_in():
+def test_analyze_urls_login_redirect():
+    spider = EdxSpider(email="abc@def.com", password="xyz")
+    api_url = "http://localhost:8000/api/courses/v1/blocks/?course_id=x"
     fake_request = scrapy.Request(
-        url="http://localhost:8000/foo/bar"
+        url="http://localhost:8000/login",
+        meta={"redirect_urls": [api_url]},
+        callback=spider.analyze_url_list,
     )
     fake_response = HtmlResponse(
-        url="http://localhost:8000/login?next=/foo/bar",
+        url="http://localhost:8000/login",
         request=fake_request,
         body=LOGIN_HTML.encode("utf-8"),
         encoding="utf-8",
         headers={"Set-Cookie": CSRF_HEADER},
     )
+
+    # the login page isn't parsed as JSON: we log in again
+    login, = list(spider.analyze_url_list(fake_response))
+    assert login.callback == spider.after_login
+    (replay, _), = spider.session.parked
+    assert replay.url == api_url
+    assert replay.callback == spider.analyze_url_list
+
+
+def test_parse_item_sharded(mocker):
+    spiders = [EdxSpider(shard_index=index, shard_count=3) for index in range(3)]
+    for spider in spiders:
+        spider.crawler = mocker.Mock()
+    audited = collections.Counter()
+    for page in range(20):
+        url = "http://localhost:8000/courses/course/courseware/a/b/{}".format(page)
+        for index, spider in enumerate(spiders):
+            request = scrapy.Request(url + "?activate_block_id=x")
+            response = HtmlResponse(url=request.url, request=request, body=b"<title>x</title>")
+            if list(spider.parse_item(response)):
+                audited[index] += 1
+    # every page is audited by exactly one shard
+    assert sum(audited.values()) == 20
+    assert len(audited) == 3
+    assert spiders[0].crawler.stats.inc_value.call_count == 20 - audited[0]
+    with pytest.raises(ValueError):
+        EdxSpider(shard_index=2, shard_count=2)
+
+    # a spider without a crawler skips other shards' pages too
+    spider = EdxSpider(shard_index=0, shard_count=3)
+    urls = [
+        "http://localhost:8000/courses/course/courseware/a/b/{}".format(page)
+        for page in range(20)
+    ]
+    url = next(url for url in urls if not spider.in_shard(url))
+    request = scrapy.Request(url)
+    response = HtmlResponse(url=url, request=request, body=b"<title>x</title>")
+    assert not list(spider.parse_item(response))
+
+
+def make_login_redirect(path):
+    """
+    Build a response for a request to `path` that was redirected to the
+    login page.
+    """
+    fake_request = scrapy.Request(
+        url="http://localhost:8000/login?next=" + path,
+        meta={"redirect_urls": ["http://localhost:8000" + path]},
+    )
+    return HtmlResponse(
+        url="http://localhost:8000/login?next=" + path,
+        request=fake_request,
+        body=LOGIN_HTML.encode("utf-8"),
+        encoding="utf-8",
+        headers={"Set-Cookie": CSRF_HEADER},
+    )
+
+
+def test_log_back_in():
+    fake_response = make_login_redirect("/foo/bar")
     spider = EdxSpider(email="abc@def.com", password="xyz")
 
     requests = list(spider.parse_item(fake_response))
 
-    assert len(requests) == 2
+    # the login page is not audited: we only log in again
+    assert len(requests) == 1
     request = requests[0]
-    item = requests[1]
-    expected_url = 'http://localhost:8000/user_api/v1/account/login_session/?next=%2Ffoo%2Fbar'
+    expected_url = 'http://localhost:8000/user_api/v1/account/login_session/'
     assert urls_are_equal(request.url, expected_url)
     assert request.method == "POST"
+    assert request.dont_filter
     body = parse_qs(request.body.decode('utf8'))
     expected_body = {
         "email": ["abc@def.com"],
@@ -199,12 +339,115 @@ def test_log_back_in():
         b'Content-Type': [b'application/x-www-form-urlencoded'],
         b'X-Csrftoken': [b'2JH7ojWIMGDjWxSrdnp4Jkg0bGxaS3MV'],
     }
-    assert item == {
-        'accessed_at': datetime(2016, 1, 1),
-        'page_title': 'Sign in or Register',
-        'request_headers': {},
-        'url': 'http://localhost:8000/login?next=/foo/bar',
-    }
+    assert spider.session.relogin_in_progress
+
+
+def test_log_back_in_single_flight():
+    spider = EdxSpider(email="abc@def.com", password="xyz")
+
+    first = list(spider.parse_item(make_login_redirect("/foo/bar")))
+    second = list(spider.parse_item(make_login_redirect("/baz")))
+    assert len(first) == 1
+    assert second == []
+
+    login_response = HtmlResponse(
+        url="http://localhost:8000/user_api/v1/account/login_session/",
+        body=b"",
+        encoding="utf-8",
+        headers={"Set-Cookie": "sessionid=abc; Max-Age=3600; Path=/"},
+    )
+    replays = list(spider.after_login(login_response))
+    assert [req.url for req in replays] == [
+        "http://localhost:8000/foo/bar",
+        "http://localhost:8000/baz",
+    ]
+    assert all(req.dont_filter for req in replays)
+    assert all("redirect_urls" not in req.meta for req in replays)
+    assert not spider.session.relogin_in_progress
+    assert spider.session.expires_at is not None
+
+
+def test_log_back_in_replay_limit(mocker, caplog):
+    spider = EdxSpider(email="abc@def.com", password="xyz")
+    spider.crawler = mocker.Mock()
+    spider.max_replays = 2
+    login_response = HtmlResponse(
+        url="http://localhost:8000/user_api/v1/account/login_session/",
+        body=b"",
+        encoding="utf-8",
+    )
+    response = make_login_redirect("/foo/bar")
+    for replays in range(1, 3):
+        list(spider.parse_item(response))
+        replay, = list(spider.after_login(login_response))
+        assert replay.meta["login_replays"] == replays
+        # the replay is redirected to the login page again
+        response = make_login_redirect("/foo/bar")
+        response.request.meta.update(replay.meta, redirect_urls=[replay.url])
+
+    # after two replays, the page is given up on, without logging in again
+    assert list(spider.parse_item(response)) == []
+    assert spider.session.parked == []
+    assert not spider.session.relogin_in_progress
+    assert "giving up on http://localhost:8000/foo/bar" in caplog.text
+    spider.crawler.stats.inc_value.assert_called_with(
+        "session/abandoned_requests", spider=spider,
+    )
+
+
+def test_log_back_in_failure():
+    spider = EdxSpider(email="abc@def.com", password="xyz")
+    list(spider.parse_item(make_login_redirect("/foo/bar")))
+
+    login_response = HtmlResponse(
+        url="http://localhost:8000/user_api/v1/account/login_session/",
+        body=LOGIN_FAILURE_MSG.encode("utf-8"),
+        encoding="utf-8",
+    )
+    assert list(spider.after_login(login_response)) == []
+    assert not spider.session.relogin_in_progress
+    assert spider.session.parked == []
+
+
+def test_proactive_session_refresh():
+    spider = EdxSpider(email="abc@def.com", password="xyz")
+    spider.session.set_expiry(time.time() + 10)
+    fake_response = HtmlResponse(
+        url="http://localhost:8000/foo/bar",
+        request=scrapy.Request(url="http://localhost:8000/foo/bar"),
+        body=b"<html><head><title>Foo</title></head></html>",
+        encoding="utf-8",
+    )
+
+    results = list(spider.parse_item(fake_response))
+    assert len(results) == 2
+    refresh, item = results
+    assert isinstance(refresh, scrapy.Request)
+    assert urls_are_equal(refresh.url, "http://localhost:8000/login")
+    assert item["page_title"] == "Foo"
+
+    # no second refresh while the first is in progress
+    results = list(spider.parse_item(fake_response))
+    assert len(results) == 1
+
+
+def test_parse_item_snapshot(tmpdir):
+    from pa11ycrawler.snapshots import SnapshotStore
+    spider = EdxSpider(email="abc@def.com", password="xyz")
+    spider.snapshots = SnapshotStore(str(tmpdir))
+    body = b"<html><head><title>Foo</title></head></html>"
+    fake_response = HtmlResponse(
+        url="http://localhost:8000/foo/bar",
+        request=scrapy.Request(url="http://localhost:8000/foo/bar"),
+        body=body,
+        encoding="utf-8",
+    )
+
+    item, = list(spider.parse_item(fake_response))
+    assert spider.snapshots.get(item["snapshot"]) == body
+    page, = spider.snapshots.pages()
+    assert page["url"] == "http://localhost:8000/foo/bar"
+    assert page["snapshot"] == item["snapshot"]
 
 
 def test_load_pa11y_rules_file(tmpdir):
@@ -234,6 +477,26 @@ def test_load_pa11y_rules_file(tmpdir):
     assert result == expected_result
 
 
+def test_ignore_rules_from_crawler(tmpdir, mocker):
+    rule_file = tmpdir / "ignore.yaml"
+    rule_file.write_text(u'"*": [{"type": "notice"}]', encoding="utf8")
+    crawler = get_crawler(settings_dict={
+        "PA11Y_IGNORE_RULES_CACHE_DIR": str(tmpdir / "cache"),
+        "PA11Y_IGNORE_RULES_RELOAD_INTERVAL": 60,
+    })
+    spider = EdxSpider.from_crawler(crawler, pa11y_ignore_rules_file=str(rule_file))
+    assert spider.ignore_rules_source.cache_dir == str(tmpdir / "cache")
+    assert spider.pa11y_ignore_rules == {"*": [{"type": "notice"}]}
+
+    looping_call = mocker.patch("pa11ycrawler.spiders.edx.task.LoopingCall")
+    spider.start_reloading_ignore_rules(spider)
+    looping_call.return_value.start.assert_called_once_with(60.0, now=False)
+
+    # a missing rules file is an error before the crawl starts
+    with pytest.raises(ValueError):
+        EdxSpider.from_crawler(crawler, pa11y_ignore_rules_file=str(tmpdir / "nope.yaml"))
+
+
 def test_single_url():
     url = 'http://localhost:8003/courses/course-v1:edX+Test101+course/discussion/forum/'
     fake_result = {
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+import json
+from io import BytesIO
+import pytest
+from twisted.web.test.requesthelper import DummyRequest
+from scrapy.exceptions import NotConfigured
+from scrapy.statscollectors import MemoryStatsCollector
+from scrapy.utils.test import get_crawler
+from pa11ycrawler.extensions import StatusServer
+from pa11ycrawler.extensions.status import StatusResource
+from pa11ycrawler.pipelines import Pa11yPipeline
+
+
+@pytest.fixture
+def status_server(mocker):
+    mocker.patch("subprocess.check_call")
+    crawler = get_crawler(settings_dict={"STATUS_ENABLED": True, "STATUS_TOKEN": "s3cret"})
+    crawler.stats = MemoryStatsCollector(crawler)
+    crawler.spider = mocker.Mock()
+    engine = crawler.engine = mocker.Mock()
+    engine.spider.name = "edx"
+    engine.slot.scheduler.__len__ = lambda self: 40
+    engine.downloader.active = [None] * 3
+    engine.scraper.slot.active = []
+    engine.scraper.slot.itemproc_size = 7
+    engine.scraper.itemproc.middlewares = [Pa11yPipeline(audit_concurrency=2)]
+    engine.downloader.total_concurrency = 16
+    engine.downloader.ip_concurrency = 0
+    engine.downloader.slots = {"localhost": mocker.Mock(concurrency=8)}
+    return StatusServer.from_crawler(crawler)
+
+
+def request(ext, method, path, body=None, token="s3cret"):
+    req = DummyRequest([])
+    req.method = method
+    req.path = path
+    if token:
+        req.requestHeaders.setRawHeaders(b"Authorization", [b"Bearer " + token.encode("ascii")])
+    req.content = BytesIO(json.dumps(body).encode("utf8") if body is not None else b"")
+    resource = StatusResource(ext)
+    output = resource.render_POST(req) if method == b"POST" else resource.render_GET(req)
+    return req.responseCode or 200, json.loads(output.decode("utf8"))
+
+
+def test_status_disabled():
+    with pytest.raises(NotConfigured):
+        StatusServer.from_crawler(get_crawler())
+
+
+def test_status(mocker, status_server):
+    stats = status_server.stats
+    stats.set_value("seed/pages", 100)
+    stats.set_value("response_received_count", 30)
+    stats.set_value("item_scraped_count", 18)
+    stats.set_value("item_dropped_count", 2)
+    stats.set_value("pa11y/retries", 4)
+    stats.set_value("pa11y/error", 50)
+    # 20 pages were finished in the last minute
+    clock = mocker.patch("time.time", return_value=1000.0)
+    status_server.started_at = 900.0
+    status_server.samples.append((940.0, 0))
+
+    code, status = request(status_server, b"GET", b"/")
+    assert code == 200
+    assert status["uptime"] == 100
+    assert status["pages"] == {"seeded": 100, "crawled": 30, "audited": 18, "dropped": 2}
+    assert status["queues"]["scheduler"] == 40
+    assert status["queues"]["items"] == 7
+    assert status["pages_per_minute"] == 20
+    assert status["eta_seconds"] == 240
+    assert status["errors"] == {"pa11y/retries": 4}
+    assert status["audits"] == {"running": 0, "concurrency": 2, "waiting": 0, "paused": False}
+    assert clock.called
+
+
+def test_control(status_server):
+    code, status = request(status_server, b"POST", b"/control", {
+        "audits": "pause", "audit_concurrency": 4, "download_concurrency": 2,
+    })
+    assert code == 200
+    assert status["audits"]["paused"]
+    assert status["audits"]["concurrency"] == 4
+    downloader = status_server.crawler.engine.downloader
+    assert downloader.total_concurrency == downloader.domain_concurrency == 2
+    assert downloader.slots["localhost"].concurrency == 2
+
+    code, status = request(status_server, b"POST", b"/control", {"audits": "resume"})
+    assert not status["audits"]["paused"]
+
+
+@pytest.mark.parametrize("body", [
+    {"audit_concurrency": 0},
+    {"audit_concurrency": "4"},
+    {"audits": "stop"},
+    {"restart": True},
+    ["pause"],
+])
+def test_invalid_control(status_server, body):
+    code, response = request(status_server, b"POST", b"/control", dict(body, download_concurrency=3)
+                             if isinstance(body, dict) else body)
+    assert code == 400
+    assert "error" in response
+    # nothing is changed
+    assert status_server.crawler.engine.downloader.total_concurrency == 16
+
+
+def test_unauthorized(status_server):
+    code, _ = request(status_server, b"GET", b"/", token=None)
+    assert code == 401
+    code, _ = request(status_server, b"POST", b"/control", {"audits": "pause"}, token="guess")
+    assert code == 401
+    assert not status_server.pipeline.slots.paused
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import signal
+import subprocess as sp
+import pytest
+from scrapy.settings import Settings
+from scrapy.statscollectors import MemoryStatsCollector
+from scrapy.utils.test import get_crawler
+from pa11ycrawler import supervisor as supervisor_module
+from pa11ycrawler.supervisor import (
+    MARKER_ENV, AuditCgroup, AuditSupervisor, marked_processes,
+)
+
+
+def make_supervisor(**kwargs):
+    stats = MemoryStatsCollector(get_crawler())
+    return AuditSupervisor(stats=stats, **kwargs), stats
+
+
+def test_from_settings(tmpdir):
+    settings = Settings({
+        "AUDIT_TIMEOUT": "30",
+        "AUDIT_MAX_MEMORY_MB": "2048",
+        "AUDIT_CGROUP_PARENT": str(tmpdir),
+        "AUDIT_CGROUP_CPUS": "1.5",
+        "AUDIT_CGROUP_MEMORY_MB": "4096",
+    })
+    supervisor = AuditSupervisor.from_settings(settings)
+    assert supervisor.timeout == 30
+    assert supervisor.max_memory_mb == 2048
+
+    # a cgroup directory that isn't in a cgroup filesystem works too
+    supervisor.open()
+    cgroup = supervisor.cgroup
+    assert os.path.dirname(cgroup.path) == str(tmpdir)
+    with open(os.path.join(cgroup.path, "cpu.max")) as cpu_max:
+        assert cpu_max.read() == "150000 100000"
+    with open(os.path.join(cgroup.path, "memory.max")) as memory_max:
+        assert memory_max.read() == str(4096 * 1024 * 1024)
+
+
+def test_missing_cgroup_parent(tmpdir):
+    supervisor, _ = make_supervisor(cgroup=AuditCgroup(str(tmpdir / "missing")))
+    supervisor.open()
+    assert supervisor.cgroup is None
+
+
+@pytest.mark.parametrize("prlimit", [True, False])
+def test_limited_child(monkeypatch, tmpdir, prlimit):
+    if prlimit and not supervisor_module.PRLIMIT:
+        pytest.skip("needs resource.prlimit")
+    # without prlimit, the limits are applied between fork and exec
+    monkeypatch.setattr(supervisor_module, "PRLIMIT", prlimit)
+    cgroup = AuditCgroup(str(tmpdir))
+    cgroup.create()
+    supervisor, stats = make_supervisor(max_cpu_seconds=5, niceness=5, cgroup=cgroup)
+    script = (
+        "import os, resource, time; "
+        "time.sleep(0.5); "
+        "print(os.getpgid(0) == os.getpid(), os.nice(0), "
+        "resource.getrlimit(resource.RLIMIT_CPU)[0], os.environ['{}'])"
+    ).format(MARKER_ENV)
+    proc = supervisor.popen([sys.executable, "-c", script], stdout=sp.PIPE)
+    stdout, _ = supervisor.communicate(proc)
+    in_own_group, niceness, cpu_limit, marker = stdout.decode("utf8").split()
+    assert in_own_group == "True"
+    assert int(niceness) >= 5
+    assert cpu_limit == "5"
+    assert marker == str(os.getpid())
+    assert not proc.timed_out
+    assert stats.get_value("pa11y/children/started") == 1
+    assert supervisor.children == {}
+    with open(os.path.join(cgroup.path, "cgroup.procs")) as procs:
+        assert procs.read() == str(proc.pid)
+
+
+def test_watchdog_kills_process_group():
+    supervisor, stats = make_supervisor(timeout=0.5)
+    # the grandchild stands in for phantomjs, and keeps stdout open
+    script = (
+        "import subprocess, sys, time; "
+        "subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)']); "
+        "time.sleep(30)"
+    )
+    proc = supervisor.popen([sys.executable, "-c", script], stdout=sp.PIPE)
+    supervisor.communicate(proc)
+    assert proc.timed_out
+    assert proc.returncode == -signal.SIGKILL
+    assert stats.get_value("pa11y/children/killed_timeout") == 1
+    assert not stats.get_value("pa11y/children/killed_signal")
+
+    supervisor.close()
+    assert stats.get_value("pa11y/children/peak_rss_mb") > 0
+
+
+def test_kill_orphans(mocker, tmpdir):
+    proc_dir = tmpdir.mkdir("proc")
+
+    def fake_process(pid, environ):
+        proc_dir.mkdir(str(pid)).join("environ").write_binary(environ)
+
+    marker = MARKER_ENV.encode("ascii")
+    fake_process(1001, b"PATH=/bin\0" + marker + b"=2000\0")  # crawler crashed
+    fake_process(1002, marker + b"=" + str(os.getpid()).encode("ascii") + b"\0")  # ours
+    fake_process(1003, b"PATH=/bin\0")  # not an audit
+    fake_process(1004, marker + b"=3000\0")  # crawler still running
+    proc_dir.mkdir("self")
+    assert sorted(marked_processes(str(proc_dir))) == [
+        (1001, 2000), (1002, os.getpid()), (1004, 3000),
+    ]
+
+    def fake_kill(pid, sig):
+        if sig == 0 and pid == 2000:
+            raise OSError(3, "No such process")
+    kill = mocker.patch("os.kill", side_effect=fake_kill)
+    supervisor, stats = make_supervisor()
+    assert supervisor.kill_orphans(str(proc_dir)) == 1
+    kill.assert_called_with(1001, signal.SIGKILL)
+    assert stats.get_value("pa11y/children/orphans_killed") == 1
+
+    # when the crawl closes, its own processes are killed too
+    assert supervisor.kill_orphans(str(proc_dir), own=True) == 2
+    kill.assert_any_call(1002, signal.SIGKILL)
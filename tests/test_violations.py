@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+import json
+from datetime import datetime
+from path import Path
+from pa11ycrawler.diff import diff_runs
+from pa11ycrawler.html import render_html
+from pa11ycrawler.manifest import MANIFEST_FILENAME, load_manifest
+from pa11ycrawler.pipelines.pa11y import write_pa11y_results
+from pa11ycrawler.sharding import merge_data_dirs
+from pa11ycrawler.util import result_files
+from pa11ycrawler.violations import (
+    VIOLATIONS_FILENAME, ViolationStore, load_result, violation_id,
+)
+
+
+def violation(selector, type_="error"):
+    return {
+        "message": "Table cell has an invalid scope attribute.",
+        "code": "WCAG2AA.Principle2.Guideline2_4.2_4_2.H63.1",
+        "type": type_,
+        "context": u"<th scope=\"column\">☃</th>",
+        "selector": selector,
+    }
+
+
+def write_result(data_dir, url, accessed_at, results, run_id=None, store=None):
+    item = {
+        "url": url,
+        "page_title": "Page",
+        "request_headers": {},
+        "accessed_at": accessed_at,
+    }
+    write_pa11y_results(item, results, data_dir, run_id=run_id, violation_store=store)
+
+
+def test_violation_id():
+    # the ID doesn't depend on the order of the keys
+    reordered = dict(reversed(list(violation("#a").items())))
+    assert violation_id(violation("#a")) == violation_id(reordered)
+    assert violation_id(violation("#a")) != violation_id(violation("#b"))
+
+
+def test_pack_and_unpack(tmpdir):
+    data_dir = Path(tmpdir)
+    store = ViolationStore(data_dir)
+    results = [violation("#a"), violation("#b"), violation("#a"), violation("#a")]
+    refs = store.pack(results)
+    assert refs == [[violation_id(violation("#a")), 3], [violation_id(violation("#b")), 1]]
+    assert len((data_dir / VIOLATIONS_FILENAME).text().splitlines()) == 2
+
+    # a new store reads the bodies that were written
+    unpacked = ViolationStore(data_dir).unpack(refs)
+    assert unpacked == [violation("#a")] * 3 + [violation("#b")]
+    unpacked[0]["pages"] = []
+    assert "pages" not in unpacked[1]
+
+
+def test_store_recovers_from_cut_off_line(tmpdir):
+    data_dir = Path(tmpdir)
+    ViolationStore(data_dir).put(violation("#a"))
+    with open(data_dir / VIOLATIONS_FILENAME, "ab") as store_file:
+        store_file.write(b'["0123')
+
+    store = ViolationStore(data_dir)
+    assert len(store) == 1
+    vid = store.put(violation("#b"))
+    assert vid in ViolationStore(data_dir)
+    # a missing violation is left out
+    assert store.unpack([["0123456789abcdef", 2], [vid, 1]]) == [violation("#b")]
+
+
+def test_deduplicated_results(tmpdir):
+    data_dir = Path(tmpdir)
+    store = ViolationStore(data_dir)
+    for page in range(20):
+        url = "http://localhost/page{}".format(page)
+        write_result(data_dir, url, datetime(2016, 1, 1), [
+            violation("#header"), violation("#footer", "warning"), violation("#page{}".format(page)),
+        ], run_id="run1", store=store)
+    assert len(store) == 22
+
+    path = result_files(data_dir)[0]
+    raw = json.loads(path.text())
+    assert "pa11y" not in raw
+    assert len(raw["pa11y_refs"]) == 3
+    data = load_result(path)
+    assert [result["selector"] for result in data["pa11y"]][:2] == ["#header", "#footer"]
+    assert "pa11y_refs" not in data
+
+    # results that aren't in the manifest are counted by resolving them
+    (data_dir / MANIFEST_FILENAME).remove()
+    assert load_manifest(data_dir)[0]["num_error"] == 2
+
+    output_dir = Path(tmpdir.mkdir("html"))
+    render_html(data_dir, output_dir)
+    assert u"#header" in (output_dir / "errors.html").text(encoding="utf8")
+    assert u"#footer" in (output_dir / "warnings.html").text(encoding="utf8")
+
+
+def test_deduplicated_results_diff_and_merge(tmpdir):
+    shard0 = Path(tmpdir.mkdir("shard0"))
+    shard1 = Path(tmpdir.mkdir("shard1"))
+    write_result(shard0, "http://localhost/a", datetime(2016, 1, 1),
+                 [violation("#a"), violation("#both")], "run1", ViolationStore(shard0))
+    # written without deduplication; the two kinds of results can be mixed
+    write_result(shard1, "http://localhost/b", datetime(2016, 1, 1),
+                 [violation("#both")], "run1")
+    write_result(shard1, "http://localhost/c", datetime(2016, 1, 1),
+                 [violation("#both")], "run1", ViolationStore(shard1))
+
+    output = Path(tmpdir) / "merged"
+    stats = merge_data_dirs([shard0, shard1], output)
+    assert stats["violations"] == 2
+    merged = sorted(
+        (data["url"], len(data["pa11y"]))
+        for data in (load_result(path) for path in result_files(output))
+    )
+    assert merged == [("http://localhost/a", 2), ("http://localhost/b", 1), ("http://localhost/c", 1)]
+
+    write_result(output, "http://localhost/a", datetime(2016, 1, 2),
+                 [violation("#both")], "run2", ViolationStore(output))
+    summary = diff_runs(output, "run1", output, "run2")
+    assert summary["counts"]["fixed"] == {"error": 1}
+    assert summary["counts"]["persisting"] == {"error": 1}